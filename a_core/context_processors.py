@@ -1,11 +1,13 @@
 import json
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from django.urls import reverse
 
+from . import request_globals
+from .request_globals import for_request, timed
 
+
+@timed
 def firebase_config(request):
     """Expose Firebase public config to templates when enabled."""
     enabled = bool(getattr(settings, 'FIREBASE_ENABLED', False))
@@ -30,6 +32,7 @@ def firebase_config(request):
     }
 
 
+@timed
 def site_contact(request):
     """Expose basic site contact info to templates."""
     return {
@@ -41,6 +44,7 @@ def site_contact(request):
     }
 
 
+@timed
 def recaptcha_config(request):
     """Expose public reCAPTCHA config to templates."""
     enabled = bool(getattr(settings, 'RECAPTCHA_ENABLED', False))
@@ -64,6 +68,7 @@ def recaptcha_config(request):
     }
 
 
+@timed
 def welcome_popup(request):
     """Expose a one-time welcome popup flag.
 
@@ -101,6 +106,7 @@ def welcome_popup(request):
         return {'SHOW_WELCOME_POPUP': False, 'WELCOME_POPUP_SOURCE': ''}
 
 
+@timed
 def location_popup(request):
     """Expose a one-time location permission popup flag.
 
@@ -149,6 +155,7 @@ def location_popup(request):
         return {'SHOW_LOCATION_POPUP': False}
 
 
+@timed
 def notifications_popup(request):
     """Expose a one-time notifications permission popup flag.
 
@@ -197,6 +204,7 @@ def notifications_popup(request):
         return {'SHOW_NOTIFICATIONS_POPUP': False}
 
 
+@timed
 def email_verify_popup(request):
     """Expose a one-time unverified-email popup flag.
 
@@ -239,20 +247,20 @@ def email_verify_popup(request):
         return {'SHOW_EMAIL_VERIFY_POPUP': False}
 
 
-def site_stats(request):
-    """Expose lightweight site-wide stats to templates (cached)."""
+def _total_users() -> int:
     try:
-        cache_key = 'vixo:total_users_count'
-        cached = cache.get(cache_key)
-        if cached is None:
-            User = get_user_model()
-            cached = int(User.objects.filter(is_active=True).count())
-            cache.set(cache_key, cached, timeout=300)
-        return {'TOTAL_USERS_COUNT': int(cached)}
+        return int(request_globals.total_users())
     except Exception:
-        return {'TOTAL_USERS_COUNT': 0}
+        return 0
+
+
+@timed
+def site_stats(request):
+    """Expose lightweight site-wide stats to templates (cached, read lazily)."""
+    return {'TOTAL_USERS_COUNT': for_request(request).lazy('site_stats', _total_users)}
 
 
+@timed
 def vpn_proxy_popup(request):
     """Expose VPN/proxy warning popup state for client-side enforcement."""
     try:
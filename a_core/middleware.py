@@ -182,7 +182,9 @@ class VpnProxyEnforcementMiddleware:
                         blocked = False
 
                     ip = get_client_ip(request)
-                    status = vpn_proxy_status_for_ip(ip)
+                    # Never block a request on the upstream lookup; unknown IPs are
+                    # resolved in the background (the client status poll waits).
+                    status = vpn_proxy_status_for_ip(ip, wait=False)
                     blocked = bool(blocked or status.get('blocked'))
         except Exception:
             blocked = False
@@ -356,3 +358,80 @@ class SecurityHeadersMiddleware:
         response.setdefault('Content-Security-Policy', csp)
 
         return response
+
+
+class ContextProcessorTimingMiddleware:
+    """Expose per-context-processor cost as a Server-Timing header.
+
+    Timings include values the processors hand to templates lazily, so a page
+    that never reads a badge shows no cost for it. Enabled by
+    CONTEXT_PROCESSOR_TIMING; totals above CONTEXT_PROCESSOR_BUDGET_MS are logged.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not bool(getattr(settings, 'CONTEXT_PROCESSOR_TIMING', False)):
+            return response
+        try:
+            from .request_globals import REQUEST_ATTR
+
+            g = getattr(request, REQUEST_ATTR, None)
+            timings = dict(getattr(g, 'timings', None) or {})
+            if not timings:
+                return response
+            total = sum(timings.values())
+            parts = [f"cp;desc=context-processors;dur={total:.2f}"]
+            parts += [f"cp-{name};dur={ms:.2f}" for name, ms in sorted(timings.items(), key=lambda kv: -kv[1])]
+            existing = response.get('Server-Timing')
+            response['Server-Timing'] = ', '.join(([existing] if existing else []) + parts)
+
+            budget = float(getattr(settings, 'CONTEXT_PROCESSOR_BUDGET_MS', 25) or 0)
+            if budget and total > budget:
+                import logging
+
+                logging.getLogger(__name__).warning(
+                    'context processors took %.1fms on %s (budget %.0fms): %s',
+                    total,
+                    getattr(request, 'path', ''),
+                    budget,
+                    ', '.join(f"{k}={v:.1f}" for k, v in sorted(timings.items(), key=lambda kv: -kv[1])),
+                )
+        except Exception:
+            pass
+        return response
+
+
+def _view_label(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    func = getattr(match, 'func', None)
+    if func is None:
+        return 'unresolved'
+    func = getattr(func, 'view_class', None) or func
+    return getattr(func, '__name__', None) or str(getattr(match, 'view_name', '') or 'view')
+
+
+class QueryProfilerMiddleware:
+    """Sample requests into the query/latency profiler (see a_core.profiler).
+
+    Unsampled requests pay one setting lookup and a random() call.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        from . import profiler
+
+        if not profiler.is_enabled():
+            return self.get_response(request)
+
+        with profiler.profile('request', kind='view') as sample:
+            if sample is not None:
+                profiler.ensure_connection_wrapped()
+            response = self.get_response(request)
+            if sample is not None:
+                sample.name = _view_label(request)
+        return response
@@ -0,0 +1,485 @@
+"""Sampled query/latency profiler for views and websocket handlers.
+
+A sampled request (QueryProfilerMiddleware) or consumer event
+(ProfiledConsumerMixin / AsyncProfiledConsumerMixin) opens a `Sample` held in
+a context variable, so it follows the work into database_sync_to_async
+threads. While it is open the process counts:
+
+- queries and DB time (an execute wrapper on every connection)
+- cache round trips (Django cache calls, plus raw redis-py commands and
+  pipelines that are not already inside a cache call)
+- template render time (outermost render only)
+
+Finished samples are folded into per-window hashes in Redis: sums, a latency
+histogram and, for SQL shapes repeated PROFILER_N_PLUS_ONE_THRESHOLD times in
+one sample, an N+1 counter. Slow samples are also kept in a short list.
+`report()` reads the last PROFILER_WINDOWS windows for the staff page.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from a_rtchat.redis_utils import get_redis
+
+
+KEY_PREFIX = 'prof:v1:'
+SLOW_KEY = KEY_PREFIX + 'slow'
+SLOW_KEEP = 50
+
+# Latency histogram upper bounds (ms); the last bucket is open-ended.
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+SUM_FIELDS = ('count', 'total_ms', 'db_ms', 'queries', 'cache_calls', 'template_ms')
+
+_current: contextvars.ContextVar['Sample | None'] = contextvars.ContextVar('vixo_profiler_sample', default=None)
+_install_lock = threading.Lock()
+_installed = False
+
+
+def _setting_float(name: str, default: float) -> float:
+    try:
+        return float(getattr(settings, name, default))
+    except Exception:
+        return default
+
+
+def is_enabled() -> bool:
+    return bool(getattr(settings, 'PROFILER_ENABLED', False))
+
+
+# --- samples ---------------------------------------------------------------------
+
+_IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+def sql_shape(sql: str) -> str:
+    """Collapse a parameterised statement so `IN (%s, %s)` lists of any length match."""
+    return _IN_LIST_RE.sub('IN (...)', str(sql or ''))[:400]
+
+
+class Sample:
+    __slots__ = ('name', 'kind', 'started', 'queries', 'db_ms', 'cache_calls', 'template_ms',
+                 'total_ms', 'shapes', '_cache_depth', '_template_depth')
+
+    def __init__(self, name: str, kind: str):
+        self.name = name
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.cache_calls = 0
+        self.template_ms = 0.0
+        self.total_ms = 0.0
+        self.shapes: Counter = Counter()
+        self._cache_depth = 0
+        self._template_depth = 0
+
+    def repeated_shapes(self, threshold: int) -> list[tuple[str, int]]:
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+def _sample_rate(kind: str) -> float:
+    if kind == 'ws':
+        return _setting_float('PROFILER_WS_SAMPLE_RATE', _setting_float('PROFILER_SAMPLE_RATE', 0.0))
+    return _setting_float('PROFILER_SAMPLE_RATE', 0.0)
+
+
+@contextmanager
+def profile(name: str, *, kind: str = 'view', force: bool = False):
+    """Profile the enclosed work as `name` when enabled and sampled; yields the Sample or None."""
+    if not is_enabled() or _current.get() is not None:
+        yield None
+        return
+    if not force:
+        rate = _sample_rate(kind)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            yield None
+            return
+
+    install()
+    sample = Sample(name, kind)
+    token = _current.set(sample)
+    try:
+        yield sample
+    finally:
+        _current.reset(token)
+        sample.total_ms = (time.perf_counter() - sample.started) * 1000.0
+        try:
+            record(sample)
+        except Exception:
+            pass
+
+
+# --- instrumentation ---------------------------------------------------------------
+
+def _db_wrapper(execute, sql, params, many, context):
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.db_ms += (time.perf_counter() - started) * 1000.0
+        sample.queries += 1
+        sample.shapes[sql_shape(sql)] += 1
+
+
+def _wrap_connection(connection) -> None:
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _wrap_connection(connection)
+
+
+def _count_cache_call(fn):
+    def wrapper(self, *args, **kwargs):
+        sample = _current.get()
+        if sample is None:
+            return fn(self, *args, **kwargs)
+        if sample._cache_depth == 0:
+            sample.cache_calls += 1
+        sample._cache_depth += 1
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            sample._cache_depth -= 1
+
+    wrapper._vixo_profiled = True
+    return wrapper
+
+
+def _count_redis_call(fn):
+    def wrapper(self, *args, **kwargs):
+        sample = _current.get()
+        if sample is not None and sample._cache_depth == 0:
+            sample.cache_calls += 1
+        return fn(self, *args, **kwargs)
+
+    wrapper._vixo_profiled = True
+    return wrapper
+
+
+def _time_template(fn):
+    def wrapper(self, *args, **kwargs):
+        sample = _current.get()
+        if sample is None or sample._template_depth:
+            return fn(self, *args, **kwargs)
+        sample._template_depth += 1
+        started = time.perf_counter()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            sample._template_depth -= 1
+            sample.template_ms += (time.perf_counter() - started) * 1000.0
+
+    wrapper._vixo_profiled = True
+    return wrapper
+
+
+CACHE_METHODS = ('get', 'set', 'add', 'delete', 'get_many', 'set_many', 'delete_many',
+                 'incr', 'decr', 'has_key', 'touch')
+
+
+def _patch(cls, names, decorator) -> None:
+    for name in names:
+        fn = cls.__dict__.get(name)
+        if fn is None or getattr(fn, '_vixo_profiled', False):
+            continue
+        setattr(cls, name, decorator(fn))
+
+
+def install() -> None:
+    """Hook DB connections, cache backends, redis-py and template rendering (idempotent)."""
+    global _installed
+    if _installed:
+        return
+    with _install_lock:
+        if _installed:
+            return
+        from django.core.cache import caches
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+        from django.template.backends.django import Template
+
+        connection_created.connect(_on_connection_created, dispatch_uid='vixo_profiler')
+        for conn in connections.all(initialized_only=True):
+            _wrap_connection(conn)
+
+        for alias in getattr(settings, 'CACHES', {}) or {}:
+            try:
+                for cls in type(caches[alias]).__mro__:
+                    if cls.__module__.startswith('django.core.cache.backends'):
+                        _patch(cls, CACHE_METHODS, _count_cache_call)
+            except Exception:
+                continue
+
+        try:
+            from redis.client import Pipeline, Redis
+
+            _patch(Redis, ('execute_command',), _count_redis_call)
+            _patch(Pipeline, ('execute',), _count_redis_call)
+        except Exception:
+            pass
+
+        _patch(Template, ('render',), _time_template)
+        _installed = True
+
+
+def ensure_connection_wrapped() -> None:
+    """Connections opened before install() (e.g. this thread's) get the wrapper too."""
+    try:
+        from django.db import connections
+
+        for conn in connections.all(initialized_only=True):
+            _wrap_connection(conn)
+    except Exception:
+        pass
+
+
+# --- aggregation ----------------------------------------------------------------------
+
+def _window_seconds() -> int:
+    try:
+        return max(60, int(getattr(settings, 'PROFILER_WINDOW_SECONDS', 300)))
+    except Exception:
+        return 300
+
+
+def _window_count() -> int:
+    try:
+        return max(1, int(getattr(settings, 'PROFILER_WINDOWS', 12)))
+    except Exception:
+        return 12
+
+
+def _window_start(now: float | None = None) -> int:
+    size = _window_seconds()
+    return int((now if now is not None else time.time()) // size * size)
+
+
+def _bucket_index(ms: float) -> int:
+    for i, bound in enumerate(BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS_MS)
+
+
+def _fields_for(sample: Sample) -> dict[str, float]:
+    key = f"{sample.kind}:{sample.name}"
+    return {
+        f"{key}|count": 1,
+        f"{key}|total_ms": round(sample.total_ms, 3),
+        f"{key}|db_ms": round(sample.db_ms, 3),
+        f"{key}|queries": sample.queries,
+        f"{key}|cache_calls": sample.cache_calls,
+        f"{key}|template_ms": round(sample.template_ms, 3),
+        f"{key}|h{_bucket_index(sample.total_ms)}": 1,
+    }
+
+
+def record(sample: Sample) -> None:
+    window = _window_start()
+    ttl = _window_seconds() * (_window_count() + 1)
+    stats_key = f"{KEY_PREFIX}w:{window}"
+    n1_key = f"{KEY_PREFIX}n1:{window}"
+
+    fields = _fields_for(sample)
+    threshold = int(getattr(settings, 'PROFILER_N_PLUS_ONE_THRESHOLD', 5) or 5)
+    repeated = sample.repeated_shapes(threshold)
+    n1_fields = {f"{sample.kind}:{sample.name}|{shape}": 1 for shape, _ in repeated}
+
+    slow = None
+    slow_ms = _setting_float('PROFILER_SLOW_MS', 500)
+    if slow_ms and sample.total_ms >= slow_ms:
+        slow = {
+            'name': f"{sample.kind}:{sample.name}",
+            'at': time.time(),
+            'total_ms': round(sample.total_ms, 1),
+            'db_ms': round(sample.db_ms, 1),
+            'queries': sample.queries,
+            'cache_calls': sample.cache_calls,
+            'template_ms': round(sample.template_ms, 1),
+            'repeated': [[shape, n] for shape, n in repeated[:3]],
+        }
+
+    client = get_redis()
+    if client is not None:
+        pipe = client.pipeline(transaction=False)
+        for field, value in fields.items():
+            if isinstance(value, float):
+                pipe.hincrbyfloat(stats_key, field, value)
+            else:
+                pipe.hincrby(stats_key, field, int(value))
+        pipe.expire(stats_key, ttl)
+        for field in n1_fields:
+            pipe.hincrby(n1_key, field, 1)
+        if n1_fields:
+            pipe.expire(n1_key, ttl)
+        if slow is not None:
+            pipe.lpush(SLOW_KEY, json.dumps(slow))
+            pipe.ltrim(SLOW_KEY, 0, SLOW_KEEP - 1)
+        pipe.execute()
+        return
+
+    # Without Redis (local/dev): best-effort read-modify-write in the cache.
+    for key, add in ((stats_key, fields), (n1_key, n1_fields)):
+        if not add:
+            continue
+        current = cache.get(key) or {}
+        for field, value in add.items():
+            current[field] = current.get(field, 0) + value
+        cache.set(key, current, timeout=ttl)
+    if slow is not None:
+        items = [slow] + list(cache.get(SLOW_KEY) or [])
+        cache.set(SLOW_KEY, items[:SLOW_KEEP], timeout=None)
+
+
+def _read_hashes(keys: list[str]) -> list[dict]:
+    client = get_redis()
+    if client is not None:
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        out = []
+        for raw in pipe.execute():
+            out.append({
+                (k.decode() if isinstance(k, bytes) else k): float(v)
+                for k, v in (raw or {}).items()
+            })
+        return out
+    found = cache.get_many(keys)
+    return [dict(found.get(key) or {}) for key in keys]
+
+
+def _read_slow() -> list[dict]:
+    client = get_redis()
+    if client is not None:
+        out = []
+        for raw in client.lrange(SLOW_KEY, 0, SLOW_KEEP - 1):
+            try:
+                out.append(json.loads(raw))
+            except Exception:
+                continue
+        return out
+    return list(cache.get(SLOW_KEY) or [])
+
+
+def _percentile(hist: list[float], q: float) -> int | None:
+    total = sum(hist)
+    if total <= 0:
+        return None
+    seen = 0.0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen >= q * total:
+            return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+    return None
+
+
+def report() -> dict:
+    """Aggregate the rolling windows into per-name rows, N+1 flags and recent slow samples."""
+    newest = _window_start()
+    windows = [newest - i * _window_seconds() for i in range(_window_count())]
+    stats = _read_hashes([f"{KEY_PREFIX}w:{w}" for w in windows])
+    n1 = _read_hashes([f"{KEY_PREFIX}n1:{w}" for w in windows])
+
+    rows: dict[str, dict] = {}
+    for window in stats:
+        for field, value in window.items():
+            name, _, metric = field.rpartition('|')
+            row = rows.setdefault(name, {**{f: 0.0 for f in SUM_FIELDS}, 'hist': [0.0] * (len(BUCKETS_MS) + 1)})
+            if metric.startswith('h') and metric[1:].isdigit():
+                idx = int(metric[1:])
+                if idx < len(row['hist']):
+                    row['hist'][idx] += value
+            elif metric in row:
+                row[metric] += value
+
+    out_rows = []
+    for name, row in rows.items():
+        count = row['count'] or 0
+        if not count:
+            continue
+        kind, _, label = name.partition(':')
+        p95 = _percentile(row['hist'], 0.95)
+        out_rows.append({
+            'name': label,
+            'kind': kind,
+            'count': int(count),
+            'avg_ms': round(row['total_ms'] / count, 1),
+            'p50_ms': _percentile(row['hist'], 0.50),
+            'p95_ms': p95,
+            'p95_over': p95 is None,
+            'avg_queries': round(row['queries'] / count, 1),
+            'avg_db_ms': round(row['db_ms'] / count, 1),
+            'avg_cache_calls': round(row['cache_calls'] / count, 1),
+            'avg_template_ms': round(row['template_ms'] / count, 1),
+        })
+    out_rows.sort(key=lambda r: r['avg_ms'] * r['count'], reverse=True)
+
+    flags: Counter = Counter()
+    for window in n1:
+        for field, value in window.items():
+            flags[field] += value
+    n_plus_one = []
+    for field, hits in flags.most_common(50):
+        name, _, shape = field.partition('|')
+        kind, _, label = name.partition(':')
+        n_plus_one.append({'name': label, 'kind': kind, 'shape': shape, 'samples': int(hits)})
+
+    return {
+        'rows': out_rows,
+        'n_plus_one': n_plus_one,
+        'slow': _read_slow(),
+        'window_seconds': _window_seconds(),
+        'windows': _window_count(),
+        'buckets_ms': BUCKETS_MS,
+    }
+
+
+# --- consumers --------------------------------------------------------------------------
+
+class ProfiledConsumerMixin:
+    """Profile each handler of a sync consumer as `<Consumer>.<handler>` (sampled)."""
+
+    def _profiled_dispatch(self, message):
+        from channels.consumer import get_handler_name
+
+        handler_name = get_handler_name(message)
+        handler = getattr(self, handler_name, None)
+        if not handler:
+            raise ValueError("No handler for message type %s" % message['type'])
+        with profile(f"{type(self).__name__}.{handler_name}", kind='ws') as sample:
+            if sample is not None:
+                ensure_connection_wrapped()
+            handler(message)
+
+    async def dispatch(self, message):
+        from channels.db import database_sync_to_async
+
+        await database_sync_to_async(self._profiled_dispatch)(message)
+
+
+class AsyncProfiledConsumerMixin:
+    """Async counterpart: the sample follows the handler into its DB threads."""
+
+    async def dispatch(self, message):
+        from channels.consumer import get_handler_name
+
+        # Same row as the sync consumer it mirrors.
+        name = getattr(getattr(self, 'sync_class', None), '__name__', None) or type(self).__name__
+        with profile(f"{name}.{get_handler_name(message)}", kind='ws'):
+            await super().dispatch(message)
@@ -0,0 +1,242 @@
+"""Lazy, cached globals for the template context processors.
+
+Context processors run on every full render, before the template has read
+anything. Values that cost a query are therefore handed to the template as
+`Lazy` callables: the template engine calls a callable variable when it is
+resolved, so the work happens only if the page reads the name, and at most
+once per request.
+
+- site-wide values (announcement, active user total, staff open counts) live
+  in the shared cache and are deleted by signals when their rows change
+- per-user counters (unread notifications, pending follow requests) are read
+  with one get_many on first access; misses are counted once and cached
+- time spent per processor, including deferred evaluation, is kept on the
+  request and sent as a Server-Timing header by ContextProcessorTimingMiddleware
+"""
+
+from __future__ import annotations
+
+import functools
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+REQUEST_ATTR = '_vixo_request_globals'
+
+ANNOUNCEMENT_KEY = 'vixo:global_announcement:v1'
+TOTAL_USERS_KEY = 'vixo:total_users_count'
+ADMIN_OPEN_COUNTS_KEY = 'vixo:admin_open_counts:v1'
+FOLLOWREQ_KEY_PREFIX = 'followreq:pending:v1:'
+
+DEFAULT_ANNOUNCEMENT_PREFIX = 'Team Vixogram:'
+
+
+def _site_ttl() -> int:
+    try:
+        return max(60, int(getattr(settings, 'SITE_GLOBALS_CACHE_SECONDS', 3600)))
+    except Exception:
+        return 3600
+
+
+class Lazy:
+    """Template value computed on first use and memoized for the request."""
+
+    __slots__ = ('_fn', '_value', '_done')
+
+    def __init__(self, fn):
+        self._fn = fn
+        self._value = None
+        self._done = False
+
+    def __call__(self):
+        if not self._done:
+            self._value = self._fn()
+            self._done = True
+        return self._value
+
+    # Python-side callers (views/tests reading response.context) see the value.
+    def __bool__(self):
+        return bool(self())
+
+    def __int__(self):
+        return int(self())
+
+    def __str__(self):
+        return str(self())
+
+    def __repr__(self):
+        return f"Lazy({self()!r})" if self._done else 'Lazy(<pending>)'
+
+
+class RequestGlobals:
+    """Per-request memo of grouped values plus per-processor timings (ms)."""
+
+    def __init__(self, request):
+        self.request = request
+        self.timings: dict[str, float] = {}
+        self._memo: dict[str, object] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds * 1000.0
+
+    def memo(self, name: str, fn):
+        if name not in self._memo:
+            started = time.perf_counter()
+            try:
+                self._memo[name] = fn()
+            finally:
+                self.record(name, time.perf_counter() - started)
+        return self._memo[name]
+
+    def lazy(self, name: str, fn, key: str | None = None) -> Lazy:
+        """A template value backed by memo(name, fn); `key` picks one item of a dict result."""
+        if key is None:
+            return Lazy(lambda: self.memo(name, fn))
+        return Lazy(lambda: self.memo(name, fn)[key])
+
+    def user_counters(self) -> dict[str, int]:
+        # Untimed: its cost already lands on whichever badge reads it first.
+        if 'user_counters' not in self._memo:
+            self._memo['user_counters'] = self._load_user_counters()
+        return self._memo['user_counters']
+
+    def _load_user_counters(self) -> dict[str, int]:
+        user = getattr(self.request, 'user', None)
+        if not user or not getattr(user, 'is_authenticated', False):
+            return {'notifications': 0, 'follow_requests': 0}
+
+        from a_rtchat import notifications
+
+        keys = {
+            'notifications': notifications.UNREAD_KEY_PREFIX + str(user.id),
+            'follow_requests': FOLLOWREQ_KEY_PREFIX + str(user.id),
+        }
+        try:
+            found = cache.get_many(list(keys.values()))
+        except Exception:
+            found = {}
+
+        out: dict[str, int] = {}
+        for name, key in keys.items():
+            value = found.get(key)
+            if value is not None:
+                try:
+                    out[name] = max(0, int(value))
+                    continue
+                except Exception:
+                    pass
+            try:
+                if name == 'notifications':
+                    out[name] = notifications.unread_count(user.id)
+                else:
+                    out[name] = pending_follow_requests(user.id)
+            except Exception:
+                out[name] = 0
+        return out
+
+
+def for_request(request) -> RequestGlobals:
+    g = getattr(request, REQUEST_ATTR, None)
+    if g is None:
+        g = RequestGlobals(request)
+        try:
+            setattr(request, REQUEST_ATTR, g)
+        except Exception:
+            pass
+    return g
+
+
+def timed(fn):
+    """Record a context processor's eager run time under its function name."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(request):
+        started = time.perf_counter()
+        try:
+            return fn(request)
+        finally:
+            for_request(request).record(name, time.perf_counter() - started)
+
+    return wrapper
+
+
+# --- per-user counters ---------------------------------------------------------------
+
+def pending_follow_requests(user_id) -> int:
+    from a_users.models import FollowRequest
+
+    count = int(FollowRequest.objects.filter(to_user_id=user_id).count() or 0)
+    try:
+        cache.add(FOLLOWREQ_KEY_PREFIX + str(user_id), count, timeout=_site_ttl())
+    except Exception:
+        pass
+    return count
+
+
+def invalidate_follow_requests(user_id) -> None:
+    try:
+        cache.delete(FOLLOWREQ_KEY_PREFIX + str(user_id))
+    except Exception:
+        pass
+
+
+# --- site-wide values ----------------------------------------------------------------
+
+def _cached(key: str, compute, timeout: int):
+    try:
+        value = cache.get(key)
+        if value is not None:
+            return value
+    except Exception:
+        pass
+    value = compute()
+    try:
+        cache.set(key, value, timeout=timeout)
+    except Exception:
+        pass
+    return value
+
+
+def announcement() -> dict[str, str]:
+    def compute():
+        from a_rtchat.models import GlobalAnnouncement
+
+        ann = GlobalAnnouncement.objects.filter(is_active=True).order_by('-updated_at').first()
+        return {
+            'prefix': (getattr(ann, 'prefix', '') or '').strip() or DEFAULT_ANNOUNCEMENT_PREFIX,
+            'message': (getattr(ann, 'message', '') or '').strip(),
+        }
+
+    return _cached(ANNOUNCEMENT_KEY, compute, _site_ttl())
+
+
+def total_users() -> int:
+    def compute():
+        from django.contrib.auth import get_user_model
+
+        return int(get_user_model().objects.filter(is_active=True).count())
+
+    # Shorter TTL: activation flips are not pushed, only signups/deletions.
+    return int(_cached(TOTAL_USERS_KEY, compute, 300))
+
+
+def admin_open_counts() -> dict[str, int]:
+    def compute():
+        from a_users.models import SupportEnquiry, UserReport
+
+        return {
+            'reports': int(UserReport.objects.filter(status=UserReport.STATUS_OPEN).count() or 0),
+            'enquiries': int(SupportEnquiry.objects.filter(status=SupportEnquiry.STATUS_OPEN).count() or 0),
+        }
+
+    return _cached(ADMIN_OPEN_COUNTS_KEY, compute, _site_ttl())
+
+
+def invalidate(*keys: str) -> None:
+    try:
+        cache.delete_many(list(keys))
+    except Exception:
+        pass
@@ -425,6 +425,8 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'a_core.middleware.SecurityHeadersMiddleware',
+    'a_core.middleware.QueryProfilerMiddleware',
+    'a_core.middleware.ContextProcessorTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'a_core.middleware.ForceCustom404Middleware',
@@ -718,6 +720,32 @@ CHAT_MAX_MESSAGES_PER_ROOM = int(os.environ.get('CHAT_MAX_MESSAGES_PER_ROOM', '2
 # Default is higher than public rooms, but still bounded.
 PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM = int(os.environ.get('PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', '1000'))
 
+# Retention worker (a_rtchat.retention): sends only mark the room; a background
+# worker checks marked rooms every RETENTION_INTERVAL_SECONDS.
+RETENTION_ENABLED = _env_bool('RETENTION_ENABLED', default=True)
+RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', '5'))
+# Rooms may exceed their cap by this many messages before a trim, so deletes come
+# in chunks instead of one row per send.
+RETENTION_TRIM_SLACK = int(os.environ.get('RETENTION_TRIM_SLACK', '25'))
+# Messages deleted per transaction, and rooms handled per worker pass.
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+RETENTION_ROOMS_PER_PASS = int(os.environ.get('RETENTION_ROOMS_PER_PASS', '200'))
+# Run the worker as a thread in each web process; turn off when `manage.py run_retention_worker` runs.
+RETENTION_WORKER_IN_PROCESS = _env_bool('RETENTION_WORKER_IN_PROCESS', default=True)
+
+# Age-based purges (a_rtchat.purge: purge_old_messages / purge_old_rooms)
+# Rows per chunk; each chunk is one short transaction and a checkpoint.
+PURGE_CHUNK_SIZE = int(os.environ.get('PURGE_CHUNK_SIZE', '500'))
+# Chunks slower than this make the purge back off (pause grows with the overshoot).
+PURGE_TARGET_CHUNK_MS = int(os.environ.get('PURGE_TARGET_CHUNK_MS', '200'))
+PURGE_MIN_PAUSE_MS = int(os.environ.get('PURGE_MIN_PAUSE_MS', '50'))
+PURGE_MAX_PAUSE_MS = int(os.environ.get('PURGE_MAX_PAUSE_MS', '5000'))
+# With --loop: wait this long after a sweep reaches the horizon before the next one.
+PURGE_IDLE_SECONDS = int(os.environ.get('PURGE_IDLE_SECONDS', '60'))
+
+# Messages older than this move from the hot table to the archive (manage.py archive_messages).
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', '30'))
+
 # Private code room member cap.
 # Increase default so room admins can admit users without hitting an unexpectedly low limit.
 PRIVATE_ROOM_MEMBER_LIMIT = int(os.environ.get('PRIVATE_ROOM_MEMBER_LIMIT', '100'))
@@ -728,6 +756,41 @@ PRIVATE_ROOM_MEMBER_LIMIT = int(os.environ.get('PRIVATE_ROOM_MEMBER_LIMIT', '100
 CHAT_INITIAL_MESSAGES = int(os.environ.get('CHAT_INITIAL_MESSAGES', '40'))
 # Page size when the user taps "Load older".
 CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', '35'))
+# How long viewer-neutral history fragments (a_rtchat.history) stay cached. Edits,
+# deletes and reactions invalidate them; the TTL bounds profile/name staleness.
+# 0 disables the fragment cache.
+CHAT_HISTORY_FRAGMENT_TTL_SECONDS = int(os.environ.get('CHAT_HISTORY_FRAGMENT_TTL_SECONDS', '600'))
+# Render each new message once per viewer role (own/other/staff) and ship the HTML
+# in the channel-layer event, instead of re-rendering it on every connected socket.
+CHAT_RENDER_ONCE_FANOUT = _env_bool('CHAT_RENDER_ONCE_FANOUT', default=True)
+# Presence (a_rtchat.presence): a user counts as online while their last websocket
+# heartbeat is newer than this. Clients ping every ~25s.
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', '120'))
+# Online-status broadcasts are coalesced into at most one delta per interval.
+PRESENCE_BROADCAST_INTERVAL_SECONDS = float(os.environ.get('PRESENCE_BROADCAST_INTERVAL_SECONDS', '1.5'))
+# Heartbeats check this often whether anyone in the last broadcast has expired (dropped sockets).
+PRESENCE_EXPIRY_CHECK_SECONDS = int(os.environ.get('PRESENCE_EXPIRY_CHECK_SECONDS', '10'))
+# Chat sockets cache the user's ban/block/membership/verified state (a_rtchat.user_state).
+# Admin actions push updates immediately; this TTL only bounds out-of-band edits.
+CHAT_USER_STATE_TTL_SECONDS = int(os.environ.get('CHAT_USER_STATE_TTL_SECONDS', '60'))
+# Route websockets to the async consumers (a_rtchat.async_consumers) instead of the
+# sync ones. Off by default so connections-per-core can be A/B tested per deploy.
+CHAT_ASYNC_CONSUMERS = _env_bool('CHAT_ASYNC_CONSUMERS', default=False)
+# Verified-badge user IDs (a_users.badges) are cached per process and in the shared
+# cache. Threshold crossings invalidate both; other processes catch up within the local TTL.
+VERIFIED_IDS_LOCAL_TTL_SECONDS = int(os.environ.get('VERIFIED_IDS_LOCAL_TTL_SECONDS', '30'))
+VERIFIED_IDS_CACHE_TTL_SECONDS = int(os.environ.get('VERIFIED_IDS_CACHE_TTL_SECONDS', '3600'))
+# Auto badges (a_rtchat.auto_badges) are updated from message/reaction events; each
+# author's badge state in a room is also rebuilt from the database once per this interval,
+# by at most one request per room at a time (the lock expires after the second setting).
+AUTO_BADGE_WARM_TTL_SECONDS = int(os.environ.get('AUTO_BADGE_WARM_TTL_SECONDS', '21600'))
+AUTO_BADGE_WARM_LOCK_SECONDS = int(os.environ.get('AUTO_BADGE_WARM_LOCK_SECONDS', '30'))
+# Link previews (a_rtchat.link_preview) are shared per normalized URL; failed fetches
+# are remembered for the shorter negative TTL so dead links are not retried per paste.
+LINK_PREVIEW_CACHE_TTL_SECONDS = int(os.environ.get('LINK_PREVIEW_CACHE_TTL_SECONDS', '86400'))
+LINK_PREVIEW_NEGATIVE_TTL_SECONDS = int(os.environ.get('LINK_PREVIEW_NEGATIVE_TTL_SECONDS', '900'))
+# Background fetch threads per process; a URL locked by another process is requeued, not waited on.
+LINK_PREVIEW_WORKERS = int(os.environ.get('LINK_PREVIEW_WORKERS', '4'))
 
 # Email verification: unverified users are allowed a limited number of messages.
 # After this, they must verify their email to continue chatting.
@@ -774,6 +837,41 @@ SPEED_SPAM_TTL = int(os.environ.get('SPEED_SPAM_TTL', '10'))
 # the recipient is online, which can make the dropdown look empty.
 PERSIST_NOTIFICATIONS_WHEN_ONLINE = _env_bool('PERSIST_NOTIFICATIONS_WHEN_ONLINE', default=True)
 
+# How long a per-user unread notification counter lives in the cache before it
+# is recounted from the database (writes keep it current in between).
+NOTIFICATION_UNREAD_CACHE_SECONDS = int(os.environ.get('NOTIFICATION_UNREAD_CACHE_SECONDS', '3600'))
+
+# Template globals (a_core.request_globals)
+# Site-wide values (announcement, staff open counts) and per-user badge counters
+# are cached this long; signals drop them when the underlying rows change.
+SITE_GLOBALS_CACHE_SECONDS = int(os.environ.get('SITE_GLOBALS_CACHE_SECONDS', '3600'))
+# Emit a Server-Timing header with per-context-processor cost, and log pages whose
+# processors together exceed the budget.
+CONTEXT_PROCESSOR_TIMING = _env_bool('CONTEXT_PROCESSOR_TIMING', default=DEBUG)
+CONTEXT_PROCESSOR_BUDGET_MS = int(os.environ.get('CONTEXT_PROCESSOR_BUDGET_MS', '25'))
+
+# Query/latency profiler (a_core.profiler, staff page: /chat/admin/profiler/)
+# Sampled views and websocket handlers record query count, DB time, cache round
+# trips, template time and latency into rolling windows in Redis.
+PROFILER_ENABLED = _env_bool('PROFILER_ENABLED', default=True)
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', '1.0' if DEBUG else '0.02'))
+# Websocket handlers fire far more often than views; sample them separately.
+PROFILER_WS_SAMPLE_RATE = float(os.environ.get('PROFILER_WS_SAMPLE_RATE', '1.0' if DEBUG else '0.005'))
+PROFILER_WINDOW_SECONDS = int(os.environ.get('PROFILER_WINDOW_SECONDS', '300'))
+PROFILER_WINDOWS = int(os.environ.get('PROFILER_WINDOWS', '12'))
+# Samples slower than this are kept in the "recent slow" list.
+PROFILER_SLOW_MS = int(os.environ.get('PROFILER_SLOW_MS', '500'))
+# The same SQL shape this many times in one sample is flagged as a likely N+1.
+PROFILER_N_PLUS_ONE_THRESHOLD = int(os.environ.get('PROFILER_N_PLUS_ONE_THRESHOLD', '5'))
+
+# Author cards for message rendering (a_users.author_cards)
+# Cards live this long in the shared cache; Profile/User saves delete them.
+AUTHOR_CARD_CACHE_SECONDS = int(os.environ.get('AUTHOR_CARD_CACHE_SECONDS', '3600'))
+# Per-process LRU in front of the cache. The TTL bounds how long another process
+# can keep showing a card after it was invalidated.
+AUTHOR_CARD_LOCAL_MAX_ENTRIES = int(os.environ.get('AUTHOR_CARD_LOCAL_MAX_ENTRIES', '5000'))
+AUTHOR_CARD_LOCAL_TTL_SECONDS = int(os.environ.get('AUTHOR_CARD_LOCAL_TTL_SECONDS', '30'))
+
 # Fast long message heuristic (server-side)
 FAST_LONG_MSG_LEN = int(os.environ.get('FAST_LONG_MSG_LEN', '80'))
 FAST_LONG_MSG_MIN_INTERVAL = int(os.environ.get('FAST_LONG_MSG_MIN_INTERVAL', '1'))
@@ -819,6 +917,22 @@ GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash')
 GEMINI_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_TIMEOUT_SECONDS', '4.0'))
 
+# Moderation pipeline (a_rtchat.moderation_pipeline):
+# - inline (default): classify before saving (blocks the send for the model round trip)
+# - optimistic (opt-in): deliver first, classify in the background, retract blocked messages
+# - batched (opt-in): optimistic, grouping messages from all rooms into one classifier request
+# Optimistic modes briefly show blocked messages to the room, so they must be enabled explicitly.
+AI_MODERATION_MODE = (os.environ.get('AI_MODERATION_MODE') or 'inline').strip().lower()
+# 'gemini' or 'stub' (offline substring matcher for dev/tests).
+AI_MODERATION_CLASSIFIER = (os.environ.get('AI_MODERATION_CLASSIFIER') or 'gemini').strip().lower()
+AI_MODERATION_STUB_BLOCK_TERMS = [t.strip() for t in (os.environ.get('AI_MODERATION_STUB_BLOCK_TERMS') or '').split(',') if t.strip()]
+AI_MODERATION_STUB_FLAG_TERMS = [t.strip() for t in (os.environ.get('AI_MODERATION_STUB_FLAG_TERMS') or '').split(',') if t.strip()]
+AI_MODERATION_BATCH_SIZE = int(os.environ.get('AI_MODERATION_BATCH_SIZE', '20'))
+AI_MODERATION_BATCH_WINDOW_MS = int(os.environ.get('AI_MODERATION_BATCH_WINDOW_MS', '250'))
+# Verdicts are cached per normalized-text fingerprint (process LRU + shared cache).
+AI_MODERATION_VERDICT_TTL_SECONDS = int(os.environ.get('AI_MODERATION_VERDICT_TTL_SECONDS', str(24 * 60 * 60)))
+AI_MODERATION_VERDICT_LRU_SIZE = int(os.environ.get('AI_MODERATION_VERDICT_LRU_SIZE', '5000'))
+
 # Other endpoints
 PRIVATE_ROOM_CREATE_RATE_LIMIT = int(os.environ.get('PRIVATE_ROOM_CREATE_RATE_LIMIT', '5'))
 PRIVATE_ROOM_CREATE_RATE_PERIOD = int(os.environ.get('PRIVATE_ROOM_CREATE_RATE_PERIOD', '300'))
@@ -841,6 +955,11 @@ CALL_EVENT_RATE_PERIOD = int(os.environ.get('CALL_EVENT_RATE_PERIOD', '60'))
 RANDOM_VIDEO_ACTIVE_USERS_LIMIT = int(os.environ.get('RANDOM_VIDEO_ACTIVE_USERS_LIMIT', '2000'))
 RANDOM_VIDEO_REMATCH_COOLDOWN_SECONDS = int(os.environ.get('RANDOM_VIDEO_REMATCH_COOLDOWN_SECONDS', '12'))
 RANDOM_VIDEO_REMATCH_FALLBACK_WAIT_SECONDS = int(os.environ.get('RANDOM_VIDEO_REMATCH_FALLBACK_WAIT_SECONDS', '10'))
+# Matchmaking (a_rtchat.matchmaking): 'inline' pairs on enqueue inside the consumer;
+# 'worker' leaves pairing to `python manage.py run_matchmaker`.
+RANDOM_VIDEO_MATCHMAKER = (os.environ.get('RANDOM_VIDEO_MATCHMAKER') or 'inline').strip().lower()
+# How many tickets at the head of the queue each atomic pop considers.
+RANDOM_VIDEO_MATCH_WINDOW = int(os.environ.get('RANDOM_VIDEO_MATCH_WINDOW', '64'))
 
 # VPN/proxy guard
 VPN_PROXY_GUARD_ENABLED = _env_bool('VPN_PROXY_GUARD_ENABLED', default=True)
@@ -848,6 +967,14 @@ VPN_PROXY_BYPASS_ADMIN = _env_bool('VPN_PROXY_BYPASS_ADMIN', default=False)
 VPN_PROXY_CLIENT_PROBE_ENABLED = _env_bool('VPN_PROXY_CLIENT_PROBE_ENABLED', default=False)
 VPN_PROXY_STATUS_CACHE_SECONDS = int(os.environ.get('VPN_PROXY_STATUS_CACHE_SECONDS', '120'))
 VPN_PROXY_CHECK_INTERVAL_SECONDS = int(os.environ.get('VPN_PROXY_CHECK_INTERVAL_SECONDS', '5'))
+# IP intelligence (a_users.ip_intel): one upstream lookup per IP feeds both the VPN
+# check and geo. Records stay usable (refreshed in the background) for the geo TTL.
+IP_INTEL_GEO_TTL_SECONDS = int(os.environ.get('IP_INTEL_GEO_TTL_SECONDS', str(24 * 3600)))
+IP_INTEL_LOCAL_MAX_ENTRIES = int(os.environ.get('IP_INTEL_LOCAL_MAX_ENTRIES', '50000'))
+# Optional offline databases answered in-process: a CSV range table
+# (network,country,city,flags) and/or a MaxMind .mmdb (requires `maxminddb`).
+IP_INTEL_RANGES_PATH = (os.environ.get('IP_INTEL_RANGES_PATH') or '').strip()
+IP_INTEL_MMDB_PATH = (os.environ.get('IP_INTEL_MMDB_PATH') or '').strip()
 
 AGORA_TOKEN_RATE_LIMIT = int(os.environ.get('AGORA_TOKEN_RATE_LIMIT', '30'))
 AGORA_TOKEN_RATE_PERIOD = int(os.environ.get('AGORA_TOKEN_RATE_PERIOD', '300'))
@@ -1045,4 +1172,14 @@ FIREBASE_VAPID_PUBLIC_KEY = (os.getenv('FIREBASE_VAPID_PUBLIC_KEY', '') or '').s
 
 # Server-side send credentials (secret): provide either raw JSON or base64 JSON.
 FIREBASE_SERVICE_ACCOUNT_JSON = (os.getenv('FIREBASE_SERVICE_ACCOUNT_JSON', '') or '').strip()
-FIREBASE_SERVICE_ACCOUNT_B64 = (os.getenv('FIREBASE_SERVICE_ACCOUNT_B64', '') or '').strip()
\ No newline at end of file
+FIREBASE_SERVICE_ACCOUNT_B64 = (os.getenv('FIREBASE_SERVICE_ACCOUNT_B64', '') or '').strip()
+
+# Push delivery pipeline (a_users.push): 'firebase' or 'fake' (records batches in memory).
+PUSH_TRANSPORT = (os.getenv('PUSH_TRANSPORT', 'firebase') or 'firebase').strip().lower()
+# Queued mentions are flushed in windows: up to PUSH_BATCH_MAX_ITEMS per PUSH_BATCH_WINDOW_MS.
+PUSH_BATCH_WINDOW_MS = int(os.environ.get('PUSH_BATCH_WINDOW_MS', '500'))
+PUSH_BATCH_MAX_ITEMS = int(os.environ.get('PUSH_BATCH_MAX_ITEMS', '1000'))
+# After a push, further mentions of the same user from the same room are folded for this long.
+PUSH_COLLAPSE_SECONDS = int(os.environ.get('PUSH_COLLAPSE_SECONDS', '60'))
+# Drain the queue from a thread in each web process; turn off when `manage.py run_push_worker` runs.
+PUSH_WORKER_IN_PROCESS = _env_bool('PUSH_WORKER_IN_PROCESS', default=True)
\ No newline at end of file
@@ -0,0 +1,408 @@
+"""Hot/cold split of chat messages.
+
+Messages older than MESSAGE_ARCHIVE_AFTER_DAYS move from GroupMessage (hot)
+to ArchivedMessage (cold) with their original id, so the hot table, its
+indexes and every aggregate over it only cover recent traffic.
+
+- `manage.py archive_messages` moves rows with the purge engine (id walk from
+  a checkpoint, chunked transactions, latency throttle; see a_rtchat.purge)
+- each chunk, in one transaction, copies the rows with a {emoji: count}
+  snapshot of their reactions plus the reaction and one-time-view rows
+  themselves, moves moderation links to `ModerationEvent.archived_message_id`,
+  then raw-deletes the hot rows. Nothing is lost: `restore()` puts it all back
+- polls, one-time files and support submissions stay hot, and so does any
+  message a hot reply quotes (it moves in a later sweep, once the reply has)
+- `history.fetch_page` reads through `merge_page()`: the archive is queried
+  only when a page reaches below the room's newest archived id (the boundary,
+  cached per room), and archived rows come back as unsaved GroupMessage
+  instances flagged `is_archived`
+- `restore()` moves rows back (the rollback path); ids are kept both ways
+- the room cap (a_rtchat.retention) counts hot and archived rows together,
+  reading `ChatRoomSummary.archived_count` (kept by room_index)
+
+`manage.py bench_message_archive` generates a dataset and compares query
+plans and timings before and after the split.
+"""
+
+from __future__ import annotations
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.contrib.auth import get_user_model
+from django.db.models import DateTimeField, F, JSONField, Value
+from django.db.models.constants import OnConflict
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import purge, room_index
+from .models import ArchivedMessage, GroupMessage, MessageReaction, ModerationEvent, OneTimeMessageView
+
+
+BOUNDARY_KEY_PREFIX = 'archive:boundary:v1:'
+BOUNDARY_TTL = 3600
+
+# Columns copied between the two tables (besides id).
+FIELDS = (
+    'group_id', 'author_id', 'reply_to_id', 'body', 'file', 'file_caption',
+    'link_url', 'link_title', 'link_description', 'link_image', 'link_site_name',
+    'media_kind', 'media_mime', 'media_width', 'media_height', 'media_duration_ms',
+    'media_bytes', 'media_placeholder', 'created', 'edited_at',
+)
+
+
+def after_days() -> int:
+    try:
+        return max(1, int(getattr(settings, 'MESSAGE_ARCHIVE_AFTER_DAYS', 30)))
+    except Exception:
+        return 30
+
+
+# --- boundary -----------------------------------------------------------------------
+
+def boundary(group_id) -> int:
+    """Newest archived message id of a room (0 when nothing is archived)."""
+    gid = int(group_id or 0)
+    if not gid:
+        return 0
+    key = BOUNDARY_KEY_PREFIX + str(gid)
+    try:
+        value = cache.get(key)
+        if value is not None:
+            return int(value)
+    except Exception:
+        pass
+    value = int(
+        ArchivedMessage.objects.filter(group_id=gid).order_by('-id').values_list('id', flat=True).first() or 0
+    )
+    try:
+        cache.set(key, value, timeout=BOUNDARY_TTL)
+    except Exception:
+        pass
+    return value
+
+
+def _forget_boundaries(group_ids) -> None:
+    try:
+        cache.delete_many([BOUNDARY_KEY_PREFIX + str(int(g)) for g in group_ids])
+    except Exception:
+        pass
+
+
+# --- moving rows --------------------------------------------------------------------
+
+def _copy_to_archive(qs) -> None:
+    """INSERT ... SELECT the rows of `qs` into the archive (existing ids are skipped).
+
+    The copy stays inside the database; building model instances for a
+    chunk costs more than the insert itself.
+    """
+    using = router.db_for_write(ArchivedMessage)
+    conn = connections[using]
+    select = qs.order_by().annotate(
+        _reactions=Value({}, output_field=JSONField()),
+        _reactors=Value([], output_field=JSONField()),
+        _one_time_views=Value([], output_field=JSONField()),
+        _archived_at=Value(timezone.now(), output_field=DateTimeField()),
+    ).values_list('id', *FIELDS, '_reactions', '_reactors', '_one_time_views', '_archived_at')
+    sql, params = select.query.sql_with_params()
+    columns = ', '.join(
+        conn.ops.quote_name(c) for c in ('id', *FIELDS, 'reactions', 'reactors', 'one_time_views', 'archived_at')
+    )
+    suffix = conn.ops.on_conflict_suffix_sql([], OnConflict.IGNORE, None, None) or ''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"{conn.ops.insert_statement(on_conflict=OnConflict.IGNORE)} "
+            f"{conn.ops.quote_name(ArchivedMessage._meta.db_table)} ({columns}) {sql} {suffix}",
+            params,
+        )
+
+
+def _iso(value) -> str | None:
+    return value.isoformat() if value else None
+
+
+def _when(value):
+    return parse_datetime(value) if value else None
+
+
+def _unquoted(ids: set[int]) -> set[int]:
+    """`ids` minus every message a reply outside the set still quotes (transitively)."""
+    while ids:
+        quoted = set(
+            GroupMessage.objects.filter(reply_to_id__in=ids)
+            .exclude(id__in=ids)
+            .order_by()
+            .values_list('reply_to_id', flat=True)
+        )
+        if not quoted:
+            break
+        ids = ids - quoted
+    return ids
+
+
+def move_to_archive(ids) -> int:
+    """Archive the eligible messages among `ids`; returns rows moved."""
+    ids = list(ids or [])
+    if not ids:
+        return 0
+    using = router.db_for_write(GroupMessage)
+    with transaction.atomic(using=using):
+        rows = list(
+            GroupMessage.objects.filter(
+                id__in=ids,
+                poll__isnull=True,
+                one_time_view_seconds__isnull=True,
+                is_support_submission=False,
+            ).values_list('id', 'group_id')
+        )
+        keep = _unquoted({mid for mid, _gid in rows})
+        rows = [(mid, gid) for mid, gid in rows if mid in keep]
+        if not rows:
+            return 0
+        moved = [mid for mid, _gid in rows]
+
+        counts: dict[int, dict[str, int]] = {}
+        reactors: dict[int, list] = {}
+        for rid, mid, uid, emoji, created in (
+            MessageReaction.objects.filter(message_id__in=moved)
+            .order_by('id')
+            .values_list('id', 'message_id', 'user_id', 'emoji', 'created')
+        ):
+            reactors.setdefault(mid, []).append([rid, uid, emoji, _iso(created)])
+            counts.setdefault(mid, {})
+            counts[mid][emoji] = counts[mid].get(emoji, 0) + 1
+        views: dict[int, list] = {}
+        for vid, mid, uid, viewed_at in (
+            OneTimeMessageView.objects.filter(message_id__in=moved)
+            .order_by('id')
+            .values_list('id', 'message_id', 'user_id', 'viewed_at')
+        ):
+            views.setdefault(mid, []).append([vid, uid, _iso(viewed_at)])
+
+        _copy_to_archive(GroupMessage.objects.filter(id__in=moved))
+        # INSERT OR IGNORE / ON CONFLICT DO NOTHING can skip rows quietly; never delete what wasn't copied.
+        if ArchivedMessage.objects.filter(id__in=moved).count() != len(moved):
+            raise RuntimeError('archive copy incomplete; chunk rolled back')
+        extras = [
+            ArchivedMessage(
+                id=mid,
+                reactions=counts.get(mid, {}),
+                reactors=reactors.get(mid, []),
+                one_time_views=views.get(mid, []),
+            )
+            for mid in moved
+            if mid in reactors or mid in views
+        ]
+        if extras:
+            ArchivedMessage.objects.bulk_update(extras, ['reactions', 'reactors', 'one_time_views'], batch_size=500)
+        ModerationEvent.objects.filter(message_id__in=moved).update(
+            archived_message_id=F('message_id'), message=None,
+        )
+        # QuerySet._raw_delete: a plain DELETE ... WHERE, skipping the Collector.
+        # Files stay: the archived row still points at them.
+        MessageReaction.objects.filter(message_id__in=moved)._raw_delete(using)
+        OneTimeMessageView.objects.filter(message_id__in=moved)._raw_delete(using)
+        GroupMessage.objects.filter(id__in=moved)._raw_delete(using)
+
+    by_group: dict[int, tuple[int, int]] = {}
+    for mid, gid in rows:
+        n, top = by_group.get(gid, (0, 0))
+        by_group[gid] = (n + 1, max(top, mid))
+    for gid, (n, top) in by_group.items():
+        room_index.messages_archived(gid, n, max_id=top)
+    _forget_boundaries(by_group)
+    return len(moved)
+
+
+def _restore_dependents(rows) -> tuple[list, list]:
+    """(instance, original time) pairs of the MessageReaction / OneTimeMessageView rows
+    kept with archived rows, for users that still exist."""
+    user_ids = {
+        int(item[1])
+        for r in rows
+        for item in [*(r.get('reactors') or []), *(r.get('one_time_views') or [])]
+    }
+    User = get_user_model()
+    alive = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True)) if user_ids else set()
+    reactions = [
+        (MessageReaction(id=rid, message_id=r['id'], user_id=uid, emoji=emoji), _when(created))
+        for r in rows
+        for rid, uid, emoji, created in (r.get('reactors') or [])
+        if uid in alive
+    ]
+    views = [
+        (OneTimeMessageView(id=vid, message_id=r['id'], user_id=uid), _when(viewed_at))
+        for r in rows
+        for vid, uid, viewed_at in (r.get('one_time_views') or [])
+        if uid in alive
+    ]
+    return reactions, views
+
+
+def restore(*, group_id=None, batch_size: int = 500, stdout=None) -> int:
+    """Move archived rows back into the hot table (oldest first); returns rows restored.
+
+    Reactions, one-time views and moderation links come back with them.
+    """
+    done = 0
+    touched: set[int] = set()
+    while True:
+        qs = ArchivedMessage.objects.order_by('id')
+        if group_id:
+            qs = qs.filter(group_id=group_id)
+        rows = list(qs.values('id', *FIELDS, 'reactors', 'one_time_views')[:batch_size])
+        if not rows:
+            break
+        hot_ids = set(GroupMessage.objects.filter(
+            id__in=[r['reply_to_id'] for r in rows if r['reply_to_id']]
+        ).values_list('id', flat=True))
+        restoring = {r['id'] for r in rows}
+        reactions, views = _restore_dependents(rows)
+        messages = [
+            GroupMessage(**{
+                **{f: r[f] for f in ('id', *FIELDS)},
+                # Quotes only survive if their target is (or is becoming) hot again.
+                'reply_to_id': r['reply_to_id'] if r['reply_to_id'] in hot_ids | restoring else None,
+            })
+            for r in rows
+        ]
+        with transaction.atomic():
+            GroupMessage.objects.bulk_create(messages, ignore_conflicts=True)
+            MessageReaction.objects.bulk_create([x for x, _t in reactions], ignore_conflicts=True)
+            OneTimeMessageView.objects.bulk_create([x for x, _t in views], ignore_conflicts=True)
+            # bulk_create stamps auto_now_add fields; put the original times back.
+            for message, r in zip(messages, rows):
+                message.created = r['created']
+            GroupMessage.objects.bulk_update(messages, ['created'])
+            for reaction, created in reactions:
+                reaction.created = created
+            MessageReaction.objects.bulk_update([x for x, _t in reactions], ['created'], batch_size=500)
+            for view, viewed_at in views:
+                view.viewed_at = viewed_at
+            OneTimeMessageView.objects.bulk_update([x for x, _t in views], ['viewed_at'], batch_size=500)
+            ModerationEvent.objects.filter(archived_message_id__in=restoring).update(
+                message_id=F('archived_message_id'), archived_message_id=None,
+            )
+            ArchivedMessage.objects.filter(id__in=restoring).delete()
+        touched.update(r['group_id'] for r in rows)
+        done += len(rows)
+        if stdout is not None:
+            stdout.write(f"  {done} restored (last id {rows[-1]['id']})")
+    if touched:
+        room_index.refresh_rooms(touched)
+        _forget_boundaries(touched)
+    return done
+
+
+class ArchivePurge(purge.Purge):
+    """Moves hot messages older than the horizon to the archive."""
+
+    name = 'archive'
+
+    def scan(self, cursor, horizon):
+        return list(
+            GroupMessage.objects.filter(id__gt=cursor)
+            .order_by('id')
+            .values_list('id', 'created')[:self.chunk_size]
+        )
+
+    def select(self, rows, horizon):
+        return [r for r in rows if r[1] < horizon]
+
+    def delete(self, rows):
+        return move_to_archive([r[0] for r in rows])
+
+
+def oldest_ids(group_id, limit: int) -> list[int]:
+    """Ids of a room's `limit` oldest archived messages."""
+    return list(
+        ArchivedMessage.objects.filter(group_id=group_id)
+        .order_by('id')
+        .values_list('id', flat=True)[:max(0, int(limit))]
+    )
+
+
+def drop(group_id, ids) -> list[str]:
+    """Delete archived messages of a room for good (retention); returns their files."""
+    ids = list(ids or [])
+    if not ids:
+        return []
+    qs = ArchivedMessage.objects.filter(group_id=group_id, id__in=ids)
+    with transaction.atomic(using=qs.db):
+        files = [name for name in qs.exclude(file='').values_list('file', flat=True) if name]
+        ModerationEvent.objects.filter(archived_message_id__in=ids).update(archived_message_id=None)
+        dropped = qs._raw_delete(qs.db)
+    room_index.archived_dropped(group_id, dropped)
+    _forget_boundaries([group_id])
+    return files
+
+
+# --- reads --------------------------------------------------------------------------
+
+def materialize(rows, chat_group=None) -> list:
+    """GroupMessage instances (not saved, flagged `is_archived`) for archived value rows."""
+    out = []
+    for row in rows:
+        row = dict(row)
+        reactions = row.pop('reactions', None) or {}
+        message = GroupMessage(**row)
+        message._state.adding = False
+        message._state.db = ArchivedMessage.objects.db
+        message.is_archived = True
+        message.archived_reactions = reactions
+        if chat_group is not None and chat_group.pk == message.group_id:
+            message.group = chat_group
+        out.append(message)
+
+    by_id = {m.id: m for m in out}
+    wanted = {m.reply_to_id for m in out if m.reply_to_id and m.reply_to_id not in by_id}
+    targets = {}
+    if wanted:
+        targets.update({m.id: m for m in GroupMessage.objects.filter(id__in=wanted)})
+        missing = wanted - targets.keys()
+        if missing:
+            for m in materialize(ArchivedMessage.objects.filter(id__in=missing).values('id', 'reactions', *FIELDS)):
+                m.reply_to_id = None
+                targets[m.id] = m
+    for message in out:
+        if not message.reply_to_id:
+            continue
+        target = by_id.get(message.reply_to_id) or targets.get(message.reply_to_id)
+        if target is None:
+            message.reply_to_id = None
+        else:
+            message._state.fields_cache['reply_to'] = target
+    return out
+
+
+def merge_page(chat_group, hot_rows, *, before_id=None, want: int) -> list:
+    """Combine a newest-first hot page with archived rows when it reaches the boundary.
+
+    `hot_rows` is the hot query result (newest first, at most `want` rows);
+    returns up to `want` rows newest first.
+    """
+    edge = boundary(chat_group.pk)
+    if not edge:
+        return hot_rows
+    # Hot rows all newer than the archive and the page is full: nothing to merge.
+    if len(hot_rows) >= want and int(hot_rows[-1].id) > edge:
+        return hot_rows
+    qs = ArchivedMessage.objects.filter(group_id=chat_group.pk).order_by('-id')
+    if before_id:
+        qs = qs.filter(id__lt=before_id)
+    cold = materialize(list(qs.values('id', 'reactions', *FIELDS)[:want]), chat_group)
+    merged = sorted(list(hot_rows) + cold, key=lambda m: int(m.id), reverse=True)
+    return merged[:want]
+
+
+def snapshot_pills(message, emojis) -> list[dict] | None:
+    """Reaction pills of an archived message from its snapshot (None for hot messages)."""
+    if not getattr(message, 'is_archived', False):
+        return None
+    counts = getattr(message, 'archived_reactions', None) or {}
+    return [
+        {'emoji': emoji, 'count': int(counts[emoji]), 'reacted': False}
+        for emoji in emojis
+        if counts.get(emoji)
+    ]
@@ -0,0 +1,204 @@
+"""Async-native variants of the websocket consumers.
+
+The sync consumers in `consumers.py` hop to the sync thread pool for every
+channel-layer event, so room fan-out (N sockets x every message, typing and
+online-count event) is bounded by the executor size. The classes below are
+`AsyncWebsocketConsumer`s that keep the exact behaviour of their sync
+counterpart by driving a private instance of it (the "delegate"):
+
+- events whose handler only formats and forwards the payload run inline on
+  the event loop; their `send()`s are buffered and flushed with `await`
+- connect/disconnect/receive and handlers that touch the DB, Redis or the
+  channel layer run through one `database_sync_to_async` call each
+
+CHAT_ASYNC_CONSUMERS picks the implementation in `routing.py`, so both can be
+A/B tested on the same build.
+"""
+
+from __future__ import annotations
+
+from functools import lru_cache
+
+from asgiref.sync import async_to_sync
+from channels.consumer import get_handler_name
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+
+from a_core.profiler import AsyncProfiledConsumerMixin
+
+from .consumers import (
+    ChatroomConsumer,
+    GlobalAnnouncementConsumer,
+    NotificationsConsumer,
+    OnlineStatusConsumer,
+    ProfilePresenceConsumer,
+)
+from .fanout import role_variant
+
+
+def async_consumers_enabled() -> bool:
+    try:
+        return bool(getattr(settings, 'CHAT_ASYNC_CONSUMERS', False))
+    except Exception:
+        return False
+
+
+class _DelegateSend:
+    """Routes a sync consumer's `send()`s to its async owner.
+
+    Inline (event-loop) runs collect messages in `_outbox`; thread runs send
+    straight through the owner's ASGI `send`.
+    """
+
+    _outbox = None
+    _owner_send = None
+
+    def base_send(self, message):
+        if self._outbox is not None:
+            self._outbox.append(message)
+            return
+        self._owner_send(message)
+
+
+@lru_cache(maxsize=None)
+def _delegate_class(sync_class):
+    return type(f"{sync_class.__name__}Delegate", (_DelegateSend, sync_class), {})
+
+
+class AsyncDelegatingConsumer(AsyncProfiledConsumerMixin, AsyncWebsocketConsumer):
+    sync_class = None
+    # Channel-layer handlers with no DB/cache/channel-layer access.
+    inline_handlers: frozenset[str] = frozenset()
+    # True when the sync `receive` only answers keepalives.
+    inline_receive = False
+
+    def _make_delegate(self):
+        delegate = _delegate_class(self.sync_class)()
+        delegate.scope = self.scope
+        delegate.channel_layer = self.channel_layer
+        delegate.channel_name = self.channel_name
+        delegate._owner_send = async_to_sync(self.base_send)
+        return delegate
+
+    async def _run_inline(self, handler, *args) -> None:
+        delegate = self.delegate
+        outbox = delegate._outbox = []
+        try:
+            handler(*args)
+        finally:
+            delegate._outbox = None
+        for message in outbox:
+            await self.base_send(message)
+
+    def _can_run_inline(self, handler_name: str, event: dict) -> bool:
+        return handler_name in self.inline_handlers
+
+    async def connect(self):
+        self.delegate = self._make_delegate()
+        await database_sync_to_async(self.delegate.connect)()
+
+    async def disconnect(self, close_code):
+        delegate = getattr(self, 'delegate', None)
+        if delegate is not None:
+            await database_sync_to_async(delegate.disconnect)(close_code)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.inline_receive:
+            await self._run_inline(self.delegate.receive, text_data)
+            return
+        await database_sync_to_async(self.delegate.receive)(text_data)
+
+    async def dispatch(self, message):
+        handler_name = get_handler_name(message)
+        if handler_name.startswith('websocket_'):
+            await super().dispatch(message)
+            return
+
+        handler = getattr(self.delegate, handler_name, None)
+        if handler is None:
+            raise ValueError("No handler for message type %s" % message['type'])
+        if self._can_run_inline(handler_name, message):
+            await self._run_inline(handler, message)
+        else:
+            await database_sync_to_async(handler)(message)
+
+
+class AsyncChatroomConsumer(AsyncDelegatingConsumer):
+    sync_class = ChatroomConsumer
+    inline_handlers = frozenset({
+        'typing_handler',
+        'challenge_event_handler',
+        'ipl_score_handler',
+        'read_receipt_handler',
+        'one_time_seen_handler',
+        'message_delete_handler',
+        'online_count_handler',
+        'call_presence_handler',
+        'member_added_handler',
+        'member_left_handler',
+        'waiting_list_updated_handler',
+        'member_removed_handler',
+        'admin_role_removed_handler',
+        'member_mute_updated_handler',
+    })
+
+    def _can_run_inline(self, handler_name: str, event: dict) -> bool:
+        if handler_name != 'message_handler':
+            return super()._can_run_inline(handler_name, event)
+
+        # Render-once fan-out: inline only when this viewer's variant was shipped
+        # and the membership guard can be answered from the cached snapshot.
+        delegate = self.delegate
+        user = getattr(delegate, 'user', None)
+        rendered = event.get('rendered')
+        if not rendered or user is None:
+            return False
+        if getattr(getattr(delegate, 'chatroom', None), 'is_private', False):
+            state = getattr(delegate, '_user_state', None)
+            if state is None or state.is_stale():
+                return False
+        return role_variant(
+            rendered,
+            viewer_id=getattr(user, 'id', None),
+            viewer_is_staff=bool(getattr(user, 'is_staff', False)),
+        ) is not None
+
+
+class AsyncOnlineStatusConsumer(AsyncDelegatingConsumer):
+    sync_class = OnlineStatusConsumer
+    inline_handlers = frozenset({'online_status_handler'})
+
+
+class AsyncNotificationsConsumer(AsyncDelegatingConsumer):
+    sync_class = NotificationsConsumer
+    inline_handlers = frozenset({'follow_request_notify_handler', 'room_invite_notify_handler'})
+    inline_receive = True
+
+
+class AsyncProfilePresenceConsumer(AsyncDelegatingConsumer):
+    sync_class = ProfilePresenceConsumer
+    inline_handlers = frozenset({'presence_handler'})
+    inline_receive = True
+
+
+class AsyncGlobalAnnouncementConsumer(AsyncDelegatingConsumer):
+    sync_class = GlobalAnnouncementConsumer
+    inline_handlers = frozenset({'global_announcement_handler'})
+    inline_receive = True
+
+
+ASYNC_VARIANTS = {
+    ChatroomConsumer: AsyncChatroomConsumer,
+    OnlineStatusConsumer: AsyncOnlineStatusConsumer,
+    NotificationsConsumer: AsyncNotificationsConsumer,
+    ProfilePresenceConsumer: AsyncProfilePresenceConsumer,
+    GlobalAnnouncementConsumer: AsyncGlobalAnnouncementConsumer,
+}
+
+
+def consumer_for(sync_class):
+    """The consumer class to route: the async variant when CHAT_ASYNC_CONSUMERS is on."""
+    if async_consumers_enabled():
+        return ASYNC_VARIANTS.get(sync_class, sync_class)
+    return sync_class
@@ -1,143 +1,385 @@
+"""Behaviour-based chat badges, maintained incrementally.
+
+Each badge a user holds in a room is one cache key
+(`autobadge:v1:<room>:<user>:<badge>`) whose TTL is the moment the badge
+stops being earned, so rendering a batch of messages is one `get_many`
+(MGET on Redis) plus the presence lookup for "Active 10 min".
+
+The time-windowed badges keep their qualifying events in a per-(room, user)
+sorted set scored by timestamp. When an event arrives the window is trimmed
+and the badge key is (re)written to expire when the Nth-newest event ages
+out, which is exactly when the count would drop below the threshold:
+
+- fast replier: >= 3 replies to someone else within 90s, over 24h
+- helpful: >= 5 reactions from others on their messages, over 7 days
+- room OG: first message within 7 days of the room's creation (or admin)
+
+Events come from the model signals in signals.py. A user's state in a room
+is rebuilt from the database the first time it is read (and again every
+AUTO_BADGE_WARM_TTL_SECONDS), which covers history from before the engine
+existed, a flushed cache, and the odd missed event. A rebuild replaces the
+user's windows and flags outright, so deleted messages and reactions lower
+the counts too. Only the authors on the page being rendered are rebuilt, and
+one request per room does it at a time (AUTO_BADGE_WARM_LOCK_SECONDS).
+Without Redis (local/dev) the event windows live in the default cache.
+"""
+
 from __future__ import annotations
 
+import threading
+import time
 from datetime import timedelta
-from typing import Dict, Iterable, List, Optional
+from typing import Dict, Iterable, List
 
-from django.db.models import Count, DurationField, ExpressionWrapper, F, Max, Min
+from django.conf import settings
 from django.core.cache import cache
+from django.db.models import DurationField, ExpressionWrapper, F
 from django.utils import timezone
 
 from .models import ChatGroup, GroupMessage, MessageReaction
+from . import presence
+from .redis_utils import get_redis
+
+
+BADGE_KEY_PREFIX = 'autobadge:v1:'
+
+FAST_REPLY_SECONDS = 90
+FAST_REPLIER_MIN = 3
+FAST_REPLIER_WINDOW_SECONDS = 24 * 60 * 60
+
+HELPFUL_MIN = 5
+HELPFUL_WINDOW_SECONDS = 7 * 24 * 60 * 60
+
+ROOM_OG_JOIN_DAYS = 7
+
+BADGES = {
+    'active_10m': ('🔥', 'Active 10 min'),
+    'fast_replier': ('⚡', 'Fast replier'),
+    'room_og': ('👑', 'Room OG'),
+    'helpful': ('🧠', 'Helpful guy'),
+}
+# Keep stable ordering for UX
+BADGE_ORDER = ('active_10m', 'fast_replier', 'room_og', 'helpful')
+
+# Badges stored as keys (active_10m is read from presence instead).
+_STORED = ('fast_replier', 'room_og', 'helpful')
+
+_local_lock = threading.Lock()
 
 
+def _warm_ttl_seconds() -> int:
+    try:
+        return max(60, int(getattr(settings, 'AUTO_BADGE_WARM_TTL_SECONDS', 6 * 60 * 60)))
+    except Exception:
+        return 6 * 60 * 60
+
+
+def _flag_key(room_id: int, uid: int, badge: str) -> str:
+    return f"{BADGE_KEY_PREFIX}{int(room_id)}:{int(uid)}:{badge}"
+
+
+def _warm_key(room_id: int, uid: int) -> str:
+    return f"{BADGE_KEY_PREFIX}{int(room_id)}:{int(uid)}:warm"
+
+
+def _warm_lock_key(room_id: int) -> str:
+    return f"{BADGE_KEY_PREFIX}{int(room_id)}:warming"
+
+
+def _warm_lock_seconds() -> int:
+    try:
+        return max(1, int(getattr(settings, 'AUTO_BADGE_WARM_LOCK_SECONDS', 30)))
+    except Exception:
+        return 30
+
+
+def _events_key(room_id: int, uid: int, kind: str) -> str:
+    return f"{BADGE_KEY_PREFIX}ev:{int(room_id)}:{int(uid)}:{kind}"
+
+
+def _ts(value) -> float:
+    try:
+        return float(value.timestamp())
+    except Exception:
+        return time.time()
+
+
+# --- event windows ---------------------------------------------------------
+
+def _window_update(
+    key: str, *, add: dict | None = None, remove=None, window: int, need: int, replace: bool = False,
+) -> float:
+    """Apply adds/removes to an event window; returns when the badge lapses (0 = not earned).
+
+    `add` maps event member -> timestamp. The badge holds until the
+    `need`-th newest event falls out of the window. With `replace` the
+    window becomes exactly `add` (in one MULTI on Redis).
+    """
+    now = time.time()
+    floor = now - window
+    client = get_redis()
+    if client is not None:
+        pipe = client.pipeline()
+        if replace:
+            pipe.delete(key)
+        if add:
+            pipe.zadd(key, {str(m): float(ts) for m, ts in add.items()})
+        if remove:
+            pipe.zrem(key, *[str(m) for m in remove])
+        pipe.zremrangebyscore(key, '-inf', floor)
+        pipe.zrevrange(key, need - 1, need - 1, withscores=True)
+        pipe.expire(key, window)
+        nth = pipe.execute()[-2]
+        return float(nth[0][1]) + window if nth else 0.0
+
+    with _local_lock:
+        events = {} if replace else (cache.get(key) or {})
+        for m, ts in (add or {}).items():
+            events[str(m)] = float(ts)
+        for m in remove or []:
+            events.pop(str(m), None)
+        events = {m: ts for m, ts in events.items() if ts > floor}
+        cache.set(key, events, timeout=window)
+    newest = sorted(events.values(), reverse=True)
+    return newest[need - 1] + window if len(newest) >= need else 0.0
+
+
+def _set_flag(room_id: int, uid: int, badge: str, until: float) -> None:
+    key = _flag_key(room_id, uid, badge)
+    remaining = int(until - time.time()) if until else 0
+    if remaining > 0:
+        cache.set(key, 1, timeout=remaining)
+    else:
+        cache.delete(key)
+
+
+def _record_fast_reply(room_id: int, uid: int, message_id: int, created_ts: float) -> None:
+    until = _window_update(
+        _events_key(room_id, uid, 'fast'),
+        add={message_id: created_ts},
+        window=FAST_REPLIER_WINDOW_SECONDS,
+        need=FAST_REPLIER_MIN,
+    )
+    if until:
+        _set_flag(room_id, uid, 'fast_replier', until)
+
+
+def _update_helpful(room_id: int, uid: int, *, add=None, remove=None, replace: bool = False) -> None:
+    until = _window_update(
+        _events_key(room_id, uid, 'helpful'),
+        add=add,
+        remove=remove,
+        window=HELPFUL_WINDOW_SECONDS,
+        need=HELPFUL_MIN,
+        replace=replace,
+    )
+    _set_flag(room_id, uid, 'helpful', until)
+
+
+def _is_og_message(chat_group, created) -> bool:
+    room_created = getattr(chat_group, 'created', None)
+    return bool(room_created and created and created <= room_created + timedelta(days=ROOM_OG_JOIN_DAYS))
+
+
+def _set_og(room_id: int, uid: int) -> None:
+    # Refreshed by every room rebuild; outliving the warm marker keeps it readable until then.
+    cache.set(_flag_key(room_id, uid, 'room_og'), 1, timeout=_warm_ttl_seconds() * 2)
+
+
+# --- events (called from signals.py) ---------------------------------------
+
+def message_created(message) -> None:
+    """Fold a new message into the OG and fast-replier state."""
+    room_id = int(getattr(message, 'group_id', 0) or 0)
+    uid = int(getattr(message, 'author_id', 0) or 0)
+    if not room_id or not uid:
+        return
+    created = getattr(message, 'created', None) or timezone.now()
+
+    group = getattr(message, 'group', None)
+    if _is_og_message(group, created):
+        _set_og(room_id, uid)
+
+    reply_to_id = getattr(message, 'reply_to_id', None)
+    if not reply_to_id:
+        return
+    parent = GroupMessage.objects.filter(pk=reply_to_id).values_list('author_id', 'created').first()
+    if not parent or int(parent[0] or 0) == uid or not parent[1]:
+        return
+    if (created - parent[1]).total_seconds() <= FAST_REPLY_SECONDS:
+        _record_fast_reply(room_id, uid, int(message.id), _ts(created))
+
+
+def _reaction_target(reaction):
+    row = (
+        GroupMessage.objects.filter(pk=getattr(reaction, 'message_id', None))
+        .values_list('group_id', 'author_id')
+        .first()
+    )
+    if not row or not row[1] or int(row[1]) == int(getattr(reaction, 'user_id', 0) or 0):
+        return None
+    return int(row[0]), int(row[1])
+
+
+def reaction_added(reaction) -> None:
+    target = _reaction_target(reaction)
+    if target is None:
+        return
+    room_id, author_id = target
+    _update_helpful(room_id, author_id, add={int(reaction.id): _ts(getattr(reaction, 'created', None))})
+
+
+def reaction_removed(reaction) -> None:
+    target = _reaction_target(reaction)
+    if target is None:
+        return
+    room_id, author_id = target
+    _update_helpful(room_id, author_id, remove=[int(reaction.id)])
+
+
+# --- rebuild ----------------------------------------------------------------
+
+def warm_room(chat_group: ChatGroup, user_ids: Iterable[int], now=None) -> None:
+    """Rebuild the badge state of `user_ids` in one room from the database (idempotent).
+
+    Each user's windows and flags are replaced, not merged, so events whose
+    message or reaction is gone no longer count.
+    """
+    room_id = int(getattr(chat_group, 'pk', 0) or 0)
+    ids = sorted(set(int(x) for x in (user_ids or []) if x))
+    if not room_id or not ids:
+        return
+    now = now or timezone.now()
+
+    delta = ExpressionWrapper(F('created') - F('reply_to__created'), output_field=DurationField())
+    fast: dict[int, dict] = {uid: {} for uid in ids}
+    rows = (
+        GroupMessage.objects.filter(
+            group_id=room_id,
+            author_id__in=ids,
+            reply_to__isnull=False,
+            created__gte=now - timedelta(seconds=FAST_REPLIER_WINDOW_SECONDS),
+        )
+        .exclude(reply_to__author_id=F('author_id'))
+        .annotate(delta=delta)
+        .filter(delta__lte=timedelta(seconds=FAST_REPLY_SECONDS))
+        .values_list('author_id', 'id', 'created')
+    )
+    for uid, mid, created in rows:
+        fast[int(uid)][int(mid)] = _ts(created)
+    for uid, events in fast.items():
+        until = _window_update(
+            _events_key(room_id, uid, 'fast'),
+            add=events,
+            window=FAST_REPLIER_WINDOW_SECONDS,
+            need=FAST_REPLIER_MIN,
+            replace=True,
+        )
+        _set_flag(room_id, uid, 'fast_replier', until)
+
+    helpful: dict[int, dict] = {uid: {} for uid in ids}
+    rows = (
+        MessageReaction.objects.filter(
+            message__group_id=room_id,
+            message__author_id__in=ids,
+            created__gte=now - timedelta(seconds=HELPFUL_WINDOW_SECONDS),
+        )
+        .exclude(user_id=F('message__author_id'))
+        .values_list('message__author_id', 'id', 'created')
+    )
+    for uid, rid, created in rows:
+        helpful[int(uid)][int(rid)] = _ts(created)
+    for uid, events in helpful.items():
+        _update_helpful(room_id, uid, add=events, replace=True)
+
+    og_ids: set[int] = set()
+    room_created = getattr(chat_group, 'created', None)
+    if room_created:
+        cutoff = room_created + timedelta(days=ROOM_OG_JOIN_DAYS)
+        og_ids = set(
+            GroupMessage.objects.filter(group_id=room_id, author_id__in=ids, created__lte=cutoff)
+            .values_list('author_id', flat=True)
+            .distinct()
+        )
+    for uid in ids:
+        if uid in og_ids:
+            _set_og(room_id, uid)
+        else:
+            cache.delete(_flag_key(room_id, uid, 'room_og'))
+
+    cache.set_many({_warm_key(room_id, uid): 1 for uid in ids}, timeout=_warm_ttl_seconds())
+
+
+# --- read path ----------------------------------------------------------------
+
 def compute_auto_badges(
     chat_group: ChatGroup,
     user_ids: Iterable[int],
     now=None,
 ) -> Dict[int, List[dict]]:
-    """Compute lightweight, behavior-based badges for users inside a chat room.
+    """Lightweight, behavior-based badges for users inside a chat room.
 
-    These badges are meant to be dynamic (not daily streaks) and are computed from
+    These badges are meant to be dynamic (not daily streaks) and reflect
     recent room activity.
 
     Returns: {user_id: [{key, icon, label}, ...]}
     """
 
-    ids = [int(uid) for uid in set(int(x) for x in (user_ids or []) if x)]
+    ids = sorted(set(int(x) for x in (user_ids or []) if x))
     if not ids:
         return {}
 
     now = now or timezone.now()
+    room_id = int(getattr(chat_group, 'pk', 0) or 0)
 
-    out: Dict[int, List[dict]] = {uid: [] for uid in ids}
-
-    def add(uid: int, key: str, icon: str, label: str) -> None:
-        if uid not in out:
-            return
-        out[uid].append({'key': key, 'icon': icon, 'label': label})
+    held: Dict[int, set] = {uid: set() for uid in ids}
 
     # 🔥 Active 10 min
     # Show only when the user has been continuously online in this room for >=10 minutes.
     # If they leave before 10 and come back, the timer resets.
     try:
-        room_id = int(getattr(chat_group, 'pk', 0) or 0)
         if room_id:
-            online_ids = set(
-                int(x)
-                for x in chat_group.users_online.filter(id__in=ids).values_list('id', flat=True)
-                if int(x) > 0
-            )
-
-            for uid in online_ids:
+            for uid, since in presence.online_since(chat_group, ids).items():
                 try:
-                    k = f"rtchat:room:{room_id}:user:{uid}:online_since"
-                    ts = cache.get(k)
-                    if ts is None:
-                        continue
-                    since = float(ts)
-                    if (now.timestamp() - since) >= (10 * 60):
-                        add(uid, 'active_10m', '🔥', 'Active 10 min')
+                    if (now.timestamp() - float(since)) >= (10 * 60) and uid in held:
+                        held[uid].add('active_10m')
                 except Exception:
                     continue
     except Exception:
         pass
 
-    # ⚡ Fast replier (frequent quick replies in the last 24h)
-    try:
-        since = now - timedelta(hours=24)
-        delta = ExpressionWrapper(F('created') - F('reply_to__created'), output_field=DurationField())
-        rows = (
-            GroupMessage.objects.filter(
-                group=chat_group,
-                author_id__in=ids,
-                reply_to__isnull=False,
-                created__gte=since,
-            )
-            .exclude(reply_to__author_id=F('author_id'))
-            .annotate(delta=delta)
-            .filter(delta__lte=timedelta(seconds=90))
-            .values('author_id')
-            .annotate(c=Count('id'))
-        )
-        for r in rows:
-            uid = int(r['author_id'])
-            c = int(r.get('c') or 0)
-            if c >= 3:
-                add(uid, 'fast_replier', '⚡', 'Fast replier')
-    except Exception:
-        pass
+    # 👑 Room admins are always OG.
+    admin_id = int(getattr(chat_group, 'admin_id', 0) or 0)
+    if admin_id in held:
+        held[admin_id].add('room_og')
 
-    # 👑 Room OG (room admin OR joined early in room lifetime)
-    try:
-        admin_id = int(getattr(chat_group, 'admin_id', 0) or 0)
-        if admin_id and admin_id in out:
-            add(admin_id, 'room_og', '👑', 'Room OG')
-
-        # If user's first message was within 7 days of room creation, count as OG.
-        created = getattr(chat_group, 'created', None)
-        if created:
-            cutoff = created + timedelta(days=7)
-            rows = (
-                GroupMessage.objects.filter(group=chat_group, author_id__in=ids)
-                .values('author_id')
-                .annotate(first=Min('created'))
-            )
-            for r in rows:
-                uid = int(r['author_id'])
-                if uid == admin_id:
-                    continue
-                first = r.get('first')
-                if first and first <= cutoff:
-                    add(uid, 'room_og', '👑', 'Room OG')
-    except Exception:
-        pass
-
-    # 🧠 Helpful guy (their messages received reactions recently)
-    try:
-        since = now - timedelta(days=7)
-        rows = (
-            MessageReaction.objects.filter(
-                message__group=chat_group,
-                message__author_id__in=ids,
-                created__gte=since,
-            )
-            .exclude(user_id=F('message__author_id'))
-            .values('message__author_id')
-            .annotate(c=Count('id'))
-        )
-        for r in rows:
-            uid = int(r['message__author_id'])
-            c = int(r.get('c') or 0)
-            if c >= 5:
-                add(uid, 'helpful', '🧠', 'Helpful guy')
-    except Exception:
-        pass
-
-    # Keep stable ordering for UX
-    order = {'active_10m': 0, 'fast_replier': 1, 'room_og': 2, 'helpful': 3}
-    for uid in list(out.keys()):
-        out[uid].sort(key=lambda b: order.get(b.get('key') or '', 999))
+    if room_id:
+        keys = {_flag_key(room_id, uid, badge): (uid, badge) for uid in ids for badge in _STORED}
+        warm_keys = {_warm_key(room_id, uid): uid for uid in ids}
+        try:
+            found = cache.get_many([*warm_keys, *keys])
+            cold = [uid for key, uid in warm_keys.items() if key not in found]
+            # One rebuild per room at a time; the others render what is cached.
+            if cold and cache.add(_warm_lock_key(room_id), 1, timeout=_warm_lock_seconds()):
+                try:
+                    warm_room(chat_group, cold, now=now)
+                finally:
+                    cache.delete(_warm_lock_key(room_id))
+                found = cache.get_many(list(keys))
+            for key in found:
+                if key in keys:
+                    uid, badge = keys[key]
+                    held[uid].add(badge)
+        except Exception:
+            pass
 
+    out: Dict[int, List[dict]] = {}
+    for uid in ids:
+        out[uid] = [
+            {'key': key, 'icon': BADGES[key][0], 'label': BADGES[key][1]}
+            for key in BADGE_ORDER
+            if key in held[uid]
+        ]
     return out
 
 
@@ -8,6 +8,7 @@ from django.db import transaction
 from django.utils import timezone
 
 from .models import ChatChallenge, ChatGroup
+from . import presence, scoreboard
 
 
 VOWELS_RE = re.compile(r"[aeiou]", re.IGNORECASE)
@@ -429,7 +430,7 @@ def start_challenge(group: ChatGroup, created_by, kind: str) -> ChatChallenge:
             created_by_id = 0
         participants: set[int] = set()
         try:
-            participants |= set(int(x) for x in group.users_online.values_list('id', flat=True) if int(x) > 0)
+            participants |= set(int(x) for x in presence.online_ids(group) if int(x) > 0)
         except Exception:
             pass
         if created_by_id > 0:
@@ -574,12 +575,26 @@ def end_challenge(ch: ChatChallenge) -> ChatChallenge:
         meta["losers"] = sorted(losers)
 
     meta["winners"] = sorted(int(x) for x in winners)
-    ch.meta = meta
+    _complete(ch, meta)
+    return ch
+
+
+def _complete(ch: ChatChallenge, meta: dict) -> bool:
+    """Mark `ch` completed and score it; False if another worker completed it first."""
     meta["ended_kind"] = "completed"
+    ch.meta = meta
     ch.status = ChatChallenge.STATUS_COMPLETED
     ch.ended_at = timezone.now()
-    ch.save(update_fields=["meta", "status", "ended_at"])
-    return ch
+    with transaction.atomic():
+        # Conditional update so concurrent lazy expiries score a challenge once.
+        updated = ChatChallenge.objects.filter(pk=ch.pk, status=ChatChallenge.STATUS_ACTIVE).update(
+            meta=meta,
+            status=ch.status,
+            ended_at=ch.ended_at,
+        )
+        if updated:
+            scoreboard.record_result(ch.group_id, meta.get("winners"), meta.get("losers"))
+    return bool(updated)
 
 
 def check_message(ch: ChatChallenge, user_id: int, body: str) -> ChallengeCheckResult:
@@ -820,11 +835,7 @@ def check_message(ch: ChatChallenge, user_id: int, body: str) -> ChallengeCheckR
         member_ids = _participants_from_meta(ch.group, meta)
         meta["winners"] = [uid]
         meta["losers"] = [x for x in member_ids if x and int(x) != uid]
-        meta["ended_kind"] = "completed"
-        ch.meta = meta
-        ch.status = ChatChallenge.STATUS_COMPLETED
-        ch.ended_at = timezone.now()
-        ch.save(update_fields=["meta", "status", "ended_at"])
+        _complete(ch, meta)
         return ChallengeCheckResult(allowed=True, ended=True)
 
     return ChallengeCheckResult(allowed=True)
@@ -838,35 +849,11 @@ def get_win_loss_totals(
 ) -> dict:
     """Return aggregated challenge results for a user.
 
-    We count wins/losses based on the persisted `meta['winners']`/`meta['losers']`
-    lists on COMPLETED challenges.
+    Read from the materialized scoreboard (`a_rtchat.scoreboard`); `completed`
+    is the number of completed challenges the user took part in. Challenges only
+    run in private rooms, so the site-wide row already is the private-only total.
     """
-    uid = int(user_id or 0)
-    if uid <= 0:
-        return {'wins': 0, 'losses': 0, 'completed': 0}
-
-    qs = ChatChallenge.objects.filter(status=ChatChallenge.STATUS_COMPLETED)
-    if group is not None:
-        qs = qs.filter(group=group)
-    elif private_only:
-        qs = qs.filter(group__is_private=True)
-
-    wins = 0
-    losses = 0
-    completed = 0
-
-    for meta in qs.values_list('meta', flat=True):
-        if not isinstance(meta, dict):
-            continue
-        completed += 1
-        winners = meta.get('winners') or []
-        losers = meta.get('losers') or []
-        if uid in winners:
-            wins += 1
-        if uid in losers:
-            losses += 1
-
-    return {'wins': wins, 'losses': losses, 'completed': completed}
+    return scoreboard.totals(user_id, group=group)
 
 
 def challenge_public_state(ch: ChatChallenge | None) -> dict:
@@ -8,9 +8,11 @@ from django.core.cache import cache
 from django.utils import timezone
 import datetime
 import os
-from django.db.models import Count
+from django.db.models import Count, Q
 from asgiref.sync import async_to_sync
 import json
+from a_core.profiler import ProfiledConsumerMixin
+from a_users import author_cards
 from a_users.badges import get_verified_user_ids
 from .models import *
 
@@ -115,6 +117,8 @@ def _attach_poll_card_for_message(message, user):
         pass
 from django.conf import settings
 from .rate_limit import (
+    LimitCheck,
+    check_event_limits,
     check_rate_limit,
     get_client_ip_from_scope,
     get_room_muted_seconds,
@@ -123,7 +127,9 @@ from .rate_limit import (
     is_same_emoji_spam,
     is_duplicate_message,
     make_key,
+    mute_key,
     record_abuse_violation,
+    room_mute_key,
     set_muted,
 )
 
@@ -133,11 +139,13 @@ except Exception:  # pragma: no cover
     maybe_set_profile_city_from_ip = None
     vpn_proxy_status_for_ip = None
 
-from .moderation import moderate_message
+from . import moderation_pipeline
 from .channels_utils import chatroom_channel_group_name
 from .ipl_live import IPL_SCORE_GLOBAL_GROUP, get_cached_ipl_state
 from .mentions import extract_mention_usernames, resolve_mentioned_users
 from .auto_badges import attach_auto_badges
+from .fanout import message_event, select_rendered_html
+from . import presence, presence_broadcast, user_state
 
 
 VPN_PROXY_CLIENT_BLOCKED_SESSION_KEY = 'vixo_vpn_proxy_client_blocked'
@@ -146,6 +154,12 @@ VPN_PROXY_WARNING_MESSAGE = (
     'Please disable your VPN to continue using all features.'
 )
 
+# Chat socket events that never carry a message body.
+_WS_CONTROL_EVENTS = frozenset({
+    'typing', 'ping', 'heartbeat', 'read',
+    'challenge_state', 'challenge_start', 'challenge_cancel',
+})
+
 
 def _ws_counter_ttl() -> int:
     try:
@@ -283,7 +297,7 @@ def _ws_leave(bucket: str | None, global_incremented: bool, bucket_incremented:
             pass
 
 
-class GlobalAnnouncementConsumer(WebsocketConsumer):
+class GlobalAnnouncementConsumer(ProfiledConsumerMixin, WebsocketConsumer):
     """Site-wide global announcement banner updates (real-time).
 
     Any connected client joins a single channel-layer group and receives
@@ -399,7 +413,7 @@ def _celery_broker_configured() -> bool:
 from .models_read import ChatReadState
 from .models import Notification
 from .link_policy import contains_link
-from .link_preview import extract_first_http_url, fetch_link_preview
+from .link_preview import attach_or_schedule, extract_first_http_url
 from .room_policy import room_allows_links, is_free_promotion_room, is_meme_central_room
 from urllib.parse import urlparse
 from .challenges import (
@@ -514,7 +528,7 @@ def _is_vpn_proxy_blocked_for_scope(scope, user) -> bool:
             return False
 
         ip = get_client_ip_from_scope(scope)
-        status = vpn_proxy_status_for_ip(ip)
+        status = vpn_proxy_status_for_ip(ip, wait=False)
         return bool(status.get('blocked'))
     except Exception:
         return False
@@ -530,7 +544,7 @@ def _resolve_authenticated_user(scope_user):
     except Exception:
         return scope_user
 
-class ChatroomConsumer(WebsocketConsumer):
+class ChatroomConsumer(ProfiledConsumerMixin, WebsocketConsumer):
     def _is_room_admin(self) -> bool:
         try:
             if not getattr(self.user, 'is_authenticated', False):
@@ -667,6 +681,12 @@ class ChatroomConsumer(WebsocketConsumer):
             return
 
     def member_added_handler(self, event):
+        try:
+            added_id = int((event.get('member') or {}).get('id') or 0)
+        except Exception:
+            added_id = 0
+        if added_id and added_id == int(getattr(self.user, 'id', 0) or 0):
+            self._user_state = None
         try:
             self.send(text_data=json.dumps({
                 'type': 'member_added',
@@ -717,6 +737,9 @@ class ChatroomConsumer(WebsocketConsumer):
         except Exception:
             current_id = 0
         if removed_id and current_id and removed_id == current_id:
+            state = getattr(self, '_user_state', None)
+            if state is not None:
+                state.is_member = False
             try:
                 self.send(text_data=json.dumps({
                     'type': 'not_member',
@@ -778,12 +801,8 @@ class ChatroomConsumer(WebsocketConsumer):
             uid = 0
         if not uid:
             return False
-        try:
-            if ChatGroup.objects.filter(pk=getattr(self.chatroom, 'pk', None), members__id=uid).exists():
-                return True
-        except Exception:
-            # If membership check fails, be safe and stop.
-            pass
+        if self._current_user_state().is_member:
+            return True
 
         # Accept + notify, so client stops reconnecting/polling.
         try:
@@ -802,6 +821,25 @@ class ChatroomConsumer(WebsocketConsumer):
                 except Exception:
                     pass
         return False
+
+    def _current_user_state(self) -> user_state.UserStateSnapshot:
+        """Cached moderation state for this socket; reloaded only when missing or stale."""
+        state = getattr(self, '_user_state', None)
+        if state is None or state.is_stale():
+            state = user_state.load(self.user, getattr(self, 'chatroom', None))
+            self._user_state = state
+        return state
+
+    def user_state_handler(self, event):
+        state = user_state.apply_event(getattr(self, '_user_state', None), event)
+        self._user_state = state
+        # A new ban applies in real-time, like a removal does.
+        if self._current_user_state().is_banned():
+            try:
+                self.close(code=4403)
+            except Exception:
+                self.close()
+
     def _send_cooldown(self, seconds: int, reason: str = '') -> None:
         try:
             secs = int(seconds or 0)
@@ -928,92 +966,6 @@ class ChatroomConsumer(WebsocketConsumer):
         except Exception:
             return
 
-    def _room_conn_key(self) -> str:
-        room_id = getattr(self, 'chatroom', None)
-        room_pk = getattr(room_id, 'pk', None)
-        user_id = getattr(getattr(self, 'user', None), 'id', None)
-        return f"rtchat:room:{room_pk}:user:{user_id}:conns"
-
-    def _inc_room_conn(self) -> int:
-        key = self._room_conn_key()
-        try:
-            current = int(cache.get(key) or 0)
-            new_val = current + 1
-            cache.set(key, new_val, timeout=120)
-            return new_val
-        except Exception:
-            try:
-                cache.set(key, 1, timeout=120)
-            except Exception:
-                pass
-            return 1
-
-    def _dec_room_conn(self) -> int:
-        key = self._room_conn_key()
-        try:
-            current = int(cache.get(key) or 0)
-            new_val = max(0, current - 1)
-            if new_val <= 0:
-                cache.delete(key)
-            else:
-                cache.set(key, new_val, timeout=120)
-            return new_val
-        except Exception:
-            try:
-                cache.delete(key)
-            except Exception:
-                pass
-            return 0
-
-    def _touch_room_conn(self) -> None:
-        key = self._room_conn_key()
-        try:
-            current = cache.get(key)
-            if current is None:
-                return
-            cache.set(key, int(current), timeout=120)
-        except Exception:
-            return
-
-    def _cleanup_stale_online_users(self) -> None:
-        """Best-effort cleanup when disconnect events are missed (tab crash/server restart).
-
-        We treat a user as online in a room only if they have a live connection key.
-        """
-        try:
-            room = getattr(self, 'chatroom', None)
-            if not room:
-                return
-            user_ids = list(room.users_online.values_list('id', flat=True))
-        except Exception:
-            return
-
-        stale_ids: list[int] = []
-        for uid in user_ids:
-            try:
-                key = f"rtchat:room:{getattr(room, 'pk', None)}:user:{uid}:conns"
-                if cache.get(key) is None:
-                    stale_ids.append(int(uid))
-            except Exception:
-                continue
-
-        if stale_ids:
-            try:
-                room.users_online.remove(*stale_ids)
-            except Exception:
-                pass
-
-            # Also clear any cached "online since" markers for these users.
-            try:
-                room_id = getattr(room, 'pk', None)
-                if room_id:
-                    for uid in stale_ids:
-                        try:
-                            cache.delete(f"rtchat:room:{room_id}:user:{int(uid)}:online_since")
-                        except Exception:
-                            continue
-            except Exception:
-                pass
     def connect(self):
         self._ws_bucket = None
         self._ws_global_inc = False
@@ -1114,6 +1066,17 @@ class ChatroomConsumer(WebsocketConsumer):
             )
         except Exception:
             pass
+
+        # Moderation state snapshot, kept fresh by pushes to the per-user group.
+        self._user_state = None
+        if getattr(self.user, 'is_authenticated', False):
+            try:
+                async_to_sync(self.channel_layer.group_add)(
+                    user_state.user_state_group(self.user.id), self.channel_name
+                )
+            except Exception:
+                pass
+            self._current_user_state()
         
         self.accept()
 
@@ -1153,27 +1116,12 @@ class ChatroomConsumer(WebsocketConsumer):
             except Exception:
                 pass
 
-        # add and update online users (connection-counted + TTL to avoid stale "online")
+        # add and update online users (connection-counted + heartbeat TTL, Redis only)
         if getattr(self.user, 'is_authenticated', False):
-            new_count = self._inc_room_conn()
-            if new_count == 1:
-                try:
-                    if self.user not in self.chatroom.users_online.all():
-                        # ManyToMany expects a real User instance or a pk
-                        self.chatroom.users_online.add(self.user.pk)
-                except Exception:
-                    pass
-
-                # Continuous online tracking (used for badges like "Active 10 min")
-                try:
-                    room_id = getattr(self.chatroom, 'pk', None)
-                    uid = int(getattr(self.user, 'id', 0) or 0)
-                    if room_id and uid:
-                        k = f"rtchat:room:{room_id}:user:{uid}:online_since"
-                        if cache.get(k) is None:
-                            cache.set(k, timezone.now().timestamp(), timeout=60 * 60 * 6)  # 6h safety TTL
-                except Exception:
-                    pass
+            try:
+                presence.join(self.chatroom, self.user)
+            except Exception:
+                pass
             self.update_online_count()
         
         
@@ -1192,28 +1140,19 @@ class ChatroomConsumer(WebsocketConsumer):
             )
         except Exception:
             pass
+        if getattr(getattr(self, 'user', None), 'is_authenticated', False) and hasattr(self, 'room_group_name'):
+            try:
+                async_to_sync(self.channel_layer.group_discard)(
+                    user_state.user_state_group(self.user.id), self.channel_name
+                )
+            except Exception:
+                pass
         # remove and update online users
         if getattr(getattr(self, 'user', None), 'is_authenticated', False) and hasattr(self, 'chatroom'):
             try:
-                new_count = self._dec_room_conn()
+                presence.leave(self.chatroom, self.user)
             except Exception:
-                new_count = 0
-
-            if new_count <= 0:
-                try:
-                    if self.user in self.chatroom.users_online.all():
-                        self.chatroom.users_online.remove(self.user.pk)
-                except Exception:
-                    pass
-
-                # Clear continuous-online marker on last disconnect
-                try:
-                    room_id = getattr(self.chatroom, 'pk', None)
-                    uid = int(getattr(self.user, 'id', 0) or 0)
-                    if room_id and uid:
-                        cache.delete(f"rtchat:room:{room_id}:user:{uid}:online_since")
-                except Exception:
-                    pass
+                pass
             self.update_online_count()
         
     def receive(self, text_data):
@@ -1243,14 +1182,16 @@ class ChatroomConsumer(WebsocketConsumer):
                 pass
             return
 
-        # Keep the per-room connection TTL alive.
+        # Keep the per-room presence heartbeat alive.
         try:
-            self._touch_room_conn()
+            presence.touch(self.chatroom, self.user)
         except Exception:
             pass
 
+        state = self._current_user_state()
+
         # Chat-ban: stop any interaction immediately.
-        if _is_chat_banned(self.user):
+        if state.is_banned():
             try:
                 self.close(code=4403)
             except Exception:
@@ -1258,29 +1199,74 @@ class ChatroomConsumer(WebsocketConsumer):
             return
 
         # Allow blocked users to connect/read, but never allow them to send any events.
-        if _is_chat_blocked(self.user):
+        if state.chat_blocked:
             return
 
-        # Room-level mute: blocks sending in this room only.
-        try:
-            room_id = getattr(self.chatroom, 'pk', None)
-            if room_id:
-                room_muted = get_room_muted_seconds(room_id, getattr(self.user, 'id', 0))
-            else:
-                room_muted = 0
+        event_type = (text_data_json.get('type') or '').strip().lower()
+
+        # Room mute, global mute and the per-event rate limit in one round trip.
+        # Message sends add the burst guard (non-staff) and the per-room send
+        # cooldown to the same call; the room-wide quota is the only limit
+        # checked later, once the message has passed validation.
+        send_body = '' if event_type in _WS_CONTROL_EVENTS else (text_data_json.get('body') or '').strip()
+        is_command = send_body.lower().split(' ', 1)[0] == '!sc'
+        if event_type == 'typing':
+            event_check = LimitCheck(
+                make_key('ws_typing', self.chatroom_name, self.user.id),
+                int(getattr(settings, 'WS_TYPING_RATE_LIMIT', 12)),
+                int(getattr(settings, 'WS_TYPING_RATE_PERIOD', 10)),
+            )
+        else:
+            event_check = LimitCheck(
+                make_key('ws_event', self.chatroom_name, self.user.id),
+                int(getattr(settings, 'WS_MSG_RATE_LIMIT', 8)),
+                int(getattr(settings, 'WS_MSG_RATE_PERIOD', 10)),
+            )
+        checks = [event_check]
+        burst_idx = cd_idx = None
+        if send_body and not getattr(self.user, 'is_staff', False):
+            burst_idx = len(checks)
+            checks.append(LimitCheck(
+                make_key('chat_burst', self.chatroom_name, self.user.id),
+                int(getattr(settings, 'CHAT_BURST_MSG_LIMIT', 5)),
+                int(getattr(settings, 'CHAT_BURST_MSG_PERIOD', 3)),
+            ))
+        if send_body and not is_command:
+            # Meme Central: 3s between sends; Free Promotion: a strict 60s.
+            cd_period = 0
+            if is_meme_central_room(self.chatroom):
+                cd_period = 3
+            elif is_free_promotion_room(self.chatroom):
+                cd_period = 60
+            if cd_period:
+                cd_idx = len(checks)
+                checks.append(LimitCheck(make_key('chat_cd', self.chatroom_name, self.user.id), 1, cd_period))
+        room_id = getattr(self.chatroom, 'pk', None)
+        user_id = getattr(self.user, 'id', 0)
+        try:
+            gate = check_event_limits(
+                checks,
+                mute_keys=[room_mute_key(room_id or 0, user_id), mute_key(user_id)],
+            )
+            room_muted, muted = gate.mutes
+            results = list(gate.results)
         except Exception:
-            room_muted = 0
+            room_muted = get_room_muted_seconds(room_id, user_id) if room_id else 0
+            muted = get_muted_seconds(user_id)
+            results = [check_rate_limit(c.key, limit=c.limit, period_seconds=c.period_seconds) for c in checks]
+        event_rl = results[0]
+        burst_rl = results[burst_idx] if burst_idx is not None else None
+        cd_rl = results[cd_idx] if cd_idx is not None else None
+
+        # Room-level mute: blocks sending in this room only.
         if room_muted > 0:
             self._send_cooldown(room_muted, reason='room_muted')
             return
 
-        muted = get_muted_seconds(getattr(self.user, 'id', 0))
         if muted > 0:
             self._send_cooldown(muted, reason='muted')
             return
 
-        event_type = (text_data_json.get('type') or '').strip().lower()
-
         # Room setting: only admins can send messages.
         try:
             admin_only = bool(getattr(self.chatroom, 'is_private', False) and getattr(self.chatroom, 'only_admins_can_send', False))
@@ -1389,21 +1375,13 @@ class ChatroomConsumer(WebsocketConsumer):
         # After a limited number of messages, require verified email to continue sending.
         # (Typing events are still allowed.)
         if event_type != 'typing' and not getattr(self.user, 'is_staff', False):
-            try:
-                qs = getattr(self.user, 'emailaddress_set', None)
-                verified = bool(qs and qs.filter(verified=True).exists())
-            except Exception:
-                verified = False
-
-            if not verified:
+            if not state.verified:
                 try:
                     limit = int(getattr(settings, 'UNVERIFIED_CHAT_MESSAGE_LIMIT', 3))
-                    sent = GroupMessage.objects.filter(author=self.user).count()
                 except Exception:
-                    sent = 10**9
                     limit = 3
 
-                if sent >= limit:
+                if state.sent_count >= limit:
                     try:
                         self.send(text_data=json.dumps({
                             'type': 'verify_required',
@@ -1413,11 +1391,9 @@ class ChatroomConsumer(WebsocketConsumer):
                         pass
                     return
 
-        # Rate limit websocket event spam.
+        # Rate limit websocket event spam (evaluated above together with the mutes).
+        rl = event_rl
         if event_type == 'typing':
-            limit = int(getattr(settings, 'WS_TYPING_RATE_LIMIT', 12))
-            period = int(getattr(settings, 'WS_TYPING_RATE_PERIOD', 10))
-            rl = check_rate_limit(make_key('ws_typing', self.chatroom_name, self.user.id), limit=limit, period_seconds=period)
             if not rl.allowed:
                 _strikes, muted_remaining = record_abuse_violation(
                     scope='ws_typing',
@@ -1431,9 +1407,6 @@ class ChatroomConsumer(WebsocketConsumer):
                     self._send_cooldown(muted_remaining, reason='muted')
                 return
         else:
-            limit = int(getattr(settings, 'WS_MSG_RATE_LIMIT', 8))
-            period = int(getattr(settings, 'WS_MSG_RATE_PERIOD', 10))
-            rl = check_rate_limit(make_key('ws_event', self.chatroom_name, self.user.id), limit=limit, period_seconds=period)
             if not rl.allowed:
                 _strikes, muted_remaining = record_abuse_violation(
                     scope='ws_event',
@@ -1472,19 +1445,19 @@ class ChatroomConsumer(WebsocketConsumer):
             return
 
         # Burst spam guard (WS path): 6th message within 3s => 10s mute.
-        if not getattr(self.user, 'is_staff', False):
-            burst_limit = int(getattr(settings, 'CHAT_BURST_MSG_LIMIT', 5))
-            burst_period = int(getattr(settings, 'CHAT_BURST_MSG_PERIOD', 3))
+        if burst_rl is not None and not burst_rl.allowed:
             burst_cooldown = int(getattr(settings, 'CHAT_BURST_COOLDOWN_SECONDS', 10))
-            burst_key = make_key('chat_burst', self.chatroom_name, self.user.id)
-            burst = check_rate_limit(burst_key, limit=burst_limit, period_seconds=burst_period)
-            if not burst.allowed:
-                try:
-                    set_muted(self.user.id, burst_cooldown)
-                except Exception:
-                    pass
-                self._send_cooldown(burst_cooldown, reason='muted')
-                return
+            try:
+                set_muted(self.user.id, burst_cooldown)
+            except Exception:
+                pass
+            self._send_cooldown(burst_cooldown, reason='muted')
+            return
+
+        # Per-room send cooldown (Meme Central / Free Promotion), evaluated in the gate above.
+        if cd_rl is not None and not cd_rl.allowed:
+            self._send_cooldown(cd_rl.retry_after, reason='cooldown')
+            return
 
         # Commands: scoreboard
         # !sc -> your wins total
@@ -1584,13 +1557,15 @@ class ChatroomConsumer(WebsocketConsumer):
                     pass
                 return
 
-        # AI moderation (Gemini) for WS-created messages.
+        # AI moderation (Gemini) for WS-created messages. Only the inline mode
+        # classifies before saving; other modes review after delivery (see below).
         pending_moderation = None
-        if (
+        ai_moderation = bool(
             body
             and int(getattr(settings, 'AI_MODERATION_ENABLED', 0))
             and not getattr(self.user, 'is_staff', False)
-        ):
+        )
+        if ai_moderation and not moderation_pipeline.is_async_mode():
             try:
                 last_user_msgs = list(
                     self.chatroom.chat_messages.filter(author=self.user)
@@ -1609,19 +1584,8 @@ class ChatroomConsumer(WebsocketConsumer):
                 'last_user_messages': list(reversed(list(last_user_msgs))),
             }
 
-            decision = moderate_message(text=body, context=ctx)
-            action = decision.action
-
-            block_min = int(getattr(settings, 'AI_BLOCK_MIN_SEVERITY', 2))
-            flag_min = int(getattr(settings, 'AI_FLAG_MIN_SEVERITY', 1))
-            min_conf = float(getattr(settings, 'AI_MIN_CONFIDENCE', 0.55))
-
-            if decision.confidence < min_conf:
-                action = 'allow'
-            elif decision.severity >= block_min:
-                action = 'block'
-            elif decision.severity >= flag_min:
-                action = 'flag'
+            decision = moderation_pipeline.moderate_cached(body, ctx)
+            action = moderation_pipeline.resolve_action(decision)
 
             log_all = bool(int(getattr(settings, 'AI_LOG_ALL', 0)))
             if log_all or action == 'flag':
@@ -1691,7 +1655,8 @@ class ChatroomConsumer(WebsocketConsumer):
                 self._send_cooldown(auto_muted, reason='muted')
             return
 
-        # Room-wide flood protection (WS direct send).
+        # Room-wide flood protection (WS direct send). Checked only now, so
+        # commands and messages rejected above don't use up the room's quota.
         room_rl = check_rate_limit(
             make_key('room_msg', self.chatroom_name),
             limit=int(getattr(settings, 'ROOM_MSG_RATE_LIMIT', 30)),
@@ -1772,35 +1737,14 @@ class ChatroomConsumer(WebsocketConsumer):
                         reply_to_pk = None
                     if reply_to_pk:
                         reply_to = GroupMessage.objects.filter(pk=reply_to_pk, group=self.chatroom).first()
-        
-                # Meme Central: enforce a per-message cooldown.
-                if is_meme_central_room(self.chatroom):
-                    cd = check_rate_limit(
-                        make_key('chat_cd', self.chatroom_name, self.user.id),
-                        limit=1,
-                        period_seconds=3,
-                    )
-                    if not cd.allowed:
-                        self._send_cooldown(cd.retry_after, reason='cooldown')
-                        return
 
-                # Free Promotion: enforce a strict 60-second cooldown between sends.
-                if is_free_promotion_room(self.chatroom):
-                    cd = check_rate_limit(
-                        make_key('chat_cd', self.chatroom_name, self.user.id),
-                        limit=1,
-                        period_seconds=60,
-                    )
-                    if not cd.allowed:
-                        self._send_cooldown(cd.retry_after, reason='cooldown')
-                        return
-        
         message = GroupMessage.objects.create(
             body = body,
             author = self.user,
             group = self.chatroom,
             reply_to=reply_to,
         )
+        state.sent_count += 1
 
         # Best-effort: if user didn't allow GPS location, store approximate city/country from IP
         # when they send their first message.
@@ -1814,12 +1758,9 @@ class ChatroomConsumer(WebsocketConsumer):
         # so it can lock the composer without requiring an extra send attempt.
         try:
             if not getattr(self.user, 'is_staff', False):
-                qs = getattr(self.user, 'emailaddress_set', None)
-                verified = bool(qs and qs.filter(verified=True).exists())
-                if not verified:
+                if not state.verified:
                     limit = int(getattr(settings, 'UNVERIFIED_CHAT_MESSAGE_LIMIT', 3))
-                    sent = GroupMessage.objects.filter(author=self.user).count()
-                    if sent >= limit:
+                    if state.sent_count >= limit:
                         self.send(text_data=json.dumps({
                             'type': 'verify_required',
                             'reason': 'Verify your email to continue chatting.',
@@ -1827,24 +1768,6 @@ class ChatroomConsumer(WebsocketConsumer):
         except Exception:
             pass
 
-        # Retention: keep only the newest messages per room (best-effort).
-        # Public/group rooms and private rooms can use different caps.
-        try:
-            from a_rtchat.retention import trim_chat_group_messages
-
-            is_private = bool(getattr(self.chatroom, 'is_private', False))
-            if is_private:
-                keep_last = int(getattr(settings, 'PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', 1000))
-            else:
-                keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
-
-            trim_chat_group_messages(
-                chat_group_id=getattr(self.chatroom, 'id', 0),
-                keep_last=max(1, keep_last),
-            )
-        except Exception:
-            pass
-
         # Public chat bot (Natasha): reply occasionally, async.
         try:
             if (getattr(self.chatroom, 'group_name', '') == 'public-chat'):
@@ -1855,22 +1778,13 @@ class ChatroomConsumer(WebsocketConsumer):
         except Exception:
             pass
 
-        # Best-effort link preview (kept intentionally lightweight).
+        # Best-effort link preview: applied now when cached, otherwise fetched in the
+        # background and pushed as a message_update (never delays delivery).
         try:
             is_gif, _gif_url = self._parse_gif_message(body)
-            if not is_gif:
-                url = extract_first_http_url(body)
-                preview = fetch_link_preview(url) if url else None
-            else:
-                preview = None
-
-            if preview:
-                message.link_url = preview.url
-                message.link_title = preview.title
-                message.link_description = preview.description
-                message.link_image = preview.image
-                message.link_site_name = preview.site_name
-                message.save(update_fields=['link_url', 'link_title', 'link_description', 'link_image', 'link_site_name'])
+            url = extract_first_http_url(body) if not is_gif else ''
+            if url:
+                attach_or_schedule(message, url)
         except Exception:
             pass
 
@@ -1886,32 +1800,31 @@ class ChatroomConsumer(WebsocketConsumer):
                     member_ids = set(self.chatroom.members.values_list('id', flat=True))
 
                 preview = (body or '')[:140]
-                for u in mentioned:
-                    if not getattr(u, 'id', None) or u.id == getattr(self.user, 'id', None):
-                        continue
-                    if member_ids is not None and u.id not in member_ids:
-                        continue
-
-                    # Persist notification only if the user is offline (not connected in any chat WS).
-                    try:
-                        from a_rtchat.notifications import should_persist_notification
+                room_name = getattr(self.chatroom, 'group_name', self.chatroom_name) or self.chatroom_name
+                targets = [
+                    u for u in mentioned
+                    if getattr(u, 'id', None) and u.id != getattr(self.user, 'id', None)
+                    and (member_ids is None or u.id in member_ids)
+                ]
 
-                        if should_persist_notification(
-                            user_id=u.id,
-                            chatroom_name=getattr(self.chatroom, 'group_name', self.chatroom_name) or self.chatroom_name,
-                        ) or bool(getattr(self.chatroom, 'is_private', False)):
-                            Notification.objects.create(
-                                user=u,
-                                from_user=self.user,
-                                type='mention',
-                                chatroom_name=getattr(self.chatroom, 'group_name', self.chatroom_name) or self.chatroom_name,
-                                message_id=message.id,
-                                preview=preview,
-                                url=f"/chat/room/{(getattr(self.chatroom, 'group_name', self.chatroom_name) or self.chatroom_name) }#msg-{message.id}",
-                            )
-                    except Exception:
-                        pass
+                # Persist for every mentioned user with one state query + one insert.
+                try:
+                    from a_rtchat.notifications import notify_many
+
+                    notify_many(
+                        [u.id for u in targets],
+                        type='mention',
+                        from_user=self.user,
+                        chatroom_name=room_name,
+                        message_id=message.id,
+                        preview=preview,
+                        url=f"/chat/room/{room_name}#msg-{message.id}",
+                        always_persist=bool(getattr(self.chatroom, 'is_private', False)),
+                    )
+                except Exception:
+                    pass
 
+                for u in targets:
                     async_to_sync(self.channel_layer.group_send)(
                         f"notify_user_{u.id}",
                         {
@@ -1925,15 +1838,14 @@ class ChatroomConsumer(WebsocketConsumer):
 
                     # Optional: push notification via FCM (offline / background)
                     try:
-                        from a_users.tasks import send_mention_push_task
-
-                        if _celery_broker_configured():
-                            send_mention_push_task.delay(
-                                u.id,
-                                from_username=getattr(self.user, 'username', '') or '',
-                                chatroom_name=getattr(self.chatroom, 'group_name', self.chatroom_name) or self.chatroom_name,
-                                preview=preview,
-                            )
+                        from a_users.push import enqueue_mention
+
+                        enqueue_mention(
+                            u.id,
+                            from_username=getattr(self.user, 'username', '') or '',
+                            chatroom_name=getattr(self.chatroom, 'group_name', self.chatroom_name) or self.chatroom_name,
+                            preview=preview,
+                        )
                     except Exception:
                         pass
         except Exception:
@@ -1960,17 +1872,20 @@ class ChatroomConsumer(WebsocketConsumer):
                     'via': 'ws',
                 },
             )
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-            'author_id': getattr(self.user, 'id', None),
-        }
-        if client_nonce:
-            event['client_nonce'] = client_nonce
+        event = message_event(
+            message,
+            self.chatroom,
+            author_id=getattr(self.user, 'id', None),
+            client_nonce=client_nonce,
+        )
         async_to_sync(self.channel_layer.group_send)(
             self.room_group_name, event
         )
 
+        # Optimistic moderation: already delivered, retracted if the verdict is a block.
+        if ai_moderation:
+            moderation_pipeline.submit(message.id, via='ws')
+
         # Reply notification (best-effort)
         try:
             if reply_to and getattr(reply_to, 'author_id', None) and reply_to.author_id != getattr(self.user, 'id', None):
@@ -1980,18 +1895,18 @@ class ChatroomConsumer(WebsocketConsumer):
 
                 # Persist only if the user is not online in this chat.
                 try:
-                    from a_rtchat.notifications import should_persist_notification
-
-                    if should_persist_notification(user_id=target_id, chatroom_name=room_name) or bool(getattr(self.chatroom, 'is_private', False)):
-                        Notification.objects.create(
-                            user_id=target_id,
-                            from_user=self.user,
-                            type='reply',
-                            chatroom_name=room_name,
-                            message_id=message.id,
-                            preview=preview,
-                            url=f"/chat/room/{room_name}#msg-{message.id}",
-                        )
+                    from a_rtchat.notifications import notify_many
+
+                    notify_many(
+                        [target_id],
+                        type='reply',
+                        from_user=self.user,
+                        chatroom_name=room_name,
+                        message_id=message.id,
+                        preview=preview,
+                        url=f"/chat/room/{room_name}#msg-{message.id}",
+                        always_persist=bool(getattr(self.chatroom, 'is_private', False)),
+                    )
                 except Exception:
                     pass
 
@@ -2027,8 +1942,31 @@ class ChatroomConsumer(WebsocketConsumer):
 
         if event.get('skip_sender') and event.get('author_id') == getattr(self.user, 'id', None):
             return
+
+        # Render-once fan-out: the sender already rendered every viewer role,
+        # so recipients only pick their variant (no DB, no template render).
+        rendered = event.get('rendered')
+        if rendered:
+            html = select_rendered_html(
+                rendered,
+                viewer_id=getattr(self.user, 'id', None),
+                viewer_is_staff=bool(getattr(self.user, 'is_staff', False)),
+            )
+            if html:
+                payload = {
+                    'type': 'chat_message',
+                    'html': html,
+                }
+                if event.get('client_nonce'):
+                    payload['client_nonce'] = event.get('client_nonce')
+                if event.get('author_id'):
+                    payload['author_id'] = event.get('author_id')
+                self.send(text_data=json.dumps(payload))
+                return
+
         message_id = event['message_id']
-        message = GroupMessage.objects.get(id=message_id)
+        message = GroupMessage.objects.select_related('reply_to').get(id=message_id)
+        author_cards.attach([message])
         attach_auto_badges([message], self.chatroom)
         _attach_poll_card_for_message(message, self.user)
         reaction_emojis = _reaction_context_for(message, self.user)
@@ -2116,9 +2054,10 @@ class ChatroomConsumer(WebsocketConsumer):
         message_id = event.get('message_id')
         if not message_id:
             return
-        message = GroupMessage.objects.filter(id=message_id).first()
+        message = GroupMessage.objects.select_related('reply_to').filter(id=message_id).first()
         if not message:
             return
+        author_cards.attach([message])
         attach_auto_badges([message], self.chatroom)
         _attach_poll_card_for_message(message, self.user)
         reaction_emojis = _reaction_context_for(message, self.user)
@@ -2189,13 +2128,11 @@ class ChatroomConsumer(WebsocketConsumer):
         
         
     def update_online_count(self):
-        # Best-effort cleanup to avoid "ghost" online users.
+        # Stale ("ghost") users drop out on their own once their heartbeat expires.
         try:
-            self._cleanup_stale_online_users()
+            online_count = presence.count(self.chatroom)
         except Exception:
-            pass
-
-        online_count = self.chatroom.users_online.count()
+            online_count = 0
         
         event = {
             'type': 'online_count_handler',
@@ -2265,7 +2202,7 @@ class ChatroomConsumer(WebsocketConsumer):
         }))
         
         
-class OnlineStatusConsumer(WebsocketConsumer):
+class OnlineStatusConsumer(ProfiledConsumerMixin, WebsocketConsumer):
     def _active_start_key(self) -> str:
         return f"online_status_active_start:{getattr(self.user, 'id', 0)}"
 
@@ -2330,45 +2267,6 @@ class OnlineStatusConsumer(WebsocketConsumer):
         except Exception:
             return
 
-    def _conn_key(self) -> str:
-        return f"online_status_conn:{getattr(self.user, 'id', 0)}"
-
-    def _inc_conn(self) -> int:
-        key = self._conn_key()
-        try:
-            val = cache.get(key)
-            if val is None:
-                cache.set(key, 1, timeout=60 * 60)
-                return 1
-            new_val = int(val) + 1
-            cache.set(key, new_val, timeout=60 * 60)
-            return new_val
-        except Exception:
-            try:
-                cache.set(key, 1, timeout=60 * 60)
-            except Exception:
-                pass
-            return 1
-
-    def _dec_conn(self) -> int:
-        key = self._conn_key()
-        try:
-            val = cache.get(key)
-            if val is None:
-                return 0
-            new_val = max(0, int(val) - 1)
-            if new_val <= 0:
-                cache.delete(key)
-            else:
-                cache.set(key, new_val, timeout=60 * 60)
-            return new_val
-        except Exception:
-            try:
-                cache.delete(key)
-            except Exception:
-                pass
-            return 0
-
     def connect(self):
         self._ws_bucket = None
         self._ws_global_inc = False
@@ -2402,27 +2300,21 @@ class OnlineStatusConsumer(WebsocketConsumer):
             except Exception:
                 self.close()
             return
-        self.group_name = 'online-status'
-        try:
-            self.group, _ = ChatGroup.objects.get_or_create(group_name=self.group_name)
-        except Exception:
-            try:
-                self.close(code=1011)
-            except Exception:
-                self.close()
-            return
+        self.group_name = presence.ONLINE_STATUS_ROOM
 
         # Connection counting prevents flicker when navigating (old socket closes
         # after the new page opens a new socket).
-        new_count = self._inc_conn()
+        try:
+            new_count = presence.join(self.group_name, self.user)
+        except Exception:
+            new_count = 1
         if new_count == 1:
+            # Start activity window when the first tab connects.
+            self._set_active_start_if_missing()
             try:
-                if self.user not in self.group.users_online.all():
-                    self.group.users_online.add(self.user.pk)
+                presence_broadcast.schedule()
             except Exception:
                 pass
-            # Start activity window when the first tab connects.
-            self._set_active_start_if_missing()
             
         try:
             async_to_sync(self.channel_layer.group_add)(
@@ -2443,8 +2335,24 @@ class OnlineStatusConsumer(WebsocketConsumer):
             self._ws_bucket_inc = False
             return
 
+        # Per-viewer state: the people this user chats with, loaded once per socket
+        # so later presence deltas never need a DB query.
         try:
-            self.online_status()
+            self._chat_partner_ids = self._load_chat_partner_ids()
+        except Exception:
+            self._chat_partner_ids = set()
+        self._online_partner_ids = set()
+
+        try:
+            # Only the total and this viewer's online partners; never the whole list.
+            snap = presence_broadcast.get_snapshot()
+            visible = set(int(x) for x in (snap.get('visible') or []))
+            self._send_online_state(
+                total=int(snap.get('total') or 0),
+                added=sorted(self._chat_partner_ids & visible),
+                removed=[],
+                full=True,
+            )
         except Exception:
             # Never crash the consumer from a presence update.
             pass
@@ -2458,6 +2366,15 @@ class OnlineStatusConsumer(WebsocketConsumer):
             return
         event_type = (payload.get('type') or '').strip().lower()
         if event_type in {'ping', 'heartbeat'}:
+            try:
+                presence.touch(self.group_name, self.user)
+            except Exception:
+                pass
+            # Users whose sockets died silently only drop out here.
+            try:
+                presence_broadcast.check_expired()
+            except Exception:
+                pass
             try:
                 self.send(text_data=json.dumps({'type': 'pong'}))
             except Exception:
@@ -2469,18 +2386,14 @@ class OnlineStatusConsumer(WebsocketConsumer):
         _ws_leave(getattr(self, '_ws_bucket', None), bool(getattr(self, '_ws_global_inc', False)), bool(getattr(self, '_ws_bucket_inc', False)))
         self._ws_global_inc = False
         self._ws_bucket_inc = False
+        if not getattr(getattr(self, 'user', None), 'is_authenticated', False) or not getattr(self, 'group_name', None):
+            return
         try:
-            new_count = self._dec_conn()
+            new_count = presence.leave(self.group_name, self.user)
         except Exception:
             new_count = 0
 
         if new_count <= 0:
-            try:
-                if self.user in self.group.users_online.all():
-                    self.group.users_online.remove(self.user.pk)
-            except Exception:
-                pass
-
             # End activity window when the last tab disconnects.
             try:
                 start_ts = self._pop_active_start()
@@ -2490,86 +2403,61 @@ class OnlineStatusConsumer(WebsocketConsumer):
             except Exception:
                 pass
             
+            try:
+                presence_broadcast.schedule()
+            except Exception:
+                pass
+            
         async_to_sync(self.channel_layer.group_discard)(
             self.group_name, self.channel_name
         )
-        self.online_status()
         
         
-    def online_status(self):
-        event = {
-            'type': 'online_status_handler'
-        }
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name, event
-        ) 
-        
-    def online_status_handler(self, event):
-        try:
-            total_online = 0
-            try:
-                total_online = self.group.users_online.count()
-            except Exception:
-                total_online = 0
-
-            # Stealth mode: hide users who opted to appear offline.
-            stealth_ids = set()
-            try:
-                if not bool(getattr(self.user, 'is_staff', False)):
-                    from a_users.models import Profile
-
-                    stealth_ids = set(
-                        Profile.objects.filter(is_stealth=True).values_list('user_id', flat=True)
-                    )
-            except Exception:
-                stealth_ids = set()
-
-            online_users = self.group.users_online.exclude(id=self.user.id)
-            if stealth_ids:
-                online_users = online_users.exclude(id__in=stealth_ids)
-
-            # Public chat group might not exist in a fresh DB; don't crash the socket.
-            public_chat_users = []
-            try:
-                public_group = ChatGroup.objects.filter(group_name='public-chat').first()
-                if public_group:
-                    public_chat_users = public_group.users_online.exclude(id=self.user.id)
-                    if stealth_ids:
-                        public_chat_users = public_chat_users.exclude(id__in=stealth_ids)
-            except Exception:
-                public_chat_users = []
-
-            my_chats = self.user.chat_groups.all()
+    def _load_chat_partner_ids(self) -> set[int]:
+        my_chats = self.user.chat_groups.filter(Q(is_private=True) | Q(groupchat_name__isnull=False))
+        partner_ids = (
+            get_user_model().objects.filter(chat_groups__in=my_chats)
+            .exclude(id=self.user.id)
+            .values_list('id', flat=True)
+            .distinct()
+        )
+        return set(int(x) for x in partner_ids)
 
-            def _has_visible_other_online(chat) -> bool:
-                try:
-                    qs = chat.users_online.exclude(id=self.user.id)
-                    if stealth_ids:
-                        qs = qs.exclude(id__in=stealth_ids)
-                    return qs.exists()
-                except Exception:
-                    return False
+    def _send_online_state(self, *, total: int, added, removed, full: bool = False) -> None:
+        # Only ids this viewer cares about (chat partners) go out on the socket,
+        # so the payload does not grow with the number of online users.
+        partners = getattr(self, '_chat_partner_ids', set())
+        added = [int(x) for x in (added or []) if int(x) in partners]
+        removed = [int(x) for x in (removed or []) if int(x) in partners]
 
-            private_chats_with_users = [chat for chat in my_chats.filter(is_private=True) if _has_visible_other_online(chat)]
-            group_chats_with_users = [chat for chat in my_chats.filter(groupchat_name__isnull=False) if _has_visible_other_online(chat)]
+        if full:
+            self._online_partner_ids = set()
+        self._online_partner_ids -= set(removed)
+        self._online_partner_ids |= set(added)
 
-            online_in_chats = bool(public_chat_users or private_chats_with_users or group_chats_with_users)
+        self.send(text_data=json.dumps({
+            'type': 'online_status',
+            'full': bool(full),
+            'total_online': int(total),
+            'added': added,
+            'removed': removed,
+            'online_in_chats': bool(self._online_partner_ids),
+        }))
 
-            context = {
-                'online_users': online_users,
-                'online_in_chats': online_in_chats,
-                'public_chat_users': public_chat_users,
-                'total_online': total_online,
-                'user': self.user
-            }
-            html = render_to_string("a_rtchat/partials/online_status.html", context=context)
-            self.send(text_data=html)
+    def online_status_handler(self, event):
+        """Apply one coalesced presence delta (see a_rtchat.presence_broadcast)."""
+        try:
+            self._send_online_state(
+                total=int(event.get('total') or 0),
+                added=event.get('added') or [],
+                removed=event.get('removed') or [],
+            )
         except Exception:
-            # Never let a render/db issue crash the online-status consumer.
+            # Never let a delta crash the online-status consumer.
             return
 
 
-class NotificationsConsumer(WebsocketConsumer):
+class NotificationsConsumer(ProfiledConsumerMixin, WebsocketConsumer):
     """Per-user websocket for global notifications (e.g., call invites).
 
     This allows users to receive incoming call toasts even if they switch to a
@@ -2800,7 +2688,7 @@ class NotificationsConsumer(WebsocketConsumer):
         }))
 
 
-class ProfilePresenceConsumer(WebsocketConsumer):
+class ProfilePresenceConsumer(ProfiledConsumerMixin, WebsocketConsumer):
     """Realtime online/offline for a single user's profile page."""
 
     def connect(self):
@@ -2858,7 +2746,7 @@ class ProfilePresenceConsumer(WebsocketConsumer):
         is_owner = bool(getattr(self.user, 'id', None) == getattr(target, 'id', None))
 
         self.target_id = getattr(target, 'id', None)
-        self.group_name = 'online-status'
+        self.group_name = None
         self.is_owner = bool(is_owner)
 
         self.accept()
@@ -2887,17 +2775,21 @@ class ProfilePresenceConsumer(WebsocketConsumer):
                 pass
             return
 
-        # Subscribe to online-status updates and re-check visibility rules on every event.
-        try:
-            async_to_sync(self.channel_layer.group_add)(
-                self.group_name, self.channel_name
-            )
-        except Exception:
-            pass
+        # Subscribe only to this target's presence flips. Stealth/bot rules are
+        # applied once at publish time (presence_broadcast), so events can be
+        # forwarded as-is. The owner is always online on their own page.
+        if not is_owner:
+            try:
+                self.group_name = presence_broadcast.user_presence_group(self.target_id)
+                async_to_sync(self.channel_layer.group_add)(
+                    self.group_name, self.channel_name
+                )
+            except Exception:
+                self.group_name = None
 
         # Initial state
         try:
-            online = ChatGroup.objects.filter(group_name='online-status', users_online=target).exists()
+            online = presence.is_online(target, presence.ONLINE_STATUS_ROOM)
         except Exception:
             online = False
         try:
@@ -2917,47 +2809,10 @@ class ProfilePresenceConsumer(WebsocketConsumer):
         except Exception:
             pass
 
-    def online_status_handler(self, event):
-        """Recompute target's visible online state whenever the global presence changes."""
+    def presence_handler(self, event):
+        """Target's visible online state flipped (published by presence_broadcast)."""
         try:
-            from a_users.models import Profile
-
-            prof = (
-                Profile.objects
-                .filter(user_id=self.target_id)
-                .values('is_stealth', 'is_bot')
-                .first()
-                or {}
-            )
-            is_bot = bool(prof.get('is_bot', False))
-            is_stealth = bool(prof.get('is_stealth', False))
-
-            # Bots: don't expose presence.
-            if is_bot:
-                try:
-                    self.send(text_data=json.dumps({'type': 'presence', 'online': False}))
-                except Exception:
-                    pass
-                try:
-                    self.close()
-                except Exception:
-                    pass
-                return
-
-            # Stealth: everyone except owner sees offline.
-            if is_stealth and not bool(getattr(self, 'is_owner', False)):
-                try:
-                    self.send(text_data=json.dumps({'type': 'presence', 'online': False}))
-                except Exception:
-                    pass
-                try:
-                    self.close()
-                except Exception:
-                    pass
-                return
-
-            online = bool(ChatGroup.objects.filter(group_name='online-status', users_online_id=self.target_id).exists())
-            self.send(text_data=json.dumps({'type': 'presence', 'online': online}))
+            self.send(text_data=json.dumps({'type': 'presence', 'online': bool(event.get('online'))}))
         except Exception:
             return
 
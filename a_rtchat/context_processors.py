@@ -2,6 +2,9 @@ from __future__ import annotations
 
 from django.conf import settings
 
+from a_core import request_globals
+from a_core.request_globals import for_request, timed
+
 try:
     from a_users.models import UserReport
 except Exception:  # pragma: no cover
@@ -13,32 +16,35 @@ except Exception:  # pragma: no cover
     SupportEnquiry = None
 
 
-def admin_reports_badge(request):
-    """Expose open report count to templates for staff users."""
+def _admin_open_counts() -> dict:
     try:
-        user = getattr(request, 'user', None)
-        if not user or not getattr(user, 'is_authenticated', False):
+        if UserReport is None or SupportEnquiry is None:
             return {'ADMIN_OPEN_REPORTS': 0, 'ADMIN_OPEN_SUPPORT_ENQUIRIES': 0}
-        if not getattr(user, 'is_staff', False):
-            return {'ADMIN_OPEN_REPORTS': 0, 'ADMIN_OPEN_SUPPORT_ENQUIRIES': 0}
-        if UserReport is None:
-            open_reports = 0
-        else:
-            open_reports = UserReport.objects.filter(status=UserReport.STATUS_OPEN).count()
-
-        if SupportEnquiry is None:
-            open_enquiries = 0
-        else:
-            open_enquiries = SupportEnquiry.objects.filter(status=SupportEnquiry.STATUS_OPEN).count()
-
+        counts = request_globals.admin_open_counts()
         return {
-            'ADMIN_OPEN_REPORTS': int(open_reports or 0),
-            'ADMIN_OPEN_SUPPORT_ENQUIRIES': int(open_enquiries or 0),
+            'ADMIN_OPEN_REPORTS': int(counts.get('reports') or 0),
+            'ADMIN_OPEN_SUPPORT_ENQUIRIES': int(counts.get('enquiries') or 0),
         }
     except Exception:
         return {'ADMIN_OPEN_REPORTS': 0, 'ADMIN_OPEN_SUPPORT_ENQUIRIES': 0}
 
 
+@timed
+def admin_reports_badge(request):
+    """Expose open report count to templates for staff users (cached, signal-invalidated)."""
+    user = getattr(request, 'user', None)
+    if not user or not getattr(user, 'is_authenticated', False):
+        return {'ADMIN_OPEN_REPORTS': 0, 'ADMIN_OPEN_SUPPORT_ENQUIRIES': 0}
+    if not getattr(user, 'is_staff', False):
+        return {'ADMIN_OPEN_REPORTS': 0, 'ADMIN_OPEN_SUPPORT_ENQUIRIES': 0}
+    g = for_request(request)
+    return {
+        key: g.lazy('admin_reports_badge', _admin_open_counts, key)
+        for key in ('ADMIN_OPEN_REPORTS', 'ADMIN_OPEN_SUPPORT_ENQUIRIES')
+    }
+
+
+@timed
 def mobile_ads_config(request):
     """Expose mobile ads config to templates.
 
@@ -99,16 +105,25 @@ def mobile_ads_config(request):
         }
 
 
-def global_announcement(request):
-    """Expose the current active global announcement (staff-set) to templates."""
+def _announcement() -> dict:
     try:
-        from a_rtchat.models import GlobalAnnouncement
-
-        ann = GlobalAnnouncement.objects.filter(is_active=True).order_by('-updated_at').first()
-        prefix = (getattr(ann, 'prefix', '') or '').strip() or 'Team Vixogram:'
-        msg = (getattr(ann, 'message', '') or '').strip()
-        if not msg:
-            return {'GLOBAL_ANNOUNCEMENT_PREFIX': prefix, 'GLOBAL_ANNOUNCEMENT_MESSAGE': ''}
-        return {'GLOBAL_ANNOUNCEMENT_PREFIX': prefix, 'GLOBAL_ANNOUNCEMENT_MESSAGE': msg}
+        ann = request_globals.announcement()
+        return {
+            'GLOBAL_ANNOUNCEMENT_PREFIX': ann.get('prefix') or 'Team Vixogram:',
+            'GLOBAL_ANNOUNCEMENT_MESSAGE': ann.get('message') or '',
+        }
     except Exception:
         return {'GLOBAL_ANNOUNCEMENT_PREFIX': 'Team Vixogram:', 'GLOBAL_ANNOUNCEMENT_MESSAGE': ''}
+
+
+@timed
+def global_announcement(request):
+    """Expose the current active global announcement (staff-set) to templates.
+
+    Cached site-wide; GlobalAnnouncement saves/deletes drop the cache entry.
+    """
+    g = for_request(request)
+    return {
+        key: g.lazy('global_announcement', _announcement, key)
+        for key in ('GLOBAL_ANNOUNCEMENT_PREFIX', 'GLOBAL_ANNOUNCEMENT_MESSAGE')
+    }
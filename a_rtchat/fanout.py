@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.template.loader import render_to_string
+
+from .models import ChatReadState, GroupMessage, MessageReaction
+from .auto_badges import attach_auto_badges
+from a_users import author_cards
+
+
+# Viewer roles a freshly-created message can be shown to. Everything else in
+# `chat_message.html` is viewer-neutral for a brand-new message (no votes, no
+# one-time opens yet), so one render per role covers every socket in the room.
+ROLE_OWN = 'own'
+ROLE_OTHER = 'other'
+ROLE_STAFF = 'staff'
+
+
+def render_once_enabled() -> bool:
+    try:
+        return bool(getattr(settings, 'CHAT_RENDER_ONCE_FANOUT', True))
+    except Exception:
+        return False
+
+
+def _reaction_emojis() -> list[str]:
+    return list(getattr(settings, 'CHAT_REACTION_EMOJIS', ['👍', '❤️', '😂', '😮', '😢', '🙏']))
+
+
+def _neutral_reaction_state(message, emojis):
+    """Return (pills, reacted_by) where pills are rendered as not-reacted.
+
+    `reacted_by` maps emoji -> [user_id, ...] so recipients can flip their own
+    `reacted` flag without touching the DB.
+    """
+    reacted_by: dict[str, list[int]] = {}
+    for row in (
+        MessageReaction.objects.filter(message=message, emoji__in=emojis)
+        .values_list('emoji', 'user_id')
+    ):
+        reacted_by.setdefault(row[0], []).append(int(row[1]))
+
+    pills = []
+    for emoji in emojis:
+        users = reacted_by.get(emoji) or []
+        if users:
+            pills.append({'emoji': emoji, 'count': len(set(users)), 'reacted': False})
+    return pills, reacted_by
+
+
+def _other_last_read_id(message, chat_group) -> int:
+    """Read-receipt state for the author's own bubble (private rooms only)."""
+    if not getattr(chat_group, 'is_private', False):
+        return 0
+    try:
+        other_id = (
+            chat_group.members.exclude(id=getattr(message, 'author_id', None))
+            .values_list('id', flat=True)
+            .first()
+        )
+        if not other_id:
+            return 0
+        return int(
+            ChatReadState.objects.filter(user_id=other_id, group=chat_group)
+            .values_list('last_read_message_id', flat=True)
+            .first()
+            or 0
+        )
+    except Exception:
+        return 0
+
+
+def build_rendered_message(message, chat_group, *, include_own: bool = True) -> dict | None:
+    """Render a new message once per viewer role.
+
+    Returns a payload suitable for the channel layer:
+    {'message_id', 'author_id', 'html': {role: html}, 'reactions', 'reacted_by'}
+    or None on failure.
+    """
+    try:
+        from .consumers import _attach_poll_card_for_message
+
+        message = (
+            GroupMessage.objects
+            .select_related('reply_to', 'poll')
+            .get(id=getattr(message, 'id', message))
+        )
+        author_cards.attach([message])
+        emojis = _reaction_emojis()
+        attach_auto_badges([message], chat_group)
+        # Viewer-neutral poll card: counts are shared, nobody's own vote is selected.
+        _attach_poll_card_for_message(message, None)
+        pills, reacted_by = _neutral_reaction_state(message, emojis)
+        message.reaction_pills = pills
+        message.one_time_viewed_by_me = False
+
+        from a_users.badges import get_verified_user_ids
+
+        base_context = {
+            'message': message,
+            'chat_group': chat_group,
+            'reaction_emojis': emojis,
+            'other_last_read_id': 0,
+            'verified_user_ids': get_verified_user_ids([getattr(message, 'author_id', None)]),
+        }
+
+        User = get_user_model()
+        viewers = {
+            ROLE_OTHER: User(is_staff=False),
+            ROLE_STAFF: User(is_staff=True),
+        }
+        if include_own:
+            viewers[ROLE_OWN] = message.author
+
+        rendered = {}
+        for role, viewer in viewers.items():
+            context = dict(base_context, user=viewer)
+            if role == ROLE_OWN:
+                context['other_last_read_id'] = _other_last_read_id(message, chat_group)
+            rendered[role] = render_to_string('a_rtchat/chat_message.html', context=context)
+    except Exception:
+        return None
+
+    return {
+        'message_id': int(message.id),
+        'author_id': int(getattr(message, 'author_id', 0) or 0),
+        'html': rendered,
+        'reactions': pills,
+        'reacted_by': reacted_by,
+    }
+
+
+def message_event(
+    message,
+    chat_group,
+    *,
+    author_id=None,
+    skip_sender: bool = False,
+    client_nonce: str | None = None,
+) -> dict:
+    """Build the `message_handler` channel-layer event for a new message.
+
+    With CHAT_RENDER_ONCE_FANOUT enabled the event carries pre-rendered HTML so
+    recipients never query the DB; otherwise (or if rendering fails) it carries
+    only the id and each socket renders for itself.
+    """
+    event = {
+        'type': 'message_handler',
+        'message_id': getattr(message, 'id', message),
+    }
+    if author_id:
+        event['author_id'] = author_id
+    if skip_sender:
+        event['skip_sender'] = True
+    if client_nonce:
+        event['client_nonce'] = client_nonce
+
+    if render_once_enabled() and chat_group is not None:
+        rendered = build_rendered_message(message, chat_group, include_own=not skip_sender)
+        if rendered:
+            event['rendered'] = rendered
+    return event
+
+
+def role_variant(rendered: dict, *, viewer_id, viewer_is_staff: bool) -> str | None:
+    """Raw pre-rendered HTML for one recipient's role (None if it wasn't rendered)."""
+    variants = rendered.get('html') or {}
+    try:
+        is_own = bool(viewer_id) and int(viewer_id) == int(rendered.get('author_id') or 0)
+    except Exception:
+        is_own = False
+
+    if is_own:
+        return variants.get(ROLE_OWN) or None
+    if viewer_is_staff:
+        return variants.get(ROLE_STAFF) or None
+    return variants.get(ROLE_OTHER) or None
+
+
+def select_rendered_html(rendered: dict, *, viewer_id, viewer_is_staff: bool) -> str | None:
+    """Pick the role variant for one recipient and apply per-viewer patches."""
+    html = role_variant(rendered, viewer_id=viewer_id, viewer_is_staff=viewer_is_staff)
+    if not html:
+        return None
+
+    reacted_by = rendered.get('reacted_by') or {}
+    mine = {emoji for emoji, ids in reacted_by.items() if viewer_id and int(viewer_id) in set(ids or [])}
+    if mine:
+        html = patch_reacted_pills(html, rendered.get('message_id'), rendered.get('reactions') or [], mine)
+    return html
+
+
+def patch_reacted_pills(html: str, message_id, pills: list, mine: set) -> str:
+    """Swap the neutral reactions bar in `html` for one with `mine` marked as reacted."""
+    neutral = render_to_string('a_rtchat/partials/reactions_bar.html', {
+        'message': {'id': message_id, 'reaction_pills': pills},
+    })
+    patched = render_to_string('a_rtchat/partials/reactions_bar.html', {
+        'message': {
+            'id': message_id,
+            'reaction_pills': [dict(p, reacted=p.get('emoji') in mine) for p in pills],
+        },
+    })
+    return html.replace(neutral.strip(), patched.strip(), 1)
@@ -0,0 +1,328 @@
+"""Keyset-paginated chat history with cached message fragments.
+
+A history page is read with one `id < before` query of `page_size + 1` rows:
+the extra row answers `has_more` without a second `exists()` query.
+
+Most of `chat_message.html` does not depend on who is looking, so rendered
+fragments are cached per (message id, edited_at, viewer role, grouped header)
+and shared by every viewer of that role. Only the `reacted` flag on reaction
+pills is personal; it is patched in from one query per page, the same way the
+render-once fan-out does (see `fanout.patch_reacted_pills`).
+
+Messages whose markup is personal (polls, one-time files, the author's own
+bubble in private rooms with read receipts) are never cached and are left to
+the caller's normal per-viewer render.
+
+Fragments are dropped via `invalidate()` on edit, delete and reaction changes;
+edits also change `edited_at`, so a stale key can never be read back.
+
+Pages that reach below a room's archive boundary are topped up from the
+archive table (see `archive.merge_page`).
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count
+from django.template.loader import render_to_string
+
+from a_users import author_cards
+
+from . import archive
+from .fanout import ROLE_OTHER, ROLE_OWN, ROLE_STAFF, patch_reacted_pills
+from .models import MessageReaction
+
+
+FRAGMENT_KEY_PREFIX = 'chat:frag:v2:'
+
+
+def _reaction_emojis() -> list[str]:
+    return list(getattr(settings, 'CHAT_REACTION_EMOJIS', ['👍', '❤️', '😂', '😮', '😢', '🙏']))
+
+
+def _fragment_ttl() -> int:
+    try:
+        return max(0, int(getattr(settings, 'CHAT_HISTORY_FRAGMENT_TTL_SECONDS', 600)))
+    except Exception:
+        return 600
+
+
+def fragments_enabled() -> bool:
+    return _fragment_ttl() > 0
+
+
+def page_size(setting: str = 'CHAT_HISTORY_PAGE_SIZE', default: int = 50) -> int:
+    """Clamp a page-size setting to 10..200 (falls back to `default` when unset or <= 0)."""
+    try:
+        size = int(getattr(settings, setting, default))
+    except Exception:
+        size = default
+    if size <= 0:
+        size = default
+    return max(10, min(size, 200))
+
+
+@dataclass
+class HistoryPage:
+    # Chronological (oldest first).
+    messages: list
+    has_more: bool
+
+    @property
+    def oldest_id(self) -> int:
+        if not self.messages:
+            return 0
+        return int(getattr(self.messages[0], 'id', 0) or 0)
+
+
+def fetch_page(chat_group, *, before_id: int | None = None, limit: int = 50) -> HistoryPage:
+    """The `limit` messages before `before_id` (latest when None), oldest first."""
+    qs = (
+        chat_group.chat_messages
+        .select_related('reply_to', 'poll')
+        .order_by('-id')
+    )
+    if before_id:
+        qs = qs.filter(id__lt=before_id)
+    rows = list(qs[:limit + 1])
+    rows = archive.merge_page(chat_group, rows, before_id=before_id, want=limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    # Authors (and quoted authors) come from the author-card cache, not a join.
+    author_cards.attach(rows)
+    return HistoryPage(messages=rows, has_more=has_more)
+
+
+def viewer_role(message, viewer) -> str:
+    viewer_id = getattr(viewer, 'id', None)
+    if viewer_id and int(viewer_id) == int(getattr(message, 'author_id', 0) or 0):
+        return ROLE_OWN
+    if getattr(viewer, 'is_staff', False):
+        return ROLE_STAFF
+    return ROLE_OTHER
+
+
+def is_cacheable(message, chat_group, role: str) -> bool:
+    """True when the fragment for `role` is the same for every viewer of that role."""
+    if getattr(message, 'poll_id', None):
+        return False
+    if getattr(message, 'one_time_view_seconds', None) and getattr(message, 'file', None):
+        return False
+    # Own bubbles in private rooms carry the other member's read receipt.
+    if role == ROLE_OWN and getattr(chat_group, 'is_private', False):
+        return False
+    return True
+
+
+def _ts(value) -> str:
+    try:
+        return str(int(value.timestamp() * 1000)) if value else '0'
+    except Exception:
+        return '0'
+
+
+def _author_blocked(message) -> bool:
+    try:
+        return bool(message.author_card.chat_blocked)
+    except Exception:
+        return False
+
+
+def _card_version(message) -> str:
+    try:
+        return message.author_card.version
+    except Exception:
+        return '0'
+
+
+def fragment_key(message, role: str, *, grouped: bool) -> str:
+    # The quoted reply preview, the staff-only block toggle and both authors'
+    # cards (name, avatar, glow, badges) are baked into the markup too, so
+    # their state is part of the key.
+    reply = getattr(message, 'reply_to', None) if getattr(message, 'reply_to_id', None) else None
+    reply_sig = f"{getattr(reply, 'id', 0) or 0}.{_ts(getattr(reply, 'edited_at', None))}"
+    if reply is not None:
+        reply_sig += f".{_card_version(reply)}"
+    blocked = int(role == ROLE_STAFF and _author_blocked(message))
+    return (
+        f"{FRAGMENT_KEY_PREFIX}{int(message.id)}:{_ts(getattr(message, 'edited_at', None))}"
+        f":{role}:{int(bool(grouped))}:{_card_version(message)}:{reply_sig}:{blocked}"
+    )
+
+
+def _neutral_pills(message_ids, emojis) -> dict[int, list[dict]]:
+    counts: dict[tuple[int, str], int] = {}
+    for row in (
+        MessageReaction.objects.filter(message_id__in=message_ids, emoji__in=emojis)
+        .values('message_id', 'emoji')
+        .annotate(count=Count('user_id', distinct=True))
+    ):
+        counts[(int(row['message_id']), row['emoji'])] = int(row['count'] or 0)
+
+    out: dict[int, list[dict]] = {}
+    for mid in message_ids:
+        out[int(mid)] = [
+            {'emoji': emoji, 'count': counts[(int(mid), emoji)], 'reacted': False}
+            for emoji in emojis
+            if counts.get((int(mid), emoji))
+        ]
+    return out
+
+
+def _role_viewer(role: str, viewer):
+    """A stand-in user that renders `role` without anything personal to `viewer`."""
+    if role == ROLE_OWN:
+        return viewer
+    User = get_user_model()
+    return User(is_staff=(role == ROLE_STAFF))
+
+
+def attach_fragments(messages, viewer, chat_group) -> list:
+    """Set `message.history_html` from the fragment cache, rendering misses once.
+
+    `messages` must be chronological; a message's header is hidden when the
+    previous one has the same author. Returns the messages that still need a
+    per-viewer render (with `history_html` unset).
+    """
+    if not messages:
+        return []
+    if not fragments_enabled():
+        return list(messages)
+
+    emojis = _reaction_emojis()
+    keys = {}
+    prev = None
+    for message in messages:
+        role = viewer_role(message, viewer)
+        if is_cacheable(message, chat_group, role):
+            grouped = bool(prev is not None and prev.author_id == message.author_id)
+            try:
+                keys[message.id] = (fragment_key(message, role, grouped=grouped), role, prev)
+            except Exception:
+                pass
+        prev = message
+
+    if not keys:
+        return list(messages)
+
+    try:
+        hits = cache.get_many([k for k, _role, _prev in keys.values()])
+    except Exception:
+        hits = {}
+
+    misses = [m for m in messages if m.id in keys and keys[m.id][0] not in hits]
+    if misses:
+        pills_by_id = _neutral_pills([m.id for m in misses], emojis)
+        to_store = {}
+        for message in misses:
+            key, role, prev = keys[message.id]
+            snapshot = archive.snapshot_pills(message, emojis)
+            message.reaction_pills = snapshot if snapshot is not None else pills_by_id.get(int(message.id), [])
+            message.one_time_viewed_by_me = False
+            try:
+                html = render_to_string('a_rtchat/chat_message.html', {
+                    'message': message,
+                    'user': _role_viewer(role, viewer),
+                    'chat_group': chat_group,
+                    'reaction_emojis': emojis,
+                    'other_last_read_id': 0,
+                    'prev_message': prev,
+                })
+            except Exception:
+                continue
+            value = {'html': html, 'reactions': message.reaction_pills}
+            hits[key] = value
+            to_store[key] = value
+        if to_store:
+            try:
+                cache.set_many(to_store, timeout=_fragment_ttl())
+            except Exception:
+                pass
+
+    mine: dict[int, set[str]] = {}
+    viewer_id = getattr(viewer, 'id', None)
+    cached_ids = [m.id for m in messages if m.id in keys and keys[m.id][0] in hits]
+    if viewer_id and cached_ids:
+        try:
+            for mid, emoji in (
+                MessageReaction.objects.filter(message_id__in=cached_ids, user_id=viewer_id, emoji__in=emojis)
+                .values_list('message_id', 'emoji')
+            ):
+                mine.setdefault(int(mid), set()).add(emoji)
+        except Exception:
+            mine = {}
+
+    for message in messages:
+        entry = keys.get(message.id)
+        value = hits.get(entry[0]) if entry else None
+        if not isinstance(value, dict) or not value.get('html'):
+            continue
+        html = value['html']
+        if mine.get(int(message.id)):
+            html = patch_reacted_pills(html, message.id, value.get('reactions') or [], mine[int(message.id)])
+        message.history_html = html
+
+    return [m for m in messages if not getattr(m, 'history_html', None)]
+
+
+def invalidate(message) -> None:
+    """Drop every cached fragment of `message` (call before changing edited_at/deleting)."""
+    try:
+        keys = [
+            fragment_key(message, role, grouped=grouped)
+            for role in (ROLE_OWN, ROLE_OTHER, ROLE_STAFF)
+            for grouped in (False, True)
+        ]
+        cache.delete_many(keys)
+    except Exception:
+        pass
+
+
+def serialize_message(message) -> dict:
+    """Structured form of a message for clients that render locally."""
+    card = message.author_card
+    try:
+        file_url = message.file.url if getattr(message, 'file', None) else ''
+    except Exception:
+        file_url = ''
+    one_time = bool(getattr(message, 'one_time_view_seconds', None) and getattr(message, 'file', None))
+    return {
+        'id': int(message.id),
+        'author': {
+            'id': int(getattr(message, 'author_id', 0) or 0),
+            'username': card.username,
+            'name': card.name,
+            'avatar': card.avatar,
+        },
+        'body': str(getattr(message, 'body', '') or ''),
+        # One-time files are only handed out through the open endpoint.
+        'file_url': '' if one_time else file_url,
+        'file_caption': str(getattr(message, 'file_caption', '') or ''),
+        'media': {
+            'kind': str(getattr(message, 'media_kind', '') or ''),
+            'mime': str(getattr(message, 'media_mime', '') or ''),
+            'width': getattr(message, 'media_width', None),
+            'height': getattr(message, 'media_height', None),
+            'duration_ms': getattr(message, 'media_duration_ms', None),
+            'bytes': getattr(message, 'media_bytes', None),
+            'placeholder': str(getattr(message, 'media_placeholder', '') or ''),
+        } if getattr(message, 'file', None) else None,
+        'one_time_view_seconds': int(getattr(message, 'one_time_view_seconds', 0) or 0) if one_time else 0,
+        'reply_to_id': getattr(message, 'reply_to_id', None),
+        'poll_id': getattr(message, 'poll_id', None),
+        'link': {
+            'url': str(getattr(message, 'link_url', '') or ''),
+            'title': str(getattr(message, 'link_title', '') or ''),
+            'description': str(getattr(message, 'link_description', '') or ''),
+            'image': str(getattr(message, 'link_image', '') or ''),
+            'site_name': str(getattr(message, 'link_site_name', '') or ''),
+        },
+        'created': message.created.isoformat() if getattr(message, 'created', None) else None,
+        'edited_at': message.edited_at.isoformat() if getattr(message, 'edited_at', None) else None,
+        'reactions': list(getattr(message, 'reaction_pills', None) or []),
+    }
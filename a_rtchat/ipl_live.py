@@ -14,6 +14,7 @@ from django.contrib.auth import get_user_model
 from django.core.cache import cache
 
 from .channels_utils import chatroom_channel_group_name
+from .fanout import message_event
 from .models import ChatGroup, GroupMessage
 
 
@@ -272,11 +273,7 @@ def _persist_public_admin_message(snapshot: dict[str, Any]) -> None:
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
             chatroom_channel_group_name(room),
-            {
-                'type': 'message_handler',
-                'message_id': int(msg.id),
-                'author_id': int(getattr(admin_user, 'id', 0) or 0),
-            },
+            message_event(msg, room, author_id=int(getattr(admin_user, 'id', 0) or 0)),
         )
     except Exception:
         logger.exception('Failed to persist/broadcast IPL admin message')
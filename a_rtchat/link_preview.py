@@ -1,18 +1,52 @@
+"""Link previews for chat messages.
+
+Previews are shared by everyone who posts the same link:
+
+- results are cached under the normalized URL (scheme/host case, default
+  port, fragment and tracking parameters do not matter), failures are cached
+  too for a shorter time so dead links are not retried on every paste
+- concurrent misses for one URL are collapsed: a cache lock lets a single
+  process fetch while others wait for its result (single-flight)
+- messages are delivered without waiting: `attach_or_schedule()` fills the
+  preview in straight away on a cache hit, otherwise a small background pool
+  fetches it and pushes a `message_update` to the room once it is saved; a URL
+  another process is already fetching is requeued, never waited on
+- only the document `<head>` is read and scanned (no full-page soup)
+"""
+
 from __future__ import annotations
 
+import codecs
+import hashlib
 import ipaddress
+import itertools
+import queue
 import re
 import socket
-from dataclasses import dataclass
+import threading
+import time
+from dataclasses import asdict, dataclass
+from html.parser import HTMLParser
 from typing import Optional
-from urllib.parse import urljoin, urlparse
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 
 
 _URL_RE = re.compile(r"(https?://[^\s<>()\"']+)", re.IGNORECASE)
 
+CACHE_KEY_PREFIX = 'linkpreview:v1:'
+LOCK_KEY_PREFIX = 'linkpreview:lock:v1:'
+# Stored for URLs that produced no preview (blocked, non-HTML, errors).
+_NEGATIVE = '-'
+
+_TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'igshid', 'mc_cid', 'mc_eid', 'ref_src'}
+
+LINK_FIELDS = ['link_url', 'link_title', 'link_description', 'link_image', 'link_site_name']
+
 
 @dataclass(frozen=True)
 class LinkPreview:
@@ -89,17 +123,125 @@ def _is_safe_public_url(url: str) -> bool:
     return any_public
 
 
-def fetch_link_preview(url: str) -> Optional[LinkPreview]:
-    if not url:
-        return None
+def normalize_url(url: str) -> str:
+    """Canonical form used as the cache identity of a link ('' when unusable)."""
+    try:
+        parsed = urlparse((url or '').strip())
+        scheme = (parsed.scheme or '').lower()
+        host = (parsed.hostname or '').lower().rstrip('.')
+        port = parsed.port
+    except Exception:
+        return ''
+    if scheme not in {'http', 'https'} or not host:
+        return ''
+    netloc = host
+    if port and port != (443 if scheme == 'https' else 80):
+        netloc = f"{host}:{port}"
+    query = [
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if not k.lower().startswith('utm_') and k.lower() not in _TRACKING_PARAMS
+    ]
+    query.sort()
+    return urlunparse((scheme, netloc, parsed.path or '/', '', urlencode(query), ''))
 
-    if not bool(getattr(settings, 'LINK_PREVIEW_ENABLED', True)):
+
+def _cache_key(normalized: str) -> str:
+    return CACHE_KEY_PREFIX + hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def _lock_key(normalized: str) -> str:
+    return LOCK_KEY_PREFIX + hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def _timeout_seconds() -> float:
+    return float(getattr(settings, 'LINK_PREVIEW_TIMEOUT_SECONDS', 3.0))
+
+
+def _lock_wait_seconds() -> float:
+    """Longest one fetch can hold the per-URL lock (connect + read timeouts, plus slack)."""
+    return _timeout_seconds() * 2 + 1
+
+
+def _lock_ttl() -> int:
+    return int(_lock_wait_seconds()) + 1
+
+
+# --- head-only parsing -------------------------------------------------------
+
+class _HeadScanner(HTMLParser):
+    """Collects <title> and <meta> values and flags when the <head> is over."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
+        self.meta: dict[str, str] = {}
+        self.title = ''
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'body':
+            self.done = True
+        elif tag == 'title':
+            self._in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            name = (attrs.get('property') or attrs.get('name') or '').strip().lower()
+            content = attrs.get('content')
+            if name and content and name not in self.meta:
+                self.meta[name] = str(content).strip()
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title and not self.done:
+            self.title += data
+
+
+def parse_head(chunks, *, base_url: str, encoding: str = 'utf-8') -> Optional[LinkPreview]:
+    """Build a preview from an iterable of HTML byte chunks, reading only up to </head>."""
+    scanner = _HeadScanner()
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='ignore')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    try:
+        for chunk in chunks:
+            if chunk:
+                scanner.feed(decoder.decode(chunk))
+            if scanner.done:
+                break
+    except Exception:
         return None
 
+    meta = scanner.meta
+    title = meta.get('og:title') or scanner.title.strip()
+    description = meta.get('og:description') or meta.get('description') or ''
+    image = meta.get('og:image') or ''
+    site_name = meta.get('og:site_name') or ''
+
+    if image:
+        image = urljoin(base_url, image)
+
+    # Normalize lengths so they don't blow up the UI.
+    return LinkPreview(
+        url=base_url,
+        title=title[:300],
+        description=description[:500],
+        image=image[:500] if image else '',
+        site_name=site_name[:120],
+    )
+
+
+def _fetch_uncached(url: str) -> Optional[LinkPreview]:
     if not _is_safe_public_url(url):
         return None
 
-    timeout = float(getattr(settings, 'LINK_PREVIEW_TIMEOUT_SECONDS', 3.0))
     max_bytes = int(getattr(settings, 'LINK_PREVIEW_MAX_BYTES', 256_000))
 
     headers = {
@@ -108,74 +250,261 @@ def fetch_link_preview(url: str) -> Optional[LinkPreview]:
     }
 
     try:
-        resp = requests.get(url, headers=headers, timeout=timeout, allow_redirects=True, stream=True)
+        resp = requests.get(url, headers=headers, timeout=_timeout_seconds(), allow_redirects=True, stream=True)
     except Exception:
         return None
 
-    final_url = getattr(resp, 'url', url) or url
-    if not _is_safe_public_url(final_url):
-        return None
+    try:
+        final_url = getattr(resp, 'url', url) or url
+        if not _is_safe_public_url(final_url):
+            return None
+
+        content_type = (resp.headers.get('Content-Type') or '').lower()
+        if 'text/html' not in content_type and 'application/xhtml' not in content_type:
+            return None
+
+        def limited_chunks():
+            read = 0
+            for chunk in resp.iter_content(chunk_size=16_384):
+                yield chunk
+                read += len(chunk or b'')
+                if read > max_bytes:
+                    return
+
+        return parse_head(limited_chunks(), base_url=final_url, encoding=resp.encoding or 'utf-8')
+    finally:
+        try:
+            resp.close()
+        except Exception:
+            pass
+
+
+# --- shared cache + single-flight ----------------------------------------------
+
+def _decode(value) -> Optional[LinkPreview]:
+    if isinstance(value, dict):
+        try:
+            return LinkPreview(**value)
+        except Exception:
+            return None
+    return None
+
+
+def cached_link_preview(url: str) -> tuple[bool, Optional[LinkPreview]]:
+    """(hit, preview) from the shared cache only; a negative hit is (True, None)."""
+    normalized = normalize_url(url)
+    if not normalized:
+        return True, None
+    try:
+        value = cache.get(_cache_key(normalized))
+    except Exception:
+        return False, None
+    if value is None:
+        return False, None
+    return True, _decode(value)
 
-    content_type = (resp.headers.get('Content-Type') or '').lower()
-    if 'text/html' not in content_type and 'application/xhtml' not in content_type:
-        return None
 
-    content = bytearray()
+def _fetch_if_free(url: str) -> tuple[bool, Optional[LinkPreview]]:
+    """(done, preview) without waiting; (False, None) while another process holds the URL's lock."""
+    hit, preview = cached_link_preview(url)
+    if hit:
+        return True, preview
+
+    normalized = normalize_url(url)
+    key = _cache_key(normalized)
+    lock = _lock_key(normalized)
     try:
-        for chunk in resp.iter_content(chunk_size=16_384):
-            if not chunk:
-                continue
-            content.extend(chunk)
-            if len(content) > max_bytes:
-                break
+        owner = cache.add(lock, 1, timeout=_lock_ttl())
     except Exception:
-        return None
+        owner = True
+    if not owner:
+        return False, None
 
     try:
-        html = content.decode(resp.encoding or 'utf-8', errors='ignore')
-    except Exception:
+        preview = _fetch_uncached(url)
+        try:
+            if preview is not None:
+                ttl = int(getattr(settings, 'LINK_PREVIEW_CACHE_TTL_SECONDS', 86400))
+                cache.set(key, asdict(preview), timeout=ttl)
+            else:
+                ttl = int(getattr(settings, 'LINK_PREVIEW_NEGATIVE_TTL_SECONDS', 900))
+                cache.set(key, _NEGATIVE, timeout=ttl)
+        except Exception:
+            pass
+        return True, preview
+    finally:
+        try:
+            cache.delete(lock)
+        except Exception:
+            pass
+
+
+def fetch_link_preview(url: str) -> Optional[LinkPreview]:
+    """Preview for `url`, fetching at most once per URL across processes."""
+    if not url:
         return None
 
-    try:
-        from bs4 import BeautifulSoup
-    except Exception:
+    if not bool(getattr(settings, 'LINK_PREVIEW_ENABLED', True)):
         return None
 
-    soup = BeautifulSoup(html, 'html.parser')
-
-    def meta(prop: str = '', name: str = '') -> str:
-        if prop:
-            tag = soup.find('meta', attrs={'property': prop})
-            if tag and tag.get('content'):
-                return str(tag.get('content')).strip()
-        if name:
-            tag = soup.find('meta', attrs={'name': name})
-            if tag and tag.get('content'):
-                return str(tag.get('content')).strip()
-        return ''
+    done, preview = _fetch_if_free(url)
+    if done:
+        return preview
+
+    # Someone else is fetching this URL: wait for their result.
+    deadline = time.monotonic() + _lock_wait_seconds()
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        hit, preview = cached_link_preview(url)
+        if hit:
+            return preview
+    return None
+
+
+# --- message integration -------------------------------------------------------
+
+def _apply(message_id: int, preview: LinkPreview) -> bool:
+    """Store `preview` on a message that has none yet; True when it was written."""
+    from .models import GroupMessage
+
+    return bool(
+        GroupMessage.objects.filter(pk=message_id, link_url='').update(
+            link_url=preview.url,
+            link_title=preview.title,
+            link_description=preview.description,
+            link_image=preview.image,
+            link_site_name=preview.site_name,
+        )
+    )
 
-    title = meta(prop='og:title')
-    if not title:
-        t = soup.find('title')
-        if t and t.text:
-            title = t.text.strip()
 
-    description = meta(prop='og:description') or meta(name='description')
-    image = meta(prop='og:image')
-    site_name = meta(prop='og:site_name')
+def _publish_update(message_id: int) -> None:
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+
+    from . import history
+    from .channels_utils import chatroom_channel_group_name
+    from .models import GroupMessage
+
+    message = GroupMessage.objects.select_related('group').filter(pk=message_id).first()
+    if message is None:
+        return
+    history.invalidate(message)
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        chatroom_channel_group_name(message.group),
+        {
+            'type': 'message_update_handler',
+            'message_id': message.id,
+        },
+    )
 
-    if image:
-        image = urljoin(final_url, image)
 
-    # Normalize lengths so they don't blow up the UI.
-    title = title[:300]
-    description = description[:500]
-    site_name = site_name[:120]
+class _PreviewWorker:
+    """Small thread pool that fetches previews for already-delivered messages.
+
+    Jobs are ordered by the time they become due. A URL whose lock is held by
+    another process is requeued after RETRY_DELAY instead of parking a thread;
+    it is dropped once that lock must have expired, by which point the job
+    would have taken the lock and fetched the URL itself.
+    """
+
+    RETRY_DELAY = 0.25
+
+    def __init__(self, size: int | None = None):
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._size = size
+        self._seq = itertools.count()
+
+    def _pool_size(self) -> int:
+        if self._size is not None:
+            return max(1, int(self._size))
+        try:
+            return max(1, int(getattr(settings, 'LINK_PREVIEW_WORKERS', 4)))
+        except Exception:
+            return 4
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self._pool_size():
+                thread = threading.Thread(target=self._run, name=f'link-preview-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _put(self, due: float, message_id: int, url: str, give_up: float) -> None:
+        self._queue.put((due, next(self._seq), message_id, url, give_up))
+
+    def submit(self, message_id: int, url: str) -> None:
+        now = time.monotonic()
+        self._put(now, int(message_id), url, now + _lock_ttl() + self.RETRY_DELAY)
+        self._ensure_started()
+
+    def _process(self, message_id: int, url: str, give_up: float) -> None:
+        done, preview = _fetch_if_free(url)
+        if not done:
+            now = time.monotonic()
+            if now < give_up:
+                self._put(now + self.RETRY_DELAY, message_id, url, give_up)
+            return
+        if preview is not None and _apply(message_id, preview):
+            _publish_update(message_id)
+
+    def _run(self) -> None:
+        from django.db import close_old_connections
+
+        while True:
+            job = self._queue.get()
+            due, _seq, message_id, url, give_up = job
+            delay = due - time.monotonic()
+            if delay > 0:
+                # Earliest job is a requeued one that is not due yet.
+                self._queue.put(job)
+                time.sleep(min(delay, self.RETRY_DELAY))
+                continue
+            close_old_connections()
+            try:
+                self._process(message_id, url, give_up)
+            except Exception:
+                pass
+            close_old_connections()
 
-    return LinkPreview(
-        url=final_url,
-        title=title,
-        description=description,
-        image=image[:500] if image else '',
-        site_name=site_name,
-    )
+
+_worker = _PreviewWorker()
+
+
+def attach_or_schedule(message, url: str) -> bool:
+    """Fill in `message`'s preview from the cache, or fetch it in the background.
+
+    Returns True when the preview was applied right away (before delivery).
+    Background results are pushed to the room as a `message_update`.
+    """
+    if not url or not bool(getattr(settings, 'LINK_PREVIEW_ENABLED', True)):
+        return False
+
+    hit, preview = cached_link_preview(url)
+    if hit:
+        if preview is None:
+            return False
+        for field, value in zip(LINK_FIELDS, (preview.url, preview.title, preview.description, preview.image, preview.site_name)):
+            setattr(message, field, value)
+        message.save(update_fields=LINK_FIELDS)
+        return True
+
+    message_id = int(message.id)
+
+    def _kickoff():
+        try:
+            _worker.submit(message_id, url)
+        except Exception:
+            pass
+
+    try:
+        transaction.on_commit(_kickoff)
+    except Exception:
+        _kickoff()
+    return False
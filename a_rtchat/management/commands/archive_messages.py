@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import archive, purge
+
+
+class Command(BaseCommand):
+    help = "Move old chat messages to the archive table (resumable id walk, throttled chunks)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=None,
+            help="Archive messages older than this many days (default: settings.MESSAGE_ARCHIVE_AFTER_DAYS)",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=None,
+            help="Rows scanned and moved per chunk/transaction (default: settings.PURGE_CHUNK_SIZE)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many would be archived.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running: start a new sweep every PURGE_IDLE_SECONDS after catching up.",
+        )
+        parser.add_argument(
+            "--max-chunks",
+            type=int,
+            default=0,
+            help="Stop after this many chunks (default: run until the sweep is done).",
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Forget the checkpoint and stats, then start from the oldest message.",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print checkpoint, rows/s and lag, then exit.",
+        )
+        parser.add_argument(
+            "--restore",
+            action="store_true",
+            help="Move archived messages back into the hot table (rollback).",
+        )
+        parser.add_argument(
+            "--room",
+            type=int,
+            default=None,
+            help="With --restore: only this room id.",
+        )
+
+    def handle(self, *args, **options):
+        days = options.get("days")
+        engine = archive.ArchivePurge(
+            days=int(days) if days is not None else archive.after_days(),
+            chunk_size=options.get("batch"),
+        )
+        if options.get("stats"):
+            self.stdout.write(json.dumps(purge.stats(engine), indent=2, sort_keys=True, default=str))
+            return
+        if options.get("restore"):
+            restored = archive.restore(
+                group_id=options.get("room"),
+                batch_size=engine.chunk_size,
+                stdout=self.stdout,
+            )
+            # The walk starts over so restored rows are reconsidered.
+            engine.reset()
+            self.stdout.write(f"archive_messages: {restored} restored")
+            return
+        if options.get("reset"):
+            engine.reset()
+
+        totals = purge.run(
+            engine,
+            loop=bool(options.get("loop")),
+            dry_run=bool(options.get("dry_run")),
+            max_chunks=max(0, int(options.get("max_chunks") or 0)),
+            stdout=self.stdout,
+        )
+        if options.get("dry_run"):
+            self.stdout.write(f"archive_messages: {totals['would_delete']} would archive")
+            return
+        self.stdout.write(f"archive_messages: {totals['deleted']} archived")
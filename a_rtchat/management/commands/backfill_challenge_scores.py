@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import scoreboard
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the challenge scoreboard (ChallengeScore) from completed challenges. '
+        'Run once after deploying the scoreboard, ideally while no challenges are ending.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=1000,
+            help='Rows read/written per batch (default 1000).',
+        )
+
+    def handle(self, *args, **options):
+        batch = max(1, int(options.get('batch') or 1000))
+        seen = scoreboard.rebuild(batch_size=batch, stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"Scoreboard rebuilt from {seen} completed challenges."))
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import media_meta
+
+
+class Command(BaseCommand):
+    help = (
+        'Probe stored chat attachments that have no media metadata yet (kind, MIME, '
+        'dimensions, duration, size, placeholder). Reads files through the storage '
+        'backend, so run it off-peak after deploying the metadata fields.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=200,
+            help='Messages probed per batch (default 200).',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=0,
+            help='Stop after this many messages (default: all).',
+        )
+
+    def handle(self, *args, **options):
+        batch = max(1, int(options.get('batch') or 200))
+        limit = int(options.get('limit') or 0) or None
+        done = media_meta.backfill(batch_size=batch, limit=limit, stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"Stored media metadata for {done} messages."))
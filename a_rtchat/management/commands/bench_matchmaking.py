@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import random
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import matchmaking
+from a_rtchat.redis_utils import get_redis
+
+
+def _percentile(sorted_vals: list[float], pct: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(pct / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[idx]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark random video matchmaking: users arrive over time (Poisson, --rate per second) and are '
+        'paired inline (like the consumer) or by a worker loop (like run_matchmaker); reports enqueue-to-pair time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20_000, help='Arrivals to simulate (default 20000).')
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=2_000.0,
+            help='Mean arrivals per second; inter-arrival gaps are exponential (default 2000).',
+        )
+        parser.add_argument(
+            '--mode',
+            choices=('inline', 'worker'),
+            default='inline',
+            help='inline: pop a pair after every enqueue; worker: a separate matcher loop (default inline).',
+        )
+        parser.add_argument(
+            '--idle-sleep',
+            type=float,
+            default=0.05,
+            help='Worker mode: seconds to sleep when no pair is available (default 0.05, as run_matchmaker).',
+        )
+        parser.add_argument(
+            '--recent-ratio',
+            type=float,
+            default=0.2,
+            help='Fraction of users with a recently-skipped partner also arriving (default 0.2).',
+        )
+        parser.add_argument(
+            '--duplicate-ratio',
+            type=float,
+            default=0.02,
+            help='Fraction of users with a second tab in the queue (same user key, default 0.02).',
+        )
+        parser.add_argument('--local', action='store_true', help='Force the process-local queue even if Redis is configured.')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        users = max(2, int(options['users']))
+        rate = max(1e-3, float(options['rate']))
+        mode = options['mode']
+        idle_sleep = max(0.0, float(options['idle_sleep']))
+        rng = random.Random(int(options['seed']))
+
+        client = None if options.get('local') else get_redis()
+        if client is not None:
+            queue = matchmaking.RedisMatchQueue(client, prefix=f"rv:bench:{uuid.uuid4().hex[:8]}:")
+            backend = 'redis'
+        else:
+            queue = matchmaking.LocalMatchQueue()
+            backend = 'local'
+
+        user_keys = [f"u:{i}" for i in range(users)]
+        cooldown = matchmaking.rematch_cooldown_seconds()
+        for _ in range(int(users * max(0.0, float(options['recent_ratio'])) / 2)):
+            a, b = rng.sample(user_keys, 2)
+            queue.mark_recent(a, b, cooldown)
+
+        entries = list(user_keys)
+        entries += rng.sample(user_keys, int(users * max(0.0, float(options['duplicate_ratio']))))
+        rng.shuffle(entries)
+
+        # Arrival offsets (seconds from start) with exponential gaps: a Poisson process at `rate`.
+        offsets: list[float] = []
+        at = 0.0
+        for _ in entries:
+            at += rng.expovariate(rate)
+            offsets.append(at)
+
+        self.stdout.write(
+            f'Backend: {backend} • mode: {mode} • arrivals: {len(entries):,} at {rate:,.0f}/s '
+            f'• window: {matchmaking.match_window()}'
+        )
+
+        enqueued_at: dict[str, float] = {}
+        matched_at: dict[str, float] = {}
+        pops = 0
+        arrivals_done = threading.Event()
+
+        def record(match) -> None:
+            nonlocal pops
+            pops += 1
+            now = time.perf_counter()
+            matched_at[match.a.ticket] = now
+            matched_at[match.b.ticket] = now
+
+        def worker() -> None:
+            # Mirrors run_matchmaker: drain every available pair, then idle. Stops once arrivals are
+            # over and the queue has nothing left to pair.
+            while True:
+                matched = False
+                while True:
+                    match = queue.pop_pair()
+                    if match is None:
+                        break
+                    record(match)
+                    matched = True
+                if not matched:
+                    if arrivals_done.is_set():
+                        return
+                    time.sleep(idle_sleep)
+
+        thread = None
+        if mode == 'worker':
+            thread = threading.Thread(target=worker, name='bench-matchmaker', daemon=True)
+            thread.start()
+
+        t0 = time.perf_counter()
+        try:
+            for i, (user_key, offset) in enumerate(zip(entries, offsets)):
+                delay = t0 + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                started = time.perf_counter()
+                ticket = queue.enqueue(f"bench.{i}", user_key)
+                enqueued_at[ticket] = started
+                if mode == 'inline':
+                    match = queue.pop_pair()
+                    if match is not None:
+                        record(match)
+            arrival_secs = time.perf_counter() - t0
+            arrivals_done.set()
+            if thread is not None:
+                thread.join()
+            total_secs = time.perf_counter() - t0
+        finally:
+            arrivals_done.set()
+            try:
+                queue.clear()
+            except Exception:
+                pass
+
+        waits = sorted(
+            matched_at[ticket] - started
+            for ticket, started in enqueued_at.items()
+            if ticket in matched_at
+        )
+        unmatched = len(enqueued_at) - len(waits)
+
+        self.stdout.write(
+            f'Arrivals: {len(entries):,} in {arrival_secs:.2f}s '
+            f'(offered {rate:,.0f}/s, achieved {len(entries) / max(arrival_secs, 1e-9):,.0f}/s)'
+        )
+        self.stdout.write(f'Pairs: {pops:,} in {total_secs:.2f}s • unmatched: {unmatched:,}')
+        self.stdout.write(self.style.SUCCESS(
+            'Time-to-match (enqueue to pair): '
+            f'p50 {_percentile(waits, 50) * 1000:.1f}ms • p95 {_percentile(waits, 95) * 1000:.1f}ms '
+            f'• p99 {_percentile(waits, 99) * 1000:.1f}ms'
+        ))
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from a_rtchat import archive, history, purge, room_index
+from a_rtchat.models import ArchivedMessage, ChatGroup, GroupMessage
+
+
+INSERT_SLICE = 1_000_000
+
+# Columns filled by the generator; the rest are nullable.
+_INSERT_COLUMNS = (
+    'group_id, author_id, body, link_url, link_title, link_description, link_image, link_site_name, '
+    'media_kind, media_mime, media_placeholder, is_support_submission, support_submission_type, created'
+)
+
+
+class _BenchArchive(archive.ArchivePurge):
+    """ArchivePurge limited to the generated rooms, with its own checkpoint."""
+
+    name = 'bench-archive'
+
+    def __init__(self, *, rooms: list[int], **kwargs):
+        super().__init__(**kwargs)
+        self.rooms = rooms
+
+    def scan(self, cursor, horizon):
+        return list(
+            GroupMessage.objects.filter(group_id__in=self.rooms, id__gt=cursor)
+            .order_by('id')
+            .values_list('id', 'created')[:self.chunk_size]
+        )
+
+
+def _insert_sql(vendor: str) -> str:
+    """INSERT of rows n = start..end, round-robin over contiguous room ids, oldest first.
+
+    Parameters: see `_insert_params`.
+    """
+    if vendor == 'postgresql':
+        return (
+            f"INSERT INTO {GroupMessage._meta.db_table} ({_INSERT_COLUMNS}) "
+            "SELECT %s + n %% %s, %s, 'bench message ' || n, '', '', '', '', '', '', '', '', false, '', "
+            "now() - make_interval(secs => ((%s - n) * %s)::double precision) "
+            "FROM generate_series(%s, %s) AS n"
+        )
+    # SQLite and others: a recursive CTE as the row source.
+    return (
+        "WITH RECURSIVE seq(n) AS (SELECT %s UNION ALL SELECT n + 1 FROM seq WHERE n < %s) "
+        f"INSERT INTO {GroupMessage._meta.db_table} ({_INSERT_COLUMNS}) "
+        "SELECT %s + n %% %s, %s, 'bench message ' || n, '', '', '', '', '', '', '', '', 0, '', "
+        "strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now', '-' || ((%s - n) * %s / 1000.0) || ' seconds') "
+        "FROM seq"
+    )
+
+
+def _insert_params(vendor: str, *, start: int, end: int, first_room: int, rooms: int, author_id: int,
+                   rows: int, step_ms: int) -> list:
+    if vendor == 'postgresql':
+        return [first_room, rooms, author_id, rows, step_ms / 1000.0, start, end]
+    return [start, end, first_room, rooms, author_id, rows, step_ms]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the hot/cold message split: generate messages spread over --days, time and EXPLAIN '
+        'history pages, room counts and analytics aggregates, archive, then measure again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows',
+            type=int,
+            default=200_000,
+            help='Messages to generate (default 200000; the sizing target is 50000000 on Postgres).',
+        )
+        parser.add_argument('--rooms', type=int, default=50, help='Rooms to spread them over (default 50).')
+        parser.add_argument('--days', type=int, default=180, help='Age of the oldest generated message (default 180).')
+        parser.add_argument('--batch', type=int, default=5000, help='Rows moved per archive chunk (default 5000).')
+        parser.add_argument('--explain', action='store_true', help='Print query plans (ANALYZE on Postgres).')
+        parser.add_argument('--keep', action='store_true', help='Leave the generated rooms and messages in place.')
+
+    def handle(self, *args, **options):
+        if getattr(settings, 'ENVIRONMENT', '') == 'production':
+            raise CommandError('bench_message_archive writes millions of rows; refusing to run in production.')
+
+        rows = max(1, int(options['rows']))
+        room_count = max(1, min(int(options['rooms']), rows))
+        # Rows are spread evenly over --days, one message every step_ms across all rooms.
+        step_ms = max(1, int(options['days']) * 86_400_000 // rows)
+
+        tag = uuid.uuid4().hex[:8]
+        author, _ = get_user_model().objects.get_or_create(username='bench_archive')
+        rooms = [ChatGroup.objects.create(group_name=f'bench-archive-{tag}-{i}') for i in range(room_count)]
+        room_ids = [room.pk for room in rooms]
+        if room_ids != list(range(room_ids[0], room_ids[0] + room_count)):
+            ChatGroup.objects.filter(id__in=room_ids).delete()
+            raise CommandError('Generated rooms did not get contiguous ids (concurrent inserts?); run again.')
+        self.stdout.write(
+            f'Backend: {connection.vendor} • {rows:,} messages in {room_count} rooms '
+            f'• archive after {archive.after_days()} days'
+        )
+
+        engine = _BenchArchive(rooms=room_ids, days=archive.after_days(), chunk_size=int(options['batch']))
+        try:
+            t0 = time.perf_counter()
+            sql = _insert_sql(connection.vendor)
+            with connection.cursor() as cursor:
+                # In slices, so 50M rows are not one transaction.
+                for start in range(1, rows + 1, INSERT_SLICE):
+                    cursor.execute(sql, _insert_params(
+                        connection.vendor,
+                        start=start, end=min(rows, start + INSERT_SLICE - 1),
+                        first_room=room_ids[0], rooms=room_count, author_id=author.pk,
+                        rows=rows, step_ms=step_ms,
+                    ))
+            for gid in room_ids:
+                room_index.rebuild_room(gid)
+            self.stdout.write(f'Generate: {time.perf_counter() - t0:.2f}s')
+
+            self._measure('before', rooms[0], explain=bool(options['explain']))
+
+            engine.reset()
+            t1 = time.perf_counter()
+            totals = purge.run(engine, sleep=lambda _seconds: None)
+            secs = time.perf_counter() - t1
+            self.stdout.write(
+                f"Archive: {totals['deleted']:,} rows in {secs:.2f}s "
+                f"({totals['deleted'] / max(secs, 1e-9):,.0f} rows/s, {totals['chunks']} chunks)"
+            )
+
+            self._measure('after', rooms[0], explain=bool(options['explain']))
+        finally:
+            engine.reset()
+            if not options.get('keep'):
+                self._cleanup(room_ids)
+
+    def _timed(self, label: str, fn, repeat: int = 5):
+        best = None
+        result = None
+        for _ in range(repeat):
+            t = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - t
+            best = elapsed if best is None else min(best, elapsed)
+        self.stdout.write(f'  {label}: {best * 1000:.2f} ms')
+        return result
+
+    def _explain(self, label: str, qs) -> None:
+        try:
+            plan = qs.explain(analyze=True) if connection.vendor == 'postgresql' else qs.explain()
+        except Exception as exc:
+            plan = f'(explain failed: {exc})'
+        self.stdout.write(f'  -- plan: {label}')
+        for line in str(plan).splitlines():
+            self.stdout.write(f'     {line}')
+
+    def _measure(self, phase: str, room, *, explain: bool) -> None:
+        self.stdout.write(self.style.SUCCESS(
+            f'[{phase}] hot {GroupMessage.objects.count():,} rows • archive {ArchivedMessage.objects.count():,} rows'
+        ))
+        # A page from the oldest tenth of the room: hot before, archived after.
+        archived = ArchivedMessage.objects.filter(group=room).order_by('id').values_list('id', flat=True)
+        hot_ids = GroupMessage.objects.filter(group=room).order_by('id').values_list('id', flat=True)
+        offset = (archived.count() + hot_ids.count()) // 10
+        n_archived = archived.count()
+        deep_before = archived[offset] if offset < n_archived else hot_ids[offset - n_archived]
+
+        now = timezone.now()
+        last_7d = now - timedelta(days=7)
+        latest = room.chat_messages.order_by('-id')[:51]
+        deep = room.chat_messages.filter(id__lt=deep_before or 0).order_by('-id')[:51]
+        room_total = GroupMessage.objects.filter(group=room)
+        weekly = GroupMessage.objects.filter(created__gte=last_7d)
+        daily = (
+            GroupMessage.objects.filter(created__date__gte=(now - timedelta(days=6)).date())
+            .annotate(day=TruncDate('created'))
+            .values('day')
+            .annotate(count=Count('id'))
+            .order_by('day')
+        )
+
+        self._timed('history latest page', lambda: history.fetch_page(room, limit=50))
+        self._timed('history deep page', lambda: history.fetch_page(room, before_id=deep_before, limit=50))
+        self._timed('room count', room_total.count)
+        self._timed('analytics 7d count', weekly.count)
+        self._timed('analytics daily series', lambda: list(daily.all()))
+        if explain:
+            self._explain('history latest page (hot)', latest)
+            self._explain('history deep page (hot)', deep)
+            self._explain('room count', room_total)
+            self._explain('analytics daily series', daily)
+
+    def _cleanup(self, room_ids: list[int]) -> None:
+        t = time.perf_counter()
+        archived = ArchivedMessage.objects.filter(group_id__in=room_ids)
+        archived._raw_delete(archived.db)
+        hot = GroupMessage.objects.filter(group_id__in=room_ids)
+        hot._raw_delete(hot.db)
+        ChatGroup.objects.filter(id__in=room_ids).delete()
+        self.stdout.write(f'Cleanup: {time.perf_counter() - t:.2f}s')
@@ -1,17 +1,15 @@
 from __future__ import annotations
 
-from datetime import timedelta
+import json
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.models import Count
-from django.utils import timezone
 
-from a_rtchat.models import GroupMessage
+from a_rtchat import purge
 
 
 class Command(BaseCommand):
-    help = "Delete old chat messages to control DB size (oldest first, batched)."
+    help = "Delete old chat messages to control DB size (resumable id walk, throttled chunks)."
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -23,8 +21,8 @@ class Command(BaseCommand):
         parser.add_argument(
             "--batch",
             type=int,
-            default=500,
-            help="Max number of messages to delete per run (default: 500)",
+            default=None,
+            help="Rows scanned and deleted per chunk/transaction (default: settings.PURGE_CHUNK_SIZE)",
         )
         parser.add_argument(
             "--dry-run",
@@ -36,58 +34,56 @@ class Command(BaseCommand):
             "--keep-last",
             type=int,
             default=None,
-            help="Never delete messages from a room unless it has more than this many messages (default: settings.CHAT_MAX_MESSAGES_PER_ROOM)",
+            help="Never take a room below this many messages (default: settings.CHAT_MAX_MESSAGES_PER_ROOM)",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running: start a new sweep every PURGE_IDLE_SECONDS after catching up.",
+        )
+        parser.add_argument(
+            "--max-chunks",
+            type=int,
+            default=0,
+            help="Stop after this many chunks (default: run until the sweep is done).",
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Forget the checkpoint and stats, then start from the oldest message.",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print checkpoint, rows/s and lag, then exit.",
         )
 
     def handle(self, *args, **options):
-        days = max(0, int(options.get("days") or 0))
-        batch = max(1, int(options.get("batch") or 1))
-        dry_run = bool(options.get("dry_run"))
-
         keep_last_opt = options.get('keep_last')
         try:
             keep_last = int(keep_last_opt) if keep_last_opt is not None else int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
         except Exception:
             keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
-        keep_last = max(1, int(keep_last))
-
-        cutoff = timezone.now() - timedelta(days=days)
 
-        # We only delete messages from rooms that exceed `keep_last`.
-        # This prevents low-volume group chats (even with old messages) from losing history.
-        candidates = list(
-            GroupMessage.objects.filter(created__lt=cutoff, group__is_private=False)
-            .order_by("created", "id")
-            .values_list("id", "group_id")[:batch]
+        engine = purge.MessagePurge(
+            days=int(options.get("days") or 0),
+            keep_last=max(1, keep_last),
+            chunk_size=options.get("batch"),
         )
-
-        if not candidates:
-            self.stdout.write("purge_old_messages: 0 deleted")
-            return
-
-        group_ids = sorted({gid for (_mid, gid) in candidates if gid})
-        if not group_ids:
-            self.stdout.write("purge_old_messages: 0 deleted")
-            return
-
-        counts = {
-            row['group_id']: int(row['c'] or 0)
-            for row in (
-                GroupMessage.objects.filter(group_id__in=group_ids, group__is_private=False)
-                .values('group_id')
-                .annotate(c=Count('id'))
-            )
-        }
-
-        ids = [mid for (mid, gid) in candidates if int(counts.get(gid, 0)) > keep_last]
-
-        if not ids:
-            self.stdout.write("purge_old_messages: 0 deleted")
+        if options.get("stats"):
+            self.stdout.write(json.dumps(purge.stats(engine), indent=2, sort_keys=True, default=str))
             return
-
-        if dry_run:
-            self.stdout.write(f"purge_old_messages: {len(ids)} would delete")
+        if options.get("reset"):
+            engine.reset()
+
+        totals = purge.run(
+            engine,
+            loop=bool(options.get("loop")),
+            dry_run=bool(options.get("dry_run")),
+            max_chunks=max(0, int(options.get("max_chunks") or 0)),
+            stdout=self.stdout,
+        )
+        if options.get("dry_run"):
+            self.stdout.write(f"purge_old_messages: {totals['would_delete']} would delete")
             return
-
-        deleted_count, _ = GroupMessage.objects.filter(id__in=ids).delete()
-        self.stdout.write(f"purge_old_messages: {deleted_count} deleted")
+        self.stdout.write(f"purge_old_messages: {totals['deleted']} deleted")
@@ -1,69 +1,75 @@
 from __future__ import annotations
 
-from datetime import timedelta
+import json
 
 from django.core.management.base import BaseCommand
-from django.db.models import Max
-from django.db.models.functions import Coalesce
-from django.utils import timezone
 
-from a_rtchat.models import ChatGroup
+from a_rtchat import purge
 
 
 class Command(BaseCommand):
-    help = "Delete old private rooms (code rooms) to control DB size (batched)."
+    help = "Delete old private rooms (code rooms) to control DB size (resumable id walk, throttled chunks)."
 
     def add_arguments(self, parser):
         parser.add_argument(
             "--days",
             type=int,
             default=4,
-            help="Delete private code rooms older than this many days (default: 4)",
+            help="Delete private code rooms inactive for this many days (default: 4)",
         )
         parser.add_argument(
             "--batch",
             type=int,
             default=50,
-            help="Max number of rooms to delete per run (default: 50)",
+            help="Rooms scanned per chunk (default: 50)",
         )
         parser.add_argument(
             "--dry-run",
             action="store_true",
             help="Only report how many would be deleted.",
         )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running: start a new sweep every PURGE_IDLE_SECONDS after catching up.",
+        )
+        parser.add_argument(
+            "--max-chunks",
+            type=int,
+            default=0,
+            help="Stop after this many chunks (default: run until the sweep is done).",
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Forget the checkpoint and stats, then start from the oldest room.",
+        )
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print checkpoint, rows/s and lag, then exit.",
+        )
 
     def handle(self, *args, **options):
-        days = max(0, int(options.get("days") or 0))
-        batch = max(1, int(options.get("batch") or 1))
-        dry_run = bool(options.get("dry_run"))
-
-        cutoff = timezone.now() - timedelta(days=days)
-
-        # Delete only rooms that have been inactive for N days.
-        # Inactivity is computed as:
-        # - last message created time, if any
-        # - else room.created
-        ids = list(
-            ChatGroup.objects.filter(
-                is_private=True,
-                is_code_room=True,
-            )
-            .annotate(
-                last_message_at=Max('chat_messages__created'),
-                last_activity_at=Coalesce('last_message_at', 'created'),
-            )
-            .filter(last_activity_at__lt=cutoff)
-            .order_by('last_activity_at', 'id')
-            .values_list('id', flat=True)[:batch]
+        # Inactivity: last message time (from the room summary), else room.created.
+        engine = purge.RoomPurge(
+            days=int(options.get("days") or 0),
+            chunk_size=max(1, int(options.get("batch") or 1)),
         )
-
-        if not ids:
-            self.stdout.write("purge_old_rooms: 0 deleted")
+        if options.get("stats"):
+            self.stdout.write(json.dumps(purge.stats(engine), indent=2, sort_keys=True, default=str))
             return
+        if options.get("reset"):
+            engine.reset()
 
-        if dry_run:
-            self.stdout.write(f"purge_old_rooms: {len(ids)} would delete")
+        totals = purge.run(
+            engine,
+            loop=bool(options.get("loop")),
+            dry_run=bool(options.get("dry_run")),
+            max_chunks=max(0, int(options.get("max_chunks") or 0)),
+            stdout=self.stdout,
+        )
+        if options.get("dry_run"):
+            self.stdout.write(f"purge_old_rooms: {totals['would_delete']} would delete")
             return
-
-        deleted_count, _ = ChatGroup.objects.filter(id__in=ids).delete()
-        self.stdout.write(f"purge_old_rooms: {deleted_count} deleted")
+        self.stdout.write(f"purge_old_rooms: {totals['deleted']} deleted")
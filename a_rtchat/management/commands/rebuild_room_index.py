@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import room_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the room-summary index (ChatRoomSummary) and private-room unread counters '
+        'from the messages table. Run once after deploying the index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--room',
+            action='append',
+            default=[],
+            help='Only rebuild this room (group_name); can be repeated.',
+        )
+
+    def handle(self, *args, **options):
+        names = [str(n).strip() for n in (options.get('room') or []) if str(n).strip()]
+        if names:
+            from a_rtchat.models import ChatGroup
+
+            ids = list(ChatGroup.objects.filter(group_name__in=names).values_list('id', flat=True))
+            room_index.refresh_rooms(ids)
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(ids)} room summaries."))
+            return
+
+        done = room_index.rebuild_all(stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {done} room summaries."))
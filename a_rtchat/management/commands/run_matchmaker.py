@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from a_rtchat import matchmaking
+from a_rtchat.redis_utils import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Run the random video matchmaking worker (use with RANDOM_VIDEO_MATCHMAKER=worker).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--idle-sleep',
+            type=float,
+            default=0.05,
+            help='Seconds to sleep when the queue has no matchable pair (default 0.05).',
+        )
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=500,
+            help='Max pairs delivered per loop iteration (default 500).',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single matching pass and exit.',
+        )
+
+    def handle(self, *args, **options):
+        idle_sleep = max(0.01, float(options.get('idle_sleep') or 0.05))
+        batch = max(1, int(options.get('batch') or 500))
+        channel_layer = get_channel_layer()
+
+        if get_redis() is None:
+            self.stdout.write(self.style.WARNING(
+                'Redis is not configured: the worker only sees its own process-local queue.'
+            ))
+
+        self.stdout.write(self.style.NOTICE(f'Matchmaker started (batch: {batch}, idle sleep: {idle_sleep}s)'))
+        while True:
+            made = matchmaking.run_matcher_once(matchmaking.get_queue(), channel_layer, max_pairs=batch)
+            if options.get('once'):
+                self.stdout.write(self.style.SUCCESS(f'Matched {made} pair(s).'))
+                return
+            if made == 0:
+                time.sleep(idle_sleep)
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from a_rtchat import retention
+from a_rtchat.redis_utils import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Trim rooms marked by new messages (use with RETENTION_WORKER_IN_PROCESS=0).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='Print retention counters and exit.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run a single pass and exit.',
+        )
+
+    def handle(self, *args, **options):
+        if options.get('stats'):
+            self.stdout.write(json.dumps(retention.metrics(), indent=2, sort_keys=True))
+            return
+
+        if get_redis() is None:
+            self.stdout.write(self.style.WARNING(
+                'Redis is not configured: the worker only sees rooms marked by its own process.'
+            ))
+
+        self.stdout.write(self.style.NOTICE('Retention worker started'))
+        while True:
+            counts = retention._worker.run_once()
+            if counts['rooms_checked']:
+                self.stdout.write(
+                    f"{counts['rooms_checked']} room(s) checked -> {counts['rooms_trimmed']} trimmed, "
+                    f"{counts['messages_deleted']} message(s) and {counts['files_deleted']} file(s) deleted"
+                )
+            if options.get('once'):
+                return
+            time.sleep(retention._worker._interval())
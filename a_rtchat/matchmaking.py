@@ -0,0 +1,320 @@
+"""Random video matchmaking queue.
+
+Waiting users live in a sorted set scored by enqueue time (FIFO), one hash
+per ticket holds `channel`/`user_key`. A single Lua script atomically pops
+the first compatible pair from the head of the queue, so there is no global
+lock and no full-queue scan: each pop looks at most RANDOM_VIDEO_MATCH_WINDOW
+tickets.
+
+Recently-skipped partners are kept per user in a sorted set scored by the
+cooldown expiry (`{rv:mm}:recent:<user_key>` -> {peer_user_key: until_ts}).
+
+The script reads ticket and recent-partner keys it only discovers from the
+queue, so every key of a queue shares one hash tag (`{rv:mm}`) and lives in
+one Redis Cluster slot.
+A recent pair is only matched once both sides have waited
+RANDOM_VIDEO_REMATCH_FALLBACK_WAIT_SECONDS and no other pair is available.
+
+Matching runs inline on enqueue by default, or in a dedicated worker
+(`manage.py run_matchmaker`) when RANDOM_VIDEO_MATCHMAKER = 'worker'.
+Without Redis (local/dev) a process-local queue with the same rules is used.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+
+from .redis_utils import get_redis
+
+
+PAIR_KEY_PREFIX = 'rv:pair:v1:'
+DEFAULT_PREFIX = 'rv:mm:'
+
+# Tickets older than this are dropped (clients show "Retry" well before).
+TICKET_MAX_WAIT_SECONDS = 45
+
+_POP_PAIR_LUA = """
+local now = tonumber(ARGV[1])
+local max_wait = tonumber(ARGV[2])
+local fallback = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+-- Same hash tag as KEYS[1] (see RedisMatchQueue), so these stay in its slot.
+local tprefix = ARGV[5]
+local rprefix = ARGV[6]
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - max_wait)
+local head = redis.call('ZRANGE', KEYS[1], 0, window - 1, 'WITHSCORES')
+local cands = {}
+for i = 1, #head, 2 do
+    local t = head[i]
+    local info = redis.call('HMGET', tprefix .. t, 'channel', 'user_key')
+    if info[1] and info[2] then
+        cands[#cands + 1] = {t, info[1], info[2], tonumber(head[i + 1])}
+    else
+        redis.call('ZREM', KEYS[1], t)
+    end
+end
+
+-- Pass 1: fresh pairs only. Pass 2: recent pairs that both waited long enough.
+for pass = 1, 2 do
+    for i = 1, #cands - 1 do
+        local a = cands[i]
+        for j = i + 1, #cands do
+            local b = cands[j]
+            if a[3] ~= b[3] then
+                local ok = true
+                local until_ts = redis.call('ZSCORE', rprefix .. a[3], b[3])
+                if until_ts and tonumber(until_ts) > now then
+                    ok = pass == 2 and (now - a[4]) >= fallback and (now - b[4]) >= fallback
+                end
+                if ok then
+                    redis.call('ZREM', KEYS[1], a[1], b[1])
+                    redis.call('DEL', tprefix .. a[1], tprefix .. b[1])
+                    return {a[1], a[2], a[3], b[1], b[2], b[3]}
+                end
+            end
+        end
+    end
+end
+return false
+"""
+
+
+@dataclass(frozen=True)
+class Ticket:
+    ticket: str
+    channel: str
+    user_key: str
+
+
+@dataclass(frozen=True)
+class Match:
+    a: Ticket
+    b: Ticket
+
+
+def _setting_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(getattr(settings, name, default)))
+    except Exception:
+        return default
+
+
+def fallback_wait_seconds() -> int:
+    return _setting_int('RANDOM_VIDEO_REMATCH_FALLBACK_WAIT_SECONDS', 10)
+
+
+def rematch_cooldown_seconds() -> int:
+    return _setting_int('RANDOM_VIDEO_REMATCH_COOLDOWN_SECONDS', 12)
+
+
+def match_window() -> int:
+    return _setting_int('RANDOM_VIDEO_MATCH_WINDOW', 64)
+
+
+def worker_mode() -> bool:
+    try:
+        return str(getattr(settings, 'RANDOM_VIDEO_MATCHMAKER', 'inline') or '').strip().lower() == 'worker'
+    except Exception:
+        return False
+
+
+class RedisMatchQueue:
+    def __init__(self, client, prefix: str = DEFAULT_PREFIX):
+        self.client = client
+        # Hash tag: the pop script touches ticket/recent keys not passed in KEYS.
+        self.prefix = '{' + prefix.strip(':') + '}:'
+        self.queue_key = f"{self.prefix}queue"
+        self._pop_pair = client.register_script(_POP_PAIR_LUA)
+
+    def _ticket_key(self, ticket: str) -> str:
+        return f"{self.prefix}ticket:{ticket}"
+
+    def _recent_key(self, user_key: str) -> str:
+        return f"{self.prefix}recent:{user_key}"
+
+    def enqueue(self, channel: str, user_key: str, *, now: float | None = None) -> str:
+        ticket = uuid.uuid4().hex
+        now = time.time() if now is None else now
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(self._ticket_key(ticket), mapping={'channel': channel, 'user_key': user_key})
+        pipe.expire(self._ticket_key(ticket), TICKET_MAX_WAIT_SECONDS)
+        pipe.zadd(self.queue_key, {ticket: now})
+        pipe.execute()
+        return ticket
+
+    def cancel(self, ticket: str) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrem(self.queue_key, ticket)
+        pipe.delete(self._ticket_key(ticket))
+        pipe.execute()
+
+    def mark_recent(self, user_key_a: str, user_key_b: str, cooldown: int) -> None:
+        until = time.time() + cooldown
+        pipe = self.client.pipeline(transaction=False)
+        for left, right in ((user_key_a, user_key_b), (user_key_b, user_key_a)):
+            key = self._recent_key(left)
+            pipe.zadd(key, {right: until})
+            pipe.zremrangebyscore(key, '-inf', time.time())
+            pipe.expire(key, cooldown)
+        pipe.execute()
+
+    def pop_pair(self, *, now: float | None = None) -> Match | None:
+        now = time.time() if now is None else now
+        res = self._pop_pair(
+            keys=[self.queue_key],
+            args=[
+                now,
+                TICKET_MAX_WAIT_SECONDS,
+                fallback_wait_seconds(),
+                match_window(),
+                f"{self.prefix}ticket:",
+                f"{self.prefix}recent:",
+            ],
+        )
+        if not res:
+            return None
+        vals = [v.decode() if isinstance(v, bytes) else str(v) for v in res]
+        return Match(a=Ticket(*vals[0:3]), b=Ticket(*vals[3:6]))
+
+    def size(self) -> int:
+        return int(self.client.zcard(self.queue_key) or 0)
+
+    def clear(self) -> None:
+        tickets = self.client.zrange(self.queue_key, 0, -1)
+        pipe = self.client.pipeline(transaction=False)
+        for t in tickets:
+            pipe.delete(self._ticket_key(t.decode() if isinstance(t, bytes) else t))
+        pipe.delete(self.queue_key)
+        pipe.execute()
+
+
+class LocalMatchQueue:
+    """Process-local equivalent of RedisMatchQueue (dev, tests, benchmark fallback)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue: OrderedDict[str, tuple[str, str, float]] = OrderedDict()
+        self._recent: dict[str, dict[str, float]] = {}
+
+    def enqueue(self, channel: str, user_key: str, *, now: float | None = None) -> str:
+        ticket = uuid.uuid4().hex
+        now = time.time() if now is None else now
+        with self._lock:
+            self._queue[ticket] = (channel, user_key, now)
+        return ticket
+
+    def cancel(self, ticket: str) -> None:
+        with self._lock:
+            self._queue.pop(ticket, None)
+
+    def mark_recent(self, user_key_a: str, user_key_b: str, cooldown: int) -> None:
+        until = time.time() + cooldown
+        with self._lock:
+            self._recent.setdefault(user_key_a, {})[user_key_b] = until
+            self._recent.setdefault(user_key_b, {})[user_key_a] = until
+
+    def _is_recent(self, a: str, b: str, now: float) -> bool:
+        return self._recent.get(a, {}).get(b, 0) > now
+
+    def pop_pair(self, *, now: float | None = None) -> Match | None:
+        now = time.time() if now is None else now
+        fallback = fallback_wait_seconds()
+        window = match_window()
+        with self._lock:
+            while self._queue:
+                ticket, (_, _, created) = next(iter(self._queue.items()))
+                if created > now - TICKET_MAX_WAIT_SECONDS:
+                    break
+                self._queue.pop(ticket, None)
+
+            cands = []
+            for ticket, (channel, user_key, created) in self._queue.items():
+                cands.append((ticket, channel, user_key, created))
+                if len(cands) >= window:
+                    break
+
+            for strict in (True, False):
+                for i in range(len(cands) - 1):
+                    a = cands[i]
+                    for b in cands[i + 1:]:
+                        if a[2] == b[2]:
+                            continue
+                        if self._is_recent(a[2], b[2], now):
+                            if strict or (now - a[3]) < fallback or (now - b[3]) < fallback:
+                                continue
+                        self._queue.pop(a[0], None)
+                        self._queue.pop(b[0], None)
+                        return Match(a=Ticket(*a[:3]), b=Ticket(*b[:3]))
+        return None
+
+    def size(self) -> int:
+        return len(self._queue)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._queue.clear()
+            self._recent.clear()
+
+
+_local_queue = LocalMatchQueue()
+
+
+def get_queue():
+    """Shared matchmaking queue: Redis when available, otherwise process-local."""
+    client = get_redis()
+    if client is None:
+        return _local_queue
+    return RedisMatchQueue(client)
+
+
+def deliver_match(match: Match, channel_layer) -> bool:
+    """Persist the pairing for both sockets and tell each side who offers."""
+    a, b = match.a, match.b
+    if not a.channel or not b.channel:
+        return False
+
+    room_id = f"rv-{uuid.uuid4().hex[:12]}"
+    cache.set(
+        f"{PAIR_KEY_PREFIX}{a.channel}",
+        {'peer': b.channel, 'room': room_id, 'peer_user_key': b.user_key},
+        timeout=1800,
+    )
+    cache.set(
+        f"{PAIR_KEY_PREFIX}{b.channel}",
+        {'peer': a.channel, 'room': room_id, 'peer_user_key': a.user_key},
+        timeout=1800,
+    )
+
+    async_to_sync(channel_layer.send)(
+        a.channel,
+        {'type': 'rv_matched', 'room': room_id, 'peer_channel': b.channel, 'offerer': True},
+    )
+    async_to_sync(channel_layer.send)(
+        b.channel,
+        {'type': 'rv_matched', 'room': room_id, 'peer_channel': a.channel, 'offerer': False},
+    )
+    return True
+
+
+def run_matcher_once(queue, channel_layer, *, max_pairs: int = 500) -> int:
+    """Pop and deliver up to `max_pairs` matches; returns how many were made."""
+    made = 0
+    while made < max_pairs:
+        match = queue.pop_pair()
+        if match is None:
+            break
+        try:
+            if deliver_match(match, channel_layer):
+                made += 1
+        except Exception:
+            continue
+    return made
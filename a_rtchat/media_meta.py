@@ -0,0 +1,228 @@
+"""Media metadata for chat attachments, sniffed once when the file arrives.
+
+`probe_upload()` runs in chat_file_upload on the in-memory/temporary upload,
+so the returned fields go into the same INSERT as the message. Templates then
+read `media_kind`, size and the LQIP placeholder from the row and never open
+the file (with ModeratedMediaCloudinaryStorage that would be a download).
+
+Images are identified by PIL from their header; MP4/MOV, WebM and Ogg by
+their magic bytes (MP4/MOV duration comes from the `mvhd` box). Anything else
+is stored as a plain file. `backfill()` fills rows saved before this existed.
+"""
+
+from __future__ import annotations
+
+import base64
+import io
+import mimetypes
+import struct
+
+from PIL import Image
+
+
+PLACEHOLDER_MAX_SIDE = 8
+# Placeholders larger than this (as a data: URI) are dropped.
+PLACEHOLDER_MAX_CHARS = 600
+
+_MP4_CONTAINERS = {b'moov', b'trak', b'mdia'}
+
+
+def _empty() -> dict:
+    return {
+        'media_kind': 'file',
+        'media_mime': '',
+        'media_width': None,
+        'media_height': None,
+        'media_duration_ms': None,
+        'media_bytes': None,
+        'media_placeholder': '',
+    }
+
+
+def _placeholder(image) -> str:
+    try:
+        thumb = image.copy()
+        thumb.thumbnail((PLACEHOLDER_MAX_SIDE, PLACEHOLDER_MAX_SIDE))
+        if thumb.mode not in ('RGB', 'L'):
+            thumb = thumb.convert('RGB')
+        buf = io.BytesIO()
+        thumb.save(buf, format='PNG', optimize=True)
+        uri = 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+        return uri if len(uri) <= PLACEHOLDER_MAX_CHARS else ''
+    except Exception:
+        return ''
+
+
+def _probe_image(fileobj) -> dict | None:
+    try:
+        fileobj.seek(0)
+        with Image.open(fileobj) as image:
+            fmt = image.format
+            width, height = image.size
+            # Decode only for the placeholder; draft() lets JPEG decode at 1/8 scale.
+            try:
+                image.draft('RGB', (PLACEHOLDER_MAX_SIDE * 4, PLACEHOLDER_MAX_SIDE * 4))
+            except Exception:
+                pass
+            placeholder = _placeholder(image)
+    except Exception:
+        return None
+    out = _empty()
+    out.update({
+        'media_kind': 'image',
+        'media_mime': Image.MIME.get(fmt or '', '') or '',
+        'media_width': int(width),
+        'media_height': int(height),
+        'media_placeholder': placeholder,
+    })
+    return out
+
+
+def _mp4_duration_ms(fileobj, size: int | None) -> int | None:
+    """Walk MP4 boxes (seeking, not reading) down to moov/mvhd."""
+
+    def walk(start: int, end: int | None):
+        pos = start
+        while end is None or pos + 8 <= end:
+            fileobj.seek(pos)
+            header = fileobj.read(8)
+            if len(header) < 8:
+                return None
+            box_size, box_type = struct.unpack('>I4s', header)
+            header_len = 8
+            if box_size == 1:
+                box_size = struct.unpack('>Q', fileobj.read(8))[0]
+                header_len = 16
+            elif box_size == 0:
+                if end is None:
+                    return None
+                box_size = end - pos
+            if box_size < header_len:
+                return None
+            if box_type == b'mvhd':
+                version = fileobj.read(1)
+                fileobj.read(3)
+                if version == b'\x01':
+                    fileobj.read(16)
+                    timescale, duration = struct.unpack('>IQ', fileobj.read(12))
+                else:
+                    fileobj.read(8)
+                    timescale, duration = struct.unpack('>II', fileobj.read(8))
+                if timescale:
+                    return int(duration * 1000 // timescale)
+                return None
+            if box_type in _MP4_CONTAINERS:
+                found = walk(pos + header_len, pos + box_size)
+                if found is not None:
+                    return found
+            pos += box_size
+        return None
+
+    try:
+        return walk(0, size)
+    except Exception:
+        return None
+
+
+def _sniff_video(head: bytes) -> str:
+    if len(head) >= 12 and head[4:8] == b'ftyp':
+        return 'video/quicktime' if head[8:12] == b'qt  ' else 'video/mp4'
+    if head.startswith(b'\x1aE\xdf\xa3'):
+        return 'video/webm'
+    if head.startswith(b'OggS'):
+        return 'video/ogg'
+    return ''
+
+
+def probe(fileobj, *, name: str = '', content_type: str = '', size: int | None = None) -> dict:
+    """Model field values for `fileobj`; reads headers only (plus a tiny decode for images)."""
+    out = _probe_image(fileobj)
+    if out is None:
+        out = _empty()
+        try:
+            fileobj.seek(0)
+            head = fileobj.read(16)
+        except Exception:
+            head = b''
+        video_mime = _sniff_video(head or b'')
+        if video_mime:
+            out['media_kind'] = 'video'
+            out['media_mime'] = video_mime
+            if video_mime in ('video/mp4', 'video/quicktime'):
+                out['media_duration_ms'] = _mp4_duration_ms(fileobj, size)
+        else:
+            guessed, _ = mimetypes.guess_type(name or '')
+            out['media_mime'] = (guessed or content_type or '')[:100]
+    if size is not None:
+        out['media_bytes'] = int(size)
+    try:
+        fileobj.seek(0)
+    except Exception:
+        pass
+    return out
+
+
+def probe_upload(upload) -> dict:
+    return probe(
+        upload,
+        name=getattr(upload, 'name', '') or '',
+        content_type=(getattr(upload, 'content_type', '') or '').lower(),
+        size=getattr(upload, 'size', None),
+    )
+
+
+def probe_stored(message) -> dict:
+    """Probe a message's file through its storage (backfill path; may download)."""
+    field = message.file
+    try:
+        size = field.size
+    except Exception:
+        size = None
+    field.open('rb')
+    try:
+        return probe(field, name=field.name or '', size=size)
+    finally:
+        try:
+            field.close()
+        except Exception:
+            pass
+
+
+def backfill(*, batch_size: int = 200, limit: int | None = None, stdout=None) -> int:
+    """Probe stored files of messages without metadata; returns rows updated."""
+    from .models import GroupMessage
+
+    fields = list(_empty().keys())
+    done = 0
+    last_id = 0
+    while limit is None or done < limit:
+        rows = list(
+            GroupMessage.objects
+            .filter(id__gt=last_id, media_kind='')
+            .exclude(file='')
+            .exclude(file__isnull=True)
+            .order_by('id')
+            .only('id', 'file')[:batch_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        changed = []
+        for message in rows:
+            try:
+                meta = probe_stored(message)
+            except Exception:
+                # Missing/unreadable file: fall back to the name so it is not retried forever.
+                meta = _empty()
+                guessed, _ = mimetypes.guess_type(message.file.name or '')
+                if guessed and guessed.startswith('image/'):
+                    meta['media_kind'] = 'image'
+                meta['media_mime'] = (guessed or '')[:100]
+            for key, value in meta.items():
+                setattr(message, key, value)
+            changed.append(message)
+        GroupMessage.objects.bulk_update(changed, fields)
+        done += len(changed)
+        if stdout is not None:
+            stdout.write(f"  {done} messages probed (last id {last_id})")
+    return done
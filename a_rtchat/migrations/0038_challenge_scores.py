@@ -0,0 +1,32 @@
+# Generated by Django 5.2.9 on 2026-10-17 02:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0037_groupmessage_support_submission'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChallengeScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wins', models.PositiveIntegerField(default=0)),
+                ('losses', models.PositiveIntegerField(default=0)),
+                ('played', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='challenge_scores', to='a_rtchat.chatgroup')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='challenge_scores', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', '-wins', 'losses'], name='cs_group_rank_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'group'), name='cs_user_group_uniq'), models.UniqueConstraint(condition=models.Q(('group__isnull', True)), fields=('user',), name='cs_user_global_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def backfill_summaries(apps, schema_editor):
+    # Same result as `manage.py rebuild_room_index`, with set-based queries.
+    GroupMessage = apps.get_model('a_rtchat', 'GroupMessage')
+    ChatRoomSummary = apps.get_model('a_rtchat', 'ChatRoomSummary')
+    ChatReadState = apps.get_model('a_rtchat', 'ChatReadState')
+
+    stats = {
+        row['group_id']: row
+        for row in GroupMessage.objects.values('group_id').annotate(n=Count('id'), last_id=Max('id')).order_by()
+    }
+    last_rows = {
+        mid: (author_id, created)
+        for mid, author_id, created in GroupMessage.objects.filter(
+            id__in=[row['last_id'] for row in stats.values()]
+        ).values_list('id', 'author_id', 'created')
+    }
+    summaries = []
+    for gid, row in stats.items():
+        author_id, created = last_rows.get(row['last_id'], (None, None))
+        other = (
+            GroupMessage.objects.filter(group_id=gid)
+            .exclude(author_id=author_id)
+            .aggregate(last=Max('id'))['last']
+        )
+        summaries.append(ChatRoomSummary(
+            group_id=gid,
+            last_message_id=int(row['last_id'] or 0),
+            last_message_at=created,
+            last_author_id=int(author_id or 0),
+            last_non_author_id=int(other or 0),
+            message_count=int(row['n'] or 0),
+        ))
+    ChatRoomSummary.objects.bulk_create(summaries, batch_size=1000, ignore_conflicts=True)
+
+    for pk, gid, uid, last_read in (
+        ChatReadState.objects.filter(group__is_private=True)
+        .values_list('pk', 'group_id', 'user_id', 'last_read_message_id')
+        .iterator()
+    ):
+        unread = (
+            GroupMessage.objects.filter(group_id=gid, id__gt=int(last_read or 0))
+            .exclude(author_id=uid)
+            .count()
+        )
+        if unread:
+            ChatReadState.objects.filter(pk=pk).update(unread_count=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0038_challenge_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ChatRoomSummary',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='a_rtchat.chatgroup')),
+                ('last_message_id', models.PositiveBigIntegerField(default=0)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_author_id', models.PositiveBigIntegerField(default=0)),
+                ('last_non_author_id', models.PositiveBigIntegerField(default=0)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-last_message_at'], name='roomsummary_last_at_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
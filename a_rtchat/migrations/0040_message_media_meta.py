@@ -0,0 +1,48 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0039_room_summary_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_bytes',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_duration_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_kind',
+            field=models.CharField(blank=True, choices=[('image', 'Image'), ('video', 'Video'), ('file', 'File')], default='', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_mime',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_placeholder',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='media_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0040_message_media_meta'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('reply_to_id', models.BigIntegerField(blank=True, null=True)),
+                ('body', models.CharField(blank=True, max_length=300, null=True)),
+                ('file', models.FileField(blank=True, null=True, upload_to='files/')),
+                ('file_caption', models.CharField(blank=True, max_length=300, null=True)),
+                ('link_url', models.URLField(blank=True, default='', max_length=500)),
+                ('link_title', models.CharField(blank=True, default='', max_length=300)),
+                ('link_description', models.CharField(blank=True, default='', max_length=500)),
+                ('link_image', models.URLField(blank=True, default='', max_length=500)),
+                ('link_site_name', models.CharField(blank=True, default='', max_length=120)),
+                ('media_kind', models.CharField(blank=True, default='', max_length=8)),
+                ('media_mime', models.CharField(blank=True, default='', max_length=100)),
+                ('media_width', models.PositiveIntegerField(blank=True, null=True)),
+                ('media_height', models.PositiveIntegerField(blank=True, null=True)),
+                ('media_duration_ms', models.PositiveIntegerField(blank=True, null=True)),
+                ('media_bytes', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('media_placeholder', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField()),
+                ('edited_at', models.DateTimeField(blank=True, null=True)),
+                ('reactions', models.JSONField(blank=True, default=dict)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='a_rtchat.chatgroup')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['group', '-id'], name='am_group_id_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.9 on 2026-10-17 04:12
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_archived_counts(apps, schema_editor):
+    ArchivedMessage = apps.get_model('a_rtchat', 'ArchivedMessage')
+    ChatRoomSummary = apps.get_model('a_rtchat', 'ChatRoomSummary')
+    for row in ArchivedMessage.objects.values('group_id').annotate(n=Count('id')).order_by():
+        ChatRoomSummary.objects.filter(group_id=row['group_id']).update(archived_count=row['n'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0041_archived_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='one_time_views',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='archivedmessage',
+            name='reactors',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='moderationevent',
+            name='archived_message_id',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroomsummary',
+            name='archived_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_archived_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.9 on 2026-10-17 04:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_rtchat', '0042_archive_dependents'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['message_id'], name='notif_message_idx'),
+        ),
+    ]
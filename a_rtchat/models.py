@@ -3,12 +3,11 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 import shortuuid
-from PIL import Image
 import os
 import mimetypes
 
 from .models_notifications import Notification
-from .models_read import ChatReadState
+from .models_read import ChatReadState, ChatRoomSummary
 
 class ChatGroup(models.Model):
     group_name = models.CharField(max_length=128, unique=True, blank=True)
@@ -16,6 +15,7 @@ class ChatGroup(models.Model):
     admin = models.ForeignKey(User, related_name='groupchats', blank=True, null=True, on_delete=models.SET_NULL)
     # Additional admins for this room (the `admin` field remains the room owner/creator).
     admins = models.ManyToManyField(User, related_name='admin_in_groups', blank=True)
+    # Legacy: no longer written. Live presence is kept in Redis (see a_rtchat.presence).
     users_online = models.ManyToManyField(User, related_name='online_in_groups', blank=True)
     members = models.ManyToManyField(User, related_name='chat_groups', blank=True)
     is_private = models.BooleanField(default=False)
@@ -147,6 +147,24 @@ class GroupMessage(models.Model):
     link_description = models.CharField(max_length=500, blank=True, default='')
     link_image = models.URLField(max_length=500, blank=True, default='')
     link_site_name = models.CharField(max_length=120, blank=True, default='')
+    # Media metadata, sniffed once at upload (a_rtchat.media_meta) so rendering
+    # never opens the file. Empty media_kind = not probed yet (see backfill_media_meta).
+    MEDIA_IMAGE = 'image'
+    MEDIA_VIDEO = 'video'
+    MEDIA_FILE = 'file'
+    MEDIA_KIND_CHOICES = (
+        (MEDIA_IMAGE, 'Image'),
+        (MEDIA_VIDEO, 'Video'),
+        (MEDIA_FILE, 'File'),
+    )
+    media_kind = models.CharField(max_length=8, choices=MEDIA_KIND_CHOICES, blank=True, default='')
+    media_mime = models.CharField(max_length=100, blank=True, default='')
+    media_width = models.PositiveIntegerField(null=True, blank=True)
+    media_height = models.PositiveIntegerField(null=True, blank=True)
+    media_duration_ms = models.PositiveIntegerField(null=True, blank=True)
+    media_bytes = models.PositiveBigIntegerField(null=True, blank=True)
+    # Tiny blurred preview as a data: URI (LQIP), shown while the image loads.
+    media_placeholder = models.TextField(blank=True, default='')
     # Mark user-submitted support reports/suggestions so admins can filter quickly.
     is_support_submission = models.BooleanField(default=False, db_index=True)
     support_submission_type = models.CharField(max_length=20, blank=True, default='', db_index=True)
@@ -192,20 +210,34 @@ class GroupMessage(models.Model):
             models.Index(fields=['group', '-created'], name='gm_group_created_idx'),
             models.Index(fields=['author', '-created'], name='gm_author_created_idx'),
         ]
+
+    @property
+    def author_card(self):
+        # Set in bulk by a_users.author_cards.attach(); otherwise looked up alone.
+        card = self.__dict__.get('_author_card')
+        if card is None:
+            from a_users.author_cards import get_card
+
+            card = get_card(self.author_id)
+            self._author_card = card
+        return card
         
     @property    
     def is_image(self):
-        try:
-            image = Image.open(self.file)
-            image.verify()
-            return True
-        except:
+        # Stored metadata only; rows not backfilled yet fall back to the file name.
+        if not self.file:
             return False
+        if self.media_kind:
+            return self.media_kind == self.MEDIA_IMAGE
+        guessed, _ = mimetypes.guess_type(getattr(self.file, 'name', '') or '')
+        return bool(guessed and guessed.startswith('image/'))
 
     @property
     def is_video(self):
         if not self.file:
             return False
+        if self.media_kind:
+            return self.media_kind == self.MEDIA_VIDEO
         name = (getattr(self.file, 'name', '') or '').lower()
         # Keep this to formats that are commonly playable in browsers.
         # (e.g. .mkv/.avi often upload fine but usually don't play in HTML5 video.)
@@ -215,6 +247,8 @@ class GroupMessage(models.Model):
     def video_mime_type(self):
         if not self.file:
             return ''
+        if self.media_kind == self.MEDIA_VIDEO and self.media_mime:
+            return self.media_mime
         name = (getattr(self.file, 'name', '') or '')
         guessed, _ = mimetypes.guess_type(name)
         if guessed:
@@ -227,6 +261,53 @@ class GroupMessage(models.Model):
         return 'video/mp4'
 
 
+class ArchivedMessage(models.Model):
+    """Cold copy of a GroupMessage moved out of the hot table (see a_rtchat.archive).
+
+    Keeps the original id, so history pages merge both tables by id. Messages
+    with polls, one-time files or support submissions, and messages a hot
+    reply still quotes, are never archived.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    group = models.ForeignKey(ChatGroup, related_name='archived_messages', on_delete=models.CASCADE)
+    author = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    # Hot or archived message id; no FK because the target may live in either table.
+    reply_to_id = models.BigIntegerField(null=True, blank=True)
+    body = models.CharField(max_length=300, blank=True, null=True)
+    file = models.FileField(upload_to='files/', blank=True, null=True)
+    file_caption = models.CharField(max_length=300, blank=True, null=True)
+    link_url = models.URLField(max_length=500, blank=True, default='')
+    link_title = models.CharField(max_length=300, blank=True, default='')
+    link_description = models.CharField(max_length=500, blank=True, default='')
+    link_image = models.URLField(max_length=500, blank=True, default='')
+    link_site_name = models.CharField(max_length=120, blank=True, default='')
+    media_kind = models.CharField(max_length=8, blank=True, default='')
+    media_mime = models.CharField(max_length=100, blank=True, default='')
+    media_width = models.PositiveIntegerField(null=True, blank=True)
+    media_height = models.PositiveIntegerField(null=True, blank=True)
+    media_duration_ms = models.PositiveIntegerField(null=True, blank=True)
+    media_bytes = models.PositiveBigIntegerField(null=True, blank=True)
+    media_placeholder = models.TextField(blank=True, default='')
+    created = models.DateTimeField()
+    edited_at = models.DateTimeField(null=True, blank=True)
+    # Reaction counts at archive time ({emoji: count}); reactions are read-only afterwards.
+    reactions = models.JSONField(default=dict, blank=True)
+    # The MessageReaction / OneTimeMessageView rows themselves, for `archive.restore()`:
+    # [[user_id, emoji, created], ...] and [[user_id, viewed_at], ...] (ISO times).
+    reactors = models.JSONField(default=list, blank=True)
+    one_time_views = models.JSONField(default=list, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', '-id'], name='am_group_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"archived #{self.id} ({self.group_id})"
+
+
 class OneTimeMessageView(models.Model):
     """Per-viewer open record for one-time messages.
 
@@ -260,6 +341,8 @@ class ModerationEvent(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='moderation_events')
     room = models.ForeignKey(ChatGroup, on_delete=models.SET_NULL, null=True, blank=True, related_name='moderation_events')
     message = models.ForeignKey(GroupMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='moderation_events')
+    # Set instead of `message` while the message is in the archive (see a_rtchat.archive).
+    archived_message_id = models.BigIntegerField(null=True, blank=True, db_index=True)
     text = models.TextField(blank=True, default='')
     action = models.CharField(max_length=16, choices=ACTION_CHOICES)
     categories = models.JSONField(default=list, blank=True)
@@ -385,6 +468,35 @@ class ChatChallenge(models.Model):
         return f"Challenge({self.kind}) room={getattr(self.group, 'group_name', '')} status={self.status}"
 
 
+class ChallengeScore(models.Model):
+    """Materialized challenge results per user and room.
+
+    `group=None` rows hold the user's site-wide totals. Maintained by
+    `a_rtchat.scoreboard` when a challenge completes; rebuild with
+    `manage.py backfill_challenge_scores`.
+    """
+
+    user = models.ForeignKey(User, related_name='challenge_scores', on_delete=models.CASCADE)
+    group = models.ForeignKey(ChatGroup, related_name='challenge_scores', null=True, blank=True, on_delete=models.CASCADE)
+    wins = models.PositiveIntegerField(default=0)
+    losses = models.PositiveIntegerField(default=0)
+    played = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'group'], name='cs_user_group_uniq'),
+            models.UniqueConstraint(fields=['user'], condition=models.Q(group__isnull=True), name='cs_user_global_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['group', '-wins', 'losses'], name='cs_group_rank_idx'),
+        ]
+
+    def __str__(self):
+        scope = getattr(self.group, 'group_name', '') or 'global'
+        return f"Score({self.user_id}@{scope}) W{self.wins} L{self.losses}"
+
+
 class ChatPoll(models.Model):
     group = models.ForeignKey(ChatGroup, related_name='polls', on_delete=models.CASCADE)
     created_by = models.ForeignKey(User, related_name='created_chat_polls', on_delete=models.CASCADE)
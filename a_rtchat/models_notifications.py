@@ -34,6 +34,7 @@ class Notification(models.Model):
         indexes = [
             models.Index(fields=['user', 'is_read', '-created'], name='notif_user_read_idx'),
             models.Index(fields=['user', '-created'], name='notif_user_created_idx'),
+            models.Index(fields=['message_id'], name='notif_message_idx'),
         ]
 
     def __str__(self):
@@ -8,6 +8,8 @@ class ChatReadState(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_read_states')
     group = models.ForeignKey('a_rtchat.ChatGroup', on_delete=models.CASCADE, related_name='read_states')
     last_read_message_id = models.PositiveBigIntegerField(default=0)
+    # Messages from others after `last_read_message_id` (private rooms only; see a_rtchat.room_index).
+    unread_count = models.PositiveIntegerField(default=0)
     updated = models.DateTimeField(auto_now=True)
 
     class Meta:
@@ -20,3 +22,39 @@ class ChatReadState(models.Model):
 
     def __str__(self):
         return f"ReadState(u={self.user_id}, g={self.group_id}, last={self.last_read_message_id})"
+
+
+class ChatRoomSummary(models.Model):
+    """Denormalized per-room message stats for the sidebar (see a_rtchat.room_index).
+
+    `last_non_author_id` is the newest message by someone other than
+    `last_author_id`, so "newest message not written by me" is one of the two
+    ids for any viewer.
+    """
+
+    group = models.OneToOneField('a_rtchat.ChatGroup', on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    last_message_id = models.PositiveBigIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_author_id = models.PositiveBigIntegerField(default=0)
+    last_non_author_id = models.PositiveBigIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    # Messages of the room in the archive table (a_rtchat.archive); the cap covers both.
+    archived_count = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_message_at'], name='roomsummary_last_at_idx'),
+        ]
+
+    def latest_id_not_by(self, user_id) -> int:
+        try:
+            uid = int(user_id or 0)
+        except Exception:
+            uid = 0
+        if int(self.last_author_id or 0) != uid:
+            return int(self.last_message_id or 0)
+        return int(self.last_non_author_id or 0)
+
+    def __str__(self):
+        return f"RoomSummary(g={self.group_id}, last={self.last_message_id}, n={self.message_count})"
@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import re
+import unicodedata
 from dataclasses import dataclass
 from typing import Any
 
@@ -58,49 +61,73 @@ def _gemini_url(model: str, api_key: str) -> str:
     return f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
 
 
+_PROMPT_RULES = (
+    "You are a strict chat moderation classifier for a real-time chat app. "
+    "Return ONLY valid minified JSON with no extra text.\n\n"
+    "Goal: detect abusive language (insults/personal attacks), hate speech (religion/caste/gender/race), "
+    "sexual/NSFW, harassment vs jokes (context-aware), spam, and bot-like behavior.\n\n"
+    "Rules:\n"
+    "- action must be one of: allow, flag, block\n"
+    "- categories must be a list of strings from: abusive, hate, sexual, harassment, spam, bot, self_harm, other\n"
+    "- severity must be integer 0-3 (0=clean, 1=borderline, 2=bad, 3=severe)\n"
+    "- confidence must be 0-1\n"
+    "- reason must be a short explanation WITHOUT quoting slurs or explicit content\n"
+    "- suggested_mute_seconds integer 0-3600\n"
+    "- Prefer allow unless clearly harmful. Prefer flag for ambiguous. Block for severe/clear hate/sexual/harassment threats.\n\n"
+    "JSON schema:\n"
+    "{\"action\":\"allow|flag|block\",\"categories\":[...],\"severity\":0,\"confidence\":0.0,\"reason\":\"...\",\"suggested_mute_seconds\":0}\n\n"
+)
+
+
 def _build_prompt(payload: dict[str, Any]) -> str:
+    return _PROMPT_RULES + f"Input:\n{json.dumps(payload, ensure_ascii=False)}\n"
+
+
+def _build_batch_prompt(items: list[dict[str, Any]]) -> str:
     return (
-        "You are a strict chat moderation classifier for a real-time chat app. "
-        "Return ONLY valid minified JSON with no extra text.\n\n"
-        "Goal: detect abusive language (insults/personal attacks), hate speech (religion/caste/gender/race), "
-        "sexual/NSFW, harassment vs jokes (context-aware), spam, and bot-like behavior.\n\n"
-        "Rules:\n"
-        "- action must be one of: allow, flag, block\n"
-        "- categories must be a list of strings from: abusive, hate, sexual, harassment, spam, bot, self_harm, other\n"
-        "- severity must be integer 0-3 (0=clean, 1=borderline, 2=bad, 3=severe)\n"
-        "- confidence must be 0-1\n"
-        "- reason must be a short explanation WITHOUT quoting slurs or explicit content\n"
-        "- suggested_mute_seconds integer 0-3600\n"
-        "- Prefer allow unless clearly harmful. Prefer flag for ambiguous. Block for severe/clear hate/sexual/harassment threats.\n\n"
-        "JSON schema:\n"
-        "{\"action\":\"allow|flag|block\",\"categories\":[...],\"severity\":0,\"confidence\":0.0,\"reason\":\"...\",\"suggested_mute_seconds\":0}\n\n"
-        f"Input:\n{json.dumps(payload, ensure_ascii=False)}\n"
+        _PROMPT_RULES
+        + "You receive a JSON array of independent messages (each with its own context). "
+        "Return ONLY a minified JSON array with exactly one verdict object per input, in the same order.\n\n"
+        f"Input:\n{json.dumps(items, ensure_ascii=False)}\n"
     )
 
 
-def moderate_message(*, text: str, context: dict[str, Any] | None = None) -> ModerationDecision:
+_ZERO_WIDTH_RE = re.compile('[\u200b-\u200f\u2060\ufeff]')
+_REPEAT_RE = re.compile(r'(.)\1{2,}')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form used for verdict caching (case, width, spacing, stretched letters)."""
+    s = unicodedata.normalize('NFKC', text or '')
+    s = _ZERO_WIDTH_RE.sub('', s).casefold()
+    s = _REPEAT_RE.sub(r'\1\1', s)
+    return _SPACE_RE.sub(' ', s).strip()
+
+
+def text_fingerprint(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def _post_gemini(prompt: str, *, max_output_tokens: int = 256) -> str | None:
+    """Send one prompt; returns the model's raw text, or None on any failure."""
     api_key = (getattr(settings, 'GEMINI_API_KEY', '') or '').strip()
     if not api_key:
-        return _default_decision()
+        return None
 
     model = (getattr(settings, 'GEMINI_MODEL', '') or 'gemini-1.5-flash').strip()
     timeout = float(getattr(settings, 'GEMINI_TIMEOUT_SECONDS', 4.0))
 
-    payload = {
-        'text': (text or '')[:2000],
-        'context': context or {},
-    }
-
     req = {
         'contents': [
             {
                 'role': 'user',
-                'parts': [{'text': _build_prompt(payload)}],
+                'parts': [{'text': prompt}],
             }
         ],
         'generationConfig': {
             'temperature': 0.0,
-            'maxOutputTokens': 256,
+            'maxOutputTokens': max_output_tokens,
         },
     }
 
@@ -111,15 +138,15 @@ def moderate_message(*, text: str, context: dict[str, Any] | None = None) -> Mod
             timeout=timeout,
         )
     except Exception:
-        return _default_decision()
+        return None
 
     if resp.status_code != 200:
-        return _default_decision()
+        return None
 
     try:
         data = resp.json()
     except Exception:
-        return _default_decision()
+        return None
 
     # Extract text from candidates
     try:
@@ -132,9 +159,12 @@ def moderate_message(*, text: str, context: dict[str, Any] | None = None) -> Mod
     except Exception:
         text_out = ''
 
-    if not text_out:
-        return _default_decision()
+    return text_out or None
 
+
+def _parse_json_output(text_out: str | None) -> Any:
+    if not text_out:
+        return None
     # Some models may wrap JSON in code fences; strip best-effort.
     cleaned = text_out.strip()
     if cleaned.startswith('```'):
@@ -143,9 +173,14 @@ def moderate_message(*, text: str, context: dict[str, Any] | None = None) -> Mod
             cleaned = cleaned[4:].strip()
 
     try:
-        verdict = json.loads(cleaned)
+        return json.loads(cleaned)
     except Exception:
-        return _default_decision()
+        return None
+
+
+def _decision_from_verdict(verdict: Any) -> ModerationDecision | None:
+    if not isinstance(verdict, dict):
+        return None
 
     action = str(verdict.get('action', 'allow')).strip().lower()
     if action not in {'allow', 'flag', 'block'}:
@@ -168,5 +203,75 @@ def moderate_message(*, text: str, context: dict[str, Any] | None = None) -> Mod
         confidence=confidence,
         reason=reason,
         suggested_mute_seconds=suggested_mute_seconds,
-        raw=verdict if isinstance(verdict, dict) else {},
+        raw=verdict,
+    )
+
+
+def _gemini_classify(text: str, context: dict[str, Any] | None = None) -> ModerationDecision | None:
+    payload = {
+        'text': (text or '')[:2000],
+        'context': context or {},
+    }
+    return _decision_from_verdict(_parse_json_output(_post_gemini(_build_prompt(payload))))
+
+
+def _gemini_classify_batch(items: list[dict[str, Any]]) -> list[ModerationDecision | None]:
+    """One request for many messages; any malformed reply leaves the whole batch unclassified."""
+    payload = [
+        {'text': (item.get('text') or '')[:2000], 'context': item.get('context') or {}}
+        for item in items
+    ]
+    verdicts = _parse_json_output(
+        _post_gemini(_build_batch_prompt(payload), max_output_tokens=min(8192, 160 * len(payload) + 64))
     )
+    if not isinstance(verdicts, list) or len(verdicts) != len(payload):
+        return [None] * len(payload)
+    return [_decision_from_verdict(v) for v in verdicts]
+
+
+def _stub_classify(text: str, context: dict[str, Any] | None = None) -> ModerationDecision | None:
+    """Offline classifier (dev/tests): substring match against configured term lists."""
+    normalized = normalize_text(text)
+    for terms, action, severity in (
+        (getattr(settings, 'AI_MODERATION_STUB_BLOCK_TERMS', ()) or (), 'block', 3),
+        (getattr(settings, 'AI_MODERATION_STUB_FLAG_TERMS', ()) or (), 'flag', 1),
+    ):
+        for term in terms:
+            term = normalize_text(str(term))
+            if term and term in normalized:
+                return ModerationDecision(
+                    action=action,
+                    categories=['other'],
+                    severity=severity,
+                    confidence=1.0,
+                    reason='Matched a configured stub term.',
+                    suggested_mute_seconds=0,
+                    raw={'stub': True},
+                )
+    return _default_decision()
+
+
+def _classifier_name() -> str:
+    return (str(getattr(settings, 'AI_MODERATION_CLASSIFIER', 'gemini') or 'gemini')).strip().lower()
+
+
+def classify(text: str, context: dict[str, Any] | None = None) -> ModerationDecision | None:
+    """Classify one message with the configured backend; None means "no verdict" (don't cache)."""
+    if _classifier_name() == 'stub':
+        return _stub_classify(text, context)
+    return _gemini_classify(text, context)
+
+
+def classify_batch(items: list[dict[str, Any]]) -> list[ModerationDecision | None]:
+    """Classify `[{'text', 'context'}, ...]` in a single backend call."""
+    if not items:
+        return []
+    if _classifier_name() == 'stub':
+        return [_stub_classify(item.get('text') or '', item.get('context')) for item in items]
+    if len(items) == 1:
+        return [_gemini_classify(items[0].get('text') or '', items[0].get('context'))]
+    return _gemini_classify_batch(items)
+
+
+def moderate_message(*, text: str, context: dict[str, Any] | None = None) -> ModerationDecision:
+    return classify(text, context) or _default_decision()
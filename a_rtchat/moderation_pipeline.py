@@ -0,0 +1,396 @@
+"""AI moderation pipeline: verdict cache, inline or post-delivery review.
+
+AI_MODERATION_MODE selects how chat messages are classified:
+
+- 'inline' (default): classify before saving (the original behaviour; blocks
+  the send)
+- 'optimistic' (opt-in): deliver immediately, classify in a background thread, and
+  retract the message (delete + `message_delete_handler`, and the mention/reply
+  notifications it produced) if it is blocked
+- 'batched' (opt-in): like optimistic, but messages from all rooms in this process
+  are grouped into one classifier request (AI_MODERATION_BATCH_SIZE /
+  AI_MODERATION_BATCH_WINDOW_MS)
+
+Verdicts are cached by a normalized-text fingerprint in a process LRU backed
+by the shared cache (Redis in production), so repeated texts are classified
+once. Failed classifier calls are never cached.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+from . import history, notifications, room_index
+from .channels_utils import chatroom_channel_group_name
+from .models import GroupMessage, ModerationEvent
+from .moderation import ModerationDecision, _default_decision, classify_batch, text_fingerprint
+from .rate_limit import record_abuse_violation
+
+
+MODE_INLINE = 'inline'
+MODE_OPTIMISTIC = 'optimistic'
+MODE_BATCHED = 'batched'
+
+VERDICT_KEY_PREFIX = 'mod:verdict:v1:'
+
+
+def pipeline_mode() -> str:
+    mode = str(getattr(settings, 'AI_MODERATION_MODE', MODE_INLINE) or '').strip().lower()
+    if mode in {MODE_INLINE, MODE_OPTIMISTIC, MODE_BATCHED}:
+        return mode
+    return MODE_INLINE
+
+
+def is_async_mode() -> bool:
+    return pipeline_mode() != MODE_INLINE
+
+
+def _decision_to_dict(decision: ModerationDecision) -> dict:
+    return {
+        'action': decision.action,
+        'categories': list(decision.categories or []),
+        'severity': int(decision.severity),
+        'confidence': float(decision.confidence),
+        'reason': decision.reason,
+        'suggested_mute_seconds': int(decision.suggested_mute_seconds),
+    }
+
+
+def _decision_from_dict(data: dict) -> ModerationDecision | None:
+    try:
+        return ModerationDecision(
+            action=str(data.get('action') or 'allow'),
+            categories=list(data.get('categories') or []),
+            severity=int(data.get('severity') or 0),
+            confidence=float(data.get('confidence') or 0.0),
+            reason=str(data.get('reason') or ''),
+            suggested_mute_seconds=int(data.get('suggested_mute_seconds') or 0),
+            raw={'cached': True},
+        )
+    except Exception:
+        return None
+
+
+class VerdictCache:
+    """Fingerprint -> decision, in a process LRU in front of the shared cache."""
+
+    def __init__(self, maxsize: int | None = None):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._local: OrderedDict[str, ModerationDecision] = OrderedDict()
+
+    def _limit(self) -> int:
+        if self._maxsize is not None:
+            return self._maxsize
+        try:
+            return max(0, int(getattr(settings, 'AI_MODERATION_VERDICT_LRU_SIZE', 5000)))
+        except Exception:
+            return 5000
+
+    def _remember(self, fp: str, decision: ModerationDecision) -> None:
+        limit = self._limit()
+        if limit <= 0:
+            return
+        with self._lock:
+            self._local[fp] = decision
+            self._local.move_to_end(fp)
+            while len(self._local) > limit:
+                self._local.popitem(last=False)
+
+    def get_many(self, fingerprints) -> dict[str, ModerationDecision]:
+        found: dict[str, ModerationDecision] = {}
+        missing = []
+        with self._lock:
+            for fp in fingerprints:
+                hit = self._local.get(fp)
+                if hit is None:
+                    missing.append(fp)
+                else:
+                    self._local.move_to_end(fp)
+                    found[fp] = hit
+        if missing:
+            try:
+                shared = cache.get_many([VERDICT_KEY_PREFIX + fp for fp in missing]) or {}
+            except Exception:
+                shared = {}
+            for key, data in shared.items():
+                decision = _decision_from_dict(data) if isinstance(data, dict) else None
+                if decision is None:
+                    continue
+                fp = key[len(VERDICT_KEY_PREFIX):]
+                found[fp] = decision
+                self._remember(fp, decision)
+        return found
+
+    def set(self, fp: str, decision: ModerationDecision) -> None:
+        self._remember(fp, decision)
+        try:
+            ttl = int(getattr(settings, 'AI_MODERATION_VERDICT_TTL_SECONDS', 24 * 60 * 60))
+            cache.set(VERDICT_KEY_PREFIX + fp, _decision_to_dict(decision), timeout=max(1, ttl))
+        except Exception:
+            pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+
+verdict_cache = VerdictCache()
+
+
+def classify_many_cached(items: list[dict]) -> list[ModerationDecision | None]:
+    """Classify `[{'text', 'context'}, ...]`; cache hits and in-batch duplicates skip the classifier.
+
+    `context` may be a callable so it is only built for cache misses.
+    """
+    fps = [text_fingerprint(item.get('text') or '') for item in items]
+    known = verdict_cache.get_many(set(fps))
+
+    todo: dict[str, dict] = {}
+    for fp, item in zip(fps, items):
+        if fp not in known and fp not in todo:
+            context = item.get('context')
+            todo[fp] = {'text': item.get('text') or '', 'context': context() if callable(context) else context}
+    if todo:
+        decisions = classify_batch(list(todo.values()))
+        for fp, decision in zip(list(todo.keys()), decisions):
+            if decision is None:
+                continue
+            known[fp] = decision
+            verdict_cache.set(fp, decision)
+    return [known.get(fp) for fp in fps]
+
+
+def moderate_cached(text: str, context: dict | None = None) -> ModerationDecision:
+    """Cached drop-in for `moderate_message` (allow when no verdict is available)."""
+    return classify_many_cached([{'text': text, 'context': context or {}}])[0] or _default_decision()
+
+
+def resolve_action(decision: ModerationDecision) -> str:
+    """Apply the configured confidence/severity thresholds to a model verdict."""
+    block_min = int(getattr(settings, 'AI_BLOCK_MIN_SEVERITY', 2))
+    flag_min = int(getattr(settings, 'AI_FLAG_MIN_SEVERITY', 1))
+    min_conf = float(getattr(settings, 'AI_MIN_CONFIDENCE', 0.55))
+
+    if decision.confidence < min_conf:
+        return 'allow'
+    if decision.severity >= block_min:
+        return 'block'
+    if decision.severity >= flag_min:
+        return 'flag'
+    return decision.action
+
+
+def _message_context(message) -> dict:
+    try:
+        last_user_msgs = list(
+            GroupMessage.objects.filter(group_id=message.group_id, author_id=message.author_id, id__lt=message.id)
+            .exclude(body__isnull=True)
+            .exclude(body='')
+            .order_by('-id')
+            .values_list('body', flat=True)[:5]
+        )
+    except Exception:
+        last_user_msgs = []
+    return {
+        'room': getattr(message.group, 'group_name', ''),
+        'room_id': message.group_id,
+        'user_id': message.author_id,
+        'last_user_messages': list(reversed(last_user_msgs)),
+    }
+
+
+def _retract(message, decision: ModerationDecision, *, via: str) -> None:
+    room = message.group
+    ModerationEvent.objects.create(
+        user_id=message.author_id,
+        room=room,
+        message=None,
+        text=(message.body or '')[:2000],
+        action='block',
+        categories=decision.categories,
+        severity=decision.severity,
+        confidence=decision.confidence,
+        reason=decision.reason,
+        source='gemini',
+        meta={
+            'model_action': decision.action,
+            'suggested_mute_seconds': decision.suggested_mute_seconds,
+            'via': via,
+            'retracted_message_id': int(message.id),
+        },
+    )
+
+    weight = 1 + int(decision.severity >= 2)
+    record_abuse_violation(
+        scope='ai_block',
+        user_id=message.author_id,
+        room=getattr(room, 'group_name', ''),
+        window_seconds=int(getattr(settings, 'CHAT_ABUSE_WINDOW', 600)),
+        threshold=int(getattr(settings, 'CHAT_ABUSE_STRIKE_THRESHOLD', 5)),
+        mute_seconds=int(getattr(settings, 'CHAT_ABUSE_MUTE_SECONDS', 60)),
+        weight=weight,
+    )
+
+    deleted_id = int(message.id)
+    history.invalidate(message)
+    message.delete()
+    room_index.messages_deleted(message.group_id, 1, max_id=deleted_id)
+    # Optimistic delivery already notified mentioned/replied-to users; drop those rows.
+    try:
+        notifications.delete_for_message(deleted_id, getattr(room, 'group_name', '') or '')
+    except Exception:
+        pass
+    try:
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            chatroom_channel_group_name(room),
+            {
+                'type': 'message_delete_handler',
+                'message_id': deleted_id,
+            },
+        )
+    except Exception:
+        pass
+
+
+def review_messages(message_ids, *, via: str | dict = 'ws') -> dict[str, int]:
+    """Classify already-delivered messages (one classifier call) and act on the verdicts.
+
+    Blocked messages are retracted; flagged ones (or all, with AI_LOG_ALL) get a
+    linked ModerationEvent. `via` is a label or {message_id: label}. Returns
+    counts per resolved action.
+    """
+    counts = {'allow': 0, 'flag': 0, 'block': 0, 'skipped': 0}
+    messages = list(
+        GroupMessage.objects.select_related('group')
+        .filter(id__in=list(message_ids or []))
+        .exclude(body__isnull=True)
+        .exclude(body='')
+        .order_by('id')
+    )
+    if not messages:
+        return counts
+
+    decisions = classify_many_cached([
+        {'text': m.body, 'context': (lambda m=m: _message_context(m))} for m in messages
+    ])
+    log_all = bool(int(getattr(settings, 'AI_LOG_ALL', 0)))
+    for message, decision in zip(messages, decisions):
+        if decision is None:
+            counts['skipped'] += 1
+            continue
+        source = via.get(message.id, 'ws') if isinstance(via, dict) else via
+        action = resolve_action(decision)
+        counts[action] += 1
+        try:
+            if action == 'block':
+                _retract(message, decision, via=source)
+                continue
+            if action == 'flag':
+                record_abuse_violation(
+                    scope='ai_flag',
+                    user_id=message.author_id,
+                    room=getattr(message.group, 'group_name', ''),
+                    window_seconds=int(getattr(settings, 'CHAT_ABUSE_WINDOW', 600)),
+                    threshold=int(getattr(settings, 'CHAT_ABUSE_STRIKE_THRESHOLD', 5)),
+                    mute_seconds=int(getattr(settings, 'CHAT_ABUSE_MUTE_SECONDS', 60)),
+                    weight=1,
+                )
+            if log_all or action == 'flag':
+                ModerationEvent.objects.create(
+                    user_id=message.author_id,
+                    room=message.group,
+                    message=message,
+                    text=(message.body or '')[:2000],
+                    action=action,
+                    categories=decision.categories,
+                    severity=decision.severity,
+                    confidence=decision.confidence,
+                    reason=decision.reason,
+                    source='gemini',
+                    meta={
+                        'model_action': decision.action,
+                        'suggested_mute_seconds': decision.suggested_mute_seconds,
+                        'linked': True,
+                        'via': source,
+                    },
+                )
+        except Exception:
+            continue
+    return counts
+
+
+class _ReviewWorker:
+    """Background thread that drains submitted message ids in batches."""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='moderation-review', daemon=True)
+            self._thread.start()
+
+    def submit(self, message_id: int, via: str) -> None:
+        self._queue.put((int(message_id), via))
+        self._ensure_started()
+
+    def _batch_limits(self) -> tuple[int, float]:
+        if pipeline_mode() != MODE_BATCHED:
+            return 1, 0.0
+        try:
+            size = max(1, int(getattr(settings, 'AI_MODERATION_BATCH_SIZE', 20)))
+            window = max(0.0, float(getattr(settings, 'AI_MODERATION_BATCH_WINDOW_MS', 250)) / 1000.0)
+        except Exception:
+            size, window = 20, 0.25
+        return size, window
+
+    def _run(self) -> None:
+        from django.db import close_old_connections
+
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            size, window = self._batch_limits()
+            deadline = time.monotonic() + window
+            while len(batch) < size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            close_old_connections()
+            try:
+                review_messages([mid for mid, _ in batch], via=dict(batch))
+            except Exception:
+                pass
+            close_old_connections()
+
+
+_worker = _ReviewWorker()
+
+
+def submit(message_id, *, via: str = 'ws') -> None:
+    """Queue a delivered message for background review (no-op in inline mode)."""
+    if not is_async_mode():
+        return
+    try:
+        _worker.submit(int(message_id), via)
+    except Exception:
+        pass
@@ -18,6 +18,7 @@ from a_users.models import Profile
 
 from .models import ChatGroup, GroupMessage, Notification
 from .mentions import extract_mention_usernames, resolve_mentioned_users
+from . import presence
 
 
 NATASHA_USERNAME = "natasha"
@@ -129,16 +130,12 @@ def _send_ai_unavailable_notice(chat_group: ChatGroup, bot) -> None:
             from channels.layers import get_channel_layer
             from asgiref.sync import async_to_sync
             from .channels_utils import chatroom_channel_group_name
+            from .fanout import message_event
 
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 chatroom_channel_group_name(chat_group),
-                {
-                    'type': 'message_handler',
-                    'message_id': msg.id,
-                    'skip_sender': False,
-                    'author_id': getattr(bot, 'id', None),
-                },
+                message_event(msg, chat_group, author_id=getattr(bot, 'id', None)),
             )
         except Exception:
             pass
@@ -179,6 +176,7 @@ def _send_mention_notifications(chat_group: ChatGroup, *, from_user, message: Gr
         except Exception:
             channel_layer = None
 
+        targets = []
         for u in mentioned:
             try:
                 if not getattr(u, 'id', None):
@@ -189,32 +187,31 @@ def _send_mention_notifications(chat_group: ChatGroup, *, from_user, message: Gr
                     continue
             except Exception:
                 continue
+            targets.append(u)
 
-            # Persist notification (best-effort)
-            try:
-                from a_rtchat.notifications import should_persist_notification
-
-                if should_persist_notification(user_id=u.id, chatroom_name=chat_group.group_name) or bool(getattr(chat_group, 'is_private', False)):
-                    Notification.objects.create(
-                        user=u,
-                        from_user=from_user,
-                        type='mention',
-                        chatroom_name=chat_group.group_name,
-                        message_id=message.id,
-                        preview=preview,
-                        url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
-                    )
-            except Exception:
-                pass
+        # Persist notifications (best-effort): one state query + one insert.
+        states = None
+        try:
+            from a_rtchat.notifications import notify_many
+
+            states = notify_many(
+                [u.id for u in targets],
+                type='mention',
+                from_user=from_user,
+                chatroom_name=chat_group.group_name,
+                message_id=message.id,
+                preview=preview,
+                url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
+                always_persist=bool(getattr(chat_group, 'is_private', False)),
+            )
+        except Exception:
+            states = None
 
+        for u in targets:
             # DND: don't send realtime/push to this user.
             allow_realtime = True
-            try:
-                from a_rtchat.notifications import should_send_realtime_notification
-
-                allow_realtime = bool(should_send_realtime_notification(user_id=u.id))
-            except Exception:
-                allow_realtime = True
+            if states is not None:
+                allow_realtime = bool(u.id in states and states[u.id].realtime)
 
             # Live websocket notify (best-effort)
             try:
@@ -234,11 +231,10 @@ def _send_mention_notifications(chat_group: ChatGroup, *, from_user, message: Gr
 
             # Optional: push notification via FCM (offline / background)
             try:
-                from a_users.tasks import send_mention_push_task
-                from .views import _celery_broker_configured
+                from a_users.push import enqueue_mention
 
-                if allow_realtime and _celery_broker_configured():
-                    send_mention_push_task.delay(
+                if allow_realtime:
+                    enqueue_mention(
                         u.id,
                         from_username=getattr(from_user, 'username', '') or NATASHA_USERNAME,
                         chatroom_name=chat_group.group_name,
@@ -269,16 +265,12 @@ def _send_openrouter_privacy_notice(chat_group: ChatGroup, bot) -> None:
             from channels.layers import get_channel_layer
             from asgiref.sync import async_to_sync
             from .channels_utils import chatroom_channel_group_name
+            from .fanout import message_event
 
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 chatroom_channel_group_name(chat_group),
-                {
-                    'type': 'message_handler',
-                    'message_id': msg.id,
-                    'skip_sender': False,
-                    'author_id': getattr(bot, 'id', None),
-                },
+                message_event(msg, chat_group, author_id=getattr(bot, 'id', None)),
             )
         except Exception:
             pass
@@ -384,7 +376,7 @@ def _recent_non_bot_chatter_count(chat_group: ChatGroup) -> int:
     except Exception:
         # Fallback: connected users (may over-count idle users)
         try:
-            return int(chat_group.users_online.count())
+            return int(presence.count(chat_group))
         except Exception:
             return 0
 
@@ -484,16 +476,12 @@ def _send_ai_not_configured_notice(chat_group: ChatGroup, bot) -> None:
             from channels.layers import get_channel_layer
             from asgiref.sync import async_to_sync
             from .channels_utils import chatroom_channel_group_name
+            from .fanout import message_event
 
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 chatroom_channel_group_name(chat_group),
-                {
-                    'type': 'message_handler',
-                    'message_id': msg.id,
-                    'skip_sender': False,
-                    'author_id': getattr(bot, 'id', None),
-                },
+                message_event(msg, chat_group, author_id=getattr(bot, 'id', None)),
             )
         except Exception:
             pass
@@ -518,16 +506,12 @@ def _send_ai_rate_limited_goodbye(chat_group: ChatGroup, bot) -> None:
             from channels.layers import get_channel_layer
             from asgiref.sync import async_to_sync
             from .channels_utils import chatroom_channel_group_name
+            from .fanout import message_event
 
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 chatroom_channel_group_name(chat_group),
-                {
-                    'type': 'message_handler',
-                    'message_id': msg.id,
-                    'skip_sender': False,
-                    'author_id': getattr(bot, 'id', None),
-                },
+                message_event(msg, chat_group, author_id=getattr(bot, 'id', None)),
             )
         except Exception:
             pass
@@ -967,16 +951,12 @@ def natasha_maybe_reply(chat_group_id: int, trigger_message_id: int) -> None:
                 from channels.layers import get_channel_layer
                 from asgiref.sync import async_to_sync
                 from .channels_utils import chatroom_channel_group_name
+                from .fanout import message_event
 
                 channel_layer = get_channel_layer()
                 async_to_sync(channel_layer.group_send)(
                     chatroom_channel_group_name(chat_group),
-                    {
-                        'type': 'message_handler',
-                        'message_id': msg.id,
-                        'skip_sender': False,
-                        'author_id': getattr(bot, 'id', None),
-                    },
+                    message_event(msg, chat_group, author_id=getattr(bot, 'id', None)),
                 )
             except Exception:
                 pass
@@ -4,6 +4,10 @@ from dataclasses import dataclass
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+
+UNREAD_KEY_PREFIX = 'notif:unread:v1:'
 
 
 def _is_dnd_user(user) -> bool:
@@ -34,13 +38,12 @@ class NotifyTarget:
 def _is_user_online_in_any_chat(user) -> bool:
     """Best-effort online check.
 
-    Uses ChatGroup.users_online M2M which is updated by websocket connects.
+    Uses the Redis presence sets which are updated by websocket connects.
     """
     try:
-        # Avoid circular import at module load.
-        from a_rtchat.models import ChatGroup
+        from a_rtchat import presence
 
-        return ChatGroup.objects.filter(users_online=user).exists()
+        return presence.is_online(user)
     except Exception:
         return False
 
@@ -50,9 +53,9 @@ def _is_user_online_in_chat(*, user, chatroom_name: str) -> bool:
     try:
         if not chatroom_name:
             return False
-        from a_rtchat.models import ChatGroup
+        from a_rtchat import presence
 
-        return ChatGroup.objects.filter(group_name=chatroom_name, users_online=user).exists()
+        return presence.is_online(user, chatroom_name)
     except Exception:
         return False
 
@@ -81,3 +84,190 @@ def should_persist_notification(*, user_id: int, chatroom_name: str | None = Non
     if chatroom_name:
         return not _is_user_online_in_chat(user=user, chatroom_name=chatroom_name)
     return not _is_user_online_in_any_chat(user)
+
+
+# --- batched write path ------------------------------------------------------------
+
+@dataclass
+class RecipientState:
+    user_id: int
+    active: bool
+    dnd: bool
+    persisted: bool = False
+
+    @property
+    def realtime(self) -> bool:
+        """Same answer as should_send_realtime_notification()."""
+        return self.active and not self.dnd
+
+
+def recipient_states(user_ids) -> dict[int, RecipientState]:
+    """Active/DND state for many users with one query (unknown ids are left out)."""
+    ids = {int(x) for x in (user_ids or []) if x}
+    if not ids:
+        return {}
+    User = get_user_model()
+    return {
+        int(uid): RecipientState(user_id=int(uid), active=bool(active), dnd=bool(dnd))
+        for uid, active, dnd in User.objects.filter(id__in=ids).values_list('id', 'is_active', 'profile__is_dnd')
+    }
+
+
+def _persist_allowed(state: RecipientState, chatroom_name: str | None) -> bool:
+    """should_persist_notification() for an already-loaded recipient."""
+    if not state.realtime:
+        return False
+    if bool(getattr(settings, 'PERSIST_NOTIFICATIONS_WHEN_ONLINE', True)):
+        return True
+    if chatroom_name:
+        return not _is_user_online_in_chat(user=state.user_id, chatroom_name=chatroom_name)
+    return not _is_user_online_in_any_chat(state.user_id)
+
+
+def notify_many(
+    user_ids,
+    *,
+    type: str,
+    from_user=None,
+    chatroom_name: str = '',
+    message_id: int | None = None,
+    preview: str = '',
+    url: str = '',
+    always_persist: bool = False,
+    skip_dnd: bool = False,
+) -> dict[int, RecipientState]:
+    """Persist one notification per recipient with one state query and one insert.
+
+    A row is written where should_persist_notification() would allow it, or for
+    every known recipient when `always_persist` (private rooms). With
+    `skip_dnd`, inactive/DND recipients get no row either way. Returns the
+    recipients' states so callers can gate realtime delivery on `.realtime`.
+    """
+    from .models import Notification
+
+    states = recipient_states(user_ids)
+    rows = []
+    for uid, state in states.items():
+        if skip_dnd and not state.realtime:
+            continue
+        if always_persist or _persist_allowed(state, chatroom_name):
+            state.persisted = True
+            rows.append(Notification(
+                user_id=uid,
+                from_user=from_user,
+                type=type,
+                chatroom_name=chatroom_name or '',
+                message_id=message_id,
+                preview=(preview or '')[:180],
+                url=url or '',
+            ))
+    if rows:
+        Notification.objects.bulk_create(rows)
+        for row in rows:
+            bump_unread(row.user_id)
+    return states
+
+
+# --- cached unread counters -----------------------------------------------------------
+# `bulk_create` and queryset updates/deletes bypass model signals, so every write
+# path adjusts the counter explicitly; single `.create()` calls are covered by the
+# post_save receiver in signals.py. A missing key is simply recounted on read.
+
+def _unread_key(user_id) -> str:
+    return f"{UNREAD_KEY_PREFIX}{int(user_id)}"
+
+
+def _unread_ttl() -> int:
+    try:
+        return max(60, int(getattr(settings, 'NOTIFICATION_UNREAD_CACHE_SECONDS', 3600)))
+    except Exception:
+        return 3600
+
+
+def unread_count(user_id) -> int:
+    """Unread notifications for the navbar badge (a COUNT only on a cold cache)."""
+    from .models import Notification
+
+    key = _unread_key(user_id)
+    try:
+        value = cache.get(key)
+        if value is not None:
+            return max(0, int(value))
+    except Exception:
+        pass
+    count = int(Notification.objects.filter(user_id=user_id, is_read=False).count() or 0)
+    try:
+        cache.add(key, count, timeout=_unread_ttl())
+    except Exception:
+        pass
+    return count
+
+
+def bump_unread(user_id, delta: int = 1) -> None:
+    if not delta:
+        return
+    key = _unread_key(user_id)
+    try:
+        value = cache.incr(key, delta) if delta > 0 else cache.decr(key, -delta)
+        if value < 0:
+            cache.delete(key)
+    except ValueError:
+        # Not cached: the next read counts from the database.
+        pass
+    except Exception:
+        try:
+            cache.delete(key)
+        except Exception:
+            pass
+
+
+def reset_unread(user_id, value: int | None = None) -> None:
+    """Set the counter (e.g. 0 after mark-all-read) or drop it so it is recounted."""
+    key = _unread_key(user_id)
+    try:
+        if value is None:
+            cache.delete(key)
+        else:
+            cache.set(key, int(value), timeout=_unread_ttl())
+    except Exception:
+        pass
+
+
+def mark_read(user_id, **filters) -> int:
+    """Mark the user's unread notifications matching `filters` as read; returns rows changed."""
+    from .models import Notification
+
+    updated = Notification.objects.filter(user_id=user_id, is_read=False, **filters).update(is_read=True)
+    if updated:
+        if filters:
+            bump_unread(user_id, -updated)
+        else:
+            reset_unread(user_id, 0)
+    return int(updated or 0)
+
+
+def clear_all(user_id) -> None:
+    from .models import Notification
+
+    Notification.objects.filter(user_id=user_id).delete()
+    reset_unread(user_id, 0)
+
+
+def delete_for_message(message_id, chatroom_name: str = '') -> int:
+    """Drop the mention/reply notifications a removed message produced.
+
+    The recipients' unread counters are reset so their badges are recounted.
+    Returns rows deleted.
+    """
+    from .models import Notification
+
+    qs = Notification.objects.filter(message_id=int(message_id))
+    if chatroom_name:
+        qs = qs.filter(chatroom_name=chatroom_name)
+    user_ids = set(qs.values_list('user_id', flat=True))
+    if not user_ids:
+        return 0
+    deleted, _ = qs.delete()
+    for uid in user_ids:
+        reset_unread(uid)
+    return int(deleted or 0)
@@ -0,0 +1,309 @@
+"""Redis-backed presence.
+
+Each scope (a chat room's group_name, 'online-status', or the global scope)
+keeps three structures:
+
+- a sorted set of user ids scored by last heartbeat (epoch seconds)
+- a hash of per-user connection counts (HINCRBY, so multi-tab is atomic)
+- a hash of "online since" timestamps for the current continuous session
+
+Members whose heartbeat is older than PRESENCE_TTL_SECONDS are treated as
+offline, so crashed sockets expire on their own without any cleanup pass.
+Without Redis (local/dev) the same API is served from the default cache.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .redis_utils import get_redis
+
+
+ONLINE_STATUS_ROOM = 'online-status'
+GLOBAL_SCOPE = '*'
+
+# Keys are refreshed on every join/touch; this only reaps abandoned rooms.
+_KEY_TTL_SECONDS = 6 * 60 * 60
+
+_JOIN_LUA = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if (not score) or tonumber(score) < tonumber(ARGV[3]) then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+end
+local n = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return n
+"""
+
+_LEAVE_LUA = """
+local n = redis.call('HINCRBY', KEYS[2], ARGV[1], -1)
+if n <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    return 0
+end
+return n
+"""
+
+_local_lock = threading.Lock()
+
+
+def _ttl_seconds() -> int:
+    try:
+        return max(10, int(getattr(settings, 'PRESENCE_TTL_SECONDS', 120)))
+    except Exception:
+        return 120
+
+
+def _scope_name(room) -> str:
+    if room is None:
+        return GLOBAL_SCOPE
+    name = getattr(room, 'group_name', None)
+    return str(name if name is not None else room)
+
+
+def _keys(scope: str) -> tuple[str, str, str]:
+    base = f"presence:{scope}"
+    return base, f"{base}:conns", f"{base}:since"
+
+
+def _uid(user) -> int:
+    try:
+        return int(getattr(user, 'id', user) or 0)
+    except Exception:
+        return 0
+
+
+# --- LocMem fallback -------------------------------------------------------
+# Single-process dev only: {uid: [conns, last_seen, since]} per scope.
+
+def _local_key(scope: str) -> str:
+    return f"presence:local:{scope}"
+
+
+def _local_load(scope: str) -> dict:
+    try:
+        return dict(cache.get(_local_key(scope)) or {})
+    except Exception:
+        return {}
+
+
+def _local_save(scope: str, data: dict) -> None:
+    try:
+        cache.set(_local_key(scope), data, timeout=_KEY_TTL_SECONDS)
+    except Exception:
+        pass
+
+
+def _local_join(scope: str, uid: int, now: float, stale_before: float) -> int:
+    with _local_lock:
+        data = _local_load(scope)
+        row = data.get(uid)
+        if not row or row[1] < stale_before:
+            row = [0, now, now]
+        row = [row[0] + 1, now, row[2]]
+        data[uid] = row
+        _local_save(scope, data)
+        return row[0]
+
+
+def _local_leave(scope: str, uid: int) -> int:
+    with _local_lock:
+        data = _local_load(scope)
+        row = data.get(uid)
+        if not row:
+            return 0
+        n = int(row[0]) - 1
+        if n <= 0:
+            data.pop(uid, None)
+            n = 0
+        else:
+            data[uid] = [n, row[1], row[2]]
+        _local_save(scope, data)
+        return n
+
+
+def _local_touch(scope: str, uid: int, now: float) -> bool:
+    with _local_lock:
+        data = _local_load(scope)
+        row = data.get(uid)
+        if not row:
+            return False
+        data[uid] = [row[0], now, row[2]]
+        _local_save(scope, data)
+        return True
+
+
+def _local_online(scope: str, stale_before: float) -> dict[int, list]:
+    return {uid: row for uid, row in _local_load(scope).items() if row and row[1] >= stale_before}
+
+
+# --- Public API ------------------------------------------------------------
+
+def _join_scope(scope: str, uid: int) -> int:
+    now = time.time()
+    stale_before = now - _ttl_seconds()
+    client = get_redis()
+    if client is None:
+        return _local_join(scope, uid, now, stale_before)
+    try:
+        script = client.register_script(_JOIN_LUA)
+        return int(script(keys=list(_keys(scope)), args=[uid, now, stale_before, _KEY_TTL_SECONDS]) or 0)
+    except Exception:
+        return 1
+
+
+def _leave_scope(scope: str, uid: int) -> int:
+    client = get_redis()
+    if client is None:
+        return _local_leave(scope, uid)
+    try:
+        script = client.register_script(_LEAVE_LUA)
+        return int(script(keys=list(_keys(scope)), args=[uid]) or 0)
+    except Exception:
+        return 0
+
+
+def join(room, user) -> int:
+    """Register one connection for `user` in `room`; returns that user's connection count.
+
+    A return value of 1 means this is the user's first live connection in the room.
+    Every join also counts towards the global scope used by `is_online(user)`.
+    """
+    uid = _uid(user)
+    if uid <= 0:
+        return 0
+    scope = _scope_name(room)
+    n = _join_scope(scope, uid)
+    if scope != GLOBAL_SCOPE:
+        _join_scope(GLOBAL_SCOPE, uid)
+    return n
+
+
+def leave(room, user) -> int:
+    """Drop one connection; returns the remaining count (0 = user went offline in the room)."""
+    uid = _uid(user)
+    if uid <= 0:
+        return 0
+    scope = _scope_name(room)
+    n = _leave_scope(scope, uid)
+    if scope != GLOBAL_SCOPE:
+        _leave_scope(GLOBAL_SCOPE, uid)
+    return n
+
+
+def touch(room, user) -> bool:
+    """Heartbeat: refresh the user's score in `room` (and globally). No-op if not joined."""
+    uid = _uid(user)
+    if uid <= 0:
+        return False
+    now = time.time()
+    scopes = [_scope_name(room)]
+    if scopes[0] != GLOBAL_SCOPE:
+        scopes.append(GLOBAL_SCOPE)
+
+    client = get_redis()
+    if client is None:
+        ok = False
+        for scope in scopes:
+            ok = _local_touch(scope, uid, now) or ok
+        return ok
+    try:
+        pipe = client.pipeline(transaction=False)
+        for scope in scopes:
+            zkey, ckey, skey = _keys(scope)
+            pipe.zadd(zkey, {uid: now}, xx=True, ch=True)
+            pipe.expire(zkey, _KEY_TTL_SECONDS)
+            pipe.expire(ckey, _KEY_TTL_SECONDS)
+            pipe.expire(skey, _KEY_TTL_SECONDS)
+        results = pipe.execute()
+        return bool(results and results[0])
+    except Exception:
+        return False
+
+
+def online_ids(room=None) -> set[int]:
+    """User ids with a live heartbeat in `room` (None = anywhere)."""
+    scope = _scope_name(room)
+    stale_before = time.time() - _ttl_seconds()
+    client = get_redis()
+    if client is None:
+        return set(_local_online(scope, stale_before).keys())
+    try:
+        zkey = _keys(scope)[0]
+        pipe = client.pipeline(transaction=False)
+        # Lazily drop expired members so the set doesn't grow with crashed sockets.
+        pipe.zremrangebyscore(zkey, '-inf', f"({stale_before}")
+        pipe.zrangebyscore(zkey, stale_before, '+inf')
+        _, members = pipe.execute()
+        return {int(m) for m in (members or [])}
+    except Exception:
+        return set()
+
+
+def count(room=None) -> int:
+    """Number of users online in `room` (None = distinct users online anywhere)."""
+    scope = _scope_name(room)
+    stale_before = time.time() - _ttl_seconds()
+    client = get_redis()
+    if client is None:
+        return len(_local_online(scope, stale_before))
+    try:
+        return int(client.zcount(_keys(scope)[0], stale_before, '+inf') or 0)
+    except Exception:
+        return 0
+
+
+def is_online(user, room=None) -> bool:
+    """True if `user` has a live connection in `room` (None = anywhere)."""
+    uid = _uid(user)
+    if uid <= 0:
+        return False
+    scope = _scope_name(room)
+    stale_before = time.time() - _ttl_seconds()
+    client = get_redis()
+    if client is None:
+        return uid in _local_online(scope, stale_before)
+    try:
+        score = client.zscore(_keys(scope)[0], uid)
+        return score is not None and float(score) >= stale_before
+    except Exception:
+        return False
+
+
+def online_since(room, user_ids) -> dict[int, float]:
+    """Start of the current continuous session for each online user in `room`."""
+    ids = [u for u in (_uid(x) for x in (user_ids or [])) if u > 0]
+    if not ids:
+        return {}
+    scope = _scope_name(room)
+    stale_before = time.time() - _ttl_seconds()
+    client = get_redis()
+    if client is None:
+        rows = _local_online(scope, stale_before)
+        return {uid: float(rows[uid][2]) for uid in ids if uid in rows}
+    try:
+        zkey, _ckey, skey = _keys(scope)
+        pipe = client.pipeline(transaction=False)
+        for uid in ids:
+            pipe.zscore(zkey, uid)
+        pipe.hmget(skey, ids)
+        results = pipe.execute()
+        scores, since = results[:-1], results[-1] or []
+        out: dict[int, float] = {}
+        for uid, score, ts in zip(ids, scores, since):
+            if score is None or float(score) < stale_before or ts is None:
+                continue
+            out[uid] = float(ts)
+        return out
+    except Exception:
+        return {}
@@ -0,0 +1,247 @@
+"""Coalesced online-status broadcasts.
+
+Presence changes only mark the site-wide snapshot dirty. At most once per
+PRESENCE_BROADCAST_INTERVAL_SECONDS a single process (whoever wins the
+`cache.add` below) recomputes the shared snapshot and pushes one compact
+delta to the 'online-status' group:
+
+    {'type': 'online_status_handler', 'total': 123, 'added': [...], 'removed': [...]}
+
+`added`/`removed` are ids whose *visible* online state changed (stealth and
+bot accounts are never visible). Recipients only filter the delta for
+themselves, so a tick costs O(changes) per socket instead of O(N) queries,
+and each socket only forwards the ids of its own chat partners (a new
+socket gets the total plus its online partners, never the whole list).
+
+The hidden (stealth/bot) ids live in one Redis set (`HIDDEN_KEY`, or the
+default cache without Redis), built from Profile once per HIDDEN_TTL and
+kept current by the Profile save signal (`set_hidden()`), so a flush never
+queries the database.
+
+The same flips are also published to per-target groups (`presence.user.<id>`)
+so profile pages only wake up when the viewed user's visibility changes.
+
+Sockets that drop without a close frame never reach `disconnect()`; their
+heartbeat just goes stale. `check_expired()` runs from the heartbeat handler
+(at most once per PRESENCE_EXPIRY_CHECK_SECONDS across processes) and
+schedules a broadcast when someone in the published snapshot has expired.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+from . import presence
+from .redis_utils import get_redis
+
+
+PENDING_KEY = 'presence:bcast:pending'
+SNAPSHOT_KEY = 'presence:bcast:snapshot'
+EXPIRY_CHECK_KEY = 'presence:bcast:expiry-check'
+HIDDEN_KEY = 'presence:hidden:v1'
+HIDDEN_TTL = 3600
+# Redis drops empty sets; this member marks "built, nobody hidden".
+_HIDDEN_SENTINEL = '0'
+
+# Only update a built set; a missing one is rebuilt from Profile on read
+# (creating it here would make a partial set look complete).
+_hidden_lock = threading.Lock()
+
+_SET_HIDDEN_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  if ARGV[2] == '1' then
+    redis.call('SADD', KEYS[1], ARGV[1])
+  else
+    redis.call('SREM', KEYS[1], ARGV[1])
+  end
+end
+return 1
+"""
+
+
+def user_presence_group(user_id) -> str:
+    return f"presence.user.{int(user_id)}"
+
+
+def _interval_seconds() -> float:
+    try:
+        return max(0.0, float(getattr(settings, 'PRESENCE_BROADCAST_INTERVAL_SECONDS', 1.5)))
+    except Exception:
+        return 1.5
+
+
+def _load_hidden() -> set[int]:
+    from django.db.models import Q
+    from a_users.models import Profile
+
+    return set(
+        int(x)
+        for x in Profile.objects.filter(Q(is_stealth=True) | Q(is_bot=True)).values_list('user_id', flat=True)
+    )
+
+
+def hidden_user_ids() -> set[int]:
+    """Users who must never appear online to others (stealth or bot accounts)."""
+    try:
+        client = get_redis()
+        if client is not None:
+            members = client.smembers(HIDDEN_KEY)
+            if members:
+                return {int(m) for m in members} - {int(_HIDDEN_SENTINEL)}
+            ids = _load_hidden()
+            pipe = client.pipeline()
+            pipe.delete(HIDDEN_KEY)
+            pipe.sadd(HIDDEN_KEY, _HIDDEN_SENTINEL, *ids)
+            pipe.expire(HIDDEN_KEY, HIDDEN_TTL)
+            pipe.execute()
+            return ids
+        ids = cache.get(HIDDEN_KEY)
+        if ids is None:
+            ids = _load_hidden()
+            cache.set(HIDDEN_KEY, ids, timeout=HIDDEN_TTL)
+        return set(ids)
+    except Exception:
+        return set()
+
+
+def set_hidden(user_id, hidden: bool) -> None:
+    """Keep the hidden set current after a stealth/bot change (Profile save signal)."""
+    try:
+        uid = int(user_id or 0)
+    except Exception:
+        return
+    if not uid:
+        return
+    try:
+        client = get_redis()
+        if client is None:
+            with _hidden_lock:
+                ids = cache.get(HIDDEN_KEY)
+                if ids is not None:
+                    ids = set(ids) | {uid} if hidden else set(ids) - {uid}
+                    cache.set(HIDDEN_KEY, ids, timeout=HIDDEN_TTL)
+            return
+        script = client.register_script(_SET_HIDDEN_LUA)
+        script(keys=[HIDDEN_KEY], args=[uid, '1' if hidden else '0'])
+    except Exception:
+        pass
+
+
+def get_snapshot() -> dict:
+    """Last published snapshot: {'total': int, 'visible': [ids]} (computed if missing)."""
+    try:
+        snap = cache.get(SNAPSHOT_KEY)
+    except Exception:
+        snap = None
+    if isinstance(snap, dict):
+        return snap
+    online = presence.online_ids(presence.ONLINE_STATUS_ROOM)
+    return {'total': len(online), 'visible': sorted(online - hidden_user_ids())}
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def schedule() -> None:
+    """Mark presence dirty; the first caller in a window schedules the flush."""
+    interval = _interval_seconds()
+    if interval <= 0:
+        if _on_event_loop():
+            # flush() blocks (async_to_sync, cache I/O); never on the loop thread.
+            threading.Thread(target=flush, name='presence-flush', daemon=True).start()
+        else:
+            flush()
+        return
+    try:
+        # TTL > interval so a process dying mid-window can't wedge broadcasts.
+        if not cache.add(PENDING_KEY, 1, timeout=max(5, int(interval * 4))):
+            return
+    except Exception:
+        return
+    timer = threading.Timer(interval, flush)
+    timer.daemon = True
+    timer.start()
+
+
+def check_expired() -> bool:
+    """Schedule a broadcast if a user in the last snapshot is no longer online.
+
+    Returns True when one was scheduled. Costs one cache.add per call and a
+    presence read per PRESENCE_EXPIRY_CHECK_SECONDS.
+    """
+    try:
+        every = max(1, int(getattr(settings, 'PRESENCE_EXPIRY_CHECK_SECONDS', 10)))
+    except Exception:
+        every = 10
+    try:
+        if not cache.add(EXPIRY_CHECK_KEY, 1, timeout=every):
+            return False
+        snap = cache.get(SNAPSHOT_KEY)
+    except Exception:
+        return False
+    if not isinstance(snap, dict):
+        return False
+    visible = set(int(x) for x in (snap.get('visible') or []))
+    if not visible or not (visible - presence.online_ids(presence.ONLINE_STATUS_ROOM)):
+        return False
+    schedule()
+    return True
+
+
+def flush() -> dict | None:
+    """Compute the snapshot once, diff it against the last one and publish the delta."""
+    try:
+        cache.delete(PENDING_KEY)
+    except Exception:
+        pass
+
+    try:
+        online = presence.online_ids(presence.ONLINE_STATUS_ROOM)
+        visible = online - hidden_user_ids()
+        try:
+            prev_snap = cache.get(SNAPSHOT_KEY) or {}
+        except Exception:
+            prev_snap = {}
+        prev = set(int(x) for x in (prev_snap.get('visible') or []))
+        try:
+            cache.set(SNAPSHOT_KEY, {'total': len(online), 'visible': sorted(visible)}, timeout=60 * 60)
+        except Exception:
+            pass
+
+        event = {
+            'type': 'online_status_handler',
+            'total': len(online),
+            'added': sorted(visible - prev),
+            'removed': sorted(prev - visible),
+        }
+        channel_layer = get_channel_layer()
+        if channel_layer is not None:
+            async_to_sync(channel_layer.group_send)(presence.ONLINE_STATUS_ROOM, event)
+            _publish_user_flips(channel_layer, event['added'], event['removed'])
+        return event
+    except Exception:
+        return None
+
+
+def _publish_user_flips(channel_layer, added, removed) -> None:
+    """Notify profile viewers of users whose visible online state flipped."""
+    for online, ids in ((True, added), (False, removed)):
+        for uid in ids:
+            try:
+                async_to_sync(channel_layer.group_send)(
+                    user_presence_group(uid),
+                    {'type': 'presence_handler', 'online': online},
+                )
+            except Exception:
+                continue
@@ -0,0 +1,329 @@
+"""Resumable, throttled purges of old messages and rooms.
+
+`purge_old_messages` and `purge_old_rooms` both drive a `Purge` through
+`run()`:
+
+- the table is walked by primary key from a checkpoint kept in the cache
+  (`purge:v1:<name>:cursor`), one chunk of PURGE_CHUNK_SIZE rows at a time, so
+  a run can stop anywhere and the next one resumes where it left off
+- each chunk is deleted in its own short transaction (messages with the raw,
+  cascade-aware deletes from `retention.delete_messages`)
+- after each chunk the worker pauses; the pause grows with how far the chunk
+  overshot PURGE_TARGET_CHUNK_MS, so a slow database gets fewer, sparser
+  deletes instead of a steady stream
+- when a walk reaches the retention horizon the cursor goes back to the start
+  for the next sweep (rows skipped earlier may have become eligible)
+
+Rows per second, the walk's lag behind the horizon and totals are kept in
+`purge:v1:<name>:stats`; see `stats()` or the commands' `--stats`.
+"""
+
+from __future__ import annotations
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import retention, room_index
+
+
+KEY_PREFIX = 'purge:v1:'
+
+# Smoothing for the rows/second figure (weight of the newest chunk).
+RATE_ALPHA = 0.3
+
+
+def _setting_int(name: str, default: int, minimum: int = 0) -> int:
+    try:
+        return max(minimum, int(getattr(settings, name, default)))
+    except Exception:
+        return default
+
+
+class Purge:
+    """One purgeable table: how to find the next chunk and how to delete it."""
+
+    name = ''
+
+    def __init__(self, *, days: int, chunk_size: int | None = None):
+        self.days = max(0, int(days))
+        self.chunk_size = max(1, int(chunk_size or _setting_int('PURGE_CHUNK_SIZE', 500, minimum=1)))
+
+    def horizon(self):
+        return timezone.now() - timedelta(days=self.days)
+
+    def scan(self, cursor: int, horizon) -> list[tuple]:
+        """Up to `chunk_size` rows with id > cursor: (id, timestamp, ...)."""
+        raise NotImplementedError
+
+    def select(self, rows: list[tuple], horizon) -> list[tuple]:
+        """The rows of a scanned chunk that should go."""
+        raise NotImplementedError
+
+    def delete(self, rows: list[tuple]) -> int:
+        raise NotImplementedError
+
+    # --- checkpoint + stats ---
+
+    @property
+    def cursor_key(self) -> str:
+        return f"{KEY_PREFIX}{self.name}:cursor"
+
+    @property
+    def stats_key(self) -> str:
+        return f"{KEY_PREFIX}{self.name}:stats"
+
+    def load_cursor(self) -> int:
+        try:
+            return max(0, int(cache.get(self.cursor_key) or 0))
+        except Exception:
+            return 0
+
+    def save_cursor(self, cursor: int) -> None:
+        try:
+            cache.set(self.cursor_key, int(cursor), timeout=None)
+        except Exception:
+            pass
+
+    def reset(self) -> None:
+        try:
+            cache.delete_many([self.cursor_key, self.stats_key])
+        except Exception:
+            pass
+
+
+class MessagePurge(Purge):
+    """Public-room messages older than the horizon, never taking a room below `keep_last`."""
+
+    name = 'messages'
+
+    def __init__(self, *, days: int, keep_last: int, chunk_size: int | None = None):
+        super().__init__(days=days, chunk_size=chunk_size)
+        self.keep_last = max(1, int(keep_last))
+
+    def scan(self, cursor, horizon):
+        from .models import GroupMessage
+
+        return list(
+            GroupMessage.objects.filter(id__gt=cursor)
+            .order_by('id')
+            .values_list('id', 'created', 'group_id')[:self.chunk_size]
+        )
+
+    def select(self, rows, horizon):
+        from .models import ChatGroup
+
+        old = [r for r in rows if r[1] < horizon]
+        if not old:
+            return []
+        # Room sizes come from the sidebar counters, not a COUNT per room.
+        allowance = {
+            gid: int(count or 0) - self.keep_last
+            for gid, is_private, count in (
+                ChatGroup.objects.filter(id__in={r[2] for r in old})
+                .values_list('id', 'is_private', 'summary__message_count')
+            )
+            if not is_private
+        }
+        out = []
+        for row in old:
+            if allowance.get(row[2], 0) > 0:
+                allowance[row[2]] -= 1
+                out.append(row)
+        return out
+
+    def delete(self, rows):
+        ids = [r[0] for r in rows]
+        files = retention.delete_messages(ids)
+        by_group: dict[int, tuple[int, int]] = {}
+        for mid, _created, gid in rows:
+            n, top = by_group.get(gid, (0, 0))
+            by_group[gid] = (n + 1, max(top, mid))
+        for gid, (n, top) in by_group.items():
+            room_index.messages_deleted(gid, n, max_id=top)
+        if files:
+            retention.delete_files(files)
+        return len(ids)
+
+
+class RoomPurge(Purge):
+    """Private code rooms whose last activity (last message, else creation) is older than the horizon."""
+
+    name = 'rooms'
+
+    def scan(self, cursor, horizon):
+        from .models import ChatGroup
+
+        rows = list(
+            ChatGroup.objects.filter(id__gt=cursor, is_private=True, is_code_room=True)
+            .order_by('id')
+            .values_list('id', 'created', 'summary__last_message_at', 'summary__group_id')[:self.chunk_size]
+        )
+        # Rooms without a summary row yet: take their last message time directly.
+        missing = [r[0] for r in rows if r[3] is None]
+        last_at = {}
+        if missing:
+            last_at = dict(
+                ChatGroup.objects.filter(id__in=missing)
+                .annotate(last=Max('chat_messages__created'))
+                .values_list('id', 'last')
+            )
+        return [
+            (gid, created, (last if summary_id is not None else last_at.get(gid)) or created)
+            for gid, created, last, summary_id in rows
+        ]
+
+    def select(self, rows, horizon):
+        return [r for r in rows if r[2] < horizon]
+
+    def delete(self, rows):
+        from .models import ChatGroup, GroupMessage
+
+        deleted = 0
+        for gid, _created, _activity in rows:
+            # Messages first, in chunks, so the room's own delete cascades over little.
+            while True:
+                ids = list(
+                    GroupMessage.objects.filter(group_id=gid)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:self.chunk_size]
+                )
+                if not ids:
+                    break
+                files = retention.delete_messages(ids)
+                if files:
+                    retention.delete_files(files)
+            with transaction.atomic():
+                deleted += ChatGroup.objects.filter(id=gid).delete()[1].get(ChatGroup._meta.label, 0)
+        return deleted
+
+
+# --- runner -----------------------------------------------------------------------
+
+def _pause_seconds(elapsed: float) -> float:
+    """Pause after a chunk that took `elapsed` seconds."""
+    target = _setting_int('PURGE_TARGET_CHUNK_MS', 200, minimum=1) / 1000.0
+    base = _setting_int('PURGE_MIN_PAUSE_MS', 50) / 1000.0
+    cap = _setting_int('PURGE_MAX_PAUSE_MS', 5000) / 1000.0
+    if elapsed <= target:
+        return base
+    # Over target: back off in proportion to the overshoot (elapsed * elapsed/target).
+    return min(cap, max(base, elapsed * (elapsed / target)))
+
+
+def stats(purge: Purge) -> dict:
+    try:
+        found = cache.get(purge.stats_key) or {}
+    except Exception:
+        found = {}
+    out = {
+        'cursor': purge.load_cursor(),
+        'deleted_total': 0,
+        'scanned_total': 0,
+        'sweeps': 0,
+        'rows_per_second': 0.0,
+        'lag_seconds': 0,
+        'last_chunk_ms': 0,
+        'last_pause_ms': 0,
+        'updated': None,
+    }
+    out.update(found)
+    return out
+
+
+def _record(purge: Purge, current: dict, *, scanned: int, deleted: int, work: float, pause: float,
+            lag: float, swept: bool) -> dict:
+    current = dict(current)
+    current['deleted_total'] = int(current.get('deleted_total') or 0) + deleted
+    current['scanned_total'] = int(current.get('scanned_total') or 0) + scanned
+    current['sweeps'] = int(current.get('sweeps') or 0) + int(swept)
+    rate = deleted / max(work + pause, 1e-6)
+    previous = float(current.get('rows_per_second') or 0.0)
+    current['rows_per_second'] = round(rate if not previous else previous + RATE_ALPHA * (rate - previous), 1)
+    current['lag_seconds'] = int(max(0.0, lag))
+    current['last_chunk_ms'] = int(work * 1000)
+    current['last_pause_ms'] = int(pause * 1000)
+    current['updated'] = time.time()
+    try:
+        cache.set(purge.stats_key, current, timeout=None)
+    except Exception:
+        pass
+    return current
+
+
+def run_chunk(purge: Purge, *, dry_run: bool = False, cursor: int | None = None) -> dict:
+    """Scan and delete one chunk from the checkpoint; returns what happened (no pause)."""
+    horizon = purge.horizon()
+    if cursor is None:
+        cursor = purge.load_cursor()
+    started = time.monotonic()
+    rows = purge.scan(cursor, horizon)
+    doomed = purge.select(rows, horizon) if rows else []
+    deleted = 0
+    if doomed and not dry_run:
+        deleted = purge.delete(doomed)
+    elapsed = time.monotonic() - started
+
+    # A short chunk, or one that reached rows newer than the horizon, ends the sweep.
+    swept = len(rows) < purge.chunk_size or bool(rows and rows[-1][1] >= horizon)
+    next_cursor = 0 if swept else int(rows[-1][0])
+    lag = 0.0 if swept else (horizon - rows[-1][1]).total_seconds()
+    return {
+        'scanned': len(rows),
+        'selected': len(doomed),
+        'deleted': deleted,
+        'elapsed': elapsed,
+        'swept': swept,
+        'cursor': next_cursor,
+        'lag': lag,
+    }
+
+
+def run(purge: Purge, *, loop: bool = False, dry_run: bool = False, max_chunks: int = 0,
+        stdout=None, sleep=time.sleep) -> dict:
+    """Delete chunks until the sweep reaches the horizon (or forever with `loop`).
+
+    Dry runs walk from the checkpoint without deleting or moving it.
+    Returns totals for this run.
+    """
+    totals = {'chunks': 0, 'scanned': 0, 'deleted': 0, 'would_delete': 0}
+    current = stats(purge)
+    cursor = purge.load_cursor()
+    idle = _setting_int('PURGE_IDLE_SECONDS', 60, minimum=1)
+    while True:
+        result = run_chunk(purge, dry_run=dry_run, cursor=cursor)
+        totals['chunks'] += 1
+        totals['scanned'] += result['scanned']
+        totals['deleted'] += result['deleted']
+        totals['would_delete'] += result['selected']
+        cursor = result['cursor']
+
+        pause = _pause_seconds(result['elapsed']) if result['deleted'] else 0.0
+        if not dry_run:
+            purge.save_cursor(cursor)
+            current = _record(
+                purge, current,
+                scanned=result['scanned'], deleted=result['deleted'],
+                work=result['elapsed'], pause=pause, lag=result['lag'], swept=result['swept'],
+            )
+            if stdout is not None and result['deleted']:
+                stdout.write(
+                    f"  {result['deleted']} deleted (cursor {cursor}, "
+                    f"{current['rows_per_second']} rows/s, lag {current['lag_seconds']}s)"
+                )
+
+        if max_chunks and totals['chunks'] >= max_chunks:
+            break
+        if result['swept']:
+            if not loop or dry_run:
+                break
+            sleep(idle)
+            continue
+        if pause:
+            sleep(pause)
+    return totals
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import json
-import time
 import uuid
 
 from asgiref.sync import async_to_sync
@@ -9,62 +8,24 @@ from channels.generic.websocket import WebsocketConsumer
 from django.conf import settings
 from django.core.cache import cache
 
-
-QUEUE_KEY = 'rv:queue:v1'
-WAITING_KEY_PREFIX = 'rv:waiting:v1:'
-PAIR_KEY_PREFIX = 'rv:pair:v1:'
-ACTIVE_USERS_KEY = 'rv:active:v1'
-LOCK_KEY = 'rv:lock:v1'
-RECENT_PAIR_KEY_PREFIX = 'rv:recentpair:v1:'
+from . import matchmaking
+from .matchmaking import PAIR_KEY_PREFIX
 
 
-def _now_ts() -> int:
-    try:
-        return int(time.time())
-    except Exception:
-        return 0
+ACTIVE_USERS_KEY = 'rv:active:v1'
 
 
 class RandomVideoConsumer(WebsocketConsumer):
-    def _rematch_fallback_wait_seconds(self) -> int:
-        try:
-            return max(1, int(getattr(settings, 'RANDOM_VIDEO_REMATCH_FALLBACK_WAIT_SECONDS', 10)))
-        except Exception:
-            return 10
-
-    def _rematch_cooldown_seconds(self) -> int:
-        try:
-            return max(1, int(getattr(settings, 'RANDOM_VIDEO_REMATCH_COOLDOWN_SECONDS', 12)))
-        except Exception:
-            return 12
-
-    def _recent_pair_key(self, user_key_a: str, user_key_b: str) -> str:
-        left = str(user_key_a or '').strip()
-        right = str(user_key_b or '').strip()
-        if left <= right:
-            return f"{RECENT_PAIR_KEY_PREFIX}{left}|{right}"
-        return f"{RECENT_PAIR_KEY_PREFIX}{right}|{left}"
-
     def _mark_recent_pair(self, user_key_a: str, user_key_b: str) -> None:
         left = str(user_key_a or '').strip()
         right = str(user_key_b or '').strip()
         if not left or not right or left == right:
             return
         try:
-            cache.set(self._recent_pair_key(left, right), 1, timeout=self._rematch_cooldown_seconds())
+            matchmaking.get_queue().mark_recent(left, right, matchmaking.rematch_cooldown_seconds())
         except Exception:
             return
 
-    def _is_recent_pair(self, user_key_a: str, user_key_b: str) -> bool:
-        left = str(user_key_a or '').strip()
-        right = str(user_key_b or '').strip()
-        if not left or not right or left == right:
-            return False
-        try:
-            return bool(cache.get(self._recent_pair_key(left, right)))
-        except Exception:
-            return False
-
     def _limit(self) -> int:
         try:
             return max(1, int(getattr(settings, 'RANDOM_VIDEO_ACTIVE_USERS_LIMIT', 2000)))
@@ -90,9 +51,6 @@ class RandomVideoConsumer(WebsocketConsumer):
 
         return f"g:{uuid.uuid4().hex}"
 
-    def _waiting_key(self, ticket: str) -> str:
-        return f"{WAITING_KEY_PREFIX}{ticket}"
-
     def _pair_key(self, channel_name: str) -> str:
         return f"{PAIR_KEY_PREFIX}{channel_name}"
 
@@ -198,50 +156,15 @@ class RandomVideoConsumer(WebsocketConsumer):
         if action == 'ping':
             self._send_json({'type': 'pong'})
 
-    def _acquire_lock(self) -> bool:
-        try:
-            return bool(cache.add(LOCK_KEY, '1', timeout=2))
-        except Exception:
-            return True
-
-    def _release_lock(self):
-        try:
-            cache.delete(LOCK_KEY)
-        except Exception:
-            return
-
-    def _queue_list(self) -> list[str]:
-        try:
-            value = cache.get(QUEUE_KEY) or []
-            if isinstance(value, list):
-                return [str(x) for x in value if x]
-            return []
-        except Exception:
-            return []
-
-    def _set_queue_list(self, items: list[str]):
-        try:
-            cache.set(QUEUE_KEY, items, timeout=3600)
-        except Exception:
-            return
-
     def _remove_from_queue(self):
         if not self.ticket:
             return
 
         try:
-            cache.delete(self._waiting_key(self.ticket))
+            matchmaking.get_queue().cancel(self.ticket)
         except Exception:
             pass
 
-        if self._acquire_lock():
-            try:
-                q = self._queue_list()
-                q = [x for x in q if x != self.ticket]
-                self._set_queue_list(q)
-            finally:
-                self._release_lock()
-
         self.ticket = None
 
     def _enqueue_and_match(self):
@@ -250,161 +173,29 @@ class RandomVideoConsumer(WebsocketConsumer):
 
         self._remove_from_queue()
 
-        my_ticket = uuid.uuid4().hex
-        self.ticket = my_ticket
-        waiting_payload = {
-            'ticket': my_ticket,
-            'channel': self.channel_name,
-            'user_key': self.user_key,
-            'created_at': _now_ts(),
-        }
-        cache.set(self._waiting_key(my_ticket), waiting_payload, timeout=45)
-
-        if not self._acquire_lock():
+        queue = matchmaking.get_queue()
+        try:
+            self.ticket = queue.enqueue(self.channel_name, self.user_key)
+        except Exception:
+            self.ticket = None
             self._send_json({'type': 'waiting'})
             return
 
-        try:
-            q = self._queue_list()
-            q = [x for x in q if x and x != my_ticket]
-            q.append(my_ticket)
-
-            cleaned = []
-            for t in q:
-                item = cache.get(self._waiting_key(t))
-                if not item:
-                    continue
-                if int(_now_ts() - int(item.get('created_at') or 0)) > 45:
-                    cache.delete(self._waiting_key(t))
-                    continue
-                cleaned.append(t)
-
-            q = cleaned
-            now_ts = _now_ts()
-
-            matched = None
-            if len(q) >= 2:
-                waiting_map = {}
-                for t in q:
-                    item = cache.get(self._waiting_key(t))
-                    if item:
-                        waiting_map[t] = item
-
-                pair_indexes = None
-                for i in range(len(q) - 1):
-                    first = q[i]
-                    a = waiting_map.get(first)
-                    if not a:
-                        continue
-                    a_user_key = str(a.get('user_key') or '')
-                    if not a_user_key:
-                        continue
-
-                    for j in range(i + 1, len(q)):
-                        second = q[j]
-                        b = waiting_map.get(second)
-                        if not b:
-                            continue
-                        b_user_key = str(b.get('user_key') or '')
-                        if not b_user_key:
-                            continue
-                        if a_user_key == b_user_key:
-                            continue
-                        if self._is_recent_pair(a_user_key, b_user_key):
-                            continue
-
-                        matched = (a, b)
-                        pair_indexes = (i, j)
-                        cache.delete(self._waiting_key(first))
-                        cache.delete(self._waiting_key(second))
-                        break
-
-                    if matched:
-                        break
-
-                if pair_indexes:
-                    i, j = pair_indexes
-                    q = [ticket for idx, ticket in enumerate(q) if idx not in (i, j)]
-                elif len(q) == 2:
-                    first = q[0]
-                    second = q[1]
-                    a = waiting_map.get(first)
-                    b = waiting_map.get(second)
-
-                    if a and b:
-                        a_user_key = str(a.get('user_key') or '')
-                        b_user_key = str(b.get('user_key') or '')
-
-                        if (
-                            a_user_key
-                            and b_user_key
-                            and a_user_key != b_user_key
-                            and self._is_recent_pair(a_user_key, b_user_key)
-                        ):
-                            wait_limit = self._rematch_fallback_wait_seconds()
-                            a_wait = max(0, int(now_ts - int(a.get('created_at') or now_ts)))
-                            b_wait = max(0, int(now_ts - int(b.get('created_at') or now_ts)))
-
-                            if a_wait >= wait_limit and b_wait >= wait_limit:
-                                matched = (a, b)
-                                q = []
-                                cache.delete(self._waiting_key(first))
-                                cache.delete(self._waiting_key(second))
-
-            self._set_queue_list(q)
-        finally:
-            self._release_lock()
-
-        if not matched:
+        # Worker mode: `run_matchmaker` pairs tickets out of band.
+        if matchmaking.worker_mode():
             self._send_json({'type': 'waiting'})
             return
 
-        a, b = matched
-        room_id = f"rv-{uuid.uuid4().hex[:12]}"
-
-        a_ch = str(a.get('channel') or '')
-        b_ch = str(b.get('channel') or '')
-
-        if not a_ch or not b_ch:
-            return
-
-        cache.set(
-            self._pair_key(a_ch),
-            {
-                'peer': b_ch,
-                'room': room_id,
-                'peer_user_key': str(b.get('user_key') or ''),
-            },
-            timeout=1800,
-        )
-        cache.set(
-            self._pair_key(b_ch),
-            {
-                'peer': a_ch,
-                'room': room_id,
-                'peer_user_key': str(a.get('user_key') or ''),
-            },
-            timeout=1800,
-        )
-
-        async_to_sync(self.channel_layer.send)(
-            a_ch,
-            {
-                'type': 'rv_matched',
-                'room': room_id,
-                'peer_channel': b_ch,
-                'offerer': True,
-            },
-        )
-        async_to_sync(self.channel_layer.send)(
-            b_ch,
-            {
-                'type': 'rv_matched',
-                'room': room_id,
-                'peer_channel': a_ch,
-                'offerer': False,
-            },
-        )
+        match = None
+        try:
+            match = queue.pop_pair()
+            if match:
+                matchmaking.deliver_match(match, self.channel_layer)
+        except Exception:
+            match = None
+
+        if not match or self.ticket not in (match.a.ticket, match.b.ticket):
+            self._send_json({'type': 'waiting'})
 
     def _break_pair(self, notify_peer: bool):
         pair = cache.get(self._pair_key(self.channel_name))
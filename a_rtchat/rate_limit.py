@@ -1,14 +1,19 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Iterable
 
 import hashlib
+import math
+import time
 import unicodedata
+import uuid
 
 from django.core.cache import cache
 from django.utils import timezone
 
+from .redis_utils import get_redis
+
 
 @dataclass(frozen=True)
 class RateLimitResult:
@@ -16,13 +21,96 @@ class RateLimitResult:
     count: int
     limit: int
     period_seconds: int
+    # Seconds until the window frees a slot (Redis engine only; None = unknown).
+    reset_after: float | None = None
 
     @property
     def retry_after(self) -> int:
-        # We don't have a portable TTL from all cache backends, so return the window length.
+        if self.reset_after is not None:
+            return max(1, int(math.ceil(self.reset_after)))
+        # LocMem/fallback: no portable TTL, so return the window length.
         return max(1, int(self.period_seconds))
 
 
+@dataclass(frozen=True)
+class LimitCheck:
+    key: str
+    limit: int
+    period_seconds: int
+
+
+@dataclass(frozen=True)
+class EventLimitResult:
+    """Outcome of `check_event_limits`: per-check results plus remaining mute seconds."""
+
+    results: tuple[RateLimitResult, ...]
+    mutes: tuple[int, ...]
+
+    @property
+    def allowed(self) -> bool:
+        return all(r.allowed for r in self.results)
+
+    @property
+    def denied(self) -> RateLimitResult | None:
+        for r in self.results:
+            if not r.allowed:
+                return r
+        return None
+
+
+# Sliding-window log per key (sorted set of hit timestamps in ms).
+# KEYS: mute keys (nm of them, as stored by the cache; see `_mute_redis_key`), then limit keys.
+# ARGV: now_ms, nm, member, then (limit, period_ms) per limit key.
+# Mutes are read with PTTL; if any is active, or any limit is exhausted,
+# nothing is recorded (all-or-nothing for the event).
+_EVENT_LIMITS_LUA = """
+local now = tonumber(ARGV[1])
+local nm = tonumber(ARGV[2])
+local member = ARGV[3]
+local out = {}
+local muted = false
+for i = 1, nm do
+    local ttl = redis.call('PTTL', KEYS[i])
+    if ttl > 0 then muted = true else ttl = 0 end
+    out[#out + 1] = ttl
+end
+
+local nl = #KEYS - nm
+local counts = {}
+local resets = {}
+local denied = false
+for i = 1, nl do
+    local key = KEYS[nm + i]
+    local limit = tonumber(ARGV[2 + 2 * i])
+    local period = tonumber(ARGV[3 + 2 * i])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - period)
+    local c = redis.call('ZCARD', key)
+    local reset = 0
+    if c >= limit then
+        denied = true
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        if oldest[2] then reset = tonumber(oldest[2]) + period - now end
+    end
+    counts[i] = c
+    resets[i] = reset
+end
+
+if not denied and not muted then
+    for i = 1, nl do
+        local key = KEYS[nm + i]
+        redis.call('ZADD', key, now, member)
+        redis.call('PEXPIRE', key, tonumber(ARGV[3 + 2 * i]))
+    end
+end
+
+for i = 1, nl do
+    out[#out + 1] = counts[i]
+    out[#out + 1] = resets[i]
+end
+return out
+"""
+
+
 def mute_key(user_id: int | str) -> str:
     return make_key('mute', user_id)
 
@@ -35,27 +123,18 @@ def strikes_key(scope: str, user_id: int | str, room: str | None = None) -> str:
     return make_key('strikes', scope, user_id, room)
 
 
-def get_muted_seconds(user_id: int | str) -> int:
-    """Return remaining mute seconds for a user (0 if not muted)."""
-    try:
-        raw = cache.get(mute_key(user_id))
-    except Exception:
-        raw = None
-    if not raw:
-        return 0
-    try:
-        muted_until = float(raw)
-    except Exception:
-        return 0
-    now = timezone.now().timestamp()
-    remaining = int(muted_until - now)
-    return max(0, remaining)
+# Mutes are always written and read through the cache API (value: muted-until
+# timestamp, expiring with the mute). The event-limit script reads the same
+# entries by their full cache key, so both paths see one mute.
 
+def _mute_redis_key(key: str) -> str:
+    """The Redis key the cache stores `key` under (prefix and version applied)."""
+    return cache.make_key(key)
 
-def get_room_muted_seconds(room_id: int | str, user_id: int | str) -> int:
-    """Return remaining mute seconds for a user in a specific room (0 if not muted)."""
+
+def _mute_remaining(key: str) -> int:
     try:
-        raw = cache.get(room_mute_key(room_id, user_id))
+        raw = cache.get(key)
     except Exception:
         raw = None
     if not raw:
@@ -65,30 +144,36 @@ def get_room_muted_seconds(room_id: int | str, user_id: int | str) -> int:
     except Exception:
         return 0
     now = timezone.now().timestamp()
-    remaining = int(muted_until - now)
+    remaining = int(math.ceil(muted_until - now))
     return max(0, remaining)
 
 
-def set_muted(user_id: int | str, seconds: int) -> int:
-    seconds = int(seconds)
-    seconds = max(1, seconds)
+def _set_mute(key: str, seconds: int) -> int:
+    seconds = max(1, int(seconds))
     muted_until = timezone.now().timestamp() + seconds
     try:
-        cache.set(mute_key(user_id), str(muted_until), timeout=seconds)
+        cache.set(key, str(muted_until), timeout=seconds)
     except Exception:
         pass
     return seconds
 
 
+def get_muted_seconds(user_id: int | str) -> int:
+    """Return remaining mute seconds for a user (0 if not muted)."""
+    return _mute_remaining(mute_key(user_id))
+
+
+def get_room_muted_seconds(room_id: int | str, user_id: int | str) -> int:
+    """Return remaining mute seconds for a user in a specific room (0 if not muted)."""
+    return _mute_remaining(room_mute_key(room_id, user_id))
+
+
+def set_muted(user_id: int | str, seconds: int) -> int:
+    return _set_mute(mute_key(user_id), seconds)
+
+
 def set_room_muted(room_id: int | str, user_id: int | str, seconds: int) -> int:
-    seconds = int(seconds)
-    seconds = max(1, seconds)
-    muted_until = timezone.now().timestamp() + seconds
-    try:
-        cache.set(room_mute_key(room_id, user_id), str(muted_until), timeout=seconds)
-    except Exception:
-        pass
-    return seconds
+    return _set_mute(room_mute_key(room_id, user_id), seconds)
 
 
 def clear_room_muted(room_id: int | str, user_id: int | str) -> None:
@@ -307,15 +392,120 @@ def _increment_counter(key: str, period_seconds: int) -> int:
         return current
 
 
+def _check_rate_limit_fixed_window(key: str, limit: int, period_seconds: int) -> RateLimitResult:
+    count = _increment_counter(key, period_seconds=period_seconds)
+    allowed = count <= limit
+    return RateLimitResult(allowed=allowed, count=count, limit=limit, period_seconds=period_seconds)
+
+
+def _eval_event_limits(client, checks: list[LimitCheck], mute_keys: list[str]) -> EventLimitResult:
+    script = client.register_script(_EVENT_LIMITS_LUA)
+    args: list[Any] = [int(time.time() * 1000), len(mute_keys), uuid.uuid4().hex]
+    for c in checks:
+        args.extend([int(c.limit), int(c.period_seconds) * 1000])
+    keys = [*(_mute_redis_key(k) for k in mute_keys), *(c.key for c in checks)]
+    raw = [int(x) for x in script(keys=keys, args=args)]
+
+    mutes = tuple(int(math.ceil(ms / 1000.0)) for ms in raw[:len(mute_keys)])
+    muted = any(mutes)
+    rest = raw[len(mute_keys):]
+    denied = muted or any(rest[2 * i] >= c.limit for i, c in enumerate(checks))
+
+    results = []
+    for i, c in enumerate(checks):
+        count, reset_ms = rest[2 * i], rest[2 * i + 1]
+        results.append(RateLimitResult(
+            allowed=count < c.limit,
+            count=count if denied else count + 1,
+            limit=c.limit,
+            period_seconds=c.period_seconds,
+            reset_after=(reset_ms / 1000.0) if count >= c.limit else None,
+        ))
+    return EventLimitResult(results=tuple(results), mutes=mutes)
+
+
+def _unlimited(check: LimitCheck) -> RateLimitResult:
+    return RateLimitResult(
+        allowed=True,
+        count=0,
+        limit=max(0, int(check.limit)),
+        period_seconds=max(1, int(check.period_seconds)),
+    )
+
+
+def _fallback_event_limits(checks: list[LimitCheck], mute_keys: list[str]) -> EventLimitResult:
+    """Cache-only path: read mutes, then chain fixed-window counters until one denies."""
+    mutes = [_mute_remaining(key) for key in mute_keys]
+
+    results = []
+    stop = any(mutes)
+    for c in checks:
+        if stop:
+            # Not evaluated (muted, or an earlier check already denied the event).
+            results.append(_unlimited(c))
+            continue
+        res = _check_rate_limit_fixed_window(c.key, int(c.limit), int(c.period_seconds))
+        results.append(res)
+        stop = not res.allowed
+    return EventLimitResult(results=tuple(results), mutes=tuple(mutes))
+
+
+def check_event_limits(
+    checks: Iterable[LimitCheck],
+    *,
+    mute_keys: Iterable[str] = (),
+) -> EventLimitResult:
+    """Evaluate every limit for one event (plus mute lookups) in a single round trip.
+
+    On Redis this is one Lua call using sliding windows: a hit is only recorded
+    when no mute is active and every limit has room, and denied results carry
+    the real time until the window frees up (`retry_after`).
+    Without Redis it falls back to the fixed-window counters, stopping at the
+    first denied check like the old chained calls did.
+
+    The chat socket passes every per-user limit for a send here (event rate,
+    burst guard, room cooldown) together with the mutes. The room-wide
+    `room_msg` quota is the one deliberate second round trip: it is checked
+    with `check_rate_limit` only after the message passes validation, so
+    rejected messages never use up the room's shared quota.
+
+    `results` lines up with `checks`; limits <= 0 are treated as disabled.
+    """
+    checks = list(checks)
+    mute_keys = [str(k) for k in mute_keys]
+    active_idx = [i for i, c in enumerate(checks) if int(c.limit) > 0 and int(c.period_seconds) > 0]
+    active = [checks[i] for i in active_idx]
+
+    evaluated = None
+    client = get_redis()
+    if client is not None:
+        try:
+            evaluated = _eval_event_limits(client, active, mute_keys)
+        except Exception:
+            evaluated = None
+    if evaluated is None:
+        evaluated = _fallback_event_limits(active, mute_keys)
+
+    results = [_unlimited(c) for c in checks]
+    for i, res in zip(active_idx, evaluated.results):
+        results[i] = res
+    return EventLimitResult(results=tuple(results), mutes=evaluated.mutes)
+
+
 def check_rate_limit(key: str, limit: int, period_seconds: int) -> RateLimitResult:
     limit = int(limit)
     period_seconds = int(period_seconds)
     if limit <= 0 or period_seconds <= 0:
         return RateLimitResult(allowed=True, count=0, limit=max(0, limit), period_seconds=max(1, period_seconds))
 
-    count = _increment_counter(key, period_seconds=period_seconds)
-    allowed = count <= limit
-    return RateLimitResult(allowed=allowed, count=count, limit=limit, period_seconds=period_seconds)
+    client = get_redis()
+    if client is not None:
+        try:
+            return _eval_event_limits(client, [LimitCheck(key, limit, period_seconds)], []).results[0]
+        except Exception:
+            pass
+
+    return _check_rate_limit_fixed_window(key, limit, period_seconds)
 
 
 def get_client_ip(request) -> str:
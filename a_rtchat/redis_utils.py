@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from django.core.cache import cache
+
+
+def get_redis():
+    """Return the raw redis-py client behind the default cache, or None.
+
+    Only the Redis cache backend exposes a client; LocMem (local/dev) returns None
+    so callers can fall back to plain cache operations.
+    """
+    try:
+        backend = getattr(cache, '_cache', None)
+        get_client = getattr(backend, 'get_client', None)
+        if get_client is None:
+            return None
+        return get_client(write=True)
+    except Exception:
+        return None
+
+
+def register_script(source: str):
+    """Register a Lua script on the current Redis client (None without Redis)."""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        return client.register_script(source)
+    except Exception:
+        return None
@@ -1,67 +1,376 @@
+"""Per-room message retention, off the send path.
+
+A new message only calls `schedule(group_id)` (from the GroupMessage
+post_save signal): the room id is added to a pending set (a Redis set shared
+by every process, or an in-process set without Redis), so any number of sends
+to a room coalesce into one pending trim. A background worker wakes every
+RETENTION_INTERVAL_SECONDS, pops pending rooms and for each one:
+
+- reads the room's message counter (`ChatRoomSummary.message_count`, kept by
+  room_index, with `archived_count` for rows in a_rtchat.archive) and stops
+  there while hot + archived is within the cap plus RETENTION_TRIM_SLACK,
+  so most passes cost one indexed read per room
+- otherwise recounts the room (it is near the cap, so this is small) and
+  deletes the oldest rows of both tables in batches of RETENTION_BATCH_SIZE ids
+- each batch is raw deletes: reactions and one-time views, then SET NULL for
+  replies and moderation events, then the messages. No Collector and no
+  per-row signals; room_index is told once per batch
+- stored files of deleted messages are queued and removed from media storage
+  (Cloudinary in production) after the batch commits
+
+The cap is CHAT_MAX_MESSAGES_PER_ROOM, or PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM
+for private rooms. Counters: `metrics()` and `manage.py run_retention_worker --stats`.
+"""
+
 from __future__ import annotations
 
+import threading
+import time
+
+from django.conf import settings
 from django.core.cache import cache
+from django.db import router, transaction
 
+from .redis_utils import get_redis
 
-def trim_chat_group_messages(*, chat_group_id: int, keep_last: int | None = None) -> None:
-    """Best-effort: keep only the newest `keep_last` messages for a room.
 
-    This runs throttled because deleting can be expensive.
-    """
+PENDING_KEY = 'retention:pending:v1'
+FILES_KEY = 'retention:files:v1'
+METRICS_KEY_PREFIX = 'retention:metrics:v1:'
+
+METRIC_NAMES = (
+    'rooms_checked',
+    'rooms_trimmed',
+    'messages_deleted',
+    'files_deleted',
+    'file_errors',
+)
+
+
+def _setting_int(name: str, default: int, minimum: int = 0) -> int:
     try:
-        gid = int(chat_group_id)
+        return max(minimum, int(getattr(settings, name, default)))
     except Exception:
-        return
+        return default
 
-    if gid <= 0:
-        return
 
-    if keep_last is None:
-        try:
-            from django.conf import settings
+def keep_last_for(is_private: bool) -> int:
+    if is_private:
+        return _setting_int('PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', 1000, minimum=1)
+    return _setting_int('CHAT_MAX_MESSAGES_PER_ROOM', 250, minimum=1)
+
+
+# --- metrics --------------------------------------------------------------------
 
-            keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 250))
+def _bump(counts: dict[str, int]) -> None:
+    for name, n in counts.items():
+        if not n:
+            continue
+        key = METRICS_KEY_PREFIX + name
+        try:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, n)
         except Exception:
-            keep_last = 250
+            continue
+
 
+def metrics() -> dict:
+    keys = [METRICS_KEY_PREFIX + name for name in METRIC_NAMES]
     try:
-        keep_last = int(keep_last)
+        found = cache.get_many(keys + [METRICS_KEY_PREFIX + 'last'])
     except Exception:
-        return
+        found = {}
+    out = {name: int(found.get(METRICS_KEY_PREFIX + name) or 0) for name in METRIC_NAMES}
+    out['last_pass'] = found.get(METRICS_KEY_PREFIX + 'last') or {}
+    out['pending_rooms'] = _worker.pending_size()
+    return out
+
+
+# --- trimming -------------------------------------------------------------------
+
+def delete_messages(ids: list[int]) -> list[str]:
+    """Delete messages `ids` and their dependent rows; returns their stored file names."""
+    from .models import GroupMessage, MessageReaction, ModerationEvent, OneTimeMessageView
+
+    using = router.db_for_write(GroupMessage)
+    with transaction.atomic(using=using):
+        files = [
+            name for name in
+            GroupMessage.objects.filter(id__in=ids).exclude(file='').values_list('file', flat=True)
+            if name
+        ]
+        # QuerySet._raw_delete: a plain DELETE ... WHERE, skipping the Collector.
+        MessageReaction.objects.filter(message_id__in=ids)._raw_delete(using)
+        OneTimeMessageView.objects.filter(message_id__in=ids)._raw_delete(using)
+        ModerationEvent.objects.filter(message_id__in=ids).update(message=None)
+        GroupMessage.objects.filter(reply_to_id__in=ids).update(reply_to=None)
+        GroupMessage.objects.filter(id__in=ids)._raw_delete(using)
+    return files
 
-    if keep_last <= 0:
-        return
 
-    # Throttle trims per room.
+def trim_room(chat_group_id, *, keep_last: int | None = None, force: bool = False) -> int:
+    """Delete the oldest messages of a room beyond its cap; returns rows deleted.
+
+    The cap covers hot and archived messages together, oldest (by id) first
+    across both tables. Without `force`, the room counters are checked first
+    and rooms within cap + RETENTION_TRIM_SLACK are left alone.
+    """
+    from .models import ArchivedMessage, ChatGroup, ChatRoomSummary, GroupMessage
+    from . import archive, room_index
+
     try:
-        # Keep this short so a busy room trims promptly.
-        if not cache.add(f"msg_trim_lock:{gid}", "1", timeout=2):
-            return
+        gid = int(chat_group_id)
     except Exception:
-        # If cache isn't configured, still attempt trimming (best-effort).
-        pass
+        return 0
+    if gid <= 0:
+        return 0
 
-    try:
-        from .models import GroupMessage
-
-        # Find the cutoff id: the Nth newest message id.
-        cutoff_qs = (
-            GroupMessage.objects
-            .filter(group_id=gid)
-            .order_by('-id')
-            .values_list('id', flat=True)
+    row = (
+        ChatGroup.objects.filter(id=gid)
+        .values_list('is_private', 'summary__message_count', 'summary__archived_count')
+        .first()
+    )
+    if row is None:
+        return 0
+    is_private, counter, archived = row
+    if keep_last is None:
+        keep_last = keep_last_for(bool(is_private))
+    keep_last = max(1, int(keep_last))
+
+    slack = _setting_int('RETENTION_TRIM_SLACK', 25)
+    if not force and counter is not None and int(counter) + int(archived or 0) <= keep_last + slack:
+        return 0
+
+    # The counters are only a trigger; what gets deleted comes from exact counts.
+    total = GroupMessage.objects.filter(group_id=gid).count()
+    archived_total = ArchivedMessage.objects.filter(group_id=gid).count()
+    if counter is not None and (int(counter), int(archived or 0)) != (total, archived_total):
+        ChatRoomSummary.objects.filter(group_id=gid).update(message_count=total, archived_count=archived_total)
+    excess = total + archived_total - keep_last
+    if excess <= 0:
+        return 0
+
+    batch_size = _setting_int('RETENTION_BATCH_SIZE', 500, minimum=1)
+    deleted = 0
+    while deleted < excess:
+        want = min(batch_size, excess - deleted)
+        hot = list(
+            GroupMessage.objects.filter(group_id=gid)
+            .order_by('id')
+            .values_list('id', flat=True)[:want]
         )
+        cold = set(archive.oldest_ids(gid, want))
+        ids = sorted([*hot, *cold])[:want]
+        if not ids:
+            break
+        cold_ids = [i for i in ids if i in cold]
+        hot_ids = [i for i in ids if i not in cold]
+        files = archive.drop(gid, cold_ids)
+        if hot_ids:
+            files += delete_messages(hot_ids)
+            room_index.messages_deleted(gid, len(hot_ids), max_id=hot_ids[-1])
+        deleted += len(ids)
+        if files:
+            _worker.queue_files(files)
+    return deleted
+
+
+def trim_chat_group_messages(*, chat_group_id: int, keep_last: int | None = None) -> int:
+    """Trim a room right now (management commands, tests); sends use `schedule()`."""
+    try:
+        return trim_room(chat_group_id, keep_last=keep_last, force=True)
+    except Exception:
+        return 0
+
+
+def delete_files(names) -> tuple[int, int]:
+    """Remove stored files no message refers to any more; returns (deleted, errors)."""
+    from .models import GroupMessage
 
+    names = sorted({n for n in names or [] if n})
+    if not names:
+        return 0, 0
+    from .models import ArchivedMessage
+
+    still_used = set(GroupMessage.objects.filter(file__in=names).values_list('file', flat=True))
+    still_used.update(ArchivedMessage.objects.filter(file__in=names).values_list('file', flat=True))
+    storage = GroupMessage._meta.get_field('file').storage
+    done = errors = 0
+    for name in names:
+        if name in still_used:
+            continue
         try:
-            cutoff_id = cutoff_qs[keep_last - 1]
+            storage.delete(name)
+            done += 1
         except Exception:
-            # Fewer than keep_last messages.
-            return
+            errors += 1
+    return done, errors
+
+
+# --- queue + worker ---------------------------------------------------------------
+
+class _RetentionWorker:
+    """Background thread that trims pending rooms every interval."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local_rooms: set[int] = set()
+        self._local_files: list[str] = []
+        # Rooms this process already scheduled, so a busy room costs one SADD per interval.
+        self._recent: dict[int, float] = {}
+        self._thread = None
+
+    def _interval(self) -> float:
+        return float(_setting_int('RETENTION_INTERVAL_SECONDS', 5, minimum=1))
+
+    def put(self, gid: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self._recent.get(gid, 0.0) > now:
+                return
+            self._recent[gid] = now + self._interval()
+            if len(self._recent) > 10000:
+                self._recent = {k: v for k, v in self._recent.items() if v > now}
+        client = get_redis()
+        if client is not None:
+            try:
+                client.sadd(PENDING_KEY, gid)
+                return
+            except Exception:
+                pass
+        with self._lock:
+            self._local_rooms.add(gid)
+
+    def queue_files(self, names: list[str]) -> None:
+        client = get_redis()
+        if client is not None:
+            try:
+                client.rpush(FILES_KEY, *names)
+                return
+            except Exception:
+                pass
+        with self._lock:
+            self._local_files.extend(names)
 
-        if not cutoff_id:
-            return
+    def pending_size(self) -> int:
+        client = get_redis()
+        if client is not None:
+            try:
+                return int(client.scard(PENDING_KEY) or 0)
+            except Exception:
+                pass
+        with self._lock:
+            return len(self._local_rooms)
 
-        # Delete everything older than the cutoff.
-        GroupMessage.objects.filter(group_id=gid, id__lt=int(cutoff_id)).delete()
+    def pop_rooms(self, limit: int) -> list[int]:
+        client = get_redis()
+        raw = []
+        if client is not None:
+            try:
+                raw = client.spop(PENDING_KEY, limit) or []
+            except Exception:
+                raw = []
+        with self._lock:
+            while self._local_rooms and len(raw) < limit:
+                raw.append(self._local_rooms.pop())
+        out = []
+        for value in raw:
+            try:
+                out.append(int(value))
+            except Exception:
+                continue
+        return out
+
+    def pop_files(self, limit: int = 500) -> list[str]:
+        client = get_redis()
+        names = []
+        if client is not None:
+            try:
+                pipe = client.pipeline()
+                pipe.lrange(FILES_KEY, 0, limit - 1)
+                pipe.ltrim(FILES_KEY, limit, -1)
+                got, _ = pipe.execute()
+                names = [v.decode() if isinstance(v, bytes) else str(v) for v in got]
+            except Exception:
+                names = []
+        with self._lock:
+            take = self._local_files[:max(0, limit - len(names))]
+            del self._local_files[:len(take)]
+        return names + take
+
+    def ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.run_forever, name='message-retention', daemon=True)
+            self._thread.start()
+
+    def run_once(self) -> dict:
+        """Trim pending rooms, then delete queued files; returns the counters it added."""
+        started = time.monotonic()
+        counts = {name: 0 for name in METRIC_NAMES}
+        rooms = self.pop_rooms(_setting_int('RETENTION_ROOMS_PER_PASS', 200, minimum=1))
+        for gid in rooms:
+            counts['rooms_checked'] += 1
+            try:
+                n = trim_room(gid)
+            except Exception:
+                continue
+            if n:
+                counts['rooms_trimmed'] += 1
+                counts['messages_deleted'] += n
+        while True:
+            names = self.pop_files()
+            if not names:
+                break
+            try:
+                done, errors = delete_files(names)
+            except Exception:
+                done, errors = 0, len(names)
+            counts['files_deleted'] += done
+            counts['file_errors'] += errors
+        _bump(counts)
+        if rooms:
+            try:
+                cache.set(METRICS_KEY_PREFIX + 'last', {
+                    'rooms': len(rooms),
+                    'deleted': counts['messages_deleted'],
+                    'seconds': round(time.monotonic() - started, 4),
+                    'at': time.time(),
+                }, timeout=None)
+            except Exception:
+                pass
+        return counts
+
+    def run_forever(self) -> None:
+        from django.db import close_old_connections
+
+        while True:
+            time.sleep(self._interval())
+            close_old_connections()
+            try:
+                self.run_once()
+            except Exception:
+                pass
+            close_old_connections()
+
+
+_worker = _RetentionWorker()
+
+
+def schedule(chat_group_id) -> None:
+    """Mark a room for a retention check (called for every new message; no DB work)."""
+    if not bool(getattr(settings, 'RETENTION_ENABLED', True)):
+        return
+    try:
+        gid = int(chat_group_id or 0)
     except Exception:
         return
+    if gid <= 0:
+        return
+    try:
+        _worker.put(gid)
+        if bool(getattr(settings, 'RETENTION_WORKER_IN_PROCESS', True)):
+            _worker.ensure_started()
+    except Exception:
+        pass
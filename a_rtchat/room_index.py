@@ -0,0 +1,261 @@
+"""Room-summary index behind the chat sidebar.
+
+`ChatRoomSummary` keeps last message id/time/author, the newest message by
+anyone else (`last_non_author_id`) and the message count for each room, so
+the sidebar never aggregates over `GroupMessage`. It also counts the room's
+archived messages, for the retention cap:
+
+- new messages update it with one conditional UPDATE (post_save, see signals.py)
+- deletes call `messages_deleted()` / `refresh_rooms()` explicitly, because
+  bulk deletes (retention, purges) would otherwise pay a signal per row;
+  archiving calls `messages_archived()` and `archived_dropped()`
+- `ChatReadState.unread_count` is kept for private rooms only: members get +1
+  per message from someone else, and it is recomputed when they read
+
+`manage.py rebuild_room_index` (re)creates everything from the messages table.
+"""
+
+from __future__ import annotations
+
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.db.models.functions import Greatest
+
+from .models import ArchivedMessage, ChatGroup, ChatReadState, ChatRoomSummary, GroupMessage
+
+
+def _private_member_ids(group_id, *, exclude_user_id=None) -> list[int]:
+    qs = ChatGroup.members.through.objects.filter(chatgroup_id=group_id)
+    if exclude_user_id:
+        qs = qs.exclude(user_id=exclude_user_id)
+    return [int(x) for x in qs.values_list('user_id', flat=True)]
+
+
+def record_message(message) -> None:
+    """Fold a newly created message into its room summary and unread counters."""
+    gid = int(getattr(message, 'group_id', 0) or 0)
+    mid = int(getattr(message, 'id', 0) or 0)
+    aid = int(getattr(message, 'author_id', 0) or 0)
+    if not gid or not mid:
+        return
+
+    rebuilt = False
+    with transaction.atomic():
+        rows = ChatRoomSummary.objects.filter(group_id=gid)
+        updated = rows.filter(last_message_id__lt=mid).update(
+            last_non_author_id=Case(
+                When(~Q(last_author_id=aid), then=F('last_message_id')),
+                default=F('last_non_author_id'),
+            ),
+            last_author_id=aid,
+            last_message_id=mid,
+            last_message_at=getattr(message, 'created', None),
+            message_count=F('message_count') + 1,
+        )
+        if not updated and not rows.update(message_count=F('message_count') + 1):
+            # First message since the index was introduced: build the row.
+            rebuild_room(gid)
+            rebuilt = True
+
+    group = getattr(message, 'group', None)
+    if not getattr(group, 'is_private', False):
+        return
+    members = _private_member_ids(gid, exclude_user_id=aid)
+    if not members:
+        return
+    ChatReadState.objects.bulk_create(
+        [ChatReadState(user_id=uid, group_id=gid) for uid in members],
+        ignore_conflicts=True,
+    )
+    if rebuilt:
+        _recount_private_unread(gid)
+        return
+    ChatReadState.objects.filter(group_id=gid, user_id__in=members).update(unread_count=F('unread_count') + 1)
+
+
+def _unread_since(group_id, user_id, last_read_id) -> int:
+    return int(
+        GroupMessage.objects.filter(group_id=group_id, id__gt=int(last_read_id or 0))
+        .exclude(author_id=user_id)
+        .count()
+    )
+
+
+def record_read(state) -> None:
+    """Recompute one member's unread counter after their read marker moved."""
+    gid = int(getattr(state, 'group_id', 0) or 0)
+    uid = int(getattr(state, 'user_id', 0) or 0)
+    if not gid or not uid:
+        return
+    summary = ChatRoomSummary.objects.filter(group_id=gid).select_related('group').first()
+    last_read = int(getattr(state, 'last_read_message_id', 0) or 0)
+    if summary is None or last_read >= summary.latest_id_not_by(uid):
+        unread = 0
+    elif getattr(summary.group, 'is_private', False):
+        unread = _unread_since(gid, uid, last_read)
+    else:
+        return
+    ChatReadState.objects.filter(pk=state.pk).exclude(unread_count=unread).update(unread_count=unread)
+
+
+def _refresh_last(group_id) -> None:
+    last = (
+        GroupMessage.objects.filter(group_id=group_id)
+        .order_by('-id')
+        .values_list('id', 'author_id', 'created')
+        .first()
+    )
+    if not last:
+        ChatRoomSummary.objects.filter(group_id=group_id).update(
+            last_message_id=0, last_message_at=None, last_author_id=0, last_non_author_id=0, message_count=0,
+        )
+        return
+    other = (
+        GroupMessage.objects.filter(group_id=group_id)
+        .exclude(author_id=last[1])
+        .order_by('-id')
+        .values_list('id', flat=True)
+        .first()
+    )
+    ChatRoomSummary.objects.filter(group_id=group_id).update(
+        last_message_id=int(last[0]),
+        last_author_id=int(last[1] or 0),
+        last_message_at=last[2],
+        last_non_author_id=int(other or 0),
+    )
+
+
+def _recount_private_unread(group_id) -> None:
+    for pk, uid, last_read in (
+        ChatReadState.objects.filter(group_id=group_id, group__is_private=True)
+        .values_list('pk', 'user_id', 'last_read_message_id')
+    ):
+        ChatReadState.objects.filter(pk=pk).update(unread_count=_unread_since(group_id, uid, last_read))
+
+
+def messages_deleted(group_id, count: int, *, max_id=None) -> None:
+    """Account for `count` deleted messages of one room (best-effort).
+
+    `max_id` is the newest deleted id; when it is older than both ids the
+    summary points at, the last-message fields are still valid and kept.
+    """
+    try:
+        gid = int(group_id or 0)
+        count = int(count or 0)
+    except Exception:
+        return
+    if not gid or count <= 0:
+        return
+    try:
+        summary = ChatRoomSummary.objects.filter(group_id=gid).first()
+        if summary is None:
+            rebuild_room(gid)
+            return
+        ChatRoomSummary.objects.filter(group_id=gid).update(
+            message_count=Greatest(F('message_count') - count, 0),
+        )
+        oldest_tracked = min(int(summary.last_message_id or 0), int(summary.last_non_author_id or 0))
+        if max_id is None or int(max_id) >= oldest_tracked:
+            _refresh_last(gid)
+        _recount_private_unread(gid)
+    except Exception:
+        pass
+
+
+def messages_archived(group_id, count: int, *, max_id=None) -> None:
+    """`count` messages of one room moved from the hot table to the archive."""
+    try:
+        gid = int(group_id or 0)
+        count = int(count or 0)
+    except Exception:
+        return
+    if not gid or count <= 0:
+        return
+    try:
+        if not ChatRoomSummary.objects.filter(group_id=gid).update(archived_count=F('archived_count') + count):
+            rebuild_room(gid)
+            return
+    except Exception:
+        return
+    messages_deleted(gid, count, max_id=max_id)
+
+
+def archived_dropped(group_id, count: int) -> None:
+    """`count` archived messages of one room deleted for good."""
+    try:
+        ChatRoomSummary.objects.filter(group_id=int(group_id or 0)).update(
+            archived_count=Greatest(F('archived_count') - int(count or 0), 0),
+        )
+    except Exception:
+        pass
+
+
+def rebuild_room(group_id) -> None:
+    """Recompute one room's summary (and private unread counters) from scratch."""
+    gid = int(group_id or 0)
+    if not gid:
+        return
+    count = GroupMessage.objects.filter(group_id=gid).count()
+    archived = ArchivedMessage.objects.filter(group_id=gid).count()
+    ChatRoomSummary.objects.update_or_create(
+        group_id=gid, defaults={'message_count': count, 'archived_count': archived},
+    )
+    _refresh_last(gid)
+    _recount_private_unread(gid)
+
+
+def refresh_rooms(group_ids) -> None:
+    """Rebuild the summaries of several rooms (after multi-room deletes)."""
+    for gid in sorted({int(x) for x in (group_ids or []) if x}):
+        try:
+            rebuild_room(gid)
+        except Exception:
+            continue
+
+
+def rebuild_all(*, stdout=None) -> int:
+    """Rebuild every room's summary; returns the number of rooms indexed."""
+    done = 0
+    for gid in ChatGroup.objects.order_by('id').values_list('id', flat=True).iterator():
+        rebuild_room(gid)
+        done += 1
+        if stdout is not None and done % 500 == 0:
+            stdout.write(f"Indexed {done} rooms…")
+    return done
+
+
+def private_unread(user, room_ids) -> dict[int, int]:
+    """{room_id: unread_count} for the user's private rooms that have unread messages."""
+    ids = [int(x) for x in (room_ids or []) if x]
+    uid = int(getattr(user, 'id', 0) or 0)
+    if not ids or not uid:
+        return {}
+
+    read = {
+        int(gid): (int(last or 0), int(unread or 0))
+        for gid, last, unread in ChatReadState.objects.filter(user_id=uid, group_id__in=ids)
+        .values_list('group_id', 'last_read_message_id', 'unread_count')
+    }
+    out = {}
+    for summary in ChatRoomSummary.objects.filter(group_id__in=ids):
+        latest = summary.latest_id_not_by(uid)
+        last_read, unread = read.get(int(summary.group_id), (0, 0))
+        if latest > last_read:
+            out[int(summary.group_id)] = max(1, unread)
+    return out
+
+
+def nearby_active_rooms(city: str, *, exclude_group_name: str = '', limit: int = 6) -> list:
+    """Public group chats mentioning `city`, most recently active first."""
+    if not city:
+        return []
+    qs = (
+        ChatGroup.objects
+        .filter(groupchat_name__isnull=False, is_private=False, summary__message_count__gt=0)
+        .filter(Q(groupchat_name__icontains=city) | Q(room_description__icontains=city))
+        .exclude(group_name='online-status')
+        .order_by('-summary__last_message_at')
+    )
+    if exclude_group_name:
+        qs = qs.exclude(group_name=exclude_group_name)
+    return list(qs[:limit])
@@ -1,12 +1,13 @@
 from django.urls import path
 from .consumers import *
+from .async_consumers import consumer_for
 from .random_video_consumers import RandomVideoConsumer
 
 websocket_urlpatterns = [
-    path("ws/chatroom/<chatroom_name>", ChatroomConsumer.as_asgi()),
+    path("ws/chatroom/<chatroom_name>", consumer_for(ChatroomConsumer).as_asgi()),
     path("ws/random-video/", RandomVideoConsumer.as_asgi()),
-    path("ws/online-status/", OnlineStatusConsumer.as_asgi()),
-    path("ws/presence/<username>/", ProfilePresenceConsumer.as_asgi()),
-    path("ws/notify/", NotificationsConsumer.as_asgi()),
-    path("ws/global-announcement/", GlobalAnnouncementConsumer.as_asgi()),
+    path("ws/online-status/", consumer_for(OnlineStatusConsumer).as_asgi()),
+    path("ws/presence/<username>/", consumer_for(ProfilePresenceConsumer).as_asgi()),
+    path("ws/notify/", consumer_for(NotificationsConsumer).as_asgi()),
+    path("ws/global-announcement/", consumer_for(GlobalAnnouncementConsumer).as_asgi()),
 ]
\ No newline at end of file
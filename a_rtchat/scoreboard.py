@@ -0,0 +1,126 @@
+"""Materialized challenge scoreboard.
+
+`ChallengeScore` keeps wins/losses/played per (user, room) plus one
+site-wide row per user (`group=None`), so `!sc` and leaderboards are index
+lookups instead of a scan over every completed challenge's `meta`.
+
+Results are recorded exactly once, when a challenge flips from active to
+completed (see `challenges._complete`). Losers marked while a challenge is
+still running are not scored yet: a cancelled challenge counts for nobody.
+"""
+
+from __future__ import annotations
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import ChallengeScore, ChatChallenge
+
+
+def _ids(values) -> list[int]:
+    out = set()
+    for x in values or []:
+        try:
+            if int(x) > 0:
+                out.add(int(x))
+        except Exception:
+            continue
+    return sorted(out)
+
+
+def record_result(group_id, winners, losers) -> None:
+    """Add one completed challenge's outcome to the room and global rows."""
+    winners = _ids(winners)
+    losers = [uid for uid in _ids(losers) if uid not in set(winners)]
+    players = winners + losers
+    if not players:
+        return
+
+    scopes = [int(group_id)] if group_id else []
+    scopes.append(None)
+    with transaction.atomic():
+        ChallengeScore.objects.bulk_create(
+            [ChallengeScore(user_id=uid, group_id=gid) for gid in scopes for uid in players],
+            ignore_conflicts=True,
+        )
+        for gid in scopes:
+            rows = ChallengeScore.objects.filter(group_id=gid) if gid else ChallengeScore.objects.filter(group__isnull=True)
+            if winners:
+                rows.filter(user_id__in=winners).update(wins=F('wins') + 1, played=F('played') + 1)
+            if losers:
+                rows.filter(user_id__in=losers).update(losses=F('losses') + 1, played=F('played') + 1)
+
+
+def totals(user_id, *, group=None) -> dict:
+    """{'wins', 'losses', 'completed'} for one user in a room, or site-wide."""
+    uid = int(user_id or 0)
+    empty = {'wins': 0, 'losses': 0, 'completed': 0}
+    if uid <= 0:
+        return empty
+    qs = ChallengeScore.objects.filter(user_id=uid)
+    qs = qs.filter(group=group) if group is not None else qs.filter(group__isnull=True)
+    row = qs.values_list('wins', 'losses', 'played').first()
+    if not row:
+        return empty
+    return {'wins': int(row[0]), 'losses': int(row[1]), 'completed': int(row[2])}
+
+
+def leaderboard(*, group=None, limit: int = 10) -> list[dict]:
+    """Top players by wins (fewest losses first on ties) for a room, or site-wide."""
+    limit = max(1, min(int(limit or 10), 100))
+    qs = ChallengeScore.objects.filter(wins__gt=0)
+    qs = qs.filter(group=group) if group is not None else qs.filter(group__isnull=True)
+    rows = (
+        qs.order_by('-wins', 'losses', 'user_id')
+        .values('user_id', 'user__username', 'wins', 'losses', 'played')[:limit]
+    )
+    return [
+        {
+            'rank': i,
+            'user_id': int(row['user_id']),
+            'username': str(row['user__username'] or ''),
+            'wins': int(row['wins']),
+            'losses': int(row['losses']),
+            'played': int(row['played']),
+        }
+        for i, row in enumerate(rows, start=1)
+    ]
+
+
+def rebuild(*, batch_size: int = 1000, stdout=None) -> int:
+    """Recompute every row from completed challenges; returns challenges counted."""
+    counts: dict[tuple[int, int | None], list[int]] = {}
+
+    def bump(uid, gid, col):
+        for key in ((uid, gid), (uid, None)):
+            row = counts.setdefault(key, [0, 0, 0])
+            row[col] += 1
+            row[2] += 1
+
+    seen = 0
+    qs = (
+        ChatChallenge.objects.filter(status=ChatChallenge.STATUS_COMPLETED)
+        .order_by('id')
+        .values_list('group_id', 'meta')
+    )
+    for gid, meta in qs.iterator(chunk_size=batch_size):
+        if not isinstance(meta, dict):
+            continue
+        seen += 1
+        winners = _ids(meta.get('winners'))
+        for uid in winners:
+            bump(uid, gid, 0)
+        for uid in _ids(meta.get('losers')):
+            if uid not in winners:
+                bump(uid, gid, 1)
+        if stdout is not None and seen % batch_size == 0:
+            stdout.write(f"Scanned {seen} challenges…")
+
+    rows = [
+        ChallengeScore(user_id=uid, group_id=gid, wins=w, losses=l, played=p)
+        for (uid, gid), (w, l, p) in counts.items()
+    ]
+    with transaction.atomic():
+        ChallengeScore.objects.all().delete()
+        ChallengeScore.objects.bulk_create(rows, batch_size=batch_size)
+    return seen
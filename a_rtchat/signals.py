@@ -0,0 +1,69 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import ChatReadState, GlobalAnnouncement, GroupMessage, MessageReaction, Notification
+from . import auto_badges
+from . import notifications
+from a_core import request_globals
+from . import retention
+from . import room_index
+
+
+@receiver(post_save, sender=GroupMessage)
+def index_new_message(sender, instance, created, **kwargs):
+    if not created:
+        return
+    try:
+        room_index.record_message(instance)
+    except Exception:
+        # The sidebar index is derived data; never fail a send because of it.
+        pass
+    try:
+        auto_badges.message_created(instance)
+    except Exception:
+        pass
+    # Trimming happens in the retention worker; this only marks the room.
+    retention.schedule(instance.group_id)
+
+
+@receiver(post_save, sender=ChatReadState)
+def index_read_state(sender, instance, **kwargs):
+    try:
+        room_index.record_read(instance)
+    except Exception:
+        pass
+
+
+@receiver(post_save, sender=MessageReaction)
+def badge_reaction_added(sender, instance, created, **kwargs):
+    if not created:
+        return
+    try:
+        auto_badges.reaction_added(instance)
+    except Exception:
+        pass
+
+
+@receiver(post_delete, sender=MessageReaction)
+def badge_reaction_removed(sender, instance, **kwargs):
+    try:
+        auto_badges.reaction_removed(instance)
+    except Exception:
+        pass
+
+
+@receiver(post_save, sender=Notification)
+def notification_unread_bump(sender, instance, created, **kwargs):
+    # Single .create() calls (admin/support); bulk paths bump explicitly.
+    if not created or instance.is_read:
+        return
+    try:
+        notifications.bump_unread(instance.user_id)
+    except Exception:
+        pass
+
+
+@receiver(post_save, sender=GlobalAnnouncement)
+@receiver(post_delete, sender=GlobalAnnouncement)
+def invalidate_announcement_cache(sender, instance, **kwargs):
+    request_globals.invalidate(request_globals.ANNOUNCEMENT_KEY)
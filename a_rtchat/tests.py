@@ -1,14 +1,42 @@
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.messages import get_messages
+from django.core.management import call_command
 from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
 from datetime import timedelta
+from unittest.mock import MagicMock, patch
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from PIL import Image
+import asyncio
 import base64
-
-from .models import ChatGroup, CodeRoomJoinRequest, GroupMessage, OneTimeMessageView
+import io
+import json
+import tempfile
+import threading
+import time
+
+from .models import ArchivedMessage, ChatChallenge, ChatGroup, ChatReadState, ChatRoomSummary, CodeRoomJoinRequest, GroupMessage, MessageReaction, ModerationEvent, Notification, OneTimeMessageView
+from . import archive, auto_badges, challenges, history, link_preview, matchmaking, media_meta, moderation_pipeline, notifications, presence, presence_broadcast, purge, retention, room_index, scoreboard, user_state
+from .async_consumers import (
+	AsyncChatroomConsumer,
+	AsyncGlobalAnnouncementConsumer,
+	AsyncNotificationsConsumer,
+	AsyncOnlineStatusConsumer,
+	AsyncProfilePresenceConsumer,
+	consumer_for,
+)
+from .consumers import ChatroomConsumer
+from .fanout import message_event, select_rendered_html
+from .rate_limit import LimitCheck, check_event_limits, make_key, mute_key, set_muted
 from .retention import trim_chat_group_messages
+from a_core import profiler
+from a_users import author_cards
 from a_users.models import ChatBanHistory
 
 
@@ -299,6 +327,180 @@ class MessageRetentionTests(TestCase):
 		remaining_bodies = list(qs.values_list('body', flat=True)[:6])
 		self.assertEqual(remaining_bodies[0], 'm5')
 
+	@override_settings(
+		CHAT_MAX_MESSAGES_PER_ROOM=10,
+		RETENTION_TRIM_SLACK=5,
+		RETENTION_WORKER_IN_PROCESS=False,
+		MEDIA_ROOT=tempfile.gettempdir(),
+	)
+	def test_worker_trims_marked_room_in_batches(self):
+		owner = User.objects.create_user(username='owner_ret_w', password='pass12345')
+		room = ChatGroup.objects.create(is_private=False, admin=owner)
+		worker = retention._RetentionWorker()
+		with patch.object(retention, '_worker', worker):
+			first = GroupMessage.objects.create(
+				group=room, author=owner, body='',
+				file=SimpleUploadedFile('old.txt', b'old', content_type='text/plain'),
+			)
+			stored = first.file.name
+			storage = first.file.storage
+			MessageReaction.objects.create(message=first, user=owner, emoji='👍')
+			for i in range(13):
+				GroupMessage.objects.create(group=room, author=owner, body=f'm{i}')
+			reply = GroupMessage.objects.create(group=room, author=owner, body='re', reply_to=first)
+
+			# 15 messages: within cap + slack, so the pass only reads the counter.
+			self.assertEqual(worker.pending_size(), 1)
+			with self.assertNumQueries(1):
+				counts = worker.run_once()
+			self.assertEqual(counts['messages_deleted'], 0)
+
+			for i in range(2):
+				GroupMessage.objects.create(group=room, author=owner, body=f'n{i}')
+			worker._recent.clear()
+			retention.schedule(room.id)
+			counts = worker.run_once()
+
+		self.assertEqual(counts['rooms_trimmed'], 1)
+		self.assertEqual(counts['messages_deleted'], 7)
+		self.assertEqual(GroupMessage.objects.filter(group=room).count(), 10)
+		self.assertFalse(MessageReaction.objects.filter(message_id=first.id).exists())
+		reply.refresh_from_db()
+		self.assertIsNone(reply.reply_to_id)
+		self.assertEqual(counts['files_deleted'], 1)
+		self.assertFalse(storage.exists(stored))
+		self.assertEqual(ChatRoomSummary.objects.get(group=room).message_count, 10)
+
+
+class PurgeEngineTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.owner = User.objects.create_user(username='owner_purge', password='pass12345')
+
+	def _room(self, n, *, days_old, **kwargs):
+		room = ChatGroup.objects.create(admin=self.owner, **kwargs)
+		for i in range(n):
+			GroupMessage.objects.create(group=room, author=self.owner, body=f'p{i}')
+		GroupMessage.objects.filter(group=room).update(created=timezone.now() - timedelta(days=days_old))
+		room_index.rebuild_room(room.id)
+		return room
+
+	def test_message_purge_resumes_from_checkpoint_and_keeps_room_floor(self):
+		public = self._room(12, days_old=5, is_private=False)
+		private = self._room(4, days_old=5, is_private=True)
+		fresh = self._room(3, days_old=0, is_private=False)
+		engine = purge.MessagePurge(days=2, keep_last=5, chunk_size=4)
+
+		totals = purge.run(engine, max_chunks=2, sleep=lambda s: None)
+		self.assertEqual(totals['deleted'], 7)
+		self.assertGreater(engine.load_cursor(), 0)
+		self.assertGreater(purge.stats(engine)['lag_seconds'], 0)
+
+		# The next run picks up at the checkpoint and finishes the sweep.
+		purge.run(engine, sleep=lambda s: None)
+		self.assertEqual(engine.load_cursor(), 0)
+		self.assertEqual(GroupMessage.objects.filter(group=public).count(), 5)
+		self.assertEqual(GroupMessage.objects.filter(group=private).count(), 4)
+		self.assertEqual(GroupMessage.objects.filter(group=fresh).count(), 3)
+		self.assertEqual(ChatRoomSummary.objects.get(group=public).message_count, 5)
+		self.assertEqual(purge.stats(engine)['deleted_total'], 7)
+
+	def test_room_purge_uses_last_activity(self):
+		idle = self._room(3, days_old=10, is_private=True, is_code_room=True)
+		active = self._room(3, days_old=10, is_private=True, is_code_room=True)
+		GroupMessage.objects.create(group=active, author=self.owner, body='recent')
+		ChatGroup.objects.filter(id__in=[idle.id, active.id]).update(created=timezone.now() - timedelta(days=10))
+
+		call_command('purge_old_rooms', '--days', '4', '--dry-run', stdout=io.StringIO())
+		self.assertTrue(ChatGroup.objects.filter(id=idle.id).exists())
+
+		purge.run(purge.RoomPurge(days=4, chunk_size=10), sleep=lambda s: None)
+		self.assertFalse(ChatGroup.objects.filter(id=idle.id).exists())
+		self.assertFalse(GroupMessage.objects.filter(group_id=idle.id).exists())
+		self.assertTrue(ChatGroup.objects.filter(id=active.id).exists())
+
+
+class ArchiveTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.owner = User.objects.create_user(username='owner_archive', password='pass12345')
+		self.room = ChatGroup.objects.create(admin=self.owner)
+		self.old = [GroupMessage.objects.create(group=self.room, author=self.owner, body=f'old{i}') for i in range(4)]
+		self.old[2].reply_to = self.old[0]
+		self.old[2].save(update_fields=['reply_to'])
+		MessageReaction.objects.create(message=self.old[1], user=self.owner, emoji='👍')
+		GroupMessage.objects.filter(id__in=[m.id for m in self.old]).update(created=timezone.now() - timedelta(days=40))
+		self.new = [GroupMessage.objects.create(group=self.room, author=self.owner, body=f'new{i}') for i in range(3)]
+		room_index.rebuild_room(self.room.id)
+
+	def test_archived_messages_read_back_through_history(self):
+		moved = purge.run(archive.ArchivePurge(days=30, chunk_size=3), sleep=lambda s: None)
+		self.assertEqual(moved['deleted'], 4)
+		self.assertEqual(archive.boundary(self.room.id), self.old[-1].id)
+		self.assertEqual(GroupMessage.objects.filter(group=self.room).count(), 3)
+		self.assertEqual(ChatRoomSummary.objects.get(group=self.room).message_count, 3)
+
+		page = history.fetch_page(self.room, limit=5)
+		self.assertTrue(page.has_more)
+		self.assertEqual([m.body for m in page.messages], ['old2', 'old3', 'new0', 'new1', 'new2'])
+		quoted = page.messages[0]
+		self.assertTrue(quoted.is_archived)
+		self.assertEqual(quoted.reply_to.body, 'old0')
+
+		older = history.fetch_page(self.room, before_id=page.messages[0].id, limit=5)
+		self.assertFalse(older.has_more)
+		self.assertEqual([m.body for m in older.messages], ['old0', 'old1'])
+		self.assertEqual(archive.snapshot_pills(older.messages[1], ['👍']), [{'emoji': '👍', 'count': 1, 'reacted': False}])
+
+	def test_restore_keeps_ids_and_times(self):
+		created = dict(GroupMessage.objects.filter(group=self.room).values_list('id', 'created'))
+		purge.run(archive.ArchivePurge(days=30), sleep=lambda s: None)
+		self.assertEqual(archive.restore(group_id=self.room.id), 4)
+		self.assertFalse(ArchivedMessage.objects.exists())
+		self.assertEqual(dict(GroupMessage.objects.filter(group=self.room).values_list('id', 'created')), created)
+		self.assertEqual(GroupMessage.objects.get(id=self.old[2].id).reply_to_id, self.old[0].id)
+		self.assertEqual(archive.boundary(self.room.id), 0)
+
+	def test_archiving_keeps_dependents_and_quoted_messages(self):
+		fan = User.objects.create_user(username='fan_archive', password='pass12345')
+		reaction = MessageReaction.objects.create(message=self.old[1], user=fan, emoji='🔥')
+		MessageReaction.objects.filter(id=reaction.id).update(created=timezone.now() - timedelta(days=39))
+		event = ModerationEvent.objects.create(user=self.owner, room=self.room, message=self.old[3], action='flag')
+		# A hot reply keeps its quoted message hot.
+		GroupMessage.objects.create(group=self.room, author=self.owner, body='late reply', reply_to=self.old[1])
+
+		purge.run(archive.ArchivePurge(days=30), sleep=lambda s: None)
+		self.assertEqual(GroupMessage.objects.get(id=self.old[1].id).reactions.count(), 2)
+		self.assertEqual(set(ArchivedMessage.objects.values_list('id', flat=True)), {self.old[i].id for i in (0, 2, 3)})
+		event.refresh_from_db()
+		self.assertEqual((event.message_id, event.archived_message_id), (None, self.old[3].id))
+
+		archive.restore(group_id=self.room.id)
+		event.refresh_from_db()
+		self.assertEqual((event.message_id, event.archived_message_id), (self.old[3].id, None))
+		self.assertEqual(ChatRoomSummary.objects.get(group=self.room).archived_count, 0)
+
+	def test_restore_brings_reactions_back(self):
+		before = list(MessageReaction.objects.values_list('id', 'message_id', 'user_id', 'emoji', 'created'))
+		purge.run(archive.ArchivePurge(days=30), sleep=lambda s: None)
+		self.assertFalse(MessageReaction.objects.exists())
+		archive.restore(group_id=self.room.id)
+		self.assertEqual(list(MessageReaction.objects.values_list('id', 'message_id', 'user_id', 'emoji', 'created')), before)
+
+	def test_cap_counts_hot_and_archived_messages(self):
+		purge.run(archive.ArchivePurge(days=30), sleep=lambda s: None)
+		self.assertEqual(ChatRoomSummary.objects.get(group=self.room).archived_count, 4)
+
+		# 3 hot + 4 archived against a cap of 5: the two oldest (archived) rows go.
+		self.assertEqual(trim_chat_group_messages(chat_group_id=self.room.id, keep_last=5), 2)
+		self.assertEqual(list(ArchivedMessage.objects.order_by('id').values_list('body', flat=True)), ['old2', 'old3'])
+		self.assertEqual(GroupMessage.objects.filter(group=self.room).count(), 3)
+		self.assertEqual(ChatRoomSummary.objects.get(group=self.room).archived_count, 2)
+
+		self.assertEqual(trim_chat_group_messages(chat_group_id=self.room.id, keep_last=2), 3)
+		self.assertFalse(ArchivedMessage.objects.exists())
+		self.assertEqual(list(GroupMessage.objects.filter(group=self.room).order_by('id').values_list('body', flat=True)), ['new1', 'new2'])
+
 
 class OneTimeViewTests(TestCase):
 	def _png_file(self):
@@ -350,3 +552,813 @@ class OneTimeViewTests(TestCase):
 		url = reverse('message-one-time-open', kwargs={'message_id': msg.id})
 		resp = self.client.post(url)
 		self.assertEqual(resp.status_code, 403)
+
+
+class RenderOnceFanoutTests(TestCase):
+	def test_viewer_roles_get_matching_variant(self):
+		author = User.objects.create_user(username='fan_author', password='pass12345')
+		other = User.objects.create_user(username='fan_other', password='pass12345')
+		staff = User.objects.create_user(username='fan_staff', password='pass12345', is_staff=True)
+		room = ChatGroup.objects.create(is_private=False, admin=author)
+		msg = GroupMessage.objects.create(group=room, author=author, body='hello fanout')
+
+		event = message_event(msg, room, author_id=author.id)
+		rendered = event.get('rendered')
+		self.assertIsNotNone(rendered)
+		self.assertEqual(set(rendered['html']), {'own', 'other', 'staff'})
+
+		self.assertEqual(
+			select_rendered_html(rendered, viewer_id=author.id, viewer_is_staff=False),
+			rendered['html']['own'],
+		)
+		self.assertEqual(
+			select_rendered_html(rendered, viewer_id=other.id, viewer_is_staff=False),
+			rendered['html']['other'],
+		)
+		self.assertEqual(
+			select_rendered_html(rendered, viewer_id=staff.id, viewer_is_staff=True),
+			rendered['html']['staff'],
+		)
+		self.assertIn('hello fanout', rendered['html']['other'])
+
+	def test_skip_sender_omits_own_variant(self):
+		author = User.objects.create_user(username='fan_author2', password='pass12345')
+		room = ChatGroup.objects.create(is_private=False, admin=author)
+		msg = GroupMessage.objects.create(group=room, author=author, body='x')
+
+		event = message_event(msg, room, author_id=author.id, skip_sender=True)
+		self.assertTrue(event.get('skip_sender'))
+		self.assertNotIn('own', event['rendered']['html'])
+		# Missing variant -> caller falls back to a per-socket render.
+		self.assertIsNone(select_rendered_html(event['rendered'], viewer_id=author.id, viewer_is_staff=False))
+
+
+class PresenceTests(TestCase):
+	def setUp(self):
+		cache.clear()
+
+	def test_multi_tab_join_leave(self):
+		user = User.objects.create_user(username='pr_user', password='pass12345')
+		room = ChatGroup.objects.create(is_private=False, admin=user)
+
+		self.assertEqual(presence.join(room, user), 1)
+		self.assertEqual(presence.join(room, user), 2)
+		self.assertTrue(presence.is_online(user, room))
+		self.assertTrue(presence.is_online(user))
+		self.assertEqual(presence.count(room), 1)
+		self.assertEqual(presence.online_ids(room), {user.id})
+		self.assertIn(user.id, presence.online_since(room, [user.id]))
+
+		self.assertEqual(presence.leave(room, user), 1)
+		self.assertTrue(presence.is_online(user, room))
+		self.assertEqual(presence.leave(room, user), 0)
+		self.assertFalse(presence.is_online(user, room))
+		self.assertFalse(presence.is_online(user))
+		self.assertEqual(presence.count(), 0)
+
+	def test_stale_heartbeat_counts_as_offline(self):
+		user = User.objects.create_user(username='pr_stale', password='pass12345')
+		room = ChatGroup.objects.create(is_private=False, admin=user)
+		presence.join(room, user)
+
+		with self.settings(PRESENCE_TTL_SECONDS=10):
+			with patch('a_rtchat.presence.time.time', return_value=time.time() + 60):
+				self.assertFalse(presence.is_online(user, room))
+				self.assertEqual(presence.count(room), 0)
+				# A crashed socket never called leave(); the next join starts fresh.
+				self.assertEqual(presence.join(room, user), 1)
+
+
+class PresenceBroadcastTests(TestCase):
+	def setUp(self):
+		cache.clear()
+
+	def test_flush_publishes_visible_delta_once(self):
+		alice = User.objects.create_user(username='pb_alice', password='pass12345')
+		ghost = User.objects.create_user(username='pb_ghost', password='pass12345')
+		ghost.profile.is_stealth = True
+		ghost.profile.save(update_fields=['is_stealth'])
+
+		presence.join(presence.ONLINE_STATUS_ROOM, alice)
+		presence.join(presence.ONLINE_STATUS_ROOM, ghost)
+
+		event = presence_broadcast.flush()
+		self.assertEqual(event['total'], 2)
+		self.assertEqual(event['added'], [alice.id])
+		self.assertEqual(event['removed'], [])
+
+		# Nothing changed: empty delta.
+		event = presence_broadcast.flush()
+		self.assertEqual((event['added'], event['removed']), ([], []))
+
+		presence.leave(presence.ONLINE_STATUS_ROOM, alice)
+		event = presence_broadcast.flush()
+		self.assertEqual(event['removed'], [alice.id])
+		self.assertEqual(event['total'], 1)
+
+	def test_flush_notifies_target_presence_group(self):
+		bob = User.objects.create_user(username='pb_bob', password='pass12345')
+		layer = get_channel_layer()
+		channel = async_to_sync(layer.new_channel)()
+		async_to_sync(layer.group_add)(presence_broadcast.user_presence_group(bob.id), channel)
+
+		presence.join(presence.ONLINE_STATUS_ROOM, bob)
+		presence_broadcast.flush()
+
+		msg = async_to_sync(layer.receive)(channel)
+		self.assertEqual(msg, {'type': 'presence_handler', 'online': True})
+
+	def test_expired_heartbeat_schedules_offline_broadcast(self):
+		carol = User.objects.create_user(username='pb_carol', password='pass12345')
+		presence.join(presence.ONLINE_STATUS_ROOM, carol)
+		presence_broadcast.flush()
+		self.assertFalse(presence_broadcast.check_expired())
+
+		# The socket died without disconnect(): only the heartbeat goes stale.
+		cache.delete(presence_broadcast.EXPIRY_CHECK_KEY)
+		with patch.object(presence, '_ttl_seconds', return_value=-1), \
+				patch.object(presence_broadcast, 'schedule') as schedule:
+			self.assertTrue(presence_broadcast.check_expired())
+			schedule.assert_called_once_with()
+			self.assertEqual(presence_broadcast.flush()['removed'], [carol.id])
+
+	def test_hidden_set_follows_profile_saves_without_queries(self):
+		dave = User.objects.create_user(username='pb_dave', password='pass12345')
+		self.assertNotIn(dave.id, presence_broadcast.hidden_user_ids())
+
+		dave.profile.is_stealth = True
+		dave.profile.save()
+		with self.assertNumQueries(0):
+			self.assertIn(dave.id, presence_broadcast.hidden_user_ids())
+
+		dave.profile.is_stealth = False
+		dave.profile.save(update_fields=['is_stealth'])
+		with self.assertNumQueries(0):
+			self.assertNotIn(dave.id, presence_broadcast.hidden_user_ids())
+
+	def test_unthrottled_schedule_flushes_off_the_event_loop(self):
+		threads = []
+		done = threading.Event()
+
+		def fake_flush():
+			threads.append(threading.current_thread())
+			done.set()
+
+		async def run():
+			presence_broadcast.schedule()
+			return threading.current_thread()
+
+		with self.settings(PRESENCE_BROADCAST_INTERVAL_SECONDS=0), \
+				patch.object(presence_broadcast, 'flush', fake_flush):
+			loop_thread = asyncio.run(run())
+			self.assertTrue(done.wait(2))
+		self.assertIsNot(threads[0], loop_thread)
+
+
+class MatchmakingQueueTests(TestCase):
+	def test_pairs_fifo_and_skips_same_user_and_recent_partner(self):
+		queue = matchmaking.LocalMatchQueue()
+		now = time.time()
+		t_a = queue.enqueue('ch.a', 'u:1', now=now)
+		queue.enqueue('ch.a2', 'u:1', now=now)
+		t_b = queue.enqueue('ch.b', 'u:2', now=now)
+		t_c = queue.enqueue('ch.c', 'u:3', now=now)
+		queue.mark_recent('u:1', 'u:2', cooldown=60)
+
+		match = queue.pop_pair(now=now)
+		self.assertEqual({match.a.ticket, match.b.ticket}, {t_a, t_c})
+		self.assertEqual(queue.size(), 2)
+
+		# Only the second tab of u:1 and its recent partner u:2 remain.
+		self.assertIsNone(queue.pop_pair(now=now))
+
+		with self.settings(RANDOM_VIDEO_REMATCH_FALLBACK_WAIT_SECONDS=5):
+			match = queue.pop_pair(now=now + 6)
+		self.assertIn(t_b, (match.a.ticket, match.b.ticket))
+		self.assertEqual(queue.size(), 0)
+
+	def test_redis_queue_keys_share_one_cluster_slot(self):
+		queue = matchmaking.RedisMatchQueue(MagicMock())
+		keys = [queue.queue_key, queue._ticket_key('t1'), queue._recent_key('u:1')]
+		self.assertTrue(all(k.startswith('{rv:mm}:') for k in keys), keys)
+
+
+def _chat_socket(consumer_class, user, room):
+	communicator = WebsocketCommunicator(consumer_class.as_asgi(), f'/ws/chatroom/{room.group_name}')
+	communicator.scope['user'] = user
+	communicator.scope['url_route'] = {'kwargs': {'chatroom_name': room.group_name}}
+	return communicator
+
+
+async def _ws_drain(communicator, timeout=0.3):
+	"""Every JSON frame the socket sends until it goes quiet."""
+	frames = []
+	while not await communicator.receive_nothing(timeout=timeout):
+		frames.append(await communicator.receive_json_from())
+	return frames
+
+
+class EventLimitTests(TestCase):
+	def setUp(self):
+		cache.clear()
+
+	def test_mute_blocks_counting_and_denial_reports_retry_after(self):
+		check = LimitCheck(make_key('ws_event', 'room-x', 1), 2, 10)
+
+		set_muted(1, 30)
+		gate = check_event_limits([check], mute_keys=[mute_key(1)])
+		self.assertGreater(gate.mutes[0], 0)
+		self.assertEqual(gate.results[0].count, 0)
+
+		cache.delete(mute_key(1))
+		for _ in range(2):
+			self.assertTrue(check_event_limits([check]).allowed)
+		gate = check_event_limits([check])
+		self.assertFalse(gate.allowed)
+		self.assertEqual(gate.denied.retry_after, 10)
+
+	def test_script_reads_mutes_under_their_cache_key(self):
+		check = LimitCheck(make_key('ws_event', 'room-x', 1), 2, 10)
+		client = MagicMock()
+		client.register_script.return_value.return_value = [30000, 0, 0]
+		with patch('a_rtchat.rate_limit.get_redis', return_value=client):
+			gate = check_event_limits([check], mute_keys=[mute_key(1)])
+		keys = client.register_script.return_value.call_args.kwargs['keys']
+		self.assertEqual(keys[0], cache.make_key(mute_key(1)))
+		self.assertEqual(gate.mutes, (30,))
+
+	def test_commands_do_not_use_room_message_quota(self):
+		user = User.objects.create_user(username='ws_quota', password='pass12345')
+		room = ChatGroup.objects.create(group_name='ws-quota-room')
+
+		async def run():
+			communicator = _chat_socket(AsyncChatroomConsumer, user, room)
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+			await _ws_drain(communicator)
+			await communicator.send_json_to({'body': '!sc'})
+			await _ws_drain(communicator)
+			await communicator.send_json_to({'body': 'hello there'})
+			types = [m.get('type') for m in await _ws_drain(communicator)]
+			await communicator.disconnect()
+			return types
+
+		with self.settings(ROOM_MSG_RATE_LIMIT=1):
+			types = async_to_sync(run)()
+		self.assertIn('chat_message', types)
+		self.assertTrue(GroupMessage.objects.filter(group=room, body='hello there').exists())
+
+	def test_send_cooldown_and_burst_share_the_event_gate(self):
+		user = User.objects.create_user(username='ws_promo', password='pass12345')
+		room = ChatGroup.objects.create(group_name='ws-promo-room', groupchat_name='Free Promotion')
+		calls = []
+
+		def spy(checks, **kwargs):
+			checks = list(checks)
+			calls.append([c.key for c in checks])
+			return check_event_limits(checks, **kwargs)
+
+		async def run():
+			communicator = _chat_socket(AsyncChatroomConsumer, user, room)
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+			await _ws_drain(communicator)
+			await communicator.send_json_to({'body': 'first promo'})
+			await _ws_drain(communicator)
+			await communicator.send_json_to({'body': 'second promo'})
+			frames = await _ws_drain(communicator)
+			await communicator.disconnect()
+			return frames
+
+		with patch('a_rtchat.consumers.check_event_limits', side_effect=spy):
+			frames = async_to_sync(run)()
+		cd_key = make_key('chat_cd', room.group_name, user.id)
+		sends = [keys for keys in calls if cd_key in keys]
+		self.assertEqual(len(sends), 2)
+		self.assertIn(make_key('chat_burst', room.group_name, user.id), sends[0])
+		self.assertIn({'type': 'cooldown', 'seconds': 60, 'reason': 'cooldown'}, frames)
+		self.assertFalse(GroupMessage.objects.filter(group=room, body='second promo').exists())
+
+
+class UserStateSnapshotTests(TestCase):
+	def test_load_then_patch_from_pushed_events(self):
+		user = User.objects.create_user(username='snap', password='pass12345')
+		room = ChatGroup.objects.create(group_name='snap-room', is_private=True)
+		room.members.add(user)
+		GroupMessage.objects.create(group=room, author=user, body='hi')
+
+		state = user_state.load(user, room)
+		self.assertTrue(state.is_member)
+		self.assertFalse(state.verified)
+		self.assertEqual(state.sent_count, 1)
+
+		until = timezone.now() + timedelta(hours=1)
+		state = user_state.apply_event(state, {
+			'type': 'user_state_handler',
+			'state_event': 'chat_ban_status_notify_handler',
+			'banned': True,
+			'until': until.isoformat(),
+		})
+		self.assertTrue(state.is_banned())
+
+		state = user_state.apply_event(state, {'state_event': 'chat_block_status_notify_handler', 'blocked': True})
+		self.assertTrue(state.chat_blocked)
+
+		# Unknown events ask the consumer to reload from the DB.
+		self.assertIsNone(user_state.apply_event(state, {'state_event': ''}))
+
+
+class AsyncConsumerTests(TestCase):
+	def test_global_announcement_async_variant_matches_sync_behaviour(self):
+		from channels.testing import WebsocketCommunicator
+
+		async def run():
+			communicator = WebsocketCommunicator(AsyncGlobalAnnouncementConsumer.as_asgi(), '/ws/global-announcement/')
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+			first = await communicator.receive_json_from()
+			self.assertEqual(first['type'], 'global_announcement')
+
+			await communicator.send_json_to({'type': 'ping'})
+			self.assertEqual((await communicator.receive_json_from())['type'], 'pong')
+
+			await get_channel_layer().group_send('global_announcement', {
+				'type': 'global_announcement_handler',
+				'active': True,
+				'prefix': 'Team:',
+				'message': 'hello',
+			})
+			update = await communicator.receive_json_from()
+			self.assertEqual(update['message'], 'hello')
+			await communicator.disconnect()
+
+		async_to_sync(run)()
+
+	def test_chatroom_async_variant_delivers_messages_and_typing(self):
+		alice = User.objects.create_user(username='ac_alice', password='pass12345')
+		bob = User.objects.create_user(username='ac_bob', password='pass12345')
+		room = ChatGroup.objects.create(group_name='ac-room')
+
+		async def run():
+			sender = _chat_socket(AsyncChatroomConsumer, alice, room)
+			viewer = _chat_socket(AsyncChatroomConsumer, bob, room)
+			self.assertTrue((await sender.connect())[0])
+			self.assertTrue((await viewer.connect())[0])
+			await _ws_drain(sender)
+			await _ws_drain(viewer)
+
+			await sender.send_json_to({'type': 'typing', 'is_typing': True})
+			typing = [m for m in await _ws_drain(viewer) if m.get('type') == 'typing']
+			await sender.send_json_to({'body': 'hello from async'})
+			received = await _ws_drain(viewer)
+			await sender.disconnect()
+			await viewer.disconnect()
+			return typing, received
+
+		typing, received = async_to_sync(run)()
+		self.assertEqual(typing[0]['author_id'], alice.id)
+		self.assertTrue(typing[0]['is_typing'])
+		message = GroupMessage.objects.get(group=room, body='hello from async')
+		self.assertTrue(any(m.get('type') == 'chat_message' and str(message.id) in json.dumps(m) for m in received))
+
+	def test_online_status_async_variant_tracks_presence_and_partners(self):
+		alice = User.objects.create_user(username='ao_alice', password='pass12345')
+		bob = User.objects.create_user(username='ao_bob', password='pass12345')
+		chat = ChatGroup.objects.create(is_private=True)
+		chat.members.add(alice, bob)
+
+		async def run():
+			communicator = WebsocketCommunicator(AsyncOnlineStatusConsumer.as_asgi(), '/ws/online-status/')
+			communicator.scope['user'] = alice
+			self.assertTrue((await communicator.connect())[0])
+			first = await communicator.receive_json_from()
+			online = await database_sync_to_async(presence.is_online)(alice, presence.ONLINE_STATUS_ROOM)
+
+			await communicator.send_json_to({'type': 'ping'})
+			pong = await communicator.receive_json_from()
+			await get_channel_layer().group_send(presence.ONLINE_STATUS_ROOM, {
+				'type': 'online_status_handler', 'total': 3, 'added': [bob.id, 999_999], 'removed': [],
+			})
+			delta = await communicator.receive_json_from()
+			await communicator.disconnect()
+			return first, online, pong, delta
+
+		with patch.object(presence_broadcast, 'schedule'):
+			first, online, pong, delta = async_to_sync(run)()
+		self.assertEqual((first['type'], first['full']), ('online_status', True))
+		self.assertTrue(online)
+		self.assertEqual(pong['type'], 'pong')
+		self.assertEqual(delta['added'], [bob.id])
+		self.assertTrue(delta['online_in_chats'])
+		self.assertFalse(presence.is_online(alice, presence.ONLINE_STATUS_ROOM))
+
+	def test_notifications_and_profile_presence_async_variants(self):
+		alice = User.objects.create_user(username='an_alice', password='pass12345')
+		bob = User.objects.create_user(username='an_bob', password='pass12345')
+
+		async def run():
+			notify = WebsocketCommunicator(AsyncNotificationsConsumer.as_asgi(), '/ws/notify/')
+			notify.scope['user'] = alice
+			self.assertTrue((await notify.connect())[0])
+			layer = get_channel_layer()
+			# One handler that runs inline, one that hops to a thread (DND lookup).
+			await layer.group_send(f'notify_user_{alice.id}', {
+				'type': 'follow_request_notify_handler', 'from_username': 'an_bob', 'pending_count': 2,
+			})
+			await layer.group_send(f'notify_user_{alice.id}', {
+				'type': 'follow_notify_handler', 'from_username': 'an_bob', 'url': '/u/an_bob/',
+			})
+			notes = [await notify.receive_json_from(), await notify.receive_json_from()]
+			await notify.disconnect()
+
+			profile = WebsocketCommunicator(AsyncProfilePresenceConsumer.as_asgi(), f'/ws/presence/{bob.username}/')
+			profile.scope['user'] = alice
+			profile.scope['url_route'] = {'kwargs': {'username': bob.username}}
+			self.assertTrue((await profile.connect())[0])
+			initial = await profile.receive_json_from()
+			await layer.group_send(presence_broadcast.user_presence_group(bob.id), {'type': 'presence_handler', 'online': True})
+			flip = await profile.receive_json_from()
+			await profile.disconnect()
+			return notes, initial, flip
+
+		notes, initial, flip = async_to_sync(run)()
+		self.assertEqual([n['type'] for n in notes], ['follow_request', 'follow'])
+		self.assertEqual(notes[0]['pending_count'], 2)
+		self.assertEqual(initial, {'type': 'presence', 'online': False})
+		self.assertEqual(flip, {'type': 'presence', 'online': True})
+
+	def test_consumer_for_follows_setting(self):
+		with self.settings(CHAT_ASYNC_CONSUMERS=True):
+			self.assertIs(consumer_for(ChatroomConsumer), AsyncChatroomConsumer)
+		with self.settings(CHAT_ASYNC_CONSUMERS=False):
+			self.assertIs(consumer_for(ChatroomConsumer), ChatroomConsumer)
+
+
+@override_settings(
+	AI_MODERATION_CLASSIFIER='stub',
+	AI_MODERATION_STUB_BLOCK_TERMS=['badword'],
+	AI_MODERATION_STUB_FLAG_TERMS=['meh'],
+)
+class ModerationPipelineTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		moderation_pipeline.verdict_cache.clear()
+		self.user = User.objects.create_user(username='mod-author', password='pass12345')
+		self.room = ChatGroup.objects.create(group_name='mod-room')
+
+	def test_inline_is_the_default_mode(self):
+		self.assertEqual(moderation_pipeline.pipeline_mode(), moderation_pipeline.MODE_INLINE)
+		self.assertFalse(moderation_pipeline.is_async_mode())
+		with self.settings(AI_MODERATION_MODE='optimistic'):
+			self.assertTrue(moderation_pipeline.is_async_mode())
+
+	def test_review_retracts_blocked_and_links_flagged_messages(self):
+		bad = GroupMessage.objects.create(group=self.room, author=self.user, body='you BADWORD')
+		meh = GroupMessage.objects.create(group=self.room, author=self.user, body='meh')
+		ok = GroupMessage.objects.create(group=self.room, author=self.user, body='hello')
+
+		counts = moderation_pipeline.review_messages([bad.id, meh.id, ok.id], via='ws')
+
+		self.assertEqual((counts['block'], counts['flag'], counts['allow']), (1, 1, 1))
+		self.assertFalse(GroupMessage.objects.filter(id=bad.id).exists())
+		self.assertTrue(ModerationEvent.objects.filter(action='block', meta__retracted_message_id=bad.id).exists())
+		self.assertTrue(ModerationEvent.objects.filter(action='flag', message_id=meh.id).exists())
+
+	def test_retract_drops_notifications_for_the_message(self):
+		mentioned = User.objects.create_user(username='mod-mentioned', password='pass12345')
+		bad = GroupMessage.objects.create(group=self.room, author=self.user, body='@mod-mentioned BADWORD')
+		notifications.notify_many(
+			[mentioned.id], type='mention', from_user=self.user, chatroom_name=self.room.group_name,
+			message_id=bad.id, always_persist=True,
+		)
+		Notification.objects.create(user=mentioned, from_user=self.user, type='follow')
+		self.assertEqual(notifications.unread_count(mentioned.id), 2)
+
+		moderation_pipeline.review_messages([bad.id], via='ws')
+
+		self.assertFalse(Notification.objects.filter(message_id=bad.id).exists())
+		self.assertEqual(notifications.unread_count(mentioned.id), 1)
+
+	def test_normalized_repeats_hit_the_verdict_cache(self):
+		with patch('a_rtchat.moderation_pipeline.classify_batch', wraps=moderation_pipeline.classify_batch) as spy:
+			moderation_pipeline.moderate_cached('Hellooooo   there')
+			moderation_pipeline.moderate_cached('hellooo there')
+			moderation_pipeline.verdict_cache.clear()
+			moderation_pipeline.moderate_cached('HELLOO THERE')
+		self.assertEqual(spy.call_count, 1)
+
+
+class HistoryTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.author = User.objects.create_user(username='hist_author', password='pass12345')
+		self.viewer = User.objects.create_user(username='hist_viewer', password='pass12345')
+		self.room = ChatGroup.objects.create(is_private=False, admin=self.author)
+		self.msgs = [GroupMessage.objects.create(group=self.room, author=self.author, body=f'm{i}') for i in range(12)]
+
+	def test_keyset_page_and_json_mode(self):
+		page = history.fetch_page(self.room, before_id=self.msgs[-1].id, limit=10)
+		self.assertEqual([m.id for m in page.messages], [m.id for m in self.msgs[1:11]])
+		self.assertTrue(page.has_more)
+		self.assertFalse(history.fetch_page(self.room, before_id=page.oldest_id, limit=10).has_more)
+
+		self.client.force_login(self.viewer)
+		res = self.client.get(reverse('chat-older', args=[self.room.group_name]), {'before': self.msgs[-1].id, 'format': 'json'})
+		data = res.json()
+		self.assertEqual([m['body'] for m in data['messages']], [f'm{i}' for i in range(11)])
+		self.assertFalse(data['has_more'])
+
+	def test_fragments_are_shared_and_invalidated(self):
+		msg = self.msgs[-1]
+		uncached = history.attach_fragments([msg], self.viewer, self.room)
+		self.assertEqual(uncached, [])
+		key = history.fragment_key(msg, 'other', grouped=False)
+		self.assertIsNotNone(cache.get(key))
+
+		MessageReaction.objects.create(message=msg, user=self.viewer, emoji='👍')
+		history.invalidate(msg)
+		self.assertIsNone(cache.get(key))
+
+		fresh = GroupMessage.objects.get(id=msg.id)
+		history.attach_fragments([fresh], self.viewer, self.room)
+		self.assertIn('👍', fresh.history_html)
+		self.assertEqual(cache.get(key)['reactions'][0]['reacted'], False)
+
+	def test_fragment_key_follows_author_and_quoted_author_cards(self):
+		other = User.objects.create_user(username='hist_quoted', password='pass12345')
+		quoted = GroupMessage.objects.create(group=self.room, author=other, body='original')
+		reply = GroupMessage.objects.create(group=self.room, author=self.author, body='re', reply_to=quoted)
+
+		def key():
+			msg = GroupMessage.objects.select_related('reply_to').get(id=reply.id)
+			author_cards.attach([msg])
+			return history.fragment_key(msg, 'other', grouped=False)
+
+		before = key()
+		self.author.profile.displayname = 'Renamed author'
+		self.author.profile.save()
+		after_author = key()
+		self.assertNotEqual(before, after_author)
+
+		other.profile.displayname = 'Renamed quoted'
+		other.profile.save()
+		self.assertNotEqual(after_author, key())
+
+
+class ChallengeScoreboardTests(TestCase):
+	def test_completion_updates_scores_once(self):
+		a = User.objects.create_user(username='sc_a', password='pass12345')
+		b = User.objects.create_user(username='sc_b', password='pass12345')
+		room = ChatGroup.objects.create(is_private=True, admin=a)
+		room.members.add(a, b)
+		ch = ChatChallenge.objects.create(
+			group=room,
+			kind=ChatChallenge.KIND_EMOJI_ONLY,
+			meta={'losers': [b.id], 'participants': [a.id, b.id]},
+		)
+		stale = ChatChallenge.objects.get(pk=ch.pk)
+
+		challenges.end_challenge(ch)
+		# A second worker expiring the same challenge must not score it again.
+		challenges.end_challenge(stale)
+
+		self.assertEqual(challenges.get_win_loss_totals(a.id), {'wins': 1, 'losses': 0, 'completed': 1})
+		self.assertEqual(scoreboard.totals(b.id, group=room), {'wins': 0, 'losses': 1, 'completed': 1})
+		self.assertEqual([row['username'] for row in scoreboard.leaderboard(group=room)], ['sc_a'])
+
+		scoreboard.rebuild()
+		self.assertEqual(challenges.get_win_loss_totals(b.id), {'wins': 0, 'losses': 1, 'completed': 1})
+
+
+class RoomIndexTests(TestCase):
+	def test_summary_and_unread_follow_messages_and_reads(self):
+		a = User.objects.create_user(username='idx_a', password='pass12345')
+		b = User.objects.create_user(username='idx_b', password='pass12345')
+		room = ChatGroup.objects.create(is_private=True, admin=a)
+		room.members.add(a, b)
+
+		m1 = GroupMessage.objects.create(group=room, author=b, body='hi')
+		m2 = GroupMessage.objects.create(group=room, author=a, body='hey')
+		m3 = GroupMessage.objects.create(group=room, author=a, body='there')
+
+		summary = ChatRoomSummary.objects.get(group=room)
+		self.assertEqual((summary.last_message_id, summary.last_non_author_id, summary.message_count), (m3.id, m1.id, 3))
+		self.assertEqual(summary.latest_id_not_by(a.id), m1.id)
+		self.assertEqual(room_index.private_unread(b, [room.id]), {room.id: 2})
+		self.assertEqual(room_index.private_unread(a, [room.id]), {room.id: 1})
+
+		state = ChatReadState.objects.get(user=b, group=room)
+		state.last_read_message_id = m2.id
+		state.save(update_fields=['last_read_message_id', 'updated'])
+		self.assertEqual(room_index.private_unread(b, [room.id]), {room.id: 1})
+
+		m3.delete()
+		room_index.messages_deleted(room.id, 1, max_id=m3.id)
+		summary.refresh_from_db()
+		self.assertEqual((summary.last_message_id, summary.message_count), (m2.id, 2))
+		self.assertEqual(room_index.private_unread(b, [room.id]), {})
+
+		self.client.force_login(b)
+		data = self.client.get(reverse('chat-sidebar')).json()
+		self.assertEqual([r['other_username'] for r in data['private_rooms']], ['idx_a'])
+		self.assertEqual(data['private_unread_count'], 0)
+
+
+class AutoBadgeTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.admin = User.objects.create_user(username='ab_admin', password='pass12345')
+		self.alice = User.objects.create_user(username='ab_alice', password='pass12345')
+		self.bob = User.objects.create_user(username='ab_bob', password='pass12345')
+		self.room = ChatGroup.objects.create(group_name='ab-room', admin=self.admin)
+
+	def _keys(self, user):
+		return [b['key'] for b in auto_badges.compute_auto_badges(self.room, [user.id]).get(user.id, [])]
+
+	def test_events_update_badges_and_rebuild_matches(self):
+		parent = GroupMessage.objects.create(group=self.room, author=self.alice, body='q')
+		for i in range(3):
+			GroupMessage.objects.create(group=self.room, author=self.bob, body=f'a{i}', reply_to=parent)
+		self.assertEqual(self._keys(self.bob), ['fast_replier', 'room_og'])
+		self.assertEqual(self._keys(self.admin), ['room_og'])
+
+		fans = [User.objects.create_user(username=f'ab_fan{i}', password='pass12345') for i in range(5)]
+		for fan in fans:
+			MessageReaction.objects.create(message=parent, user=fan, emoji='👍')
+		self.assertIn('helpful', self._keys(self.alice))
+		MessageReaction.objects.filter(message=parent, user=fans[0]).delete()
+		self.assertNotIn('helpful', self._keys(self.alice))
+
+		# A cold cache is rebuilt from the database with the same result.
+		cache.clear()
+		self.assertEqual(self._keys(self.bob), ['fast_replier', 'room_og'])
+		self.assertEqual(self._keys(self.alice), ['room_og'])
+
+	def test_rebuild_replaces_windows_and_drops_deleted_events(self):
+		parent = GroupMessage.objects.create(group=self.room, author=self.alice, body='q')
+		replies = [GroupMessage.objects.create(group=self.room, author=self.bob, body=f'a{i}', reply_to=parent) for i in range(3)]
+		self.assertIn('fast_replier', self._keys(self.bob))
+
+		# Deletes are not fed to the event windows; the next rebuild must drop them.
+		GroupMessage.objects.filter(id=replies[0].id).delete()
+		cache.delete(auto_badges._warm_key(self.room.id, self.bob.id))
+		self.assertNotIn('fast_replier', self._keys(self.bob))
+
+		# Only the requested authors are rebuilt.
+		self.assertIsNone(cache.get(auto_badges._warm_key(self.room.id, self.alice.id)))
+		self.assertIsNotNone(cache.get(auto_badges._warm_key(self.room.id, self.bob.id)))
+
+	def test_rebuild_is_skipped_while_another_request_holds_the_lock(self):
+		cache.add(auto_badges._warm_lock_key(self.room.id), 1)
+		GroupMessage.objects.create(group=self.room, author=self.bob, body='hi')
+		with patch.object(auto_badges, 'warm_room') as warm:
+			auto_badges.compute_auto_badges(self.room, [self.bob.id])
+		warm.assert_not_called()
+
+
+class LinkPreviewTests(TestCase):
+	def setUp(self):
+		cache.clear()
+
+	def test_head_scanner_stops_at_body(self):
+		chunks = [
+			b'<html><head><title>Fallback</title><meta property="og:title" content="OG &amp; title">',
+			b'<meta name="description" content="Desc"><meta property="og:image" content="/img.png"></head>',
+			b'<body><meta property="og:site_name" content="ignored">',
+		]
+		preview = link_preview.parse_head(iter(chunks), base_url='https://example.com/a')
+		self.assertEqual(preview.title, 'OG & title')
+		self.assertEqual(preview.description, 'Desc')
+		self.assertEqual(preview.image, 'https://example.com/img.png')
+		self.assertEqual(preview.site_name, '')
+
+	def test_fetches_once_per_normalized_url_and_caches_failures(self):
+		found = link_preview.LinkPreview(url='https://example.com/post', title='Post')
+		with patch.object(link_preview, '_fetch_uncached', return_value=found) as fetch:
+			self.assertEqual(link_preview.fetch_link_preview('https://Example.com:443/post?utm_source=x#top'), found)
+			self.assertEqual(link_preview.fetch_link_preview('https://example.com/post'), found)
+		self.assertEqual(fetch.call_count, 1)
+
+		with patch.object(link_preview, '_fetch_uncached', return_value=None) as fetch:
+			self.assertIsNone(link_preview.fetch_link_preview('https://example.com/missing'))
+			self.assertIsNone(link_preview.fetch_link_preview('https://example.com/missing'))
+		self.assertEqual(fetch.call_count, 1)
+
+	def test_worker_requeues_urls_locked_by_another_process(self):
+		user = User.objects.create_user(username='lp_author', password='pass12345')
+		room = ChatGroup.objects.create(group_name='lp-room')
+		message = GroupMessage.objects.create(group=room, author=user, body='see https://example.com/busy')
+		url = 'https://example.com/busy'
+		lock = link_preview._lock_key(link_preview.normalize_url(url))
+		cache.add(lock, 1, timeout=30)
+		worker = link_preview._PreviewWorker(size=1)
+		found = link_preview.LinkPreview(url=url, title='Busy')
+
+		with patch.object(link_preview, '_fetch_uncached', return_value=found) as fetch, \
+				patch.object(link_preview, '_publish_update') as publish:
+			started = time.monotonic()
+			worker._process(message.id, url, started + 10)
+			self.assertLess(time.monotonic() - started, 1)
+			self.assertEqual(fetch.call_count, 0)
+			due, _seq, message_id, requeued_url, give_up = worker._queue.get_nowait()
+			self.assertGreater(due, started)
+			self.assertEqual((message_id, requeued_url), (message.id, url))
+
+			cache.delete(lock)
+			worker._process(message_id, requeued_url, give_up)
+		self.assertEqual(fetch.call_count, 1)
+		publish.assert_called_once_with(message.id)
+		message.refresh_from_db()
+		self.assertEqual(message.link_title, 'Busy')
+
+
+class NotificationServiceTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.sender = User.objects.create_user(username='notif_sender', password='pass12345')
+		self.users = [User.objects.create_user(username=f'notif_u{i}', password='pass12345') for i in range(3)]
+		dnd = self.users[2].profile
+		dnd.is_dnd = True
+		dnd.save()
+
+	def test_notify_many_inserts_in_one_query_and_skips_dnd(self):
+		ids = [u.id for u in self.users]
+		with self.assertNumQueries(2):
+			states = notifications.notify_many(
+				ids, type='mention', from_user=self.sender, chatroom_name='room-x',
+				preview='hi', always_persist=True, skip_dnd=True,
+			)
+		self.assertFalse(states[self.users[2].id].realtime)
+		self.assertEqual(Notification.objects.filter(user_id__in=ids).count(), 2)
+
+	def test_unread_counter_follows_writes(self):
+		u = self.users[0]
+		self.assertEqual(notifications.unread_count(u.id), 0)
+		Notification.objects.create(user=u, from_user=self.sender, type='follow')
+		notifications.notify_many([u.id], type='mention', from_user=self.sender, chatroom_name='room-x', always_persist=True)
+		with self.assertNumQueries(0):
+			self.assertEqual(notifications.unread_count(u.id), 2)
+		notifications.mark_read(u.id, type='follow')
+		self.assertEqual(notifications.unread_count(u.id), 1)
+		notifications.clear_all(u.id)
+		with self.assertNumQueries(0):
+			self.assertEqual(notifications.unread_count(u.id), 0)
+
+
+@override_settings(PROFILER_ENABLED=True, PROFILER_SAMPLE_RATE=1.0, PROFILER_N_PLUS_ONE_THRESHOLD=5)
+class ProfilerTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.staff = User.objects.create_user(username='prof_staff', password='pass12345', is_staff=True)
+
+	def test_repeated_query_shape_is_flagged(self):
+		with profiler.profile('loop', kind='view') as sample:
+			for uid in range(6):
+				list(User.objects.filter(id=uid))
+			cache.get('prof-test-key')
+		self.assertEqual(sample.queries, 6)
+		self.assertEqual(sample.cache_calls, 1)
+
+		data = profiler.report()
+		row = next(r for r in data['rows'] if r['name'] == 'loop')
+		self.assertEqual(row['count'], 1)
+		self.assertEqual(row['avg_queries'], 6.0)
+		self.assertTrue(any(f['name'] == 'loop' and 'auth_user' in f['shape'] for f in data['n_plus_one']))
+
+	def test_staff_page_lists_sampled_views(self):
+		self.client.force_login(self.staff)
+		self.client.get(reverse('admin-analytics'))
+		response = self.client.get(reverse('admin-profiler'))
+		self.assertEqual(response.status_code, 200)
+		self.assertContains(response, 'admin_analytics_view')
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class MediaMetaTests(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(username='media_u', password='pass12345')
+		self.room = ChatGroup.objects.create(group_name='media-room')
+
+	def _png(self, size=(40, 30)):
+		buf = io.BytesIO()
+		Image.new('RGB', size, (200, 40, 40)).save(buf, format='PNG')
+		return SimpleUploadedFile('photo.png', buf.getvalue(), content_type='image/png')
+
+	def test_probe_upload_reads_type_size_and_placeholder(self):
+		upload = self._png()
+		meta = media_meta.probe_upload(upload)
+		self.assertEqual(meta['media_kind'], 'image')
+		self.assertEqual(meta['media_mime'], 'image/png')
+		self.assertEqual((meta['media_width'], meta['media_height']), (40, 30))
+		self.assertEqual(meta['media_bytes'], upload.size)
+		self.assertTrue(meta['media_placeholder'].startswith('data:image/png;base64,'))
+
+	def test_backfill_then_render_without_file_io(self):
+		message = GroupMessage.objects.create(group=self.room, author=self.user, file=self._png((12, 9)))
+		self.assertEqual(message.media_kind, '')
+		call_command('backfill_media_meta', stdout=io.StringIO())
+		message.refresh_from_db()
+		self.assertEqual((message.media_kind, message.media_width), ('image', 12))
+		with patch.object(type(message.file), 'open', side_effect=AssertionError('file opened')):
+			self.assertTrue(message.is_image)
+			self.assertFalse(message.is_video)
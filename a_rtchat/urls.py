@@ -10,6 +10,9 @@ urlpatterns = [
     path('chat/config/<chatroom_name>', chat_config_view, name='chat-config'),
     path('chat/poll/<chatroom_name>', chat_poll_view, name="chat-poll"),
     path('chat/older/<chatroom_name>', chat_older_view, name="chat-older"),
+    path('chat/sidebar/', chat_sidebar_view, name='chat-sidebar'),
+    path('chat/challenges/leaderboard/', challenge_leaderboard_view, name='challenge-leaderboard'),
+    path('chat/challenges/leaderboard/<chatroom_name>/', challenge_leaderboard_view, name='challenge-room-leaderboard'),
     path('chat/mentions/', mention_user_search, name='mention-search'),
     path('chat/push/register/', push_register, name='push-register'),
     path('chat/push/config/', push_config, name='push-config'),
@@ -67,4 +70,5 @@ urlpatterns = [
 
     path('chat/admin/analytics/', admin_analytics_view, name='admin-analytics'),
     path('chat/admin/analytics/live/', admin_analytics_live_view, name='admin-analytics-live'),
+    path('chat/admin/profiler/', admin_profiler_view, name='admin-profiler'),
 ]
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""Per-connection snapshot of a user's chat moderation state.
+
+ChatroomConsumer used to re-query membership, ban, block, email-verified and
+sent-message count on every websocket event. The snapshot is loaded once at
+connect and kept fresh by push events instead:
+
+- the admin ban/block views publish their existing notify events to
+  `user_state_group(user_id)` as well (see `publish`)
+- `member_removed_handler` flips membership for the removed user's sockets
+- confirming an email publishes a plain refresh event
+
+Every snapshot also expires after CHAT_USER_STATE_TTL_SECONDS, as a safety
+net for changes made outside those paths (e.g. Django admin edits).
+"""
+
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from .models import ChatGroup, GroupMessage
+
+
+def user_state_group(user_id) -> str:
+    return f"chat_user_state_{int(user_id)}"
+
+
+def _ttl_seconds() -> float:
+    try:
+        return max(0.0, float(getattr(settings, 'CHAT_USER_STATE_TTL_SECONDS', 60)))
+    except Exception:
+        return 60.0
+
+
+@dataclass
+class UserStateSnapshot:
+    is_member: bool = True
+    banned_until: object = None
+    chat_blocked: bool = False
+    verified: bool = False
+    # Only counted for unverified users (the verify-email gate needs it).
+    sent_count: int = 0
+    loaded_at: float = field(default_factory=time.monotonic)
+
+    def is_stale(self) -> bool:
+        ttl = _ttl_seconds()
+        return ttl <= 0 or (time.monotonic() - self.loaded_at) >= ttl
+
+    def is_banned(self) -> bool:
+        until = self.banned_until
+        if not until:
+            return False
+        try:
+            return until > timezone.now()
+        except Exception:
+            return False
+
+
+def load(user, chatroom) -> UserStateSnapshot:
+    """Read everything the receive path needs in one go (staff are never blocked/banned)."""
+    snap = UserStateSnapshot()
+    uid = getattr(user, 'id', None)
+    if not uid:
+        snap.is_member = False
+        return snap
+
+    if getattr(chatroom, 'is_private', False):
+        try:
+            snap.is_member = ChatGroup.objects.filter(pk=getattr(chatroom, 'pk', None), members__id=uid).exists()
+        except Exception:
+            # If membership check fails, be safe and stop.
+            snap.is_member = False
+
+    if getattr(user, 'is_staff', False):
+        snap.verified = True
+        return snap
+
+    try:
+        from a_users.models import Profile
+
+        row = (
+            Profile.objects.filter(user_id=uid)
+            .values_list('chat_blocked', 'chat_banned_until')
+            .first()
+        )
+        if row:
+            snap.chat_blocked = bool(row[0])
+            snap.banned_until = row[1]
+    except Exception:
+        pass
+
+    if snap.banned_until and not snap.is_banned():
+        # Expired ban: clear it (best-effort) so it auto-unbans.
+        try:
+            from a_users.models import Profile
+
+            Profile.objects.filter(user_id=uid).update(chat_banned_until=None)
+        except Exception:
+            pass
+        snap.banned_until = None
+
+    try:
+        qs = getattr(user, 'emailaddress_set', None)
+        snap.verified = bool(qs and qs.filter(verified=True).exists())
+    except Exception:
+        snap.verified = False
+
+    if not snap.verified:
+        try:
+            snap.sent_count = int(GroupMessage.objects.filter(author_id=uid).count())
+        except Exception:
+            snap.sent_count = 10**9
+    return snap
+
+
+def apply_event(snap: UserStateSnapshot | None, event: dict) -> UserStateSnapshot | None:
+    """Patch a snapshot from a pushed event; returns None when it must be reloaded."""
+    if snap is None:
+        return None
+    event_type = str(event.get('state_event') or event.get('type') or '')
+    if event_type == 'chat_block_status_notify_handler':
+        snap.chat_blocked = bool(event.get('blocked'))
+        return snap
+    if event_type == 'chat_ban_status_notify_handler':
+        if not event.get('banned'):
+            snap.banned_until = None
+            return snap
+        try:
+            from django.utils.dateparse import parse_datetime
+
+            snap.banned_until = parse_datetime(str(event.get('until') or ''))
+        except Exception:
+            snap.banned_until = None
+        # A ban without a parseable end is treated as "reload from DB".
+        return snap if snap.banned_until else None
+    return None
+
+
+def publish(user_id, event: dict | None = None) -> None:
+    """Push a state change to every chatroom socket of `user_id` (best-effort)."""
+    try:
+        uid = int(user_id or 0)
+    except Exception:
+        uid = 0
+    if uid <= 0:
+        return
+    try:
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        payload = dict(event or {})
+        payload['state_event'] = str(payload.get('type') or '')
+        payload['type'] = 'user_state_handler'
+        async_to_sync(channel_layer.group_send)(user_state_group(uid), payload)
+    except Exception:
+        pass
@@ -26,6 +26,7 @@ from django.db import transaction
 from django.db.models import Q
 from django.db.models import Count
 from django.db.models import Max
+from django.db.models import F
 from django.db.models.functions import TruncDate, TruncHour
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.text import slugify
@@ -35,6 +36,7 @@ try:
     from a_users.location_ip import maybe_set_profile_city_from_ip
 except Exception:  # pragma: no cover
     maybe_set_profile_city_from_ip = None
+from a_users import author_cards
 from a_users.badges import get_verified_user_ids
 from a_users.models import Profile
 from a_users.models import FCMToken
@@ -46,8 +48,10 @@ from a_users.location_preferences import clean_location_name, ensure_local_commu
 from .models import *
 from .forms import *
 from .agora import build_rtc_token
-from .moderation import moderate_message
+from . import moderation_pipeline
 from .channels_utils import chatroom_channel_group_name
+from .fanout import message_event
+from . import archive, history, notifications, presence, room_index, scoreboard, user_state
 
 
 CHAT_THEME_CHOICES = (
@@ -175,7 +179,8 @@ def _purge_support_chat_history(chat_group, retention_days=2):
         keep_days = 2
     cutoff = timezone.now() - timedelta(days=keep_days)
     try:
-        GroupMessage.objects.filter(group=chat_group, created__lt=cutoff).delete()
+        _total, per_model = GroupMessage.objects.filter(group=chat_group, created__lt=cutoff).delete()
+        room_index.messages_deleted(chat_group.id, per_model.get(GroupMessage._meta.label, 0))
     except Exception:
         pass
 
@@ -223,11 +228,11 @@ def _create_and_broadcast_system_join_message(chat_group, joined_user):
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
             chatroom_channel_group_name(chat_group),
-            {
-                'type': 'message_handler',
-                'message_id': msg.id,
-                'author_id': int(getattr(joined_user, 'id', 0) or 0),
-            },
+            message_event(
+                msg,
+                chat_group,
+                author_id=int(getattr(joined_user, 'id', 0) or 0),
+            ),
         )
     except Exception:
         return
@@ -463,11 +468,11 @@ def _create_and_broadcast_system_event_message(chat_group, actor_user, marker: s
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
             chatroom_channel_group_name(chat_group),
-            {
-                'type': 'message_handler',
-                'message_id': msg.id,
-                'author_id': int(getattr(actor_user, 'id', 0) or 0),
-            },
+            message_event(
+                msg,
+                chat_group,
+                author_id=int(getattr(actor_user, 'id', 0) or 0),
+            ),
         )
     except Exception:
         return
@@ -494,11 +499,11 @@ def _create_and_broadcast_system_tag_message(chat_group, actor_user, text: str):
         channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
             chatroom_channel_group_name(chat_group),
-            {
-                'type': 'message_handler',
-                'message_id': msg.id,
-                'author_id': int(getattr(actor_user, 'id', 0) or 0),
-            },
+            message_event(
+                msg,
+                chat_group,
+                author_id=int(getattr(actor_user, 'id', 0) or 0),
+            ),
         )
     except Exception:
         return
@@ -637,6 +642,10 @@ def _attach_reaction_pills(messages, user):
     )
 
     for m in messages:
+        snapshot = archive.snapshot_pills(m, CHAT_REACTION_EMOJIS)
+        if snapshot is not None:
+            m.reaction_pills = snapshot
+            continue
         pills = []
         for emoji in CHAT_REACTION_EMOJIS:
             c = counts.get((m.id, emoji), 0)
@@ -957,31 +966,126 @@ def _sidebar_nearby_active_rooms(user, current_room_name: str = ''):
     if not city:
         return []
 
-    city_key = city.lower()
-    qs = (
+    return room_index.nearby_active_rooms(city, exclude_group_name=current_room_name, limit=6)
+
+
+def _sidebar_data(user, *, current_room_name: str = '', chat_blocked: bool = False) -> dict:
+    """Everything the chat sidebar shows (shared by chat_view and chat_sidebar_view).
+
+    Unread state and room activity come from the room-summary index
+    (`a_rtchat.room_index`) instead of aggregating messages per page load.
+    """
+    sidebar_groupchats = list(
         ChatGroup.objects
-        .filter(groupchat_name__isnull=False, is_private=False)
+        .filter(groupchat_name__isnull=False)
         .exclude(group_name='online-status')
-        .annotate(message_count=Count('chat_messages'), latest_created=Max('chat_messages__created'))
-        .filter(message_count__gt=0)
-        .order_by('-latest_created')
+        .exclude(group_name__startswith='local-')
+        .order_by('groupchat_name')
     )
+    sidebar_groupchat_sections, sidebar_groupchats_remaining = _build_groupchat_sections(sidebar_groupchats)
 
-    out = []
-    for room in qs:
-        if current_room_name and str(getattr(room, 'group_name', '') or '') == current_room_name:
+    data = {
+        'sidebar_groupchats': sidebar_groupchats,
+        'sidebar_groupchat_sections': sidebar_groupchat_sections,
+        'sidebar_groupchats_remaining': sidebar_groupchats_remaining,
+        'sidebar_local_communities': _sidebar_local_communities(user),
+        'sidebar_nearby_active_rooms': _sidebar_nearby_active_rooms(user, current_room_name=current_room_name),
+        'sidebar_privatechats': [],
+        'sidebar_private_unread': {},
+        'sidebar_private_unread_count': 0,
+        'sidebar_code_rooms': [],
+    }
+    if chat_blocked:
+        return data
+
+    try:
+        # Most recently active first; members are prefetched for the name/avatar.
+        data['sidebar_privatechats'] = list(
+            user.chat_groups.filter(
+                is_private=True,
+                is_code_room=False,
+            )
+            .exclude(group_name='online-status')
+            .select_related('summary')
+            .prefetch_related('members__profile')
+            .order_by(F('summary__last_message_at').desc(nulls_last=True), '-id')
+        )
+    except Exception:
+        data['sidebar_privatechats'] = []
+
+    # Unread direct count badge (number of direct rooms with unread messages).
+    try:
+        unread = room_index.private_unread(user, [room.id for room in data['sidebar_privatechats']])
+        data['sidebar_private_unread'] = unread
+        data['sidebar_private_unread_count'] = len(unread)
+    except Exception:
+        data['sidebar_private_unread_count'] = 0
+
+    try:
+        joined_code_rooms = list(
+            user.chat_groups.filter(is_private=True, is_code_room=True)
+            .exclude(group_name='online-status')
+        )
+    except Exception:
+        joined_code_rooms = []
+
+    joined_ids = set()
+    for _room in joined_code_rooms:
+        try:
+            joined_ids.add(int(_room.id))
+        except Exception:
             continue
+        try:
+            setattr(_room, 'vixo_join_state', 'joined')
+        except Exception:
+            pass
 
-        name = str(getattr(room, 'groupchat_name', '') or '').lower()
-        desc = str(getattr(room, 'room_description', '') or '').lower()
-        if city_key not in name and city_key not in desc:
+    pending_code_rooms = []
+    try:
+        pending_room_ids = list(
+            CodeRoomJoinRequest.objects.filter(
+                user=user,
+                admitted_at__isnull=True,
+            ).values_list('room_id', flat=True)
+        )
+        if pending_room_ids:
+            pending_code_rooms = list(
+                ChatGroup.objects.filter(
+                    id__in=pending_room_ids,
+                    is_private=True,
+                    is_code_room=True,
+                ).exclude(group_name='online-status')
+            )
+    except Exception:
+        pending_code_rooms = []
+
+    merged_code_rooms = list(joined_code_rooms)
+    for _room in pending_code_rooms:
+        try:
+            room_id = int(_room.id)
+        except Exception:
             continue
+        if room_id in joined_ids:
+            continue
+        try:
+            setattr(_room, 'vixo_join_state', 'pending')
+        except Exception:
+            pass
+        merged_code_rooms.append(_room)
 
-        out.append(room)
-        if len(out) >= 6:
-            break
+    try:
+        merged_code_rooms.sort(
+            key=lambda room: str(
+                getattr(room, 'code_room_name', None)
+                or getattr(room, 'room_code', None)
+                or getattr(room, 'group_name', '')
+            ).lower()
+        )
+    except Exception:
+        pass
 
-    return out
+    data['sidebar_code_rooms'] = merged_code_rooms
+    return data
 
 
 @login_required
@@ -1102,29 +1206,20 @@ def chat_view(request, chatroom_name='public-chat'):
     # UI: render only a small slice initially to avoid freezing the browser
     # when a room has a long history. Retention is handled separately via
     # settings.CHAT_MAX_MESSAGES_PER_ROOM.
-    initial_limit = int(getattr(settings, 'CHAT_INITIAL_MESSAGES', 60))
-    if initial_limit <= 0:
-        initial_limit = 60
-    # Hard cap for safety.
-    initial_limit = max(10, min(initial_limit, 200))
-
-    # Fetch latest by id (fast, stable chronological order) then reverse.
-    latest_messages = list(chat_group.chat_messages.order_by('-id')[:initial_limit])
-    latest_messages.reverse()
-    chat_messages = latest_messages
-
-    has_older_messages = False
-    try:
-        if chat_messages:
-            oldest_id = int(getattr(chat_messages[0], 'id', 0) or 0)
-            if oldest_id:
-                has_older_messages = chat_group.chat_messages.filter(id__lt=oldest_id).exists()
-    except Exception:
-        has_older_messages = False
-
-    _attach_reaction_pills(chat_messages, request.user)
-    _attach_poll_cards(chat_messages, request.user)
-    _attach_one_time_view_flags(chat_messages, request.user)
+    initial_limit = history.page_size('CHAT_INITIAL_MESSAGES', 60)
+
+    # Fetch latest by id (fast, stable chronological order); one extra row tells
+    # whether older history exists.
+    page = history.fetch_page(chat_group, limit=initial_limit)
+    chat_messages = page.messages
+    has_older_messages = page.has_more
+
+    # Viewer-neutral bubbles come from the fragment cache; only the rest are
+    # rendered per viewer by the template.
+    uncached = history.attach_fragments(chat_messages, request.user, chat_group)
+    _attach_reaction_pills(uncached, request.user)
+    _attach_poll_cards(uncached, request.user)
+    _attach_one_time_view_flags(uncached, request.user)
     form = ChatmessageCreateForm()
     # UX: public/group chats use a more standard placeholder.
     try:
@@ -1428,24 +1523,6 @@ def chat_view(request, chatroom_name='public-chat'):
             except Exception:
                 pass
 
-            # Retention: keep only the newest messages per room (best-effort).
-            # Public/group rooms and private rooms can use different caps.
-            try:
-                from a_rtchat.retention import trim_chat_group_messages
-
-                is_private = bool(getattr(chat_group, 'is_private', False))
-                if is_private:
-                    keep_last = int(getattr(settings, 'PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', 1000))
-                else:
-                    keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
-
-                trim_chat_group_messages(
-                    chat_group_id=chat_group.id,
-                    keep_last=max(1, keep_last),
-                )
-            except Exception:
-                pass
-
             # Recompute counters after saving the upload so the UI can update without refresh.
             uploads_used = _uploads_used_today(chat_group, request.user)
             uploads_remaining = max(0, CHAT_UPLOAD_LIMIT_PER_ROOM - uploads_used)
@@ -1461,37 +1538,34 @@ def chat_view(request, chatroom_name='public-chat'):
                     if getattr(chat_group, 'group_name', '') != 'public-chat':
                         member_ids = set(chat_group.members.values_list('id', flat=True))
                     preview = (caption or message.filename or '')[:140]
-                    for u in mentioned:
-                        if not getattr(u, 'id', None) or u.id == request.user.id:
-                            continue
-                        if member_ids is not None and u.id not in member_ids:
-                            continue
-
-                        # DND: don't send notifications/push/calls to this user.
-                        try:
-                            from a_rtchat.notifications import should_send_realtime_notification
-
-                            if not should_send_realtime_notification(user_id=u.id):
-                                continue
-                        except Exception:
-                            pass
+                    targets = [
+                        u for u in mentioned
+                        if getattr(u, 'id', None) and u.id != request.user.id
+                        and (member_ids is None or u.id in member_ids)
+                    ]
+
+                    # One state query + one insert for every mentioned user.
+                    # DND: no notification/push/calls for those users.
+                    try:
+                        from a_rtchat.notifications import notify_many
+
+                        states = notify_many(
+                            [u.id for u in targets],
+                            type='mention',
+                            from_user=request.user,
+                            chatroom_name=chat_group.group_name,
+                            message_id=message.id,
+                            preview=preview,
+                            url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
+                            always_persist=bool(getattr(chat_group, 'is_private', False)),
+                            skip_dnd=True,
+                        )
+                    except Exception:
+                        states = None
 
-                        # Persist only if user is not online in this chat.
-                        try:
-                            from a_rtchat.notifications import should_persist_notification
-
-                            if should_persist_notification(user_id=u.id, chatroom_name=chat_group.group_name) or bool(getattr(chat_group, 'is_private', False)):
-                                Notification.objects.create(
-                                    user=u,
-                                    from_user=request.user,
-                                    type='mention',
-                                    chatroom_name=chat_group.group_name,
-                                    message_id=message.id,
-                                    preview=preview,
-                                    url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
-                                )
-                        except Exception:
-                            pass
+                    for u in targets:
+                        if states is not None and not (u.id in states and states[u.id].realtime):
+                            continue
 
                         async_to_sync(channel_layer.group_send)(
                             f"notify_user_{u.id}",
@@ -1506,17 +1580,14 @@ def chat_view(request, chatroom_name='public-chat'):
 
                         # Optional: push notification via FCM (offline / background)
                         try:
-                            from a_users.tasks import send_mention_push_task
-
-                            # If Celery broker isn't configured (common in local/dev),
-                            # don't enqueue tasks in-request (can block for seconds).
-                            if _celery_broker_configured():
-                                send_mention_push_task.delay(
-                                    u.id,
-                                    from_username=request.user.username,
-                                    chatroom_name=chat_group.group_name,
-                                    preview=preview,
-                                )
+                            from a_users.push import enqueue_mention
+
+                            enqueue_mention(
+                                u.id,
+                                from_username=request.user.username,
+                                chatroom_name=chat_group.group_name,
+                                preview=preview,
+                            )
                         except Exception:
                             pass
             except Exception:
@@ -1527,12 +1598,12 @@ def chat_view(request, chatroom_name='public-chat'):
             # Broadcast to others; sender will render via HTMX response.
             async_to_sync(channel_layer.group_send)(
                 chatroom_channel_group_name(chat_group),
-                {
-                    'type': 'message_handler',
-                    'message_id': message.id,
-                    'skip_sender': True,
-                    'author_id': request.user.id,
-                },
+                message_event(
+                    message,
+                    chat_group,
+                    author_id=request.user.id,
+                    skip_sender=True,
+                ),
             )
 
             _attach_reaction_pills([message], request.user)
@@ -1959,7 +2030,8 @@ def chat_view(request, chatroom_name='public-chat'):
         # AI moderation (Gemini): run after cheap anti-spam checks but before saving.
         # Default is OFF for performance unless explicitly enabled.
         pending_moderation = None
-        if raw_body and int(getattr(settings, 'AI_MODERATION_ENABLED', 0)):
+        ai_moderation = bool(raw_body and int(getattr(settings, 'AI_MODERATION_ENABLED', 0)))
+        if ai_moderation and not moderation_pipeline.is_async_mode():
             last_user_msgs = list(
                 chat_group.chat_messages.filter(author=request.user)
                 .exclude(body__isnull=True)
@@ -1985,7 +2057,7 @@ def chat_view(request, chatroom_name='public-chat'):
                 'recent_user_messages': list(reversed(last_user_msgs)),
                 'recent_room_messages': list(reversed(last_room_msgs)),
             }
-            decision = moderate_message(text=raw_body, context=ctx)
+            decision = moderation_pipeline.moderate_cached(raw_body, ctx)
 
             # Decide action
             min_block_sev = int(getattr(settings, 'AI_BLOCK_MIN_SEVERITY', 3))
@@ -2173,7 +2245,12 @@ def chat_view(request, chatroom_name='public-chat'):
                         .values_list('id', flat=True)[:50]
                     )
                     if deleted_ids:
-                        GroupMessage.objects.filter(id__in=deleted_ids, group=chat_group, author=request.user).delete()
+                        _total, per_model = GroupMessage.objects.filter(id__in=deleted_ids, group=chat_group, author=request.user).delete()
+                        room_index.messages_deleted(
+                            chat_group.id,
+                            per_model.get(GroupMessage._meta.label, 0),
+                            max_id=max(deleted_ids),
+                        )
 
                         # Realtime: remove from all connected clients (including sender).
                         try:
@@ -2213,24 +2290,6 @@ def chat_view(request, chatroom_name='public-chat'):
                 resp.headers['Retry-After'] = str(burst_cooldown)
                 return resp
 
-            # Retention: keep only the newest messages per room (best-effort).
-            # Public/group rooms and private rooms can use different caps.
-            try:
-                from a_rtchat.retention import trim_chat_group_messages
-
-                is_private = bool(getattr(chat_group, 'is_private', False))
-                if is_private:
-                    keep_last = int(getattr(settings, 'PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', 1000))
-                else:
-                    keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
-
-                trim_chat_group_messages(
-                    chat_group_id=chat_group.id,
-                    keep_last=max(1, keep_last),
-                )
-            except Exception:
-                pass
-
             # Public chat bot (Natasha): reply occasionally, async.
             try:
                 if (getattr(chat_group, 'group_name', '') == 'public-chat'
@@ -2251,37 +2310,34 @@ def chat_view(request, chatroom_name='public-chat'):
                         member_ids = set(chat_group.members.values_list('id', flat=True))
 
                     preview = (raw_body or '')[:140]
-                    for u in mentioned:
-                        if not getattr(u, 'id', None) or u.id == request.user.id:
-                            continue
-                        if member_ids is not None and u.id not in member_ids:
-                            continue
-
-                        # DND: don't send notifications/push/calls to this user.
-                        try:
-                            from a_rtchat.notifications import should_send_realtime_notification
-
-                            if not should_send_realtime_notification(user_id=u.id):
-                                continue
-                        except Exception:
-                            pass
+                    targets = [
+                        u for u in mentioned
+                        if getattr(u, 'id', None) and u.id != request.user.id
+                        and (member_ids is None or u.id in member_ids)
+                    ]
+
+                    # One state query + one insert for every mentioned user.
+                    # DND: no notification/push/calls for those users.
+                    try:
+                        from a_rtchat.notifications import notify_many
+
+                        states = notify_many(
+                            [u.id for u in targets],
+                            type='mention',
+                            from_user=request.user,
+                            chatroom_name=chat_group.group_name,
+                            message_id=message.id,
+                            preview=preview,
+                            url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
+                            always_persist=bool(getattr(chat_group, 'is_private', False)),
+                            skip_dnd=True,
+                        )
+                    except Exception:
+                        states = None
 
-                        # Persist notification only if user is offline (not connected in any chat WS).
-                        try:
-                            from a_rtchat.notifications import should_persist_notification
-
-                            if should_persist_notification(user_id=u.id, chatroom_name=chat_group.group_name) or bool(getattr(chat_group, 'is_private', False)):
-                                Notification.objects.create(
-                                    user=u,
-                                    from_user=request.user,
-                                    type='mention',
-                                    chatroom_name=chat_group.group_name,
-                                    message_id=message.id,
-                                    preview=preview,
-                                    url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
-                                )
-                        except Exception:
-                            pass
+                    for u in targets:
+                        if states is not None and not (u.id in states and states[u.id].realtime):
+                            continue
 
                         async_to_sync(channel_layer.group_send)(
                             f"notify_user_{u.id}",
@@ -2296,15 +2352,14 @@ def chat_view(request, chatroom_name='public-chat'):
 
                         # Optional: push notification via FCM (offline / background)
                         try:
-                            from a_users.tasks import send_mention_push_task
-
-                            if _celery_broker_configured():
-                                send_mention_push_task.delay(
-                                    u.id,
-                                    from_username=request.user.username,
-                                    chatroom_name=chat_group.group_name,
-                                    preview=preview,
-                                )
+                            from a_users.push import enqueue_mention
+
+                            enqueue_mention(
+                                u.id,
+                                from_username=request.user.username,
+                                chatroom_name=chat_group.group_name,
+                                preview=preview,
+                            )
                         except Exception:
                             pass
             except Exception:
@@ -2319,28 +2374,22 @@ def chat_view(request, chatroom_name='public-chat'):
 
                     allow_realtime = True
                     try:
-                        from a_rtchat.notifications import should_send_realtime_notification
-
-                        allow_realtime = bool(should_send_realtime_notification(user_id=target_id))
+                        from a_rtchat.notifications import notify_many
+
+                        states = notify_many(
+                            [target_id],
+                            type='reply',
+                            from_user=request.user,
+                            chatroom_name=chat_group.group_name,
+                            message_id=message.id,
+                            preview=preview,
+                            url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
+                            always_persist=bool(getattr(chat_group, 'is_private', False)),
+                        )
+                        allow_realtime = bool(target_id in states and states[target_id].realtime)
                     except Exception:
                         allow_realtime = True
 
-                    try:
-                        from a_rtchat.notifications import should_persist_notification
-
-                        if should_persist_notification(user_id=target_id, chatroom_name=chat_group.group_name) or bool(getattr(chat_group, 'is_private', False)):
-                            Notification.objects.create(
-                                user_id=target_id,
-                                from_user=request.user,
-                                type='reply',
-                                chatroom_name=chat_group.group_name,
-                                message_id=message.id,
-                                preview=preview,
-                                url=f"/chat/room/{chat_group.group_name}#msg-{message.id}",
-                            )
-                    except Exception:
-                        pass
-
                     if allow_realtime:
                         async_to_sync(channel_layer.group_send)(
                             f"notify_user_{target_id}",
@@ -2381,24 +2430,28 @@ def chat_view(request, chatroom_name='public-chat'):
             # Broadcast to others; sender will render via HTMX response.
             async_to_sync(channel_layer.group_send)(
                 chatroom_channel_group_name(chat_group),
-                {
-                    'type': 'message_handler',
-                    'message_id': message.id,
-                    'skip_sender': True,
-                    'author_id': request.user.id,
-                },
+                message_event(
+                    message,
+                    chat_group,
+                    author_id=request.user.id,
+                    skip_sender=True,
+                ),
             )
 
+            # Optimistic moderation: already delivered, retracted if the verdict is a block.
+            if ai_moderation:
+                moderation_pipeline.submit(message.id, via='http')
+
             if support_reply_message is not None:
                 try:
                     async_to_sync(channel_layer.group_send)(
                         chatroom_channel_group_name(chat_group),
-                        {
-                            'type': 'message_handler',
-                            'message_id': support_reply_message.id,
-                            'skip_sender': True,
-                            'author_id': request.user.id,
-                        },
+                        message_event(
+                            support_reply_message,
+                            chat_group,
+                            author_id=request.user.id,
+                            skip_sender=True,
+                        ),
                     )
                 except Exception:
                     pass
@@ -2444,36 +2497,29 @@ def chat_view(request, chatroom_name='public-chat'):
     # - Keep unread mention/reply room list for initial badge restore after refresh.
     unread_mention_rooms = []
     try:
-        Notification.objects.filter(
-            user=request.user,
-            is_read=False,
+        notifications.mark_read(
+            request.user.id,
             type__in=['mention', 'reply'],
             chatroom_name=chatroom_name,
-        ).update(is_read=True)
+        )
     except Exception:
         pass
     try:
-        unread_mention_rooms = list(
-            Notification.objects.filter(
-                user=request.user,
-                is_read=False,
-                type__in=['mention', 'reply'],
+        # Cached counter first: most opens have nothing unread and skip the query.
+        if notifications.unread_count(request.user.id):
+            unread_mention_rooms = list(
+                Notification.objects.filter(
+                    user=request.user,
+                    is_read=False,
+                    type__in=['mention', 'reply'],
+                )
+                .exclude(chatroom_name='')
+                .values_list('chatroom_name', flat=True)
+                .distinct()
             )
-            .exclude(chatroom_name='')
-            .values_list('chatroom_name', flat=True)
-            .distinct()
-        )
     except Exception:
         unread_mention_rooms = []
 
-    sidebar_groupchats_qs = (
-        ChatGroup.objects
-        .filter(groupchat_name__isnull=False)
-        .exclude(group_name='online-status')
-        .exclude(group_name__startswith='local-')
-        .order_by('groupchat_name')
-    )
-
     try:
         profile = getattr(request.user, 'profile', None)
         if profile is not None:
@@ -2486,10 +2532,7 @@ def chat_view(request, chatroom_name='public-chat'):
     except Exception:
         pass
 
-    sidebar_groupchats = list(sidebar_groupchats_qs)
-    sidebar_groupchat_sections, sidebar_groupchats_remaining = _build_groupchat_sections(sidebar_groupchats)
-    sidebar_local_communities = _sidebar_local_communities(request.user)
-    sidebar_nearby_active_rooms = _sidebar_nearby_active_rooms(request.user, current_room_name=chatroom_name)
+    sidebar = _sidebar_data(request.user, current_room_name=chatroom_name, chat_blocked=chat_blocked)
 
     needs_email_verification_for_chat = False
     try:
@@ -2536,9 +2579,6 @@ def chat_view(request, chatroom_name='public-chat'):
     except Exception:
         show_public_chat_tutorial = False
 
-    sidebar_privatechats = []
-    sidebar_private_unread_count = 0
-    sidebar_code_rooms = []
     support_chat_username = ''
     support_chat_label = 'Team Vixogram'
     is_support_private_chat = False
@@ -2564,108 +2604,6 @@ def chat_view(request, chatroom_name='public-chat'):
     except Exception:
         is_support_private_chat = False
 
-    if not chat_blocked:
-        try:
-            sidebar_privatechats = request.user.chat_groups.filter(
-                is_private=True,
-                is_code_room=False,
-            ).exclude(group_name='online-status')
-        except Exception:
-            sidebar_privatechats = []
-
-        # Unread direct count badge (number of direct rooms with unread messages).
-        try:
-            private_room_ids = [int(rid) for rid in sidebar_privatechats.values_list('id', flat=True)]
-            if private_room_ids:
-                read_state_by_room = {
-                    int(gid): int(last_id or 0)
-                    for gid, last_id in ChatReadState.objects.filter(
-                        user=request.user,
-                        group_id__in=private_room_ids,
-                    ).values_list('group_id', 'last_read_message_id')
-                }
-
-                latest_non_self_by_room = {
-                    int(row['group_id']): int(row['latest_non_self_id'] or 0)
-                    for row in GroupMessage.objects.filter(
-                        group_id__in=private_room_ids,
-                    ).exclude(author=request.user).values('group_id').annotate(
-                        latest_non_self_id=Max('id')
-                    )
-                }
-
-                sidebar_private_unread_count = sum(
-                    1
-                    for room_id in private_room_ids
-                    if int(latest_non_self_by_room.get(int(room_id), 0)) > int(read_state_by_room.get(int(room_id), 0))
-                )
-        except Exception:
-            sidebar_private_unread_count = 0
-
-        try:
-            joined_code_rooms = list(
-                request.user.chat_groups.filter(is_private=True, is_code_room=True)
-                .exclude(group_name='online-status')
-            )
-        except Exception:
-            joined_code_rooms = []
-
-        joined_ids = set()
-        for _room in joined_code_rooms:
-            try:
-                joined_ids.add(int(_room.id))
-            except Exception:
-                continue
-            try:
-                setattr(_room, 'vixo_join_state', 'joined')
-            except Exception:
-                pass
-
-        pending_code_rooms = []
-        try:
-            pending_room_ids = list(
-                CodeRoomJoinRequest.objects.filter(
-                    user=request.user,
-                    admitted_at__isnull=True,
-                ).values_list('room_id', flat=True)
-            )
-            if pending_room_ids:
-                pending_code_rooms = list(
-                    ChatGroup.objects.filter(
-                        id__in=pending_room_ids,
-                        is_private=True,
-                        is_code_room=True,
-                    ).exclude(group_name='online-status')
-                )
-        except Exception:
-            pending_code_rooms = []
-
-        merged_code_rooms = list(joined_code_rooms)
-        for _room in pending_code_rooms:
-            try:
-                room_id = int(_room.id)
-            except Exception:
-                continue
-            if room_id in joined_ids:
-                continue
-            try:
-                setattr(_room, 'vixo_join_state', 'pending')
-            except Exception:
-                pass
-            merged_code_rooms.append(_room)
-
-        try:
-            merged_code_rooms.sort(
-                key=lambda room: str(
-                    getattr(room, 'code_room_name', None)
-                    or getattr(room, 'room_code', None)
-                    or getattr(room, 'group_name', '')
-                ).lower()
-            )
-        except Exception:
-            pass
-
-        sidebar_code_rooms = merged_code_rooms
 
     try:
         private_room_lifetime_create_limit = int(getattr(settings, 'PRIVATE_ROOM_LIFETIME_CREATE_LIMIT', 15))
@@ -2704,14 +2642,14 @@ def chat_view(request, chatroom_name='public-chat'):
         'chat_muted_seconds': chat_muted_seconds,
         'needs_email_verification_for_chat': needs_email_verification_for_chat,
         # Show all group chats so admin-created rooms appear in UI even before the user joins.
-        'sidebar_groupchats': sidebar_groupchats,
-        'sidebar_groupchat_sections': sidebar_groupchat_sections,
-        'sidebar_groupchats_remaining': sidebar_groupchats_remaining,
-        'sidebar_local_communities': sidebar_local_communities,
-        'sidebar_nearby_active_rooms': sidebar_nearby_active_rooms,
-        'sidebar_privatechats': sidebar_privatechats,
-        'sidebar_private_unread_count': int(sidebar_private_unread_count or 0),
-        'sidebar_code_rooms': sidebar_code_rooms,
+        'sidebar_groupchats': sidebar['sidebar_groupchats'],
+        'sidebar_groupchat_sections': sidebar['sidebar_groupchat_sections'],
+        'sidebar_groupchats_remaining': sidebar['sidebar_groupchats_remaining'],
+        'sidebar_local_communities': sidebar['sidebar_local_communities'],
+        'sidebar_nearby_active_rooms': sidebar['sidebar_nearby_active_rooms'],
+        'sidebar_privatechats': sidebar['sidebar_privatechats'],
+        'sidebar_private_unread_count': int(sidebar['sidebar_private_unread_count'] or 0),
+        'sidebar_code_rooms': sidebar['sidebar_code_rooms'],
         'support_chat_username': support_chat_username,
         'support_chat_label': support_chat_label,
         'is_support_private_chat': bool(is_support_private_chat),
@@ -2945,27 +2883,28 @@ def chat_config_view(request, chatroom_name):
             return ''
 
     try:
-        Notification.objects.filter(
-            user=request.user,
-            is_read=False,
+        notifications.mark_read(
+            request.user.id,
             type__in=['mention', 'reply'],
             chatroom_name=chatroom_name,
-        ).update(is_read=True)
+        )
     except Exception:
         pass
 
     unread_mention_rooms = []
     try:
-        unread_mention_rooms = list(
-            Notification.objects.filter(
-                user=request.user,
-                is_read=False,
-                type__in=['mention', 'reply'],
+        # Cached counter first: most opens have nothing unread and skip the query.
+        if notifications.unread_count(request.user.id):
+            unread_mention_rooms = list(
+                Notification.objects.filter(
+                    user=request.user,
+                    is_read=False,
+                    type__in=['mention', 'reply'],
+                )
+                .exclude(chatroom_name='')
+                .values_list('chatroom_name', flat=True)
+                .distinct()
             )
-            .exclude(chatroom_name='')
-            .values_list('chatroom_name', flat=True)
-            .distinct()
-        )
     except Exception:
         unread_mention_rooms = []
 
@@ -3056,20 +2995,24 @@ def chat_older_view(request, chatroom_name):
     if before_id <= 0:
         return JsonResponse({'messages_html': '', 'oldest_id': before_id, 'has_more': False})
 
-    page_size = int(getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50))
-    if page_size <= 0:
-        page_size = 50
-    page_size = max(10, min(page_size, 200))
-
-    qs = chat_group.chat_messages.filter(id__lt=before_id).order_by('-id')
-    batch = list(qs[:page_size])
+    page = history.fetch_page(chat_group, before_id=before_id, limit=history.page_size())
+    batch = page.messages
     if not batch:
         return JsonResponse({'messages_html': '', 'oldest_id': before_id, 'has_more': False})
 
-    batch.reverse()
-    _attach_reaction_pills(batch, request.user)
-    _attach_poll_cards(batch, request.user)
-    _attach_one_time_view_flags(batch, request.user)
+    # Structured mode for clients that render messages themselves.
+    if (request.GET.get('format') or '').strip().lower() == 'json':
+        _attach_reaction_pills(batch, request.user)
+        return JsonResponse({
+            'messages': [history.serialize_message(m) for m in batch],
+            'oldest_id': page.oldest_id,
+            'has_more': page.has_more,
+        })
+
+    uncached = history.attach_fragments(batch, request.user, chat_group)
+    _attach_reaction_pills(uncached, request.user)
+    _attach_poll_cards(uncached, request.user)
+    _attach_one_time_view_flags(uncached, request.user)
 
     verified_user_ids = set()
     try:
@@ -3083,6 +3026,10 @@ def chat_older_view(request, chatroom_name):
     parts = []
     prev = None
     for message in batch:
+        if getattr(message, 'history_html', None):
+            parts.append(message.history_html)
+            prev = message
+            continue
         parts.append(
             render(
                 request,
@@ -3099,15 +3046,74 @@ def chat_older_view(request, chatroom_name):
         )
         prev = message
 
-    oldest_id = int(getattr(batch[0], 'id', 0) or 0)
-    has_more = False
+    return JsonResponse({'messages_html': ''.join(parts), 'oldest_id': page.oldest_id, 'has_more': page.has_more})
+
+
+@login_required
+def chat_sidebar_view(request):
+    """Sidebar data as JSON (same source as the server-rendered chat sidebar)."""
+    chat_blocked = _is_chat_blocked(request.user)
+    sidebar = _sidebar_data(
+        request.user,
+        current_room_name=str(request.GET.get('room') or ''),
+        chat_blocked=chat_blocked,
+    )
+    viewer_id = int(getattr(request.user, 'id', 0) or 0)
+    unread = sidebar.get('sidebar_private_unread') or {}
+
+    def _room(room, **extra):
+        return {
+            'group_name': room.group_name,
+            'name': str(room.groupchat_name or room.code_room_name or room.room_code or room.group_name),
+            **extra,
+        }
+
+    private_rooms = []
+    for room in sidebar['sidebar_privatechats']:
+        other = next((m for m in room.members.all() if m.id != viewer_id), None)
+        summary = getattr(room, 'summary', None)
+        private_rooms.append({
+            'group_name': room.group_name,
+            'other_username': getattr(other, 'username', ''),
+            'other_name': str(getattr(getattr(other, 'profile', None), 'name', '') or getattr(other, 'username', '')),
+            'last_message_at': summary.last_message_at.isoformat() if summary and summary.last_message_at else None,
+            'unread': int(unread.get(room.id, 0)),
+        })
+
+    return JsonResponse({
+        'groupchats': [_room(r) for r in sidebar['sidebar_groupchats']],
+        'local_communities': [_room(r) for r in sidebar['sidebar_local_communities']],
+        'nearby_active_rooms': [_room(r) for r in sidebar['sidebar_nearby_active_rooms']],
+        'private_rooms': private_rooms,
+        'private_unread_count': int(sidebar['sidebar_private_unread_count'] or 0),
+        'code_rooms': [
+            _room(r, join_state=str(getattr(r, 'vixo_join_state', '') or ''))
+            for r in sidebar['sidebar_code_rooms']
+        ],
+    })
+
+
+@login_required
+def challenge_leaderboard_view(request, chatroom_name=None):
+    """Top challenge players for one private room, or site-wide when no room is given."""
+    chat_group = None
+    if chatroom_name:
+        chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+        if not getattr(chat_group, 'is_private', False):
+            raise Http404()
+        if request.user not in chat_group.members.all() and not getattr(request.user, 'is_staff', False):
+            raise Http404()
+
     try:
-        if oldest_id:
-            has_more = chat_group.chat_messages.filter(id__lt=oldest_id).exists()
-    except Exception:
-        has_more = False
+        limit = int(request.GET.get('limit') or 10)
+    except ValueError:
+        limit = 10
 
-    return JsonResponse({'messages_html': ''.join(parts), 'oldest_id': oldest_id, 'has_more': has_more})
+    return JsonResponse({
+        'room': getattr(chat_group, 'group_name', None),
+        'leaders': scoreboard.leaderboard(group=chat_group, limit=limit),
+        'me': scoreboard.totals(getattr(request.user, 'id', 0), group=chat_group),
+    })
 
 
 @login_required
@@ -4311,17 +4317,17 @@ def chatroom_member_invite_view(request, chatroom_name):
         preview = f"Invited you to join room: {room_title}"[:180]
 
         try:
-            from a_rtchat.notifications import should_persist_notification
-
-            if should_persist_notification(user_id=target.id, chatroom_name=chat_group.group_name) or bool(getattr(chat_group, 'is_private', False)):
-                Notification.objects.create(
-                    user=target,
-                    from_user=request.user,
-                    type='ping',
-                    chatroom_name=chat_group.group_name,
-                    preview=preview,
-                    url=invite_url,
-                )
+            from a_rtchat.notifications import notify_many
+
+            notify_many(
+                [target.id],
+                type='ping',
+                from_user=request.user,
+                chatroom_name=chat_group.group_name,
+                preview=preview,
+                url=invite_url,
+                always_persist=bool(getattr(chat_group, 'is_private', False)),
+            )
         except Exception:
             # Still send realtime best-effort.
             pass
@@ -4576,12 +4582,22 @@ def chat_file_upload(request, chatroom_name):
             status=400,
         )
 
+    # Sniff type/dimensions/placeholder from the local upload so rendering never
+    # has to open the stored file.
+    try:
+        from a_rtchat.media_meta import probe_upload
+
+        media = probe_upload(upload)
+    except Exception:
+        media = {}
+
     message = GroupMessage.objects.create(
         file=upload,
         file_caption=caption or None,
         one_time_view_seconds=one_time_seconds,
         author=request.user,
         group=chat_group,
+        **media,
     )
 
     # Best-effort: if user didn't allow GPS location, store approximate city/country from IP.
@@ -4591,32 +4607,14 @@ def chat_file_upload(request, chatroom_name):
     except Exception:
         pass
 
-    # Retention: keep only the newest messages per room (best-effort).
-    # Public/group rooms and private rooms can use different caps.
-    try:
-        from a_rtchat.retention import trim_chat_group_messages
-
-        is_private = bool(getattr(chat_group, 'is_private', False))
-        if is_private:
-            keep_last = int(getattr(settings, 'PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', 1000))
-        else:
-            keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
-
-        trim_chat_group_messages(
-            chat_group_id=chat_group.id,
-            keep_last=max(1, keep_last),
-        )
-    except Exception:
-        pass
-
     channel_layer = get_channel_layer()
-    event = {
-        'type': 'message_handler',
-        'message_id': message.id,
-        # Sender will render via HTMX response; avoid duplicate bubble via websocket.
-        'skip_sender': True,
-        'author_id': request.user.id,
-    }
+    # Sender will render via HTMX response; avoid duplicate bubble via websocket.
+    event = message_event(
+        message,
+        chat_group,
+        author_id=request.user.id,
+        skip_sender=True,
+    )
     async_to_sync(channel_layer.group_send)(chatroom_channel_group_name(chat_group), event)
 
     # HTMX: return the rendered message HTML so the sender sees it immediately
@@ -4815,7 +4813,7 @@ def chat_poll_view(request, chatroom_name):
             after_id = int(request.GET.get('after', '0'))
         except ValueError:
             after_id = 0
-        online_count = chat_group.users_online.count()
+        online_count = presence.count(chat_group)
         return JsonResponse({'messages_html': '', 'last_id': after_id, 'online_count': online_count})
 
     try:
@@ -4823,13 +4821,14 @@ def chat_poll_view(request, chatroom_name):
     except ValueError:
         after_id = 0
 
-    online_count = chat_group.users_online.count()
+    online_count = presence.count(chat_group)
 
     new_messages_qs = chat_group.chat_messages.filter(id__gt=after_id).order_by('created', 'id')
-    new_messages = list(new_messages_qs[:50])
+    new_messages = list(new_messages_qs.select_related('reply_to')[:50])
     if not new_messages:
         return JsonResponse({'messages_html': '', 'last_id': after_id, 'online_count': online_count})
 
+    author_cards.attach(new_messages)
     _attach_reaction_pills(new_messages, request.user)
     _attach_poll_cards(new_messages, request.user)
     _attach_one_time_view_flags(new_messages, request.user)
@@ -4948,12 +4947,12 @@ def chat_poll_create_view(request, chatroom_name):
     channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
         chatroom_channel_group_name(chat_group),
-        {
-            'type': 'message_handler',
-            'message_id': message.id,
-            'skip_sender': True,
-            'author_id': request.user.id,
-        },
+        message_event(
+            message,
+            chat_group,
+            author_id=request.user.id,
+            skip_sender=True,
+        ),
     )
 
     _attach_reaction_pills([message], request.user)
@@ -5095,6 +5094,7 @@ def message_edit_view(request, message_id: int):
             return JsonResponse({'error': 'Links are only allowed in private chats.'}, status=400)
 
     if body != (message.body or ''):
+        history.invalidate(message)
         message.body = body
         message.edited_at = timezone.now()
         message.save(update_fields=['body', 'edited_at'])
@@ -5159,6 +5159,7 @@ def message_delete_view(request, message_id: int):
         message.link_description = ''
         message.link_image = ''
         message.link_site_name = ''
+        history.invalidate(message)
         message.edited_at = timezone.now()
         message.save(update_fields=[
             'body',
@@ -5182,7 +5183,9 @@ def message_delete_view(request, message_id: int):
         )
     else:
         deleted_id = message.id
+        history.invalidate(message)
         message.delete()
+        room_index.messages_deleted(chat_group.id, 1, max_id=deleted_id)
         async_to_sync(channel_layer.group_send)(
             chatroom_channel_group_name(chat_group),
             {
@@ -5225,6 +5228,7 @@ def message_react_toggle(request, message_id: int):
     else:
         qs.delete()
         MessageReaction.objects.create(message=message, user=request.user, emoji=emoji)
+    history.invalidate(message)
 
     channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
@@ -5445,18 +5449,17 @@ def admin_toggle_user_block_view(request, user_id: int):
     profile.save(update_fields=['chat_blocked'])
 
     # Realtime: notify the user (all open tabs) that their chat permissions changed.
+    block_event = {
+        'type': 'chat_block_status_notify_handler',
+        'blocked': bool(profile.chat_blocked),
+        'by_username': getattr(request.user, 'username', '') or '',
+    }
     try:
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"notify_user_{target.id}",
-            {
-                'type': 'chat_block_status_notify_handler',
-                'blocked': bool(profile.chat_blocked),
-                'by_username': getattr(request.user, 'username', '') or '',
-            },
-        )
+        async_to_sync(channel_layer.group_send)(f"notify_user_{target.id}", block_event)
     except Exception:
         pass
+    user_state.publish(target.id, block_event)
 
     if profile.chat_blocked:
         messages.success(request, f'Blocked {target.username} from chatting')
@@ -5575,19 +5578,18 @@ def admin_user_ban_view(request, user_id: int):
         messages.success(request, f'Unbanned {target.username}')
 
     # Realtime: notify the user (all open tabs) that their ban status changed.
+    ban_event = {
+        'type': 'chat_ban_status_notify_handler',
+        'banned': bool(until),
+        'until': until.isoformat() if until else '',
+        'by_username': getattr(request.user, 'username', '') or '',
+    }
     try:
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"notify_user_{target.id}",
-            {
-                'type': 'chat_ban_status_notify_handler',
-                'banned': bool(until),
-                'until': until.isoformat() if until else '',
-                'by_username': getattr(request.user, 'username', '') or '',
-            },
-        )
+        async_to_sync(channel_layer.group_send)(f"notify_user_{target.id}", ban_event)
     except Exception:
         pass
+    user_state.publish(target.id, ban_event)
 
     next_url = (request.POST.get('next') or '').strip()
     if next_url and url_has_allowed_host_and_scheme(
@@ -5876,17 +5878,12 @@ def _today_localdate():
 def _global_online_user_count() -> int:
     """Best-effort global online users count.
 
-    Presence is driven by websockets updating ChatGroup.users_online.
+    Presence is driven by websockets via `a_rtchat.presence` (no DB reads).
     """
     try:
-        through = ChatGroup.users_online.through
-        return int(through.objects.values('user_id').distinct().count())
+        return int(presence.count())
     except Exception:
-        try:
-            User = get_user_model()
-            return int(User.objects.filter(online_in_groups__isnull=False).distinct().count())
-        except Exception:
-            return 0
+        return 0
 
 
 def _get_and_update_peak_today(current: int) -> int:
@@ -6144,6 +6141,38 @@ def admin_analytics_view(request):
     return render(request, 'a_rtchat/admin_analytics.html', context)
 
 
+@login_required
+def admin_profiler_view(request):
+    """Sampled per-view/per-handler cost, N+1 suspects and recent slow samples (staff only)."""
+    if not request.user.is_staff:
+        raise Http404()
+
+    from a_core import profiler
+
+    try:
+        data = profiler.report()
+    except Exception:
+        data = {'rows': [], 'n_plus_one': [], 'slow': [], 'window_seconds': 0, 'windows': 0}
+
+    kind = (request.GET.get('kind') or '').strip()
+    rows = data.get('rows') or []
+    if kind in {'view', 'ws'}:
+        rows = [r for r in rows if r.get('kind') == kind]
+
+    context = {
+        'rows': rows[:100],
+        'n_plus_one': data.get('n_plus_one') or [],
+        'slow': data.get('slow') or [],
+        'kind': kind,
+        'span_minutes': int((data.get('window_seconds') or 0) * (data.get('windows') or 0) // 60),
+        'profiler_enabled': profiler.is_enabled(),
+        'sample_rate': getattr(settings, 'PROFILER_SAMPLE_RATE', 0),
+        'ws_sample_rate': getattr(settings, 'PROFILER_WS_SAMPLE_RATE', 0),
+        'n_plus_one_threshold': getattr(settings, 'PROFILER_N_PLUS_ONE_THRESHOLD', 5),
+    }
+    return render(request, 'a_rtchat/admin_profiler.html', context)
+
+
 @login_required
 def call_view(request, chatroom_name):
     """Agora call UI for private 1:1 chats."""
@@ -6497,24 +6526,6 @@ def call_event_view(request, chatroom_name):
         group=chat_group,
     )
 
-    # Retention: keep only the newest messages per room (best-effort).
-    # Public/group rooms and private rooms can use different caps.
-    try:
-        from a_rtchat.retention import trim_chat_group_messages
-
-        is_private = bool(getattr(chat_group, 'is_private', False))
-        if is_private:
-            keep_last = int(getattr(settings, 'PRIVATE_CHAT_MAX_MESSAGES_PER_ROOM', 1000))
-        else:
-            keep_last = int(getattr(settings, 'CHAT_MAX_MESSAGES_PER_ROOM', 300))
-
-        trim_chat_group_messages(
-            chat_group_id=chat_group.id,
-            keep_last=max(1, keep_last),
-        )
-    except Exception:
-        pass
-
     # Update call state
     if action == 'start':
         # Keep call state for a while; end will delete it.
@@ -6526,10 +6537,10 @@ def call_event_view(request, chatroom_name):
         cache.delete(invite_key)
 
     channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(chatroom_channel_group_name(chat_group), {
-        'type': 'message_handler',
-        'message_id': message.id,
-    })
+    async_to_sync(channel_layer.group_send)(
+        chatroom_channel_group_name(chat_group),
+        message_event(message, chat_group),
+    )
 
     # If one user ends the call, notify everyone in the room so they can auto-hangup.
     if action == 'end':
@@ -0,0 +1,240 @@
+"""Author cards: the few user/profile fields a chat message renders.
+
+`chat_message.html` needs the author's username, display name, avatar, glow
+and a couple of flags for every bubble. Loading full User + Profile rows for
+that (often once per recipient) is wasteful, so messages carry an immutable
+`AuthorCard` instead (`GroupMessage.author_card`).
+
+Lookups go through three tiers:
+
+- an in-process LRU (AUTHOR_CARD_LOCAL_MAX_ENTRIES, entries live for
+  AUTHOR_CARD_LOCAL_TTL_SECONDS, which bounds staleness in other processes)
+- the shared cache (Redis in production), read with one get_many
+- one query for whatever is still missing
+
+`attach()` loads the cards for a list of messages (and their quoted replies)
+in one pass. Profile/User save signals call `invalidate()`.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+CACHE_KEY_PREFIX = 'authorcard:v1:'
+
+
+class AuthorCard(NamedTuple):
+    id: int
+    username: str
+    # Display name, already falling back to the username.
+    name: str
+    avatar: str
+    # '' when the user has no glow.
+    glow: str
+    is_superuser: bool
+    chat_blocked: bool
+
+    @property
+    def verified(self) -> bool:
+        # Read live: the verified set changes with follower counts, not profile saves.
+        from .badges import is_verified
+
+        return is_verified(self.id)
+
+    @property
+    def version(self) -> str:
+        """Changes whenever anything the card renders changes (for fragment cache keys)."""
+        raw = repr((*self, self.verified)).encode('utf-8')
+        return format(zlib.crc32(raw), '08x')
+
+    @classmethod
+    def missing(cls, user_id) -> 'AuthorCard':
+        from .models import DEFAULT_AVATAR_DATA_URI
+
+        return cls(int(user_id or 0), '', 'Deleted user', DEFAULT_AVATAR_DATA_URI, '', False, False)
+
+
+def _setting_int(name: str, default: int, minimum: int = 0) -> int:
+    try:
+        return max(minimum, int(getattr(settings, name, default)))
+    except Exception:
+        return default
+
+
+class _LocalCards:
+    """Small thread-safe LRU of cards with a per-entry expiry."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items: OrderedDict[int, tuple[float, AuthorCard]] = OrderedDict()
+
+    def get_many(self, ids) -> dict[int, AuthorCard]:
+        now = time.monotonic()
+        out: dict[int, AuthorCard] = {}
+        with self._lock:
+            for uid in ids:
+                entry = self._items.get(uid)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self._items[uid]
+                    continue
+                self._items.move_to_end(uid)
+                out[uid] = entry[1]
+        return out
+
+    def put_many(self, cards) -> None:
+        ttl = _setting_int('AUTHOR_CARD_LOCAL_TTL_SECONDS', 30)
+        limit = _setting_int('AUTHOR_CARD_LOCAL_MAX_ENTRIES', 5000)
+        if not ttl or not limit:
+            return
+        expires = time.monotonic() + ttl
+        with self._lock:
+            for card in cards:
+                self._items[card.id] = (expires, card)
+                self._items.move_to_end(card.id)
+            while len(self._items) > limit:
+                self._items.popitem(last=False)
+
+    def discard(self, user_id: int) -> None:
+        with self._lock:
+            self._items.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+_local = _LocalCards()
+
+
+def _load(ids) -> dict[int, AuthorCard]:
+    from django.contrib.auth import get_user_model
+
+    from .models import DEFAULT_AVATAR_DATA_URI
+
+    User = get_user_model()
+    rows = (
+        User.objects.filter(id__in=list(ids))
+        .select_related('profile')
+        .only(
+            'id', 'username', 'is_superuser',
+            'profile__id', 'profile__user_id', 'profile__displayname', 'profile__image',
+            'profile__name_glow_color', 'profile__chat_blocked',
+        )
+    )
+    out: dict[int, AuthorCard] = {}
+    for user in rows:
+        try:
+            profile = user.profile
+        except Exception:
+            profile = None
+        if profile is not None:
+            name = profile.displayname or user.username
+            try:
+                avatar = str(profile.avatar or '')
+            except Exception:
+                avatar = DEFAULT_AVATAR_DATA_URI
+            glow = (profile.name_glow_color or '').strip()
+            blocked = bool(profile.chat_blocked)
+        else:
+            name, avatar, glow, blocked = user.username, DEFAULT_AVATAR_DATA_URI, '', False
+        out[int(user.id)] = AuthorCard(
+            id=int(user.id),
+            username=user.username,
+            name=name,
+            avatar=avatar,
+            glow='' if glow == 'none' else glow,
+            is_superuser=bool(user.is_superuser),
+            chat_blocked=blocked,
+        )
+    return out
+
+
+def get_cards(user_ids) -> dict[int, AuthorCard]:
+    """Cards for `user_ids` (unknown users get `AuthorCard.missing`)."""
+    ids = set()
+    for uid in user_ids or []:
+        try:
+            if uid:
+                ids.add(int(uid))
+        except Exception:
+            continue
+    if not ids:
+        return {}
+
+    out = _local.get_many(ids)
+    wanted = ids - out.keys()
+    if not wanted:
+        return out
+
+    shared: dict[int, AuthorCard] = {}
+    try:
+        found = cache.get_many([CACHE_KEY_PREFIX + str(uid) for uid in wanted])
+    except Exception:
+        found = {}
+    for key, value in found.items():
+        try:
+            card = AuthorCard(*value)
+        except Exception:
+            continue
+        shared[card.id] = card
+
+    wanted -= shared.keys()
+    loaded = _load(wanted) if wanted else {}
+    if loaded:
+        try:
+            cache.set_many(
+                {CACHE_KEY_PREFIX + str(uid): tuple(card) for uid, card in loaded.items()},
+                timeout=_setting_int('AUTHOR_CARD_CACHE_SECONDS', 3600, minimum=1),
+            )
+        except Exception:
+            pass
+
+    fresh = {**shared, **loaded}
+    _local.put_many(fresh.values())
+    out.update(fresh)
+    for uid in wanted - loaded.keys():
+        out[uid] = AuthorCard.missing(uid)
+    return out
+
+
+def get_card(user_id) -> AuthorCard:
+    return get_cards([user_id]).get(int(user_id or 0)) or AuthorCard.missing(user_id)
+
+
+def attach(messages) -> None:
+    """Set `_author_card` on messages and on their already-loaded reply targets."""
+    targets = []
+    for message in messages or []:
+        targets.append(message)
+        try:
+            reply = message._state.fields_cache.get('reply_to')
+        except Exception:
+            reply = None
+        if reply is not None:
+            targets.append(reply)
+    cards = get_cards(getattr(m, 'author_id', None) for m in targets)
+    for message in targets:
+        uid = int(getattr(message, 'author_id', 0) or 0)
+        message._author_card = cards.get(uid) or AuthorCard.missing(uid)
+
+
+def invalidate(user_id) -> None:
+    try:
+        uid = int(user_id)
+    except Exception:
+        return
+    _local.discard(uid)
+    try:
+        cache.delete(CACHE_KEY_PREFIX + str(uid))
+    except Exception:
+        pass
@@ -1,12 +1,95 @@
 from __future__ import annotations
 
+import threading
+import time
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Count
+from django.core.cache import cache
 
-from .models import Follow
+from .models import Profile
 
 VERIFIED_FOLLOWERS_THRESHOLD = 100_000
 
+VERIFIED_IDS_CACHE_KEY = 'badges:verified_ids:v1'
+
+# Process-local copy of the verified set: (expires_at_monotonic, ids).
+_local_lock = threading.Lock()
+_local: tuple[float, frozenset[int]] | None = None
+
+
+def _local_ttl_seconds() -> float:
+    try:
+        return max(0.0, float(getattr(settings, 'VERIFIED_IDS_LOCAL_TTL_SECONDS', 30)))
+    except Exception:
+        return 30.0
+
+
+def _shared_ttl_seconds() -> int:
+    try:
+        return max(1, int(getattr(settings, 'VERIFIED_IDS_CACHE_TTL_SECONDS', 3600)))
+    except Exception:
+        return 3600
+
+
+def _compute_verified_ids() -> frozenset[int]:
+    User = get_user_model()
+    superuser_ids = set(User.objects.filter(is_superuser=True).values_list('id', flat=True))
+    follower_ids = set(
+        Profile.objects.filter(followers_count__gte=VERIFIED_FOLLOWERS_THRESHOLD)
+        .values_list('user_id', flat=True)
+    )
+    return frozenset(int(x) for x in (superuser_ids | follower_ids))
+
+
+def verified_ids() -> frozenset[int]:
+    """Every user ID that shows a verified badge (process copy -> shared cache -> DB)."""
+    global _local
+    now = time.monotonic()
+    snap = _local
+    if snap is not None and snap[0] > now:
+        return snap[1]
+
+    ids = None
+    try:
+        raw = cache.get(VERIFIED_IDS_CACHE_KEY)
+        if isinstance(raw, (list, tuple, set, frozenset)):
+            ids = frozenset(int(x) for x in raw)
+    except Exception:
+        ids = None
+
+    if ids is None:
+        try:
+            ids = _compute_verified_ids()
+        except Exception:
+            return snap[1] if snap is not None else frozenset()
+        try:
+            cache.set(VERIFIED_IDS_CACHE_KEY, sorted(ids), timeout=_shared_ttl_seconds())
+        except Exception:
+            pass
+
+    with _local_lock:
+        _local = (now + _local_ttl_seconds(), ids)
+    return ids
+
+
+def invalidate_verified_ids() -> None:
+    """Drop the cached set (call when someone crosses the threshold or superuser status changes).
+
+    Other processes pick the change up within VERIFIED_IDS_LOCAL_TTL_SECONDS.
+    """
+    global _local
+    with _local_lock:
+        _local = None
+    try:
+        cache.delete(VERIFIED_IDS_CACHE_KEY)
+    except Exception:
+        pass
+
+
+def crossed_threshold(old_count: int, new_count: int) -> bool:
+    return (old_count >= VERIFIED_FOLLOWERS_THRESHOLD) != (new_count >= VERIFIED_FOLLOWERS_THRESHOLD)
+
 
 def get_verified_user_ids(user_ids) -> set[int]:
     """Return user IDs that should display a verified badge.
@@ -24,18 +107,11 @@ def get_verified_user_ids(user_ids) -> set[int]:
     if not ids:
         return set()
 
-    User = get_user_model()
+    return ids & verified_ids()
 
-    superuser_ids = set(
-        User.objects.filter(id__in=ids, is_superuser=True).values_list('id', flat=True)
-    )
 
-    follower_threshold_ids = set(
-        Follow.objects.filter(following_id__in=ids)
-        .values('following_id')
-        .annotate(c=Count('id'))
-        .filter(c__gte=VERIFIED_FOLLOWERS_THRESHOLD)
-        .values_list('following_id', flat=True)
-    )
-
-    return superuser_ids | follower_threshold_ids
+def is_verified(user_id) -> bool:
+    try:
+        return int(user_id or 0) in verified_ids()
+    except Exception:
+        return False
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from a_core.request_globals import for_request, timed
+
 try:
     from a_rtchat.models import Notification
 except Exception:  # pragma: no cover
@@ -27,32 +29,59 @@ except Exception:  # pragma: no cover
 
 
 
+def _user_counter(request, name: str):
+    try:
+        return int(for_request(request).user_counters().get(name) or 0)
+    except Exception:
+        return 0
+
+
+@timed
 def notifications_badge(request):
     if not getattr(request, 'user', None) or not request.user.is_authenticated:
         return {'NAV_NOTIF_UNREAD': 0}
     if Notification is None:
         return {'NAV_NOTIF_UNREAD': 0}
-    try:
-        c = Notification.objects.filter(user=request.user, is_read=False).count()
-        return {'NAV_NOTIF_UNREAD': int(c or 0)}
-    except Exception:
-        return {'NAV_NOTIF_UNREAD': 0}
+    # Both navbar counters come from one cache read (see request_globals).
+    return {'NAV_NOTIF_UNREAD': for_request(request).lazy(
+        'notifications_badge', lambda: _user_counter(request, 'notifications'),
+    )}
 
 
+@timed
 def follow_requests_badge(request):
     if not getattr(request, 'user', None) or not request.user.is_authenticated:
         return {'NAV_FOLLOWREQ_PENDING': 0}
     if FollowRequest is None:
         return {'NAV_FOLLOWREQ_PENDING': 0}
-    try:
-        c = FollowRequest.objects.filter(to_user=request.user).count()
-        return {'NAV_FOLLOWREQ_PENDING': int(c or 0)}
-    except Exception:
-        return {'NAV_FOLLOWREQ_PENDING': 0}
+    return {'NAV_FOLLOWREQ_PENDING': for_request(request).lazy(
+        'follow_requests_badge', lambda: _user_counter(request, 'follow_requests'),
+    )}
+
+
+STORY_GATE_KEYS = (
+    'CAN_ADD_STORY',
+    'STORY_MAX_ACTIVE',
+    'STORY_ACTIVE_COUNT',
+    'STORY_LIMIT_MESSAGE',
+    'STORY_REQUIRED_POINTS',
+    'STORY_REQUIRED_INVITES',
+    'STORY_POINTS',
+    'STORY_VERIFIED_INVITES',
+)
 
 
+@timed
 def story_upload_gate(request):
-    """Global template flags for story upload gating."""
+    """Global template flags for story upload gating (computed when first read)."""
+    g = for_request(request)
+    return {
+        key: g.lazy('story_upload_gate', lambda: _story_upload_state(request), key)
+        for key in STORY_GATE_KEYS
+    }
+
+
+def _story_upload_state(request) -> dict:
     user = getattr(request, 'user', None)
 
     # Story upload is free for all authenticated users, but active story count is limited.
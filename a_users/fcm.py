@@ -85,25 +85,21 @@ def send_push_to_tokens(tokens: list[str], title: str, body: str, url: str = '/'
 
 
 def send_mention_push(user, from_username: str, chatroom_name: str, preview: str = '') -> None:
-    """Send a push notification to `user` for an @mention (best-effort)."""
-    if not bool(getattr(settings, 'FIREBASE_ENABLED', False)):
-        return
+    """Send a push notification to `user` for an @mention right away (best-effort).
 
-    try:
-        from a_users.models import FCMToken
+    Goes through the batched pipeline's delivery step (collapsing, dead-token
+    pruning, metrics); chat code should queue with `a_users.push.enqueue_mention`.
+    """
+    from a_users import push
 
-        tokens = list(
-            FCMToken.objects.filter(user=user)
-            .order_by('-last_seen')
-            .values_list('token', flat=True)[:10]
-        )
-    except Exception:
+    if not push.is_enabled():
         return
-
-    if not tokens:
+    try:
+        push.deliver([{
+            'user_id': int(user.id),
+            'room': chatroom_name or '',
+            'from_username': from_username or '',
+            'preview': preview or '',
+        }])
+    except Exception:
         return
-
-    title = 'You were mentioned'
-    body = f"@{from_username}: {preview}".strip()
-    url = f"/chat/room/{chatroom_name}"
-    send_push_to_tokens(tokens, title=title, body=body[:140], url=url)
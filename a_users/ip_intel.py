@@ -0,0 +1,542 @@
+"""IP intelligence: geo location and VPN/proxy status from one lookup per IP.
+
+Lookups go through three tiers, fastest first:
+
+1. a process-local LRU of records
+2. an optional offline database, answered in-process with no network:
+   - IP_INTEL_RANGES_PATH: a CSV range table (`network,country,city,flags`,
+     flags separated by `|`, e.g. `vpn|hosting`), searched with bisect
+   - IP_INTEL_MMDB_PATH: a MaxMind-format database (needs `maxminddb`)
+3. the shared cache, filled by one ipwho.is request that yields both the
+   geo fields and the security flags
+
+A record is fresh for VPN_PROXY_STATUS_CACHE_SECONDS and kept for
+IP_INTEL_GEO_TTL_SECONDS. Stale records are served while a background
+worker refreshes them. A failed refresh keeps the last good record (until
+its original expiry) and only pushes the next attempt back by one fresh
+interval. With `wait=False` (middleware, websocket receive) a
+complete miss returns "unknown" right away and is fetched in the background.
+The client polls the security status endpoint, which waits.
+"""
+
+from __future__ import annotations
+
+import bisect
+import csv
+import ipaddress
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+
+CACHE_KEY_PREFIX = 'vixo:ipintel:v1:'
+LOCK_KEY_PREFIX = 'vixo:ipintel:lock:v1:'
+
+NET_FLAGS = ('vpn', 'proxy', 'tor', 'relay', 'hosting')
+
+_VPN_HINTS = (
+    'warp',
+    'vpn',
+    'wireguard',
+    'openvpn',
+    'tunnelbear',
+    'nordvpn',
+    'expressvpn',
+    'surfshark',
+    'protonvpn',
+    'mullvad',
+    'private internet access',
+    'pia',
+)
+
+
+def empty_net() -> dict[str, Any]:
+    return {
+        'blocked': False,
+        'vpn': False,
+        'proxy': False,
+        'tor': False,
+        'relay': False,
+        'hosting': False,
+        'reason': '',
+    }
+
+
+def _record(*, city: str = '', country: str = '', net: dict | None = None, source: str = '', at: float | None = None) -> dict:
+    return {
+        'city': city,
+        'country': country,
+        'net': dict(net or empty_net()),
+        'source': source,
+        'at': float(at if at is not None else time.time()),
+    }
+
+
+def _safe_str(v: Any, max_len: int = 80) -> str:
+    try:
+        s = str(v or '').strip()
+    except Exception:
+        return ''
+    return s[:max_len] if s else ''
+
+
+def _as_bool(v: Any) -> bool:
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, (int, float)):
+        return bool(v)
+    s = _safe_str(v, 16).lower()
+    return s in {'1', 'true', 't', 'yes', 'y', 'on'}
+
+
+def net_from_flags(*, vpn=False, proxy=False, tor=False, relay=False, hosting=False) -> dict[str, Any]:
+    reason = ''
+    if vpn:
+        reason = 'vpn'
+    elif proxy:
+        reason = 'proxy'
+    elif tor:
+        reason = 'tor'
+    elif relay:
+        reason = 'relay'
+    elif hosting:
+        reason = 'hosting'
+    return {
+        'blocked': bool(vpn or proxy or tor or relay),
+        'vpn': bool(vpn),
+        'proxy': bool(proxy),
+        'tor': bool(tor),
+        'relay': bool(relay),
+        'hosting': bool(hosting),
+        'reason': reason,
+    }
+
+
+def _fresh_seconds() -> int:
+    try:
+        ttl = int(getattr(settings, 'VPN_PROXY_STATUS_CACHE_SECONDS', 120) or 120)
+    except Exception:
+        ttl = 120
+    return max(30, ttl)
+
+
+def _keep_seconds() -> int:
+    try:
+        return max(_fresh_seconds(), int(getattr(settings, 'IP_INTEL_GEO_TTL_SECONDS', 24 * 3600)))
+    except Exception:
+        return 24 * 3600
+
+
+# --- upstream -------------------------------------------------------------------
+
+def parse_ipwho(data: dict) -> dict:
+    """Turn an ipwho.is payload into a record (geo + security flags)."""
+    security = data.get('security') if isinstance(data.get('security'), dict) else {}
+    connection = data.get('connection') if isinstance(data.get('connection'), dict) else {}
+
+    vpn = _as_bool(security.get('vpn')) or _as_bool(data.get('vpn'))
+    proxy = _as_bool(security.get('proxy')) or _as_bool(data.get('proxy'))
+    tor = _as_bool(security.get('tor')) or _as_bool(data.get('tor'))
+    relay = _as_bool(security.get('relay')) or _as_bool(security.get('is_relay'))
+
+    conn_type = _safe_str(connection.get('type'), 24).lower()
+    isp = _safe_str(connection.get('isp'), 80).lower()
+    org = _safe_str(connection.get('org'), 80).lower()
+
+    # Best-effort vendor/transport heuristic for providers not explicitly tagged
+    # by upstream security booleans (e.g., some WARP exits).
+    combined = f"{conn_type} {isp} {org}".strip()
+    if any(h in combined for h in _VPN_HINTS) and not (vpn or proxy or tor or relay):
+        vpn = True
+
+    hosting = bool(
+        security.get('hosting')
+        or security.get('datacenter')
+        or ('hosting' in conn_type)
+        or ('data center' in conn_type)
+        or ('datacenter' in conn_type)
+        or ('cloud' in isp)
+    )
+
+    city = _safe_str(data.get('city'))
+    if not city:
+        # fallback to region if city is unavailable
+        city = _safe_str(data.get('region'))
+
+    return _record(
+        city=city,
+        country=_safe_str(data.get('country')),
+        net=net_from_flags(vpn=vpn, proxy=proxy, tor=tor, relay=relay, hosting=hosting),
+        source='ipwho',
+    )
+
+
+def _fetch_ipwho(ip: str) -> dict | None:
+    """The ipwho.is payload for `ip`, or None on any failure."""
+    try:
+        resp = requests.get(f"https://ipwho.is/{ip}", timeout=3)
+        if resp.status_code != 200:
+            return None
+        data = resp.json() if resp.content else {}
+    except Exception:
+        return None
+    if not isinstance(data, dict) or data.get('success') is not True:
+        return None
+    return data
+
+
+# --- offline databases --------------------------------------------------------------
+
+class RangeTable:
+    """Sorted, non-overlapping IP ranges searched with bisect (one per IP version).
+
+    Networks may nest (a /24 inside a /16): they are split at load time so the
+    most specific network answers. A network listed twice keeps its later row.
+    """
+
+    def __init__(self, rows):
+        by_version: dict[int, list] = {4: [], 6: []}
+        for network, record in rows:
+            by_version[network.version].append((int(network.network_address), int(network.broadcast_address), record))
+        self._starts = {}
+        self._rows = {}
+        for version, items in by_version.items():
+            # Outer networks first; the sort is stable, so duplicates keep file order.
+            items.sort(key=lambda r: (r[0], -r[1]))
+            flat = self._flatten(items)
+            self._starts[version] = [r[0] for r in flat]
+            self._rows[version] = flat
+
+    @staticmethod
+    def _flatten(items: list) -> list:
+        """Disjoint (start, end, record) segments; inside nested networks the innermost wins."""
+        out = []
+        stack = []
+        cursor = 0
+
+        def emit(start, end, record):
+            if start <= end:
+                out.append((start, end, record))
+
+        for start, end, record in items:
+            # Close enclosing networks that end before this one begins.
+            while stack and stack[-1][1] < start:
+                _s, e, r = stack.pop()
+                emit(cursor, e, r)
+                cursor = e + 1
+            if stack:
+                emit(cursor, start - 1, stack[-1][2])
+            stack.append((start, end, record))
+            cursor = start
+        while stack:
+            _s, e, r = stack.pop()
+            emit(cursor, e, r)
+            cursor = e + 1
+        return out
+
+    def __len__(self) -> int:
+        return sum(len(rows) for rows in self._rows.values())
+
+    def get(self, ip: str) -> dict | None:
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        value = int(addr)
+        starts = self._starts.get(addr.version) or []
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0:
+            return None
+        start, end, record = self._rows[addr.version][i]
+        return record if start <= value <= end else None
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'RangeTable':
+        rows = []
+        with open(path, newline='', encoding='utf-8') as fh:
+            for line in csv.reader(fh):
+                if not line or line[0].strip().startswith('#'):
+                    continue
+                try:
+                    network = ipaddress.ip_network(line[0].strip(), strict=False)
+                except ValueError:
+                    continue
+                country = _safe_str(line[1] if len(line) > 1 else '')
+                city = _safe_str(line[2] if len(line) > 2 else '')
+                flags = {f.strip().lower() for f in (line[3] if len(line) > 3 else '').split('|') if f.strip()}
+                net = net_from_flags(**{f: True for f in NET_FLAGS if f in flags})
+                rows.append((network, _record(city=city, country=country, net=net, source='ranges', at=0)))
+        return cls(rows)
+
+
+_offline_lock = threading.Lock()
+_offline: dict[str, Any] = {}
+
+
+def _ranges() -> RangeTable | None:
+    path = str(getattr(settings, 'IP_INTEL_RANGES_PATH', '') or '').strip()
+    if not path:
+        return None
+    with _offline_lock:
+        if _offline.get('ranges_path') != path:
+            try:
+                table = RangeTable.from_csv(path)
+            except Exception:
+                table = None
+            _offline['ranges_path'] = path
+            _offline['ranges'] = table
+        return _offline.get('ranges')
+
+
+def _mmdb():
+    path = str(getattr(settings, 'IP_INTEL_MMDB_PATH', '') or '').strip()
+    if not path:
+        return None
+    with _offline_lock:
+        if _offline.get('mmdb_path') != path:
+            try:
+                import maxminddb
+
+                reader = maxminddb.open_database(path)
+            except Exception:
+                reader = None
+            _offline['mmdb_path'] = path
+            _offline['mmdb'] = reader
+        return _offline.get('mmdb')
+
+
+def _mmdb_record(reader, ip: str) -> dict | None:
+    try:
+        data = reader.get(ip)
+    except Exception:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    def name(section) -> str:
+        names = (data.get(section) or {}).get('names') or {}
+        return _safe_str(names.get('en'))
+
+    net = net_from_flags(
+        vpn=_as_bool(data.get('is_anonymous_vpn')),
+        proxy=_as_bool(data.get('is_public_proxy')) or _as_bool(data.get('is_residential_proxy')),
+        tor=_as_bool(data.get('is_tor_exit_node')),
+        hosting=_as_bool(data.get('is_hosting_provider')),
+    )
+    return _record(city=name('city'), country=name('country'), net=net, source='mmdb', at=0)
+
+
+def offline_lookup(ip: str) -> dict | None:
+    table = _ranges()
+    if table is not None:
+        hit = table.get(ip)
+        if hit is not None:
+            return hit
+    reader = _mmdb()
+    if reader is not None:
+        return _mmdb_record(reader, ip)
+    return None
+
+
+# --- process LRU ------------------------------------------------------------------------
+
+class _LRU:
+    def __init__(self):
+        self._data: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _max_entries(self) -> int:
+        try:
+            return max(100, int(getattr(settings, 'IP_INTEL_LOCAL_MAX_ENTRIES', 50_000)))
+        except Exception:
+            return 50_000
+
+    def get(self, ip: str) -> dict | None:
+        with self._lock:
+            record = self._data.get(ip)
+            if record is not None:
+                self._data.move_to_end(ip)
+            return record
+
+    def put(self, ip: str, record: dict) -> None:
+        with self._lock:
+            self._data[ip] = record
+            self._data.move_to_end(ip)
+            limit = self._max_entries()
+            while len(self._data) > limit:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_local = _LRU()
+
+
+# --- refresh ----------------------------------------------------------------------------
+
+def _is_fresh(record: dict, now: float, fresh_for: int) -> bool:
+    return now - float(record.get('at') or 0) < fresh_for or now < float(record.get('retry_at') or 0)
+
+
+def _last_good(ip: str) -> dict | None:
+    """The newest upstream record known for `ip` (shared cache first, then the LRU)."""
+    try:
+        record = cache.get(CACHE_KEY_PREFIX + ip)
+    except Exception:
+        record = None
+    if not isinstance(record, dict) or 'net' not in record:
+        record = _local.get(ip)
+    if record is None or record.get('source') != 'ipwho':
+        return None
+    return record
+
+
+def refresh(ip: str) -> dict:
+    """Fetch `ip` upstream once and store the record in the shared cache and the LRU."""
+    data = _fetch_ipwho(ip)
+    if data is not None:
+        record = parse_ipwho(data)
+        timeout = _keep_seconds()
+    else:
+        now = time.time()
+        previous = _last_good(ip)
+        remaining = int(_keep_seconds() - (now - float(previous.get('at') or 0))) if previous else 0
+        if previous is not None and remaining > 0:
+            # Keep serving the good record; only the next attempt moves.
+            record = dict(previous, retry_at=now + _fresh_seconds())
+            timeout = remaining
+        else:
+            # Failures are remembered only briefly.
+            record = _record(source='none')
+            timeout = _fresh_seconds()
+    try:
+        cache.set(CACHE_KEY_PREFIX + ip, record, timeout=timeout)
+    except Exception:
+        pass
+    _local.put(ip, record)
+    return record
+
+
+class _RefreshWorker:
+    """Background thread that refreshes stale or missing IP records."""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending: set[str] = set()
+        self._thread = None
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='ip-intel-refresh', daemon=True)
+            self._thread.start()
+
+    def submit(self, ip: str) -> None:
+        with self._lock:
+            if ip in self._pending:
+                return
+            self._pending.add(ip)
+        # One refresher per IP across processes.
+        try:
+            if not cache.add(LOCK_KEY_PREFIX + ip, 1, timeout=10):
+                with self._lock:
+                    self._pending.discard(ip)
+                return
+        except Exception:
+            pass
+        self._queue.put(ip)
+        self._ensure_started()
+
+    def _run(self) -> None:
+        while True:
+            ip = self._queue.get()
+            try:
+                refresh(ip)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._pending.discard(ip)
+                try:
+                    cache.delete(LOCK_KEY_PREFIX + ip)
+                except Exception:
+                    pass
+
+
+_worker = _RefreshWorker()
+
+
+def _is_public_ip(ip: str) -> bool:
+    try:
+        addr = ipaddress.ip_address((ip or '').strip())
+        return not (
+            addr.is_private
+            or addr.is_loopback
+            or addr.is_link_local
+            or addr.is_multicast
+            or addr.is_reserved
+            or addr.is_unspecified
+        )
+    except Exception:
+        return False
+
+
+def lookup(ip: str, *, wait: bool = True) -> dict:
+    """The record for `ip`: {'city', 'country', 'net', 'source', 'at'}.
+
+    `wait=False` never blocks on the network: a miss returns an empty record
+    and is fetched in the background.
+    """
+    ip = (ip or '').strip()
+    if not ip or not _is_public_ip(ip):
+        return _record(at=0)
+
+    now = time.time()
+    fresh_for = _fresh_seconds()
+
+    record = _local.get(ip)
+    if record is not None and (record.get('source') in {'ranges', 'mmdb'} or _is_fresh(record, now, fresh_for)):
+        return record
+
+    if record is None:
+        offline = offline_lookup(ip)
+        if offline is not None:
+            _local.put(ip, offline)
+            return offline
+
+    try:
+        shared = cache.get(CACHE_KEY_PREFIX + ip)
+    except Exception:
+        shared = None
+    if isinstance(shared, dict) and 'net' in shared:
+        _local.put(ip, shared)
+        if _is_fresh(shared, now, fresh_for):
+            return shared
+        record = shared
+
+    if record is not None:
+        # Stale: serve it now, refresh behind the scenes.
+        _worker.submit(ip)
+        return record
+
+    if not wait:
+        _worker.submit(ip)
+        return _record(at=0)
+    return refresh(ip)
+
+
+def clear_local() -> None:
+    """Forget the process LRU and the loaded offline databases."""
+    _local.clear()
+    with _offline_lock:
+        _offline.clear()
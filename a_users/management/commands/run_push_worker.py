@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from a_users import push
+from a_rtchat.redis_utils import get_redis
+
+
+class Command(BaseCommand):
+    help = 'Drain the push notification queue (use with PUSH_WORKER_IN_PROCESS=0).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='Print delivery counters and exit.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Flush a single window and exit.',
+        )
+
+    def handle(self, *args, **options):
+        if options.get('stats'):
+            self.stdout.write(json.dumps(push.metrics(), indent=2, sort_keys=True))
+            return
+
+        if get_redis() is None:
+            self.stdout.write(self.style.WARNING(
+                'Redis is not configured: the worker only sees its own process-local queue.'
+            ))
+
+        self.stdout.write(self.style.NOTICE('Push worker started'))
+        while True:
+            items = push._worker.drain_once()
+            if items:
+                counts = push.deliver(items)
+                self.stdout.write(
+                    f"{len(items)} queued -> {counts['notifications']} notification(s), "
+                    f"{counts['batches']} batch(es), {counts['pruned']} token(s) pruned"
+                )
+            if options.get('once'):
+                return
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_follow_counters(apps, schema_editor):
+    Profile = apps.get_model('a_users', 'Profile')
+    Follow = apps.get_model('a_users', 'Follow')
+
+    for field, key in (('followers_count', 'following_id'), ('following_count', 'follower_id')):
+        rows = Follow.objects.values(key).annotate(c=Count('id')).values_list(key, 'c')
+        for user_id, count in rows.iterator():
+            Profile.objects.filter(user_id=user_id).update(**{field: int(count or 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('a_users', '0039_story_submission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='followers_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_follow_counters, migrations.RunPython.noop),
+    ]
@@ -104,10 +104,16 @@ class Profile(models.Model):
     chat_theme = models.CharField(max_length=12, choices=CHAT_THEME_CHOICES, default=CHAT_THEME_DEFAULT)
     referral_points = models.PositiveIntegerField(default=0)
     private_rooms_created_total = models.PositiveIntegerField(default=0)
+    # Denormalized Follow counts, maintained with F() updates by a_users.signals.
+    followers_count = models.PositiveIntegerField(default=0, db_index=True)
+    following_count = models.PositiveIntegerField(default=0)
+
+    COUNTER_FIELDS = ('followers_count', 'following_count')
 
     def save(self, *args, **kwargs):
         old_image_name = None
         old_cover_name = None
+        row_exists = False
 
         # Keep a stable Cloudinary public_id for profile background updates.
         # This makes each new cover upload overwrite the previous one.
@@ -130,12 +136,24 @@ class Profile(models.Model):
         if self.pk:
             try:
                 old = Profile.objects.only('image', 'cover_image').get(pk=self.pk)
+                row_exists = True
                 old_image_name = getattr(getattr(old, 'image', None), 'name', None)
                 old_cover_name = getattr(getattr(old, 'cover_image', None), 'name', None)
             except Exception:
                 old_image_name = None
                 old_cover_name = None
 
+        # COUNTER_FIELDS are only written by the F() updates in a_users.signals.
+        # A plain save() of a row that already exists (no update_fields,
+        # force_insert or positional arguments) therefore updates every other
+        # column, so a profile loaded before a follow/unfollow cannot write its
+        # stale counts back. New rows and explicit update_fields are untouched.
+        if row_exists and not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.COUNTER_FIELDS
+            ]
+
         result = super().save(*args, **kwargs)
 
         new_image_name = getattr(getattr(self, 'image', None), 'name', None)
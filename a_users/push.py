@@ -0,0 +1,403 @@
+"""Batched push delivery (FCM).
+
+`enqueue_mention()` only appends to a queue (a Redis list shared by every
+process, or an in-process queue without Redis). A background worker drains it
+in windows of PUSH_BATCH_WINDOW_MS and, per window:
+
+- collapses repeated mentions of a user from the same room into one
+  notification ("3 new mentions"), and suppresses further pushes for that
+  (user, room) pair for PUSH_COLLAPSE_SECONDS
+- loads the tokens of every recipient with one query
+- groups recipients whose payload is identical and sends multicasts of up
+  to 500 tokens (the FCM limit)
+- deletes tokens FCM reports as UNREGISTERED
+
+PUSH_TRANSPORT='fake' swaps Firebase for an in-memory transport that records
+batches (local/dev and tests). Counters are kept in the shared cache; see
+`metrics()` and `manage.py run_push_worker --stats`.
+"""
+
+from __future__ import annotations
+
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from a_rtchat.redis_utils import get_redis
+
+
+QUEUE_KEY = 'push:queue:v1'
+COLLAPSE_KEY_PREFIX = 'push:collapse:v1:'
+METRICS_KEY_PREFIX = 'push:metrics:v1:'
+
+FCM_MULTICAST_LIMIT = 500
+TOKENS_PER_USER = 10
+
+# Per-token error codes that mean the token will never work again.
+DEAD_TOKEN_CODES = {'UNREGISTERED', 'REGISTRATION-TOKEN-NOT-REGISTERED'}
+
+METRIC_NAMES = (
+    'enqueued',
+    'collapsed',
+    'notifications',
+    'batches',
+    'tokens_sent',
+    'delivered',
+    'failed',
+    'pruned',
+)
+
+
+def _setting_int(name: str, default: int, minimum: int = 0) -> int:
+    try:
+        return max(minimum, int(getattr(settings, name, default)))
+    except Exception:
+        return default
+
+
+def _transport_name() -> str:
+    return str(getattr(settings, 'PUSH_TRANSPORT', 'firebase') or 'firebase').strip().lower()
+
+
+def is_enabled() -> bool:
+    if _transport_name() == 'fake':
+        return True
+    return bool(getattr(settings, 'FIREBASE_ENABLED', False))
+
+
+# --- transports -------------------------------------------------------------------
+
+class FirebaseTransport:
+    def send(self, tokens: list[str], data: dict) -> list[str | None] | None:
+        """Per-token error codes (None = delivered), or None when Firebase is unavailable."""
+        from .fcm import _ensure_firebase_admin
+
+        if not _ensure_firebase_admin():
+            return None
+        from firebase_admin import messaging
+
+        msg = messaging.MulticastMessage(tokens=tokens, data=data)
+        send = getattr(messaging, 'send_each_for_multicast', None) or messaging.send_multicast
+        resp = send(msg)
+        out: list[str | None] = []
+        for r in resp.responses:
+            if r.success:
+                out.append(None)
+                continue
+            exc = r.exception
+            if isinstance(exc, getattr(messaging, 'UnregisteredError', ())):
+                out.append('UNREGISTERED')
+            else:
+                out.append(str(getattr(exc, 'code', '') or 'UNKNOWN').upper())
+        return out
+
+
+class FakeTransport:
+    """Records batches instead of sending; tokens in `unregistered` fail as UNREGISTERED."""
+
+    def __init__(self):
+        self.sent: list[tuple[list[str], dict]] = []
+        self.unregistered: set[str] = set()
+
+    def send(self, tokens: list[str], data: dict) -> list[str | None]:
+        self.sent.append((list(tokens), dict(data)))
+        return ['UNREGISTERED' if t in self.unregistered else None for t in tokens]
+
+    def reset(self) -> None:
+        self.sent.clear()
+        self.unregistered.clear()
+
+
+fake_transport = FakeTransport()
+_firebase_transport = FirebaseTransport()
+
+
+def get_transport():
+    return fake_transport if _transport_name() == 'fake' else _firebase_transport
+
+
+# --- metrics --------------------------------------------------------------------
+
+def _bump(counts: dict[str, int]) -> None:
+    for name, n in counts.items():
+        if not n:
+            continue
+        key = METRICS_KEY_PREFIX + name
+        try:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, n)
+        except Exception:
+            continue
+
+
+def metrics() -> dict:
+    """Delivery counters plus the size and speed of the last flushed window."""
+    keys = [METRICS_KEY_PREFIX + name for name in METRIC_NAMES]
+    try:
+        found = cache.get_many(keys + [METRICS_KEY_PREFIX + 'last'])
+    except Exception:
+        found = {}
+    out = {name: int(found.get(METRICS_KEY_PREFIX + name) or 0) for name in METRIC_NAMES}
+    last = found.get(METRICS_KEY_PREFIX + 'last') or {}
+    out['last_window'] = last
+    return out
+
+
+def reset_metrics() -> None:
+    try:
+        cache.delete_many([METRICS_KEY_PREFIX + name for name in METRIC_NAMES + ('last',)])
+    except Exception:
+        pass
+
+
+# --- delivery -------------------------------------------------------------------
+
+def _collapse(items: list[dict]) -> list[dict]:
+    """One notification per (user, room); later mentions only raise the count."""
+    merged: OrderedDict[tuple[int, str], dict] = OrderedDict()
+    for item in items:
+        try:
+            key = (int(item['user_id']), str(item.get('room') or ''))
+        except Exception:
+            continue
+        if key in merged:
+            merged[key]['count'] += 1
+            merged[key]['from_username'] = item.get('from_username') or merged[key]['from_username']
+            merged[key]['preview'] = item.get('preview') or merged[key]['preview']
+        else:
+            merged[key] = {**item, 'user_id': key[0], 'room': key[1], 'count': 1}
+    return list(merged.values())
+
+
+def _payload(item: dict) -> dict:
+    room = item.get('room') or ''
+    count = int(item.get('count') or 1)
+    if count > 1:
+        title = f'{count} new mentions'
+    else:
+        title = 'You were mentioned'
+    body = f"@{item.get('from_username') or ''}: {item.get('preview') or ''}".strip()
+    return {
+        'title': title,
+        'body': body[:140],
+        'url': f"/chat/room/{room}",
+        # Lets the service worker replace an older notification for the same room.
+        'tag': f"mention:{room}",
+    }
+
+
+def _tokens_by_user(user_ids) -> dict[int, list[str]]:
+    from .models import FCMToken
+
+    out: dict[int, list[str]] = {}
+    rows = (
+        FCMToken.objects.filter(user_id__in=list(user_ids), user__is_active=True)
+        .order_by('user_id', '-last_seen')
+        .values_list('user_id', 'token')
+    )
+    for uid, token in rows:
+        tokens = out.setdefault(int(uid), [])
+        if len(tokens) < TOKENS_PER_USER:
+            tokens.append(token)
+    return out
+
+
+def deliver(items: list[dict], *, transport=None) -> dict:
+    """Send one window of queued mentions; returns the counters it added."""
+    started = time.monotonic()
+    transport = transport or get_transport()
+    counts = {name: 0 for name in METRIC_NAMES}
+
+    merged = _collapse(items)
+    counts['collapsed'] += len(items) - len(merged)
+
+    collapse_for = _setting_int('PUSH_COLLAPSE_SECONDS', 60)
+    ready = []
+    for item in merged:
+        if collapse_for:
+            try:
+                if not cache.add(f"{COLLAPSE_KEY_PREFIX}{item['user_id']}:{item['room']}", 1, timeout=collapse_for):
+                    counts['collapsed'] += item['count']
+                    continue
+            except Exception:
+                pass
+        ready.append(item)
+
+    tokens_by_user = _tokens_by_user({item['user_id'] for item in ready}) if ready else {}
+
+    # Recipients with identical payloads share multicasts.
+    groups: OrderedDict[str, tuple[dict, list[str]]] = OrderedDict()
+    for item in ready:
+        tokens = tokens_by_user.get(item['user_id']) or []
+        if not tokens:
+            continue
+        data = _payload(item)
+        key = json.dumps(data, sort_keys=True)
+        groups.setdefault(key, (data, []))[1].extend(tokens)
+        counts['notifications'] += 1
+
+    dead: list[str] = []
+    for data, tokens in groups.values():
+        for i in range(0, len(tokens), FCM_MULTICAST_LIMIT):
+            batch = tokens[i:i + FCM_MULTICAST_LIMIT]
+            try:
+                results = transport.send(batch, data)
+            except Exception:
+                results = ['ERROR'] * len(batch)
+            if results is None:
+                continue
+            counts['batches'] += 1
+            counts['tokens_sent'] += len(batch)
+            for token, error in zip(batch, results):
+                if error is None:
+                    counts['delivered'] += 1
+                    continue
+                counts['failed'] += 1
+                if str(error).upper() in DEAD_TOKEN_CODES:
+                    dead.append(token)
+
+    if dead:
+        from .models import FCMToken
+
+        counts['pruned'] = FCMToken.objects.filter(token__in=dead).delete()[0]
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    _bump(counts)
+    try:
+        cache.set(METRICS_KEY_PREFIX + 'last', {
+            'items': len(items),
+            'tokens': counts['tokens_sent'],
+            'seconds': round(elapsed, 4),
+            'tokens_per_second': round(counts['tokens_sent'] / elapsed, 1),
+            'at': time.time(),
+        }, timeout=None)
+    except Exception:
+        pass
+    return counts
+
+
+# --- queue + worker ---------------------------------------------------------------
+
+class _PushWorker:
+    """Background thread that drains the push queue in time windows."""
+
+    def __init__(self):
+        self._local: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, item: dict) -> None:
+        client = get_redis()
+        if client is not None:
+            try:
+                client.rpush(QUEUE_KEY, json.dumps(item))
+                return
+            except Exception:
+                pass
+        self._local.put(item)
+
+    def ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.run_forever, name='push-delivery', daemon=True)
+            self._thread.start()
+
+    def _limits(self) -> tuple[int, float]:
+        size = _setting_int('PUSH_BATCH_MAX_ITEMS', 1000, minimum=1)
+        window = _setting_int('PUSH_BATCH_WINDOW_MS', 500) / 1000.0
+        return size, window
+
+    def _drain_redis(self, client, size: int, window: float) -> list[dict]:
+        first = client.blpop(QUEUE_KEY, timeout=5)
+        if not first:
+            return []
+        raw = [first[1]]
+        deadline = time.monotonic() + window
+        while len(raw) < size and time.monotonic() < deadline:
+            want = size - len(raw)
+            pipe = client.pipeline()
+            pipe.lrange(QUEUE_KEY, 0, want - 1)
+            pipe.ltrim(QUEUE_KEY, want, -1)
+            got, _ = pipe.execute()
+            raw.extend(got)
+            if not got:
+                time.sleep(min(0.05, window))
+        items = []
+        for value in raw:
+            try:
+                items.append(json.loads(value))
+            except Exception:
+                continue
+        return items
+
+    def _drain_local(self, size: int, window: float) -> list[dict]:
+        try:
+            items = [self._local.get(timeout=5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + window
+        while len(items) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._local.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def drain_once(self) -> list[dict]:
+        size, window = self._limits()
+        client = get_redis()
+        if client is not None:
+            return self._drain_redis(client, size, window)
+        return self._drain_local(size, window)
+
+    def run_forever(self) -> None:
+        from django.db import close_old_connections
+
+        while True:
+            try:
+                items = self.drain_once()
+            except Exception:
+                time.sleep(1)
+                continue
+            if not items:
+                continue
+            close_old_connections()
+            try:
+                deliver(items)
+            except Exception:
+                pass
+            close_old_connections()
+
+
+_worker = _PushWorker()
+
+
+def enqueue_mention(user_id, *, from_username: str, chatroom_name: str, preview: str = '') -> None:
+    """Queue an @mention push for `user_id` (best-effort, never blocks on FCM)."""
+    if not is_enabled():
+        return
+    try:
+        item = {
+            'user_id': int(user_id),
+            'room': (chatroom_name or '')[:128],
+            'from_username': (from_username or '')[:150],
+            'preview': (preview or '')[:300],
+        }
+    except Exception:
+        return
+    try:
+        _worker.put(item)
+        _bump({'enqueued': 1})
+        if bool(getattr(settings, 'PUSH_WORKER_IN_PROCESS', True)):
+            _worker.ensure_started()
+    except Exception:
+        pass
@@ -1,4 +1,4 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 try:
@@ -11,6 +11,10 @@ from django.utils import timezone
 import os
 from .models import Profile
 from .models import Referral
+from .models import Follow
+from .models import FollowRequest, SupportEnquiry, UserReport
+from a_core import request_globals
+from . import author_cards
 
 try:
     from django.core import signing
@@ -48,6 +52,119 @@ def ensure_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
 
 
+@receiver(post_save, sender=User)
+def refresh_verified_ids_on_superuser_change(sender, instance, created, update_fields=None, **kwargs):
+    """Superusers are always verified; resync the cached set when that flips."""
+    if update_fields is not None and 'is_superuser' not in update_fields:
+        return
+    try:
+        from .badges import VERIFIED_FOLLOWERS_THRESHOLD, invalidate_verified_ids, verified_ids
+
+        listed = int(instance.id) in verified_ids()
+        if bool(instance.is_superuser) == listed:
+            return
+        if listed:
+            followers = Profile.objects.filter(user_id=instance.id).values_list('followers_count', flat=True).first()
+            if int(followers or 0) >= VERIFIED_FOLLOWERS_THRESHOLD:
+                return
+        invalidate_verified_ids()
+    except Exception:
+        pass
+
+
+def _bump_follow_counters(follow, delta: int) -> None:
+    """Apply one follow/unfollow to both profiles' counters (F() updates, no full save)."""
+    if delta > 0:
+        Profile.objects.filter(user_id=follow.following_id).update(followers_count=F('followers_count') + 1)
+        Profile.objects.filter(user_id=follow.follower_id).update(following_count=F('following_count') + 1)
+    else:
+        Profile.objects.filter(user_id=follow.following_id, followers_count__gt=0).update(followers_count=F('followers_count') - 1)
+        Profile.objects.filter(user_id=follow.follower_id, following_count__gt=0).update(following_count=F('following_count') - 1)
+
+    from .badges import crossed_threshold, invalidate_verified_ids
+
+    new_count = Profile.objects.filter(user_id=follow.following_id).values_list('followers_count', flat=True).first()
+    if new_count is not None and crossed_threshold(int(new_count) - delta, int(new_count)):
+        invalidate_verified_ids()
+
+
+@receiver(post_save, sender=Follow)
+def count_new_follow(sender, instance, created, **kwargs):
+    if not created:
+        return
+    try:
+        _bump_follow_counters(instance, +1)
+    except Exception:
+        pass
+
+
+@receiver(post_delete, sender=Follow)
+def count_removed_follow(sender, instance, **kwargs):
+    try:
+        _bump_follow_counters(instance, -1)
+    except Exception:
+        pass
+
+
+# Cached template globals (see a_core.request_globals): drop on change, recount on read.
+@receiver(post_save, sender=FollowRequest)
+@receiver(post_delete, sender=FollowRequest)
+def invalidate_follow_request_badge(sender, instance, **kwargs):
+    request_globals.invalidate_follow_requests(instance.to_user_id)
+
+
+@receiver(post_save, sender=UserReport)
+@receiver(post_delete, sender=UserReport)
+@receiver(post_save, sender=SupportEnquiry)
+@receiver(post_delete, sender=SupportEnquiry)
+def invalidate_admin_open_counts(sender, instance, **kwargs):
+    request_globals.invalidate(request_globals.ADMIN_OPEN_COUNTS_KEY)
+
+
+@receiver(post_save, sender=User)
+def invalidate_total_users_on_signup(sender, instance, created, **kwargs):
+    if created:
+        request_globals.invalidate(request_globals.TOTAL_USERS_KEY)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_total_users_on_delete(sender, instance, **kwargs):
+    request_globals.invalidate(request_globals.TOTAL_USERS_KEY)
+
+
+# Author cards (see a_users.author_cards): only saves touching a rendered field.
+AUTHOR_CARD_PROFILE_FIELDS = {'displayname', 'image', 'name_glow_color', 'chat_blocked'}
+AUTHOR_CARD_USER_FIELDS = {'username', 'is_superuser'}
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_author_card_on_profile_change(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not (AUTHOR_CARD_PROFILE_FIELDS & set(update_fields)):
+        return
+    author_cards.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def sync_presence_hidden_set(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not ({'is_stealth', 'is_bot'} & set(update_fields)):
+        return
+    from a_rtchat import presence_broadcast
+
+    hidden = kwargs.get('signal') is post_save and bool(instance.is_stealth or instance.is_bot)
+    presence_broadcast.set_hidden(instance.user_id, hidden)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_author_card_on_user_change(sender, instance, update_fields=None, **kwargs):
+    # Logins save only last_login.
+    if update_fields is not None and not (AUTHOR_CARD_USER_FIELDS & set(update_fields)):
+        return
+    author_cards.invalidate(instance.pk)
+
+
 if user_signed_up is not None:
     @receiver(user_signed_up)
     def queue_welcome_email(sender, request, user, **kwargs):
@@ -342,4 +459,16 @@ if django_user_logged_in is not None:
             request.session['show_email_verify_popup'] = True
             request.session['email_verify_popup_source'] = 'login'
         except Exception:
-            pass
\ No newline at end of file
+            pass
+
+
+if email_confirmed is not None:
+    @receiver(email_confirmed)
+    def refresh_chat_state_on_email_verified(sender, request, email_address, **kwargs):
+        """Let open chat sockets drop the unverified message gate right away."""
+        try:
+            from a_rtchat import user_state
+
+            user_state.publish(getattr(email_address, 'user_id', None))
+        except Exception:
+            pass
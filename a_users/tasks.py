@@ -86,24 +86,20 @@ def send_mention_push_task(
     chatroom_name: str,
     preview: str = '',
 ) -> None:
-    """Send an @mention push notification via FCM (best-effort).
+    """Queue an @mention push notification (best-effort).
 
-    This runs in the background to keep chat message sends fast.
+    Kept for tasks enqueued before the batched pipeline (a_users.push);
+    new code calls `enqueue_mention` directly.
     """
 
-    User = get_user_model()
-    user = User.objects.filter(id=user_id, is_active=True).first()
-    if not user:
-        return
-
     try:
-        from a_users.fcm import send_mention_push
+        from a_users.push import enqueue_mention
 
-        send_mention_push(
-            user,
-            from_username=(from_username or '')[:150],
-            chatroom_name=(chatroom_name or '')[:128],
-            preview=(preview or '')[:300],
+        enqueue_mention(
+            user_id,
+            from_username=from_username,
+            chatroom_name=chatroom_name,
+            preview=preview,
         )
     except Exception:
         # Best-effort: never fail the task hard.
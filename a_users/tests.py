@@ -1,13 +1,21 @@
+import ipaddress
+import os
 import tempfile
 from datetime import timedelta
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, override_settings
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 
-from .models import Story
+from a_core import request_globals
+
+from . import author_cards, badges, context_processors, ip_intel, push
+from .location_ip import geoip_city_country, vpn_proxy_status_for_ip
+from .models import FCMToken, Follow, FollowRequest, Profile, Story
 
 
 @override_settings(MEDIA_ROOT=tempfile.gettempdir())
@@ -63,3 +71,220 @@ class StoryLimitTests(TestCase):
 		state = data.get('story_upload') or {}
 		self.assertTrue(bool(state.get('can_add_story')))
 		self.assertEqual(int(state.get('active_count') or -1), 0)
+
+
+class FollowCounterTests(TestCase):
+	def setUp(self):
+		badges.invalidate_verified_ids()
+		self.alice = User.objects.create_user(username='fc_alice', password='pass12345')
+		self.bob = User.objects.create_user(username='fc_bob', password='pass12345')
+
+	def _counts(self, user):
+		return Profile.objects.filter(user=user).values_list('followers_count', 'following_count').get()
+
+	def test_follow_and_unfollow_update_counters(self):
+		follow = Follow.objects.create(follower=self.alice, following=self.bob)
+		self.assertEqual(self._counts(self.bob), (1, 0))
+		self.assertEqual(self._counts(self.alice), (0, 1))
+
+		# A full save of a stale, already-loaded profile keeps the counters.
+		stale = Profile.objects.get(user=self.bob)
+		Follow.objects.filter(pk=follow.pk).delete()
+		stale.save()
+		self.assertEqual(self._counts(self.bob), (0, 0))
+		self.assertEqual(self._counts(self.alice), (0, 0))
+
+	def test_save_only_narrows_full_saves_of_existing_rows(self):
+		profile = Profile.objects.get(user=self.bob)
+		profile.delete()
+		# pk still set, row gone: a plain save inserts it again, counters included.
+		profile.followers_count = 3
+		profile.save()
+		self.assertEqual(self._counts(self.bob), (3, 0))
+
+		# Explicit update_fields are passed through as given.
+		profile.followers_count = 5
+		profile.save(update_fields=['followers_count'])
+		self.assertEqual(self._counts(self.bob), (5, 0))
+
+	def test_verified_set_follows_threshold_crossing(self):
+		self.assertEqual(badges.get_verified_user_ids([self.bob.id]), set())
+		Profile.objects.filter(user=self.bob).update(followers_count=badges.VERIFIED_FOLLOWERS_THRESHOLD - 1)
+
+		Follow.objects.create(follower=self.alice, following=self.bob)
+		self.assertEqual(badges.get_verified_user_ids([self.alice.id, self.bob.id]), {self.bob.id})
+
+		Follow.objects.filter(follower=self.alice, following=self.bob).delete()
+		self.assertFalse(badges.is_verified(self.bob.id))
+
+
+class IpIntelTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		ip_intel.clear_local()
+		self.addCleanup(ip_intel.clear_local)
+
+	def test_one_upstream_lookup_serves_geo_and_vpn(self):
+		payload = {'success': True, 'city': 'Pune', 'country': 'India', 'security': {'vpn': True}}
+		with patch.object(ip_intel, '_fetch_ipwho', return_value=payload) as fetch:
+			self.assertEqual(geoip_city_country('8.8.8.8'), ('Pune', 'India'))
+			self.assertTrue(vpn_proxy_status_for_ip('8.8.8.8')['blocked'])
+			ip_intel.clear_local()
+			self.assertEqual(vpn_proxy_status_for_ip('8.8.8.8')['reason'], 'vpn')
+		self.assertEqual(fetch.call_count, 1)
+
+	def test_non_blocking_miss_and_offline_range_table(self):
+		with patch.object(ip_intel, '_fetch_ipwho') as fetch, patch.object(ip_intel._worker, 'submit') as submit:
+			self.assertFalse(vpn_proxy_status_for_ip('1.1.1.1', wait=False)['blocked'])
+			submit.assert_called_once_with('1.1.1.1')
+
+			with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as fh:
+				fh.write('# network,country,city,flags\n5.6.0.0/16,Netherlands,Amsterdam,vpn|hosting\n9.9.9.0/24,,,\n')
+			self.addCleanup(os.unlink, fh.name)
+			with override_settings(IP_INTEL_RANGES_PATH=fh.name):
+				self.assertTrue(vpn_proxy_status_for_ip('5.6.7.8', wait=False)['vpn'])
+				self.assertEqual(geoip_city_country('5.6.255.1'), ('Amsterdam', 'Netherlands'))
+				self.assertFalse(vpn_proxy_status_for_ip('9.9.9.9')['blocked'])
+		fetch.assert_not_called()
+
+	def test_failed_refresh_keeps_the_last_good_record(self):
+		payload = {'success': True, 'city': 'Pune', 'country': 'India', 'security': {'vpn': True}}
+		with patch.object(ip_intel, '_fetch_ipwho', return_value=payload):
+			good = ip_intel.refresh('8.8.8.8')
+
+		with patch.object(ip_intel, '_fetch_ipwho', return_value=None) as fetch:
+			kept = ip_intel.refresh('8.8.8.8')
+			ip_intel.clear_local()
+			# Served from the shared cache as fresh until the retry time, without refetching.
+			self.assertEqual(geoip_city_country('8.8.8.8'), ('Pune', 'India'))
+			self.assertTrue(vpn_proxy_status_for_ip('8.8.8.8', wait=False)['vpn'])
+		self.assertEqual(fetch.call_count, 1)
+		self.assertEqual((kept['source'], kept['at']), ('ipwho', good['at']))
+		self.assertGreater(kept['retry_at'], good['at'])
+
+		# With nothing good to keep, the failure is cached as 'none'.
+		with patch.object(ip_intel, '_fetch_ipwho', return_value=None):
+			self.assertEqual(ip_intel.refresh('8.8.4.4')['source'], 'none')
+
+	def test_range_table_prefers_the_most_specific_nested_network(self):
+		def row(cidr, city):
+			return ipaddress.ip_network(cidr), {'city': city}
+
+		table = ip_intel.RangeTable([
+			row('10.0.0.0/8', 'outer'),
+			row('10.1.0.0/16', 'middle'),
+			row('10.1.2.0/24', 'inner'),
+			row('10.200.0.0/16', 'second'),
+			row('10.1.2.0/24', 'inner-again'),
+			row('2001:db8::/32', 'v6'),
+		])
+		lookup = lambda ip: (table.get(ip) or {}).get('city')
+		self.assertEqual(lookup('10.0.0.1'), 'outer')
+		self.assertEqual(lookup('10.1.0.5'), 'middle')
+		self.assertEqual(lookup('10.1.2.3'), 'inner-again')
+		self.assertEqual(lookup('10.1.3.0'), 'middle')
+		self.assertEqual(lookup('10.2.0.0'), 'outer')
+		self.assertEqual(lookup('10.200.9.9'), 'second')
+		self.assertEqual(lookup('10.255.255.255'), 'outer')
+		self.assertIsNone(lookup('11.0.0.0'))
+		self.assertEqual(lookup('2001:db8::1'), 'v6')
+
+
+@override_settings(PUSH_TRANSPORT='fake', PUSH_COLLAPSE_SECONDS=60)
+class PushPipelineTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		push.fake_transport.reset()
+		self.addCleanup(push.fake_transport.reset)
+
+	def test_batches_collapses_and_prunes(self):
+		users = [User.objects.create_user(username=f'push_u{i}', password='pass12345') for i in range(60)]
+		FCMToken.objects.bulk_create([
+			FCMToken(user=u, token=f'tok-{u.id}-{n}') for u in users for n in range(10)
+		])
+		dead = f'tok-{users[0].id}-0'
+		push.fake_transport.unregistered.add(dead)
+
+		items = [{'user_id': u.id, 'room': 'lobby', 'from_username': 'amy', 'preview': 'hi'} for u in users]
+		items.append({'user_id': users[1].id, 'room': 'lobby', 'from_username': 'amy', 'preview': 'hi'})
+		counts = push.deliver(items)
+
+		# Identical payloads share multicasts of <= 500 tokens; the doubly-mentioned user gets their own.
+		sent = [(len(tokens), data['title']) for tokens, data in push.fake_transport.sent]
+		self.assertEqual(sent, [(500, 'You were mentioned'), (90, 'You were mentioned'), (10, '2 new mentions')])
+		self.assertEqual(counts['collapsed'], 1)
+		self.assertEqual(counts['pruned'], 1)
+		self.assertFalse(FCMToken.objects.filter(token=dead).exists())
+
+		# A repeat mention from the same room inside the collapse window is folded.
+		again = push.deliver(items[:1])
+		self.assertEqual(again['batches'], 0)
+		self.assertEqual(push.metrics()['tokens_sent'], 600)
+
+
+class RequestGlobalsTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username='globals_u', password='pass12345')
+		self.other = User.objects.create_user(username='globals_o', password='pass12345')
+		self.factory = RequestFactory()
+
+	def _request(self):
+		request = self.factory.get('/')
+		request.user = self.user
+		return request
+
+	def test_badges_are_lazy_and_share_one_cache_read(self):
+		request = self._request()
+		with self.assertNumQueries(0):
+			ctx = {}
+			ctx.update(context_processors.notifications_badge(request))
+			ctx.update(context_processors.follow_requests_badge(request))
+		# Cold cache: one COUNT per counter, then both are served from the cache.
+		with self.assertNumQueries(2):
+			self.assertEqual(ctx['NAV_NOTIF_UNREAD'](), 0)
+			self.assertEqual(ctx['NAV_FOLLOWREQ_PENDING'](), 0)
+
+		FollowRequest.objects.create(from_user=self.other, to_user=self.user)
+		request = self._request()
+		pending = context_processors.follow_requests_badge(request)['NAV_FOLLOWREQ_PENDING']
+		unread = context_processors.notifications_badge(request)['NAV_NOTIF_UNREAD']
+		with self.assertNumQueries(1):
+			self.assertEqual(pending(), 1)
+			self.assertEqual(unread(), 0)
+		self.assertIn('notifications_badge', request_globals.for_request(request).timings)
+
+
+class AuthorCardTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		author_cards._local.clear()
+		self.user = User.objects.create_user(username='card_u', password='pass12345')
+		self.other = User.objects.create_user(username='card_o', password='pass12345')
+
+	def test_bulk_load_then_served_from_local_and_shared_cache(self):
+		with self.assertNumQueries(1):
+			cards = author_cards.get_cards([self.user.id, self.other.id, 999999])
+		self.assertEqual(cards[self.user.id].username, 'card_u')
+		self.assertEqual(cards[self.user.id].name, 'card_u')
+		self.assertEqual(cards[999999], author_cards.AuthorCard.missing(999999))
+		with self.assertNumQueries(0):
+			author_cards.get_cards([self.user.id, self.other.id])
+		author_cards._local.clear()
+		with self.assertNumQueries(0):
+			self.assertEqual(author_cards.get_card(self.other.id).username, 'card_o')
+
+	def test_profile_save_invalidates(self):
+		self.assertEqual(author_cards.get_card(self.user.id).glow, '')
+		profile = self.user.profile
+		profile.displayname = 'Card Name'
+		profile.name_glow_color = Profile.NAME_GLOW_CHOICES[-1][0]
+		profile.save()
+		card = author_cards.get_card(self.user.id)
+		self.assertEqual(card.name, 'Card Name')
+		self.assertEqual(card.glow, Profile.NAME_GLOW_CHOICES[-1][0])
+
+		# Saves that touch no rendered field keep the cached card.
+		with patch.object(author_cards, 'invalidate') as invalidate:
+			self.user.save(update_fields=['last_login'])
+		invalidate.assert_not_called()
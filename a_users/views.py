@@ -58,7 +58,7 @@ from a_users.models import Follow, FollowRequest
 from a_users.models import UserReport
 from a_users.models import SupportEnquiry
 from a_users.models import Referral
-from a_users.badges import VERIFIED_FOLLOWERS_THRESHOLD, get_verified_user_ids
+from a_users.badges import get_verified_user_ids, is_verified
 
 try:
     from a_rtchat.models import Notification
@@ -219,15 +219,15 @@ def save_location_view(request):
 def _is_user_globally_online(user) -> bool:
     """Best-effort online check for profile presence.
 
-    We treat a user as globally online if they are currently connected to
-    the dedicated ChatGroup('online-status') users_online list.
+    We treat a user as globally online if they currently hold a live
+    connection in the dedicated 'online-status' presence scope.
     """
     try:
-        from a_rtchat.models import ChatGroup
+        from a_rtchat import presence
 
         if not user:
             return False
-        return ChatGroup.objects.filter(group_name='online-status', users_online=user).exists()
+        return presence.is_online(user, presence.ONLINE_STATUS_ROOM)
     except Exception:
         return False
 
@@ -334,6 +334,18 @@ def _has_verified_email(user) -> bool:
     except Exception:
         return False
 
+def _follow_counts(user) -> tuple[int, int]:
+    """(followers, following) from the denormalized Profile counters.
+
+    Read with a fresh query: an already-loaded profile may predate a follow
+    made earlier in the same request.
+    """
+    row = Profile.objects.filter(user=user).values_list('followers_count', 'following_count').first()
+    if not row:
+        return 0, 0
+    return int(row[0] or 0), int(row[1] or 0)
+
+
 def profile_view(request, username=None):
     if username:
         # Kisi aur ki profile dekh rahe hain
@@ -346,9 +358,8 @@ def profile_view(request, username=None):
         profile_user = request.user
         user_profile = request.user.profile
 
-    followers_count = Follow.objects.filter(following=profile_user).count()
-    following_count = Follow.objects.filter(follower=profile_user).count()
-    is_verified_badge = bool(getattr(profile_user, 'is_superuser', False) or (followers_count >= VERIFIED_FOLLOWERS_THRESHOLD))
+    followers_count, following_count = _follow_counts(profile_user)
+    is_verified_badge = is_verified(profile_user.id)
 
     is_following = False
     is_follow_requested = False
@@ -1455,7 +1466,7 @@ def profile_followers_partial_view(request, username: str):
     # Followers visibility rules:
     # - Owner sees full followers list.
     # - Non-owner gets limited preview only for very large follower lists (801+).
-    total_followers_for_profile = Follow.objects.filter(following=profile_user).count()
+    total_followers_for_profile, _ = _follow_counts(profile_user)
     should_limit_for_non_owner = (not is_owner) and (total_followers_for_profile >= owner_only_notice_threshold)
     viewer_limit = 15 if should_limit_for_non_owner else None
 
@@ -2129,17 +2140,11 @@ def profile_settings_view(request):
                 profile.refresh_from_db(fields=['is_stealth'])
                 new_stealth = bool(getattr(profile, 'is_stealth', False))
                 if new_stealth != old_stealth:
-                    from asgiref.sync import async_to_sync
-                    from channels.layers import get_channel_layer
+                    from a_rtchat import presence_broadcast
 
-                    channel_layer = get_channel_layer()
-
-                    # Force all profile-presence sockets to re-check stealth rules.
-                    # (ProfilePresenceConsumer listens on the same group.)
-                    async_to_sync(channel_layer.group_send)(
-                        'online-status',
-                        {'type': 'online_status_handler'},
-                    )
+                    # Visibility flipped without a connect/disconnect: republish the
+                    # presence snapshot so viewers pick up the stealth change.
+                    presence_broadcast.schedule()
             except Exception:
                 pass
 
@@ -2339,18 +2344,18 @@ def follow_toggle_view(request, username: str):
             # Optional in-app notification: only if user is offline (best-effort)
             try:
                 if Notification is not None:
-                    from a_rtchat.notifications import should_persist_notification
-
-                    should_store = should_persist_notification(user_id=target.id)
+                    from a_rtchat.notifications import notify_many
+
+                    states = notify_many(
+                        [target.id],
+                        type='follow',
+                        from_user=request.user,
+                        preview=f"@{request.user.username} followed you",
+                        url=f"/profile/u/{request.user.username}/",
+                    )
+                    should_store = bool(target.id in states and states[target.id].persisted)
 
                     if should_store:
-                        Notification.objects.create(
-                            user=target,
-                            from_user=request.user,
-                            type='follow',
-                            preview=f"@{request.user.username} followed you",
-                            url=f"/profile/u/{request.user.username}/",
-                        )
 
                         # Realtime toast/badge via per-user notify WS
                         try:
@@ -2392,8 +2397,7 @@ def follow_toggle_view(request, username: str):
     if is_htmx:
         # Tell HTMX clients to refresh counts + optionally the modal list.
         try:
-            followers_count = Follow.objects.filter(following=request.user).count()
-            following_count = Follow.objects.filter(follower=request.user).count()
+            followers_count, following_count = _follow_counts(request.user)
         except Exception:
             followers_count = None
             following_count = None
@@ -2542,7 +2546,7 @@ def remove_follower_view(request, username: str):
 
         try:
             followers_count = total_count
-            following_count = Follow.objects.filter(follower=request.user).count()
+            _, following_count = _follow_counts(request.user)
         except Exception:
             followers_count = None
             following_count = None
@@ -2597,7 +2601,9 @@ def notifications_dropdown_view(request):
         .order_by('-created')[:12]
     )
     try:
-        unread_count = int(qs.filter(is_read=False).count() or 0)
+        from a_rtchat.notifications import unread_count as cached_unread_count
+
+        unread_count = cached_unread_count(request.user.id)
     except Exception:
         unread_count = 0
     return render(request, 'a_users/partials/notifications_dropdown.html', {
@@ -2615,7 +2621,9 @@ def notifications_mark_all_read_view(request):
 
     if Notification is not None:
         try:
-            Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+            from a_rtchat.notifications import mark_read
+
+            mark_read(request.user.id)
         except Exception:
             pass
 
@@ -2646,7 +2654,9 @@ def notifications_mark_read_view(request, notif_id: int):
         return HttpResponse(status=204)
 
     try:
-        Notification.objects.filter(user=request.user, id=notif_id).update(is_read=True)
+        from a_rtchat.notifications import mark_read
+
+        mark_read(request.user.id, id=notif_id)
     except Exception:
         pass
     return HttpResponse(status=204)
@@ -2661,7 +2671,9 @@ def notifications_clear_all_view(request):
 
     if Notification is not None:
         try:
-            Notification.objects.filter(user=request.user).delete()
+            from a_rtchat.notifications import clear_all
+
+            clear_all(request.user.id)
         except Exception:
             pass
 
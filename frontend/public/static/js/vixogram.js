@@ -1111,11 +1111,11 @@
           const raw = (event && typeof event.data === 'string') ? event.data : '';
           if (!raw) return;
 
+          // Server pushes compact JSON deltas: {type:'online_status', total_online, added, removed}.
           let total = null;
           try {
-            const doc = new DOMParser().parseFromString(raw, 'text/html');
-            const el = doc.querySelector('#global-online-total');
-            total = el ? el.getAttribute('data-total-online') : null;
+            const data = JSON.parse(raw);
+            if (data && data.type === 'online_status') total = data.total_online;
           } catch {}
 
           if (total === null || total === undefined) return;